@@ -2,86 +2,466 @@
 """
 Скрипт для резервного копирования базы данных бота
 Используйте этот скрипт перед каждым деплоем для сохранения данных пользователей
+
+SQLite копируется онлайн через backup API (согласованный снимок без
+"разорванных" страниц даже во время записи, затем VACUUM снимка для
+стабильной раскладки страниц), PostgreSQL - потоковым
+логическим дампом COPY TO STDOUT по таблицам. Данные режутся на куски,
+каждый кусок сжимается и хранится один раз под своим SHA-256
+(backups/chunks), поэтому неизменившиеся части базы между копиями не
+дублируются. Резервная копия - это манифест backups/manifests/<id>.json
+со списком кусков и числом строк по таблицам.
 """
 
-import shutil
 import datetime
-import os
+import hashlib
+import json
 import logging
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+from typing import Dict, List, Optional
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def backup_database(db_path="bot_analytics.db", backup_dir="backups"):
+# Средний размер куска. Границы кусков определяются содержимым (страницы
+# снимка SQLite, строки дампа PostgreSQL), поэтому вставка данных сдвигает
+# только соседние куски, а не все последующие
+BACKUP_CHUNK_SIZE = int(os.getenv('BACKUP_CHUNK_SIZE', str(256 * 1024)))
+BACKUP_MIN_CHUNK_SIZE = BACKUP_CHUNK_SIZE // 4
+BACKUP_MAX_CHUNK_SIZE = BACKUP_CHUNK_SIZE * 4
+# Граница после строки дампа с crc32 & маска == 0 (в среднем раз в 2048 строк)
+BACKUP_LINE_BOUNDARY_MASK = 0x7FF
+# Уровень сжатия zlib
+BACKUP_COMPRESSION_LEVEL = int(os.getenv('BACKUP_COMPRESSION_LEVEL', '6'))
+# Ротация: сколько последних копий и сколько дней по одной копии хранить
+BACKUP_KEEP_LAST = int(os.getenv('BACKUP_KEEP_LAST', '7'))
+BACKUP_KEEP_DAILY = int(os.getenv('BACKUP_KEEP_DAILY', '30'))
+# Страниц SQLite за один шаг backup API (между шагами база доступна писателям)
+BACKUP_SQLITE_PAGES_PER_STEP = 1024
+# Куски моложе этого возраста не удаляются при очистке: их может писать идущая копия
+BACKUP_GC_GRACE_SECONDS = 3600
+
+
+class ChunkStore:
+    """Хранилище сжатых кусков, адресуемых SHA-256 содержимого"""
+
+    def __init__(self, root: str):
+        self.root = os.path.join(root, 'chunks')
+        self.new_chunks = 0
+        self.reused_chunks = 0
+        self.stored_bytes = 0
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + '.z')
+
+    def put(self, data: bytes) -> str:
+        """Сохраняет кусок (если такого еще нет) и возвращает его хэш"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.reused_chunks += 1
+            return digest
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, BACKUP_COMPRESSION_LEVEL)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+        self.new_chunks += 1
+        self.stored_bytes += len(compressed)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """Читает кусок и проверяет его хэш"""
+        with open(self.path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"кусок {digest[:12]} поврежден")
+        return data
+
+    def all_chunks(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            name[:-2]
+            for prefix in os.listdir(self.root)
+            for name in os.listdir(os.path.join(self.root, prefix))
+            if name.endswith('.z')
+        ]
+
+
+class _ContentChunker:
+    """Режет поток записей (страниц или строк) на куски с границами по содержимому"""
+
+    def __init__(self, store: ChunkStore, boundary_mask: int):
+        self.store = store
+        self.boundary_mask = boundary_mask
+        self.chunks: List[str] = []
+        self.size = 0
+        self.records = 0
+        self._sha = hashlib.sha256()
+        self._buffer = bytearray()
+        self._pending = b''
+
+    def add(self, record: bytes):
+        self._buffer += record
+        self.records += 1
+        size = len(self._buffer)
+        if size >= BACKUP_MAX_CHUNK_SIZE or (
+                size >= BACKUP_MIN_CHUNK_SIZE and zlib.crc32(record) & self.boundary_mask == 0):
+            self._cut()
+
+    def write(self, data):
+        """Файлоподобный приемник для COPY TO STDOUT: записи - строки дампа"""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = self._pending + data
+        lines = data.split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self.add(line + b'\n')
+
+    def _cut(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._sha.update(data)
+            self.size += len(data)
+            self.chunks.append(self.store.put(data))
+            self._buffer = bytearray()
+
+    def close(self) -> Dict:
+        if self._pending:
+            self._buffer += self._pending
+            self._pending = b''
+        self._cut()
+        return {'size': self.size, 'sha256': self._sha.hexdigest(), 'chunks': self.chunks}
+
+
+def _new_backup_id() -> str:
+    return datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+
+def _manifest_dir(backup_dir: str) -> str:
+    return os.path.join(backup_dir, 'manifests')
+
+
+def _save_manifest(backup_dir: str, manifest: Dict):
+    os.makedirs(_manifest_dir(backup_dir), exist_ok=True)
+    path = os.path.join(_manifest_dir(backup_dir), f"{manifest['id']}.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_manifest(backup_id: str, backup_dir: str = "backups") -> Dict:
+    """Манифест резервной копии по id (или пути к файлу манифеста)"""
+    path = backup_id if backup_id.endswith('.json') else os.path.join(_manifest_dir(backup_dir), f"{backup_id}.json")
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _sqlite_row_counts(conn) -> Dict[str, int]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    counts = {}
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+        counts[name] = cursor.fetchone()[0]
+    return counts
+
+
+def _snapshot_sqlite(db_path: str, snapshot_path: str):
+    """Онлайн-снимок SQLite через backup API"""
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(target, pages=BACKUP_SQLITE_PAGES_PER_STEP)
+    finally:
+        target.close()
+        source.close()
+
+
+def _backup_sqlite(db_path: str, store: ChunkStore) -> Dict:
+    with tempfile.TemporaryDirectory(prefix="backup_") as temp_dir:
+        snapshot_path = os.path.join(temp_dir, 'snapshot.db')
+        _snapshot_sqlite(db_path, snapshot_path)
+        
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            # VACUUM снимка (не рабочей базы) раскладывает каждую таблицу и индекс
+            # подряд: без него страницы индексов перемешаны с таблицами, и
+            # дописанные строки меняют куски по всему файлу
+            conn.execute("VACUUM")
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            rows = _sqlite_row_counts(conn)
+        finally:
+            conn.close()
+        
+        # Граница куска - после страницы с crc32 & маска == 0, в среднем раз в BACKUP_CHUNK_SIZE
+        pages_per_chunk = max(1, (BACKUP_CHUNK_SIZE - BACKUP_MIN_CHUNK_SIZE) // page_size)
+        chunker = _ContentChunker(store, (1 << max(0, pages_per_chunk.bit_length() - 1)) - 1)
+        with open(snapshot_path, 'rb') as f:
+            while True:
+                page = f.read(page_size)
+                if not page:
+                    break
+                chunker.add(page)
+        result = chunker.close()
+    
+    return {
+        'name': os.path.basename(db_path),
+        'kind': 'sqlite',
+        'page_size': page_size,
+        'rows': rows,
+        **result,
+    }
+
+
+def _postgres_tables(cursor) -> List[str]:
+    """Таблицы PostgreSQL в порядке, безопасном для внешних ключей при восстановлении"""
+    from migrate_to_postgres import MIGRATION_STAGES
+    
+    cursor.execute("SELECT table_name FROM information_schema.tables "
+                   "WHERE table_schema = 'public' AND table_type = 'BASE TABLE'")
+    existing = {row[0] for row in cursor.fetchall()}
+    ordered = [table for stage in MIGRATION_STAGES for table in stage if table in existing]
+    return ordered + sorted(existing - set(ordered))
+
+
+def _backup_postgres(db_url: str, store: ChunkStore) -> List[Dict]:
+    import psycopg2
+    
+    files = []
+    conn = psycopg2.connect(db_url)
+    try:
+        # Все таблицы читаются из одного снимка
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cursor = conn.cursor()
+        for table in _postgres_tables(cursor):
+            cursor.execute('''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = %s
+                ORDER BY ordinal_position
+            ''', (table,))
+            columns = [row[0] for row in cursor.fetchall()]
+            
+            chunker = _ContentChunker(store, BACKUP_LINE_BOUNDARY_MASK)
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) TO STDOUT", chunker)
+            result = chunker.close()
+            files.append({
+                'name': table,
+                'kind': 'copy',
+                'columns': columns,
+                'rows': chunker.records,
+                **result,
+            })
+        conn.rollback()
+    finally:
+        conn.close()
+    return files
+
+
+def backup_database(db_path="bot_analytics.db", backup_dir="backups", db_url=None):
     """
     Создает резервную копию базы данных
     
     Args:
-        db_path: Путь к файлу базы данных
+        db_path: Путь к файлу базы данных SQLite
         backup_dir: Директория для хранения резервных копий
+        db_url: URL PostgreSQL (по умолчанию DATABASE_URL; если задан, копируется PostgreSQL)
+    
+    Returns:
+        Манифест созданной копии или None при ошибке
     """
     try:
-        # Проверяем, существует ли файл базы данных
-        if not os.path.exists(db_path):
+        db_url = db_url or os.getenv('DATABASE_URL')
+        if not db_url and not os.path.exists(db_path):
             logging.error(f"Файл базы данных {db_path} не найден!")
-            return False
+            return None
         
-        # Создаем директорию для резервных копий, если её нет
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-            logging.info(f"Создана директория {backup_dir}")
+        started = time.monotonic()
+        store = ChunkStore(backup_dir)
+        manifest = {
+            'id': _new_backup_id(),
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'db_type': 'postgresql' if db_url else 'sqlite',
+        }
         
-        # Генерируем имя файла с временной меткой
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"bot_analytics_backup_{timestamp}.db"
-        backup_path = os.path.join(backup_dir, backup_filename)
+        if db_url:
+            manifest['files'] = _backup_postgres(db_url, store)
+        else:
+            manifest['source'] = os.path.abspath(db_path)
+            manifest['files'] = [_backup_sqlite(db_path, store)]
         
-        # Копируем файл
-        shutil.copy2(db_path, backup_path)
+        logical_bytes = sum(item['size'] for item in manifest['files'])
+        manifest['stats'] = {
+            'logical_bytes': logical_bytes,
+            'stored_bytes': store.stored_bytes,
+            'new_chunks': store.new_chunks,
+            'reused_chunks': store.reused_chunks,
+            'duration': round(time.monotonic() - started, 3),
+        }
+        _save_manifest(backup_dir, manifest)
         
-        # Получаем размер файла
-        file_size = os.path.getsize(backup_path)
-        file_size_mb = file_size / (1024 * 1024)
+        logging.info(f"✅ Резервная копия {manifest['id']} ({manifest['db_type']}) создана")
+        logging.info(f"📊 Данных: {logical_bytes / (1024 * 1024):.2f} MB, "
+                     f"записано новых: {store.stored_bytes / (1024 * 1024):.2f} MB "
+                     f"({store.new_chunks} новых кусков, {store.reused_chunks} без изменений)")
         
-        logging.info(f"✅ База данных успешно скопирована в {backup_path}")
-        logging.info(f"📊 Размер файла: {file_size_mb:.2f} MB")
+        return manifest
+    
+    except Exception as e:
+        logging.error(f"❌ Ошибка при создании резервной копии: {e}")
+        return None
+
+
+def _assemble(store: ChunkStore, item: Dict, path: str):
+    """Собирает файл из кусков с проверкой хэшей"""
+    sha = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for digest in item['chunks']:
+            data = store.get(digest)
+            sha.update(data)
+            f.write(data)
+    if sha.hexdigest() != item['sha256']:
+        raise ValueError(f"{item['name']}: контрольная сумма не совпадает")
+
+
+def verify_backup(backup_id: str, backup_dir: str = "backups") -> bool:
+    """
+    Проверяет, что копия восстанавливается: хэши всех кусков, целостность
+    снимка SQLite и число строк по таблицам
+    """
+    try:
+        manifest = load_manifest(backup_id, backup_dir)
+        store = ChunkStore(backup_dir)
         
-        return True
+        for item in manifest['files']:
+            if item['kind'] == 'sqlite':
+                with tempfile.TemporaryDirectory(prefix="verify_") as temp_dir:
+                    path = os.path.join(temp_dir, item['name'])
+                    _assemble(store, item, path)
+                    conn = sqlite3.connect(path)
+                    try:
+                        integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+                        rows = _sqlite_row_counts(conn)
+                    finally:
+                        conn.close()
+                if integrity != 'ok':
+                    raise ValueError(f"integrity_check: {integrity}")
+                if rows != item['rows']:
+                    raise ValueError("число строк в снимке не совпадает с манифестом")
+            else:
+                sha = hashlib.sha256()
+                lines = 0
+                for digest in item['chunks']:
+                    data = store.get(digest)
+                    sha.update(data)
+                    lines += data.count(b'\n')
+                if sha.hexdigest() != item['sha256'] or lines != item['rows']:
+                    raise ValueError(f"{item['name']}: дамп не совпадает с манифестом")
         
+        logging.info(f"✅ Резервная копия {manifest['id']} проверена")
+        return True
+    
     except Exception as e:
-        logging.error(f"❌ Ошибка при создании резервной копии: {e}")
+        logging.error(f"❌ Резервная копия {backup_id} не прошла проверку: {e}")
         return False
 
-def restore_database(backup_path, db_path="bot_analytics.db"):
+
+def _restore_postgres(manifest: Dict, store: ChunkStore, db_url: str):
+    import psycopg2
+    from database import AnalyticsDB
+    
+    # Схема и миграции создаются так же, как при старте бота
+    AnalyticsDB(db_url).ensure_schema()
+    conn = psycopg2.connect(db_url)
+    try:
+        cursor = conn.cursor()
+        tables = [item['name'] for item in manifest['files']]
+        cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+        for item in manifest['files']:
+            with tempfile.TemporaryFile() as dump:
+                for digest in item['chunks']:
+                    dump.write(store.get(digest))
+                dump.seek(0)
+                cursor.copy_expert(f"COPY {item['name']} ({', '.join(item['columns'])}) FROM STDIN", dump)
+            if 'id' in item['columns']:
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (item['name'],))
+                sequence = cursor.fetchone()[0]
+                if sequence:
+                    cursor.execute(
+                        f"SELECT setval(%s, COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {item['name']}",
+                        (sequence,)
+                    )
+        # Все таблицы восстанавливаются одной транзакцией
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def restore_database(backup_path, db_path="bot_analytics.db", backup_dir="backups", db_url=None):
     """
     Восстанавливает базу данных из резервной копии
     
     Args:
-        backup_path: Путь к файлу резервной копии
+        backup_path: id копии, путь к манифесту или к старой копии *.db
         db_path: Путь к файлу базы данных для восстановления
+        backup_dir: Директория с резервными копиями
+        db_url: URL PostgreSQL для восстановления дампа (по умолчанию DATABASE_URL)
     """
     try:
-        # Проверяем, существует ли файл резервной копии
-        if not os.path.exists(backup_path):
-            logging.error(f"Файл резервной копии {backup_path} не найден!")
-            return False
+        # Старые копии - полные файлы SQLite
+        if backup_path.endswith('.db'):
+            if not os.path.exists(backup_path):
+                logging.error(f"Файл резервной копии {backup_path} не найден!")
+                return False
+            manifest = None
+        else:
+            manifest = load_manifest(backup_path, backup_dir)
+            if not verify_backup(backup_path, backup_dir):
+                return False
+        
+        store = ChunkStore(backup_dir)
+        if manifest and manifest['db_type'] == 'postgresql':
+            db_url = db_url or os.getenv('DATABASE_URL')
+            if not db_url:
+                logging.error("❌ Для восстановления PostgreSQL нужен DATABASE_URL")
+                return False
+            _restore_postgres(manifest, store, db_url)
+            logging.info(f"✅ PostgreSQL восстановлен из копии {manifest['id']}")
+            return True
         
         # Создаем резервную копию текущей базы данных (если она существует)
         if os.path.exists(db_path):
             current_backup = f"{db_path}.current_backup"
-            shutil.copy2(db_path, current_backup)
+            _snapshot_sqlite(db_path, current_backup)
             logging.info(f"Текущая база данных сохранена как {current_backup}")
         
-        # Восстанавливаем из резервной копии
-        shutil.copy2(backup_path, db_path)
+        # Собираем файл рядом с базой и подменяем атомарно
+        temp_path = f"{db_path}.restore.tmp"
+        if manifest:
+            _assemble(store, manifest['files'][0], temp_path)
+        else:
+            _snapshot_sqlite(backup_path, temp_path)
+        os.replace(temp_path, db_path)
         
         logging.info(f"✅ База данных успешно восстановлена из {backup_path}")
         return True
-        
+    
     except Exception as e:
         logging.error(f"❌ Ошибка при восстановлении базы данных: {e}")
         return False
 
+
 def list_backups(backup_dir="backups"):
     """
     Показывает список доступных резервных копий
@@ -95,6 +475,21 @@ def list_backups(backup_dir="backups"):
             return []
         
         backups = []
+        manifest_dir = _manifest_dir(backup_dir)
+        if os.path.isdir(manifest_dir):
+            for filename in os.listdir(manifest_dir):
+                if not filename.endswith('.json'):
+                    continue
+                manifest = load_manifest(os.path.join(manifest_dir, filename))
+                backups.append({
+                    'filename': manifest['id'],
+                    'path': os.path.join(manifest_dir, filename),
+                    'size_mb': manifest['stats']['logical_bytes'] / (1024 * 1024),
+                    'stored_mb': manifest['stats']['stored_bytes'] / (1024 * 1024),
+                    'created': manifest['created_at'].replace('T', ' '),
+                    'db_type': manifest['db_type'],
+                })
+        
         for filename in os.listdir(backup_dir):
             if filename.startswith("bot_analytics_backup_") and filename.endswith(".db"):
                 file_path = os.path.join(backup_dir, filename)
@@ -107,7 +502,9 @@ def list_backups(backup_dir="backups"):
                     'filename': filename,
                     'path': file_path,
                     'size_mb': file_size_mb,
-                    'created': file_time_str
+                    'stored_mb': file_size_mb,
+                    'created': file_time_str,
+                    'db_type': 'sqlite',
                 })
         
         # Сортируем по времени создания (новые сначала)
@@ -115,21 +512,81 @@ def list_backups(backup_dir="backups"):
         
         logging.info("📋 Доступные резервные копии:")
         for backup in backups:
-            logging.info(f"  📁 {backup['filename']} - {backup['size_mb']:.2f} MB - {backup['created']}")
+            logging.info(f"  📁 {backup['filename']} ({backup['db_type']}) - {backup['size_mb']:.2f} MB "
+                         f"(новых данных {backup['stored_mb']:.2f} MB) - {backup['created']}")
         
         return backups
-        
+    
     except Exception as e:
         logging.error(f"❌ Ошибка при получении списка резервных копий: {e}")
         return []
 
+
+def rotate_backups(backup_dir="backups", keep_last=BACKUP_KEEP_LAST, keep_daily=BACKUP_KEEP_DAILY):
+    """
+    Удаляет старые копии и куски, на которые больше не ссылается ни один манифест
+    
+    Хранятся keep_last последних копий и по одной (последней за день) копии
+    за keep_daily последних дней.
+    
+    Returns:
+        Словарь с числом удаленных копий и кусков
+    """
+    manifest_dir = _manifest_dir(backup_dir)
+    if not os.path.isdir(manifest_dir):
+        return {'backups': 0, 'chunks': 0, 'bytes': 0}
+    
+    manifests = sorted(
+        (load_manifest(os.path.join(manifest_dir, name)) for name in os.listdir(manifest_dir) if name.endswith('.json')),
+        key=lambda m: m['id'], reverse=True
+    )
+    keep = {m['id'] for m in manifests[:keep_last]}
+    daily_cutoff = (datetime.datetime.now() - datetime.timedelta(days=keep_daily)).isoformat()
+    seen_days = set()
+    for m in manifests:
+        day = m['created_at'][:10]
+        if m['created_at'] >= daily_cutoff and day not in seen_days:
+            seen_days.add(day)
+            keep.add(m['id'])
+    
+    removed = [m for m in manifests if m['id'] not in keep]
+    for m in removed:
+        os.remove(os.path.join(manifest_dir, f"{m['id']}.json"))
+    
+    # Куски, на которые ссылаются оставшиеся копии
+    referenced = {digest for m in manifests if m['id'] in keep for item in m['files'] for digest in item['chunks']}
+    store = ChunkStore(backup_dir)
+    grace_cutoff = time.time() - BACKUP_GC_GRACE_SECONDS
+    chunks_removed = 0
+    bytes_removed = 0
+    for digest in store.all_chunks():
+        path = store.path(digest)
+        if digest not in referenced and os.path.getmtime(path) < grace_cutoff:
+            bytes_removed += os.path.getsize(path)
+            os.remove(path)
+            chunks_removed += 1
+    
+    logging.info(f"🧹 Удалено копий: {len(removed)}, кусков: {chunks_removed} ({bytes_removed / (1024 * 1024):.2f} MB)")
+    return {'backups': len(removed), 'chunks': chunks_removed, 'bytes': bytes_removed}
+
+
+def _latest_backup_id(backup_dir="backups") -> Optional[str]:
+    manifest_dir = _manifest_dir(backup_dir)
+    if not os.path.isdir(manifest_dir):
+        return None
+    ids = sorted(name[:-5] for name in os.listdir(manifest_dir) if name.endswith('.json'))
+    return ids[-1] if ids else None
+
+
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) < 2:
         print("Использование:")
         print("  python backup_database.py backup          - Создать резервную копию")
-        print("  python backup_database.py restore <file>  - Восстановить из резервной копии")
+        print("  python backup_database.py restore <id>    - Восстановить из резервной копии (id, манифест или *.db)")
+        print("  python backup_database.py verify [id]     - Проверить копию (по умолчанию последнюю)")
+        print("  python backup_database.py rotate          - Удалить старые копии и неиспользуемые куски")
         print("  python backup_database.py list            - Показать список резервных копий")
         sys.exit(1)
     
@@ -141,12 +598,24 @@ if __name__ == "__main__":
     
     elif command == "restore":
         if len(sys.argv) < 3:
-            print("❌ Укажите путь к файлу резервной копии")
+            print("❌ Укажите id или путь к файлу резервной копии")
             sys.exit(1)
         backup_file = sys.argv[2]
         success = restore_database(backup_file)
         sys.exit(0 if success else 1)
     
+    elif command == "verify":
+        backup_id = sys.argv[2] if len(sys.argv) > 2 else _latest_backup_id()
+        if not backup_id:
+            print("❌ Резервных копий нет")
+            sys.exit(1)
+        success = verify_backup(backup_id)
+        sys.exit(0 if success else 1)
+    
+    elif command == "rotate":
+        rotate_backups()
+        sys.exit(0)
+    
     elif command == "list":
         list_backups()
         sys.exit(0)
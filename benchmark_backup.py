@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк резервного копирования backup_database.py
+
+Во временной директории создается SQLite база со схемой AnalyticsDB и
+--rows строками в user_actions (по умолчанию 1 000 000), затем измеряются:
+полная копия старым способом (shutil.copy2), первая копия через backup API
+с кусками, повторная копия после дописывания --delta строк (дедупликация),
+проверка и восстановление.
+
+Использование:
+    python benchmark_backup.py [--rows 1000000] [--delta 10000]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Журнал пишется по времени: новые строки дописываются в конец таблицы
+BASE_TIME = datetime(2024, 1, 1)
+ACTION_TYPES = ['start', 'generate', 'select_model', 'select_format', 'buy_credits', 'help']
+
+
+def fill_user_actions(path, rows, start_id=1):
+    conn = sqlite3.connect(path)
+    batch = []
+    for i in range(rows):
+        user_id = random.randint(1, 50000)
+        action = random.choice(ACTION_TYPES)
+        batch.append((user_id, action, f'{{"step": {i % 7}, "model": "model_{i % 5}"}}',
+                      (BASE_TIME + timedelta(seconds=start_id + i)).strftime("%Y-%m-%d %H:%M:%S")))
+        if len(batch) >= 50000:
+            conn.executemany(
+                "INSERT INTO user_actions (user_id, action_type, action_data, timestamp) VALUES (?, ?, ?, ?)", batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany(
+            "INSERT INTO user_actions (user_id, action_type, action_data, timestamp) VALUES (?, ?, ?, ?)", batch)
+        conn.commit()
+    conn.close()
+
+
+def timed(label, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    print(f"⏱️  {label}: {elapsed:.2f} с")
+    return result, elapsed
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк резервного копирования")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="Строк в user_actions")
+    parser.add_argument('--delta', type=int, default=10_000, help="Строк, дописываемых перед второй копией")
+    args = parser.parse_args()
+    
+    os.environ.pop('DATABASE_URL', None)
+    workdir = tempfile.mkdtemp(prefix="backup_bench_")
+    os.chdir(workdir)
+    
+    from database import AnalyticsDB
+    from backup_database import backup_database, verify_backup, restore_database
+    
+    AnalyticsDB().ensure_schema()
+    db_path = "bot_analytics.db"
+    print(f"📦 Заполняем user_actions: {args.rows} строк ({workdir})")
+    timed("заполнение", fill_user_actions, db_path, args.rows)
+    db_mb = os.path.getsize(db_path) / (1024 * 1024)
+    print(f"📊 Размер базы: {db_mb:.1f} MB")
+    
+    os.makedirs("legacy", exist_ok=True)
+    timed("shutil.copy2 (старый способ)", shutil.copy2, db_path, os.path.join("legacy", "copy.db"))
+    
+    first, first_time = timed("первая копия (backup API + куски)", backup_database)
+    stored_first = dir_size("backups")
+    
+    fill_user_actions(db_path, args.delta, start_id=args.rows + 1)
+    second, second_time = timed(f"вторая копия (+{args.delta} строк)", backup_database)
+    stored_second = dir_size("backups") - stored_first
+    
+    _, verify_time = timed("проверка второй копии", verify_backup, second['id'])
+    _, restore_time = timed("восстановление второй копии", restore_database, second['id'])
+    
+    restored_rows = sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM user_actions").fetchone()[0]
+    logical_mb = second['stats']['logical_bytes'] / (1024 * 1024)
+    
+    print()
+    print("=" * 60)
+    print(f"Строк: {args.rows} + {args.delta}, восстановлено: {restored_rows}")
+    print(f"Полная копия старым способом:  {db_mb:.1f} MB на каждую копию")
+    print(f"Первая копия:  {stored_first / (1024 * 1024):.1f} MB на диске "
+          f"(сжатие x{first['stats']['logical_bytes'] / max(1, stored_first):.1f}), {first_time:.2f} с")
+    print(f"Вторая копия:  {stored_second / (1024 * 1024):.2f} MB новых данных из {logical_mb:.1f} MB, "
+          f"{second['stats']['reused_chunks']}/{second['stats']['new_chunks'] + second['stats']['reused_chunks']} "
+          f"кусков без изменений, {second_time:.2f} с")
+    print(f"Проверка: {verify_time:.2f} с, восстановление: {restore_time:.2f} с")
+    
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
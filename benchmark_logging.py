@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк накладных расходов логирования на одну генерацию
+
+Сначала сценарии load_test_bot (image, edit, video, purchase) один раз
+прогоняются через бота с заглушками внешних сервисов, и все записи лога
+каждого сценария (логгер, уровень, шаблон, аргументы) перехватываются на
+уровне DEBUG. Затем записи сценария воспроизводятся --repeat раз в трех
+конфигурациях, и замеряется процессорное время вызывающего потока (event
+loop, time.thread_time) на одну генерацию:
+
+    sync      - как было: строка собирается сразу (f-строка), запись
+                синхронно пишется StreamHandler в файл, все на уровне INFO,
+                платежные сообщения дублируются print
+    queue     - structured_logging без выборки: ленивые аргументы, очередь,
+                JSON в фоновом потоке
+    sampled   - structured_logging с выборкой и лимитами по умолчанию
+
+Отдельно выводится время, за которое фоновый поток дописывает очередь, и
+микробенчмарк f-строки против ленивых аргументов на выключенном уровне.
+
+Использование:
+    python benchmark_logging.py [--repeat 200] [--flows image,edit,video,purchase]
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from contextlib import redirect_stderr, redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices, LatencyModel
+from load_test_bot import FLOWS, LoadTest, _task_factory
+
+
+class CaptureHandler(logging.Handler):
+    """Запоминает записи без форматирования"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        # DEBUG библиотек (httpcore, telegram) не писался и раньше; DEBUG бота раньше был INFO
+        if record.levelno >= logging.INFO or record.name.startswith('bot.'):
+            self.records.append((record.name, record.levelno, record.msg, record.args))
+
+
+async def capture_flows(flows):
+    """Прогоняет каждый сценарий один раз и возвращает {сценарий: [записи]}"""
+    services = FakeServices(replicate=LatencyModel(0.01), preflight=LatencyModel(0.001),
+                            openai=LatencyModel(0.01), telegram=LatencyModel(0.001),
+                            betatransfer=LatencyModel(0.001))
+    await services.start()
+    os.environ.update(services.environ())
+    os.environ.pop('DATABASE_URL', None)
+    os.chdir(tempfile.mkdtemp(prefix="bot_logbench_"))
+    asyncio.get_event_loop().set_task_factory(_task_factory)
+
+    test = LoadTest(Namespace(users=1, flows_per_user=1, seed=1, step_timeout=60), services)
+    # Запуск бота настраивает логирование; перехват ставим после него
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        await test.setup()
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    capture = CaptureHandler()
+    root.handlers = [capture]
+    root.setLevel(logging.DEBUG)
+    captured = {}
+    try:
+        for name in flows:
+            capture.records = []
+            with redirect_stdout(io.StringIO()):
+                await test.run_flow(next(iter(test.user_ids())), name)
+            captured[name] = capture.records
+            if test.flow_errors.get(name):
+                print(f"⚠️  Сценарий {name} завершился с ошибкой: {test.error_samples[-1]['error']}")
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+        await test.teardown()
+        await services.stop()
+    return captured
+
+
+def replay_sync(records, repeat, stream):
+    """Прежняя схема: f-строка сразу, синхронная запись, print для платежей"""
+    import structured_logging
+    structured_logging.stop_logging()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(structured_logging.TEXT_FORMAT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    loggers = {name: logging.getLogger(name) for name, _, _, _ in records}
+    started = time.thread_time()
+    with redirect_stdout(stream):
+        for _ in range(repeat):
+            for name, levelno, msg, args in records:
+                text = msg % args if args else msg
+                if name == 'bot.payments':
+                    print(text)
+                loggers[name].log(max(levelno, logging.INFO), text)
+    return (time.thread_time() - started) / repeat, 0.0
+
+
+def replay_queue(records, repeat, stream, sampling, rate_limits):
+    """structured_logging: ленивые аргументы, очередь и JSON в фоновом потоке"""
+    import structured_logging
+    structured_logging.setup_logging(level='INFO', fmt='json', stream=stream, queue_size=1_000_000,
+                                     sampling=sampling, rate_limits=rate_limits)
+    loggers = {name: logging.getLogger(name) for name, _, _, _ in records}
+    started = time.thread_time()
+    for _ in range(repeat):
+        for name, levelno, msg, args in records:
+            loggers[name].log(levelno, msg, *args)
+    caller = time.thread_time() - started
+    # Фоновый поток дописывает очередь
+    drain_started = time.perf_counter()
+    structured_logging.stop_logging()
+    background = time.perf_counter() - drain_started
+    return caller / repeat, background / repeat
+
+
+def disabled_level_microbench(iterations=200_000):
+    """f-строка на выключенном DEBUG против ленивых аргументов"""
+    logger = logging.getLogger('bot.generation')
+    logger.setLevel(logging.INFO)
+    state = {'format': 'square', 'image_count': 4, 'user_prompt': 'кот в космосе ' * 5,
+             'aspect_ratio': '16:9', 'history': list(range(20))}
+    started = time.perf_counter()
+    for _ in range(iterations):
+        logger.debug(f"Состояние: {state}")
+    eager = (time.perf_counter() - started) / iterations
+    started = time.perf_counter()
+    for _ in range(iterations):
+        logger.debug("Состояние: %s", state)
+    lazy = (time.perf_counter() - started) / iterations
+    logger.setLevel(logging.NOTSET)
+    return eager, lazy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы логирования на одну генерацию")
+    parser.add_argument('--repeat', type=int, default=200, help="Повторов записей каждого сценария")
+    parser.add_argument('--flows', default='image,edit,video,purchase', help="Сценарии через запятую")
+    args = parser.parse_args()
+    flows = [name.strip() for name in args.flows.split(',') if name.strip() in FLOWS]
+
+    print(f"📝 Перехват записей лога сценариев: {', '.join(flows)}")
+    captured = asyncio.run(capture_flows(flows))
+
+    out_dir = tempfile.mkdtemp(prefix="bot_logbench_out_")
+    print(f"\n{'Сценарий':<10}{'записей':>9}{'INFO+':>7}{'sync, мкс':>12}{'queue, мкс':>12}"
+          f"{'sampled, мкс':>14}{'фон, мкс':>10}")
+    for name, records in captured.items():
+        info = sum(1 for _, levelno, _, _ in records if levelno >= logging.INFO)
+        results = {}
+        with open(os.path.join(out_dir, f'{name}_sync.log'), 'w', encoding='utf-8') as stream:
+            results['sync'] = replay_sync(records, args.repeat, stream)
+        with open(os.path.join(out_dir, f'{name}_queue.log'), 'w', encoding='utf-8') as stream:
+            results['queue'] = replay_queue(records, args.repeat, stream, sampling='', rate_limits='')
+        with open(os.path.join(out_dir, f'{name}_sampled.log'), 'w', encoding='utf-8') as stream:
+            results['sampled'] = replay_queue(records, args.repeat, stream, sampling=None, rate_limits=None)
+        print(f"{name:<10}{len(records):>9}{info:>7}{results['sync'][0] * 1e6:>12.1f}"
+              f"{results['queue'][0] * 1e6:>12.1f}{results['sampled'][0] * 1e6:>14.1f}"
+              f"{results['queue'][1] * 1e6:>10.1f}")
+
+    eager, lazy = disabled_level_microbench()
+    print(f"\n🔇 Выключенный DEBUG: f-строка {eager * 1e9:.0f} нс, ленивые аргументы {lazy * 1e9:.0f} нс на вызов")
+    print(f"📂 Записанные логи: {out_dir}")
+
+
+if __name__ == '__main__':
+    main()
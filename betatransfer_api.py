@@ -1,15 +1,38 @@
-import requests
+import aiohttp
+import asyncio
 import hashlib
+import random
 import time
 import json
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, Optional, Tuple
 import os
+import threading
 from dotenv import load_dotenv
+from lazy_imports import LazyModule
+
+# requests нужен только синхронным запросам BetatransferAPI; бот ходит в API через AsyncBetatransferAPI
+requests = LazyModule('requests')
 
 load_dotenv()
 
+# Таймауты запросов к Betatransfer (секунды)
+BETATRANSFER_CONNECT_TIMEOUT = float(os.getenv('BETATRANSFER_CONNECT_TIMEOUT', '5'))
+BETATRANSFER_TOTAL_TIMEOUT = float(os.getenv('BETATRANSFER_TOTAL_TIMEOUT', '15'))
+# Количество повторов запроса статуса (идемпотентный запрос)
+BETATRANSFER_STATUS_RETRIES = int(os.getenv('BETATRANSFER_STATUS_RETRIES', '3'))
+# Базовая задержка между повторами (секунды)
+BETATRANSFER_RETRY_BASE_DELAY = float(os.getenv('BETATRANSFER_RETRY_BASE_DELAY', '0.5'))
+# Размер пула keep-alive соединений
+BETATRANSFER_POOL_SIZE = int(os.getenv('BETATRANSFER_POOL_SIZE', '20'))
+# Адрес API (нагрузочный тест подставляет локальный сервер)
+BETATRANSFER_BASE_URL = os.getenv('BETATRANSFER_BASE_URL', 'https://merchant.betatransfer.io/api')
+
+FORM_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded"
+}
+
 class BetatransferAPI:
     """Класс для работы с Betatransfer API"""
     
@@ -19,22 +42,91 @@ class BetatransferAPI:
         self.test_mode = os.getenv('BETATRANSFER_TEST_MODE', 'false').lower() == 'true'
         
         # Используем продакшн URL согласно документации
-        self.base_url = "https://merchant.betatransfer.io/api"
+        self.base_url = BETATRANSFER_BASE_URL
+        self.payment_endpoint = f"{self.base_url}/payment?token={self.api_key}"
+        self.info_endpoint = f"{self.base_url}/info?token={self.api_key}"
+        
+        # Секретный ключ кодируем один раз, а не при каждой подписи
+        self._secret_bytes = (self.secret_key or '').encode('utf-8')
+        
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.timeout = (BETATRANSFER_CONNECT_TIMEOUT, BETATRANSFER_TOTAL_TIMEOUT)
+    
+    @property
+    def session(self):
+        """Сессия с пулом keep-alive соединений (создается при первом запросе)"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=BETATRANSFER_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
     
     def _generate_signature(self, data: Dict) -> str:
         """
         Генерирует подпись для запроса согласно документации Betatransfer
         Алгоритм: md5(implode('', $data) . $secret)
         """
-        # Создаем строку из всех значений (без ключей) + секретный ключ
         # Согласно документации: md5(implode('', $data) . $secret)
+        # Значения подаются в хэш по очереди, без склейки промежуточной строки
         # Фильтруем None значения перед созданием подписи
-        signature_string = ''.join(str(v) for v in data.values() if v is not None) + self.secret_key
+        digest = hashlib.md5()
+        for value in data.values():
+            if value is not None:
+                digest.update(str(value).encode('utf-8'))
+        digest.update(self._secret_bytes)
         
-        # Создаем MD5 подпись
-        signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
+        return digest.hexdigest()
+    
+    def _build_payment_payload(self, amount: float, currency: str, order_id: str,
+                               payer_email: str, payer_name: str, payer_id: str) -> Dict:
+        """Формирует подписанные данные запроса создания платежа"""
+        # Формируем данные запроса согласно документации Betatransfer
+        payload = {
+            'amount': str(amount),
+            'currency': currency,
+            'orderId': order_id,
+            'paymentSystem': 'P2R_KGS',
+            'payerId': str(payer_id)
+        }
+        
+        # Добавляем параметры пользователя только если они не пустые
+        if payer_email:
+            payload['payerEmail'] = payer_email
+        if payer_name:
+            payload['payerName'] = payer_name
         
-        return signature
+        # Генерируем подпись ПЕРЕД добавлением в payload
+        payload['sign'] = self._generate_signature(payload)
+        return payload
+    
+    def _build_status_payload(self, payment_id: str) -> Dict:
+        """Формирует подписанные данные запроса статуса платежа"""
+        data = {'id': payment_id}
+        data['sign'] = self._generate_signature(data)
+        return data
+    
+    @staticmethod
+    def _log_created_payment(result: Dict, amount: float, currency: str):
+        # Логируем результат создания платежа
+        if 'id' in result:
+            logging.info(f"🔍 Платеж создан успешно:")
+            logging.info(f"   ID платежа: {result['id']}")
+            logging.info(f"   Сумма: {result.get('amount', amount)} {result.get('currency', currency)}")
+            logging.info(f"   Статус: {result.get('status', 'created')}")
+        else:
+            logging.warning(f"🔍 Платеж создан, но без ID: {result}")
+    
+    @staticmethod
+    def _log_payment_status(result: Dict, payment_id: str):
+        # Логируем детали ответа
+        logging.info(f"🔍 Получен ответ для платежа {payment_id}:")
+        logging.info(f"   Статус: {result.get('status', 'unknown')}")
+        logging.info(f"   Сумма: {result.get('amount', 'N/A')} {result.get('currency', 'N/A')}")
+        logging.info(f"   Order ID: {result.get('orderId', 'N/A')}")
     
     def create_payment(self, amount: float, currency: str = "KGS", 
                        description: str = "", order_id: str = None, 
@@ -59,48 +151,18 @@ class BetatransferAPI:
         if not order_id:
             order_id = f"order{int(time.time())}"
         
-        # Формируем данные запроса согласно документации Betatransfer
-        payload = {
-            'amount': str(amount),
-            'currency': currency,
-            'orderId': order_id,
-            'paymentSystem': 'P2R_KGS',
-            'payerId': str(payer_id)
-        }
-        
-        # Добавляем параметры пользователя только если они не пустые
-        if payer_email:
-            payload['payerEmail'] = payer_email
-        if payer_name:
-            payload['payerName'] = payer_name
-        
-        # Генерируем подпись ПЕРЕД добавлением в payload
-        payload['sign'] = self._generate_signature(payload)
-        
-        # URL с токеном согласно документации
-        endpoint = f"{self.base_url}/payment?token={self.api_key}"
-        
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
+        payload = self._build_payment_payload(amount, currency, order_id, payer_email, payer_name, payer_id)
         
         try:
             logging.info(f"🔍 Создаем платеж: {amount} {currency}, Order ID: {order_id}")
             
             # Отправляем как form-data согласно документации
-            response = requests.post(endpoint, data=payload, headers=headers)
+            response = self.session.post(self.payment_endpoint, data=payload, headers=FORM_HEADERS, timeout=self.timeout)
             
             response.raise_for_status()
             result = response.json()
             
-            # Логируем результат создания платежа
-            if 'id' in result:
-                logging.info(f"🔍 Платеж создан успешно:")
-                logging.info(f"   ID платежа: {result['id']}")
-                logging.info(f"   Сумма: {result.get('amount', amount)} {result.get('currency', currency)}")
-                logging.info(f"   Статус: {result.get('status', 'created')}")
-            else:
-                logging.warning(f"🔍 Платеж создан, но без ID: {result}")
+            self._log_created_payment(result, amount, currency)
             
             return result
         except requests.exceptions.RequestException as e:
@@ -121,37 +183,16 @@ class BetatransferAPI:
         """
         logging.info(f"🔍 get_payment_status вызван с ID: {payment_id}")
         
-        # Формируем данные для подписи
-        data = {'id': payment_id}
-        signature = self._generate_signature(data)
-        
-        # URL с токеном согласно документации
-        endpoint = f"{self.base_url}/info?token={self.api_key}"
-        
-        # Добавляем подпись к данным
-        data['sign'] = signature
-        
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
+        data = self._build_status_payload(payment_id)
         
         try:
             logging.info(f"🔍 Отправляем запрос статуса платежа {payment_id}")
-            response = requests.post(endpoint, data=data, headers=headers)
+            response = self.session.post(self.info_endpoint, data=data, headers=FORM_HEADERS, timeout=self.timeout)
             
             response.raise_for_status()
             result = response.json()
             
-            # Логируем детали ответа
-            status = result.get('status', 'unknown')
-            amount = result.get('amount', 'N/A')
-            currency = result.get('currency', 'N/A')
-            order_id = result.get('orderId', 'N/A')
-            
-            logging.info(f"🔍 Получен ответ для платежа {payment_id}:")
-            logging.info(f"   Статус: {status}")
-            logging.info(f"   Сумма: {amount} {currency}")
-            logging.info(f"   Order ID: {order_id}")
+            self._log_payment_status(result, payment_id)
             
             return result
         except requests.exceptions.RequestException as e:
@@ -178,11 +219,12 @@ class BetatransferAPI:
         amount = data.get('amount', '')
         order_id = data.get('orderId', '')
         
-        # Создаем строку для подписи согласно документации
-        signature_string = str(amount) + str(order_id) + self.secret_key
-        
-        # Создаем MD5 подпись
-        expected_signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
+        # Создаем MD5 подпись согласно документации
+        digest = hashlib.md5()
+        digest.update(str(amount).encode('utf-8'))
+        digest.update(str(order_id).encode('utf-8'))
+        digest.update(self._secret_bytes)
+        expected_signature = digest.hexdigest()
         
         is_valid = signature == expected_signature
         
@@ -269,8 +311,120 @@ class BetatransferAPI:
         except requests.exceptions.RequestException as e:
             return {"success": False, "message": f"Connection error: {str(e)}"}
 
+
+class AsyncBetatransferAPI(BetatransferAPI):
+    """
+    Асинхронный клиент Betatransfer API для event loop бота
+    
+    create_payment и get_payment_status - корутины с тем же набором аргументов
+    и тем же форматом ответа, что и у BetatransferAPI. Запросы идут через одну
+    aiohttp сессию с пулом keep-alive соединений и жесткими таймаутами.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._async_session = None
+        self._async_timeout = aiohttp.ClientTimeout(
+            total=BETATRANSFER_TOTAL_TIMEOUT,
+            connect=BETATRANSFER_CONNECT_TIMEOUT
+        )
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую aiohttp сессию, создавая ее при первом обращении"""
+        if self._async_session is None or self._async_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=BETATRANSFER_POOL_SIZE,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=self._async_timeout)
+        return self._async_session
+    
+    async def close(self):
+        """Закрывает aiohttp сессию"""
+        if self._async_session and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+    
+    async def _post_form(self, endpoint: str, data: Dict) -> Dict:
+        """Отправляет form-data запрос и возвращает JSON ответа"""
+        session = await self.get_session()
+        async with session.post(endpoint, data=data, headers=FORM_HEADERS) as response:
+            body = await response.text()
+            if response.status >= 400:
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=body[:500]
+                )
+            return json.loads(body)
+    
+    async def create_payment(self, amount: float, currency: str = "KGS", 
+                             description: str = "", order_id: str = None, 
+                             payer_email: str = "", payer_name: str = "",
+                             payer_id: str = "") -> Dict:
+        """
+        Создает платеж для покупки кредитов (без повторов - запрос не идемпотентен)
+        
+        Аргументы и ответ совпадают с BetatransferAPI.create_payment
+        """
+        if not order_id:
+            order_id = f"order{int(time.time())}"
+        
+        payload = self._build_payment_payload(amount, currency, order_id, payer_email, payer_name, payer_id)
+        
+        try:
+            logging.info(f"🔍 Создаем платеж: {amount} {currency}, Order ID: {order_id}")
+            result = await self._post_form(self.payment_endpoint, payload)
+            self._log_created_payment(result, amount, currency)
+            return result
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"❌ Ошибка HTTP запроса при создании платежа: {e.status}, Тело: {e.message}")
+            return {"error": f"{e.status} {e.message}"}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"❌ Ошибка HTTP запроса при создании платежа: {e!r}")
+            return {"error": str(e) or type(e).__name__}
+    
+    async def get_payment_status(self, payment_id: str) -> Dict:
+        """
+        Получает статус платежа с повторами при сетевых ошибках, 429 и 5xx
+        
+        Аргументы и ответ совпадают с BetatransferAPI.get_payment_status
+        """
+        data = self._build_status_payload(payment_id)
+        
+        last_error = None
+        for attempt in range(BETATRANSFER_STATUS_RETRIES + 1):
+            try:
+                result = await self._post_form(self.info_endpoint, data)
+                self._log_payment_status(result, payment_id)
+                return result
+            except aiohttp.ClientResponseError as e:
+                last_error = f"{e.status} {e.message}"
+                if e.status != 429 and e.status < 500:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = str(e) or type(e).__name__
+            except ValueError as e:
+                # Некорректный JSON - повтор не поможет
+                last_error = str(e)
+                break
+            
+            if attempt < BETATRANSFER_STATUS_RETRIES:
+                # Экспоненциальная задержка с полным джиттером
+                delay = random.uniform(0, BETATRANSFER_RETRY_BASE_DELAY * (2 ** attempt))
+                logging.warning(f"⚠️ Повтор запроса статуса платежа {payment_id} через {delay:.2f} с: {last_error}")
+                await asyncio.sleep(delay)
+        
+        logging.error(f"❌ Ошибка HTTP запроса статуса платежа {payment_id}: {last_error}")
+        return {"error": last_error}
+
 # Глобальный экземпляр API
 betatransfer_api = BetatransferAPI()
 
+# Глобальный асинхронный экземпляр API для бота
+async_betatransfer_api = AsyncBetatransferAPI()
+
 
 
@@ -1,23 +1,17 @@
 import logging
 import asyncio
-import concurrent.futures
+import signal
+import threading
 from typing import Dict, Any
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument
 
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
-
-import openai
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, ContextTypes, filters
 
 import os
 
-import replicate
-
-import requests
 import aiohttp
 
-from PIL import Image
-
 import io
 
 import tempfile
@@ -27,9 +21,11 @@ import time
 from datetime import datetime, timedelta
 
 from database import analytics_db
+from tracing import tracer, format_trace
 
-# Создаем пул потоков для блокирующих операций
-THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=300)
+# Раздельные пулы потоков для базы, внешних API и файлов
+# (задачи выполняются в контексте вызывающего кода, чтобы запросы к базе попадали в трассу)
+from executors import DB_EXECUTOR, API_EXECUTOR, FILE_EXECUTOR, shutdown_executors
 
 # Создаем пул HTTP соединений для aiohttp
 HTTP_SESSION = None
@@ -37,12 +33,75 @@ HTTP_SESSION = None
 # Конфигурация функций
 CONTENT_CREATION_ENABLED = False  # Временно отключена функция "Создать контент"
 
-# Flask для callback сервера
-from flask import Flask, request, jsonify
-from betatransfer_api import betatransfer_api
+# aiohttp сервер для webhook и callback
+from aiohttp import web
+from betatransfer_api import betatransfer_api, async_betatransfer_api
 from pricing_config import format_price
+from payment_poller import PaymentPoller, PAYMENT_CHECK_DURATION
+from notification_outbox import NotificationDispatcher, NOTIFICATION_LEASE_SECONDS
+from latency_sketch import latency_sketches, LATENCY_SKETCH_FLUSH_INTERVAL
+from data_retention import RetentionManager, RETENTION_ENABLED, RETENTION_INTERVAL_HOURS
+from metrics import metrics_registry, timed_async, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from update_recorder import update_recorder_from_env
+from loop_monitor import loop_monitor, LOOP_MONITOR_ENABLED
+from profiler import sampling_profiler, heap_profiler, ProfilerBusyError, HEAP_TRACE_MAX_MINUTES
+from structured_logging import setup_logging, stop_logging
+from job_coordinator import job_coordinator, SHUTDOWN_DRAIN_SECONDS
+
+# Тяжелые SDK импортируются при первом обращении (или в фоне после старта), а не при импорте bot.py
+from lazy_imports import LazyModule, preload_in_background
+openai = LazyModule('openai')
+replicate = LazyModule('replicate')
+requests = LazyModule('requests')
+from telegram.request import HTTPXRequest
+
+# Метрики внешних вызовов и фоновых сервисов (выгружаются на /metrics)
+REPLICATE_DURATION = metrics_registry.histogram(
+    'bot_replicate_run_duration_seconds', 'Время replicate.run по модели', ['model', 'status'])
+OPENAI_DURATION = metrics_registry.histogram(
+    'bot_openai_chat_duration_seconds', 'Время OpenAI chat completion по модели', ['model', 'status'])
+TELEGRAM_API_DURATION = metrics_registry.histogram(
+    'bot_telegram_api_duration_seconds', 'Время запросов к Telegram Bot API по методу и HTTP статусу',
+    ['method', 'status'])
+
+# Логгеры шумных путей: для них действуют выборка и лимиты LOG_SAMPLING / LOG_RATE_LIMITS.
+# Аргументы передаются отдельно от шаблона, чтобы строка собиралась только для записанных сообщений
+payments_log = logging.getLogger('bot.payments')
+media_log = logging.getLogger('bot.media')
+generation_log = logging.getLogger('bot.generation')
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий каждый запрос к Bot API (все send_* и edit_* проходят через него)"""
+    
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            with tracer.span(f'telegram.{api_method}'):
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_DURATION.labels(api_method, status).observe(time.perf_counter() - started)
+
+# Архивация старых периодов журналов (user_actions, generations, errors)
+retention_manager = RetentionManager(analytics_db)
+
+def job_trace_attrs(update, state, **extra):
+    """Атрибуты корневого спана задачи генерации: пользователь, модель, формат"""
+    user = getattr(update, 'effective_user', None)
+    attrs = {
+        'user_id': user.id if user else None,
+        'model': state.get('image_gen_model'),
+        'format': state.get('format'),
+    }
+    attrs.update(extra)
+    return attrs
 
 # Функция для параллельной генерации одного изображения
+@tracer.traced('generate_image', outcome=lambda result: 'ok' if result[1] else 'error')
 async def generate_single_image_async(idx, prompt, state, send_text=None):
     """
     Генерирует одно изображение асинхронно.
@@ -52,6 +111,7 @@ async def generate_single_image_async(idx, prompt, state, send_text=None):
         # Добавляем стиль генерации к промпту
         image_gen_style = state.get('image_gen_style', '')
         selected_model = state.get('image_gen_model', 'Ideogram')
+        tracer.annotate(idx=idx, model=selected_model)
         style_suffix = ''
         
         if image_gen_style and selected_model != 'Ideogram':
@@ -538,62 +598,79 @@ async def close_http_session():
     if HTTP_SESSION:
         await HTTP_SESSION.close()
         HTTP_SESSION = None
+    await async_betatransfer_api.close()
 
 async def replicate_run_async(model: str, input_params: Dict[str, Any], timeout: int = 300) -> Any:
     """
     Асинхронная обертка для replicate.run
     Использует пул потоков для предотвращения блокировки event loop
     """
+    # Версия модели отбрасывается, чтобы не плодить серии метрик
+    model_label = model.split(':', 1)[0]
+    started = time.perf_counter()
+    status = 'error'
     try:
         loop = asyncio.get_event_loop()
-        result = await asyncio.wait_for(
-            loop.run_in_executor(
-                THREAD_POOL,
-                lambda: replicate.run(model, input=input_params)
-            ),
-            timeout=timeout
-        )
+        with tracer.span('replicate', model=model_label):
+            result = await asyncio.wait_for(
+                loop.run_in_executor(
+                    API_EXECUTOR,
+                    lambda: replicate.run(model, input=input_params)
+                ),
+                timeout=timeout
+            )
+        status = 'ok'
         return result
     except asyncio.TimeoutError:
+        status = 'timeout'
         logging.error(f"Таймаут при выполнении replicate.run для модели {model}")
         raise
     except Exception as e:
         logging.error(f"Ошибка при выполнении replicate.run для модели {model}: {e}")
         raise
+    finally:
+        REPLICATE_DURATION.labels(model_label, status).observe(time.perf_counter() - started)
 
 async def openai_chat_completion_async(messages: list, model: str = "gpt-4o-mini", max_tokens: int = 800, temperature: float = 0.7) -> str:
     """
     Асинхронная обертка для OpenAI chat completion
     """
+    started = time.perf_counter()
+    status = 'error'
     try:
         client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         loop = asyncio.get_event_loop()
-        response = await asyncio.wait_for(
-            loop.run_in_executor(
-                THREAD_POOL,
-                lambda: client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                )
-            ),
-            timeout=30.0
-        )
+        with tracer.span('openai', model=model):
+            response = await asyncio.wait_for(
+                loop.run_in_executor(
+                    API_EXECUTOR,
+                    lambda: client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                    )
+                ),
+                timeout=30.0
+            )
+        status = 'ok'
         return response.choices[0].message.content.strip()
     except asyncio.TimeoutError:
+        status = 'timeout'
         logging.error("Таймаут при выполнении OpenAI chat completion")
         raise
     except Exception as e:
         logging.error(f"Ошибка при выполнении OpenAI chat completion: {e}")
         raise
+    finally:
+        OPENAI_DURATION.labels(model, status).observe(time.perf_counter() - started)
 
 # Асинхронные обертки для операций с базой данных
 async def analytics_db_add_user_async(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
     """Асинхронная обертка для analytics_db.add_user"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.add_user(user_id, username, first_name, last_name)
     )
 
@@ -601,7 +678,7 @@ async def analytics_db_update_user_activity_async(user_id: int):
     """Асинхронная обертка для analytics_db.update_user_activity"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.update_user_activity(user_id)
     )
 
@@ -609,7 +686,7 @@ async def analytics_db_log_action_async(user_id: int, action_type: str, action_d
     """Асинхронная обертка для analytics_db.log_action"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.log_action(user_id, action_type, action_data)
     )
 
@@ -617,49 +694,78 @@ async def analytics_db_get_user_limits_async(user_id: int):
     """Асинхронная обертка для analytics_db.get_user_limits"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_user_limits(user_id)
     )
 
-async def analytics_db_get_user_credits_async(user_id: int):
-    """Асинхронная обертка для analytics_db.get_user_credits"""
+async def analytics_db_get_user_entitlements_async(user_id: int):
+    """
+    Асинхронная обертка для analytics_db.get_user_entitlements
+    При попадании в кэш возвращает снимок сразу, без обращения к пулу потоков
+    """
+    cached = analytics_db.get_cached_entitlements(user_id)
+    if cached is not None:
+        return cached
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
-        lambda: analytics_db.get_user_credits(user_id)
+        DB_EXECUTOR,
+        lambda: analytics_db.get_user_entitlements(user_id)
     )
 
+async def analytics_db_get_user_credits_async(user_id: int):
+    """Асинхронная обертка для analytics_db.get_user_credits"""
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
+    return {
+        'balance': entitlements['balance'],
+        'total_purchased': entitlements['total_purchased'],
+        'total_used': entitlements['total_used']
+    }
+
 async def analytics_db_get_free_generations_left_async(user_id: int):
     """Асинхронная обертка для analytics_db.get_free_generations_left"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        THREAD_POOL,
-        lambda: analytics_db.get_free_generations_left(user_id)
-    )
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
+    return entitlements['free_generations_left']
 
 async def analytics_db_increment_free_generations_async(user_id: int):
     """Асинхронная обертка для analytics_db.increment_free_generations"""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        THREAD_POOL,
-        lambda: analytics_db.increment_free_generations(user_id)
+    # Прерванную после списания генерацию нельзя бесплатно повторить
+    return await job_coordinator.charge(
+        loop.run_in_executor(DB_EXECUTOR, lambda: analytics_db.increment_free_generations(user_id)),
+        debited=bool
+    )
+
+async def analytics_db_consume_generations_async(user_id: int, count: int, cost_per_item: int,
+                                                 description: str = "Генерация изображений"):
+    """Асинхронная обертка для analytics_db.consume_generations"""
+    loop = asyncio.get_event_loop()
+    # Бесплатные генерации записываются, даже если на остаток не хватило кредитов
+    return await job_coordinator.charge(
+        loop.run_in_executor(
+            DB_EXECUTOR,
+            lambda: analytics_db.consume_generations(user_id, count, cost_per_item, description)
+        ),
+        debited=lambda result: bool(result['free_used'] or result['credits_used'])
     )
 
 async def analytics_db_use_credits_async(user_id: int, amount: int, description: str = "Использование кредитов"):
     """Асинхронная обертка для analytics_db.use_credits"""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        THREAD_POOL,
-        lambda: analytics_db.use_credits(user_id, amount, description)
+    return await job_coordinator.charge(
+        loop.run_in_executor(DB_EXECUTOR, lambda: analytics_db.use_credits(user_id, amount, description)),
+        debited=bool
     )
 
 async def analytics_db_log_generation_async(user_id: int, model_name: str, format_type: str, 
                                           prompt: str, image_count: int, success: bool, 
                                           error_message: str = None, generation_time: float = None):
     """Асинхронная обертка для analytics_db.log_generation"""
+    # Время успешных генераций попадает в скетч квантилей (сбрасывается в базу периодически)
+    if success and generation_time is not None:
+        latency_sketches.record(model_name, format_type, generation_time)
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.log_generation(user_id, model_name, format_type, prompt, 
                                           image_count, success, error_message, generation_time)
     )
@@ -668,7 +774,7 @@ async def analytics_db_get_user_stats_async(user_id: int):
     """Асинхронная обертка для analytics_db.get_user_stats"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_user_stats(user_id)
     )
 
@@ -676,15 +782,78 @@ async def analytics_db_get_global_stats_async(days: int = 30):
     """Асинхронная обертка для analytics_db.get_global_stats"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_global_stats(days)
     )
 
+async def analytics_db_get_latency_quantiles_async(hours: int = 24):
+    """Асинхронная обертка для analytics_db.get_latency_quantiles"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.get_latency_quantiles(hours)
+    )
+
+async def analytics_db_save_interrupted_jobs_async(jobs):
+    """Асинхронная обертка для analytics_db.save_interrupted_jobs"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.save_interrupted_jobs(jobs)
+    )
+
+async def analytics_db_claim_interrupted_job_notifications_async(limit: int = 100):
+    """Асинхронная обертка для analytics_db.claim_interrupted_job_notifications"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.claim_interrupted_job_notifications(limit)
+    )
+
+async def analytics_db_release_interrupted_job_notification_async(job_id: int):
+    """Асинхронная обертка для analytics_db.release_interrupted_job_notification"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.release_interrupted_job_notification(job_id)
+    )
+
+async def analytics_db_take_interrupted_job_async(job_id: int, user_id: int):
+    """Асинхронная обертка для analytics_db.take_interrupted_job"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.take_interrupted_job(job_id, user_id)
+    )
+
+async def flush_latency_sketches():
+    """Сливает накопленные скетчи времени генерации в базу"""
+    items = latency_sketches.drain()
+    if not items:
+        return
+    loop = asyncio.get_event_loop()
+    saved = await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.merge_latency_sketches(items)
+    )
+    if not saved:
+        # Не теряем данные: вернем скетчи в реестр до следующей попытки
+        latency_sketches.restore(items)
+
+async def start_latency_sketch_flush():
+    """Периодически сбрасывает скетчи времени генерации в базу"""
+    while True:
+        await asyncio.sleep(LATENCY_SKETCH_FLUSH_INTERVAL)
+        try:
+            await flush_latency_sketches()
+        except Exception as e:
+            logging.error(f"Ошибка сброса скетчей времени генерации: {e}")
+
 async def analytics_db_get_daily_stats_async(days: int = 7):
     """Асинхронная обертка для analytics_db.get_daily_stats"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_daily_stats(days)
     )
 
@@ -692,23 +861,23 @@ async def analytics_db_get_total_credits_statistics_async():
     """Асинхронная обертка для analytics_db.get_total_credits_statistics"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_total_credits_statistics()
     )
 
-async def analytics_db_get_pending_payments_async():
+async def analytics_db_get_pending_payments_async(created_after: datetime = None):
     """Асинхронная обертка для analytics_db.get_pending_payments"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
-        lambda: analytics_db.get_pending_payments()
+        DB_EXECUTOR,
+        lambda: analytics_db.get_pending_payments(created_after)
     )
 
 async def analytics_db_get_old_pending_payments_async(hours: int = 24):
     """Асинхронная обертка для analytics_db.get_old_pending_payments"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_old_pending_payments(hours)
     )
 
@@ -716,7 +885,7 @@ async def analytics_db_get_credit_transaction_by_payment_id_async(payment_id: st
     """Асинхронная обертка для analytics_db.get_credit_transaction_by_payment_id"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_credit_transaction_by_payment_id(payment_id)
     )
 
@@ -725,7 +894,7 @@ async def analytics_db_add_credits_async(user_id: int, amount: int, payment_id:
     """Асинхронная обертка для analytics_db.add_credits"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.add_credits(user_id, amount, payment_id, description)
     )
 
@@ -733,7 +902,7 @@ async def analytics_db_create_credit_transaction_with_payment_async(user_id: int
     """Асинхронная обертка для analytics_db.create_credit_transaction_with_payment"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.create_credit_transaction_with_payment(user_id, amount, description, payment_id)
     )
 
@@ -741,7 +910,7 @@ async def analytics_db_get_payment_by_betatransfer_id_async(betatransfer_id: str
     """Асинхронная обертка для analytics_db.get_payment_by_betatransfer_id"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_payment_by_betatransfer_id(betatransfer_id)
     )
 
@@ -749,15 +918,63 @@ async def analytics_db_update_payment_status_async(payment_id: str, status: str)
     """Асинхронная обертка для analytics_db.update_payment_status"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.update_payment_status(payment_id, status)
     )
 
+async def analytics_db_settle_payment_async(betatransfer_id: str, status: str, notification=None):
+    """Асинхронная обертка для analytics_db.settle_payment"""
+    loop = asyncio.get_event_loop()
+    settlement = await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.settle_payment(betatransfer_id, status, notification)
+    )
+    if notification and settlement['applied']:
+        wake_notification_dispatcher()
+    return settlement
+
+async def analytics_db_enqueue_notification_async(user_id: int, message: str, dedupe_key: str = None,
+                                                  parse_mode: str = 'Markdown'):
+    """Асинхронная обертка для analytics_db.enqueue_notification"""
+    loop = asyncio.get_event_loop()
+    queued = await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.enqueue_notification(user_id, message, dedupe_key, parse_mode)
+    )
+    if queued:
+        wake_notification_dispatcher()
+    return queued
+
+async def analytics_db_claim_due_notifications_async(limit: int):
+    """Асинхронная обертка для analytics_db.claim_due_notifications"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.claim_due_notifications(limit, NOTIFICATION_LEASE_SECONDS)
+    )
+
+async def analytics_db_mark_notification_sent_async(notification_id: int):
+    """Асинхронная обертка для analytics_db.mark_notification_sent"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.mark_notification_sent(notification_id)
+    )
+
+async def analytics_db_reschedule_notification_async(notification_id: int, error: str,
+                                                     delay_seconds: float, give_up: bool = False):
+    """Асинхронная обертка для analytics_db.reschedule_notification"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        DB_EXECUTOR,
+        lambda: analytics_db.reschedule_notification(notification_id, error, delay_seconds, give_up)
+    )
+
 async def analytics_db_get_payment_by_order_id_async(order_id: str):
     """Асинхронная обертка для analytics_db.get_payment_by_order_id"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_payment_by_order_id(order_id)
     )
 
@@ -768,7 +985,7 @@ async def analytics_db_create_payment_with_credits_async(user_id: int, amount: f
     """Асинхронная обертка для analytics_db.create_payment_with_credits"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.create_payment_with_credits(user_id, amount, currency, payment_id, order_id, credit_amount)
     )
 
@@ -776,315 +993,296 @@ async def analytics_db_get_user_info_by_id_async(user_id: int):
     """Асинхронная обертка для analytics_db.get_user_info_by_id"""
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(
-        THREAD_POOL,
+        DB_EXECUTOR,
         lambda: analytics_db.get_user_info_by_id(user_id)
     )
 
 
-# Функция для автоматической проверки статуса платежей
-async def check_pending_payments():
-    """Проверяет статус всех pending платежей и зачисляет кредиты при завершении"""
+# Статусы Betatransfer, после которых платеж больше не нужно опрашивать
+FINAL_PAYMENT_STATUSES = {'success', 'failed', 'error', 'not_paid_timeout', 'not_paid', 'cancelled', 'canceled', 'cancel'}
+
+# Функция для проверки статуса одного платежа
+@timed_async(PAYMENT_CHECK_DURATION.labels('single'))
+async def check_single_payment(payment: dict):
+    """
+    Проверяет статус одного pending платежа и зачисляет кредиты при завершении
+    
+    Returns:
+        True если платеж вышел из pending (проведение записано в базу или платеж
+        уже проведен), False если его нужно проверить позже, None при ошибке API
+        или базы - тогда платеж проверяется снова с отсрочкой
+    """
+    payment_id = payment.get('betatransfer_id')
+    user_id = payment.get('user_id')
+    order_id = payment.get('order_id')
+    amount = payment.get('amount', 0)
+    currency = payment.get('currency', 'UAH')
+    credit_amount = payment.get('credit_amount', 0)
+    
+    payments_log.info("📋 [PAYMENT] Обрабатываем платеж: %s (ID: %s)", order_id, payment_id)
+    
+    if not payment_id:
+        payments_log.warning("⚠️ [PAYMENT] Пропускаем платеж %s - нет Betatransfer ID", order_id)
+        return True
+    
     try:
-        print("🔄 [PAYMENT CHECK] Начинаем проверку pending платежей...")
-        logging.info("🔄 [PAYMENT CHECK] Начинаем проверку pending платежей...")
+        payments_log.info("🌐 [PAYMENT] Запрашиваем статус у Betatransfer API для платежа %s...", payment_id)
         
-        # Получаем все pending платежи из базы данных
-        pending_payments = await analytics_db_get_pending_payments_async()
+        # Проверяем статус платежа через асинхронный клиент Betatransfer API
+        status_result = await async_betatransfer_api.get_payment_status(payment_id)
         
-        if not pending_payments:
-            print("✅ [PAYMENT CHECK] Pending платежей не найдено - все платежи обработаны")
-            logging.info("✅ [PAYMENT CHECK] Pending платежей не найдено - все платежи обработаны")
-            return
+        if 'error' in status_result:
+            payments_log.error("❌ [PAYMENT] Ошибка API Betatransfer: %s", status_result['error'])
+            return None
         
-        print(f"🔍 [PAYMENT CHECK] Найдено {len(pending_payments)} pending платежей для проверки")
-        logging.info(f"🔍 [PAYMENT CHECK] Найдено {len(pending_payments)} pending платежей для проверки")
+        payment_status = status_result.get('status')
+        payments_log.info("📊 [PAYMENT] Статус платежа %s: %s", payment_id, payment_status)
+        settlement = None
         
-        for i, payment in enumerate(pending_payments, 1):
-            payment_id = payment.get('betatransfer_id')
-            user_id = payment.get('user_id')
-            order_id = payment.get('order_id')
-            amount = payment.get('amount', 0)
-            currency = payment.get('currency', 'UAH')
-            credit_amount = payment.get('credit_amount', 0)
+        # Если платеж завершен, зачисляем кредиты
+        if payment_status == 'success':
+            payments_log.info("✅ [PAYMENT] Платеж %s успешно завершен! Сумма: %s %s, Кредиты: %s", payment_id, amount, currency, credit_amount)
             
-            print(f"📋 [PAYMENT {i}/{len(pending_payments)}] Обрабатываем платеж: {order_id} (ID: {payment_id})")
-            logging.info(f"📋 [PAYMENT {i}/{len(pending_payments)}] Обрабатываем платеж: {order_id} (ID: {payment_id})")
+            notification_message = (
+                f"✅ **Кредиты зачислены!**\n\n"
+                f"🪙 **Получено:** {credit_amount:,} кредитов\n"
+                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
+                f"📦 **Платеж:** {payment_id}\n\n"
+                f"Теперь вы можете использовать кредиты для генерации изображений!"
+            )
             
-            if not payment_id:
-                print(f"⚠️ [PAYMENT {i}] Пропускаем платеж {order_id} - нет Betatransfer ID")
-                logging.warning(f"⚠️ [PAYMENT {i}] Пропускаем платеж {order_id} - нет Betatransfer ID")
-                continue
+            # Статус, баланс, транзакция и уведомление в outbox меняются одной транзакцией
+            # только для pending платежа
+            settlement = await analytics_db_settle_payment_async(payment_id, 'success', notification_message)
             
-            try:
-                print(f"🌐 [PAYMENT {i}] Запрашиваем статус у Betatransfer API для платежа {payment_id}...")
-                logging.info(f"🌐 [PAYMENT {i}] Запрашиваем статус у Betatransfer API для платежа {payment_id}...")
-                
-                # Проверяем статус платежа через Betatransfer API асинхронно
-                loop = asyncio.get_event_loop()
-                status_result = await loop.run_in_executor(
-                    THREAD_POOL,
-                    lambda: betatransfer_api.get_payment_status(payment_id)
-                )
-                
-                if 'error' in status_result:
-                    print(f"❌ [PAYMENT {i}] Ошибка API Betatransfer: {status_result['error']}")
-                    logging.error(f"❌ [PAYMENT {i}] Ошибка API Betatransfer: {status_result['error']}")
-                    continue
-                
-                payment_status = status_result.get('status')
-                print(f"📊 [PAYMENT {i}] Статус платежа {payment_id}: {payment_status}")
-                logging.info(f"📊 [PAYMENT {i}] Статус платежа {payment_id}: {payment_status}")
-                
-                # Если платеж завершен, зачисляем кредиты
-                if payment_status == 'success':
-                    print(f"✅ [PAYMENT {i}] Платеж {payment_id} успешно завершен! Сумма: {amount} {currency}, Кредиты: {credit_amount}")
-                    logging.info(f"✅ [PAYMENT {i}] Платеж {payment_id} успешно завершен! Сумма: {amount} {currency}, Кредиты: {credit_amount}")
-                    
-                    if credit_amount and credit_amount > 0:
-                        print(f"🔍 [PAYMENT {i}] Проверяем, не зачислены ли уже кредиты за этот платеж...")
-                        logging.info(f"🔍 [PAYMENT {i}] Проверяем, не зачислены ли уже кредиты за этот платеж...")
-                        
-                        # Проверяем, не зачислены ли уже кредиты за этот платеж
-                        # Ищем транзакцию с этим payment_id
-                        existing_transaction = await analytics_db_get_credit_transaction_by_payment_id_async(payment_id)
-                        
-                        if not existing_transaction:
-                            print(f"💰 [PAYMENT {i}] Зачисляем {credit_amount} кредитов пользователю {user_id}...")
-                            logging.info(f"💰 [PAYMENT {i}] Зачисляем {credit_amount} кредитов пользователю {user_id}...")
-                            
-                            # Кредиты еще не зачислены, зачисляем
-                            await analytics_db_add_credits_async(user_id, credit_amount)
-                            
-                            # Создаем транзакцию с привязкой к платежу
-                            await analytics_db_create_credit_transaction_with_payment_async(user_id, credit_amount, f"Покупка кредитов (платеж {payment_id})", payment_id)
-                            
-                            # Обновляем статус платежа
-                            await analytics_db_update_payment_status_async(payment_id, 'success')
-                            
-                            print(f"📱 [PAYMENT {i}] Отправляем уведомление пользователю {user_id}...")
-                            logging.info(f"📱 [PAYMENT {i}] Отправляем уведомление пользователю {user_id}...")
-                            
-                            # Отправляем уведомление пользователю
-                            notification_message = (
-                                f"✅ **Кредиты зачислены!**\n\n"
-                                f"🪙 **Получено:** {credit_amount:,} кредитов\n"
-                                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
-                                f"📦 **Платеж:** {payment_id}\n\n"
-                                f"Теперь вы можете использовать кредиты для генерации изображений!"
-                            )
-                            
-                            await send_telegram_notification(user_id, notification_message)
-                            print(f"🎉 [PAYMENT {i}] Кредиты успешно зачислены пользователю {user_id}: {credit_amount} кредитов")
-                            logging.info(f"🎉 [PAYMENT {i}] Кредиты успешно зачислены пользователю {user_id}: {credit_amount} кредитов")
-                        else:
-                            print(f"ℹ️ [PAYMENT {i}] Кредиты уже зачислены за платеж {payment_id}, обновляем только статус")
-                            logging.info(f"ℹ️ [PAYMENT {i}] Кредиты уже зачислены за платеж {payment_id}, обновляем только статус")
-                            
-                            # Кредиты уже зачислены, просто обновляем статус платежа
-                            await analytics_db_update_payment_status_async(payment_id, 'success')
-                
-                elif payment_status == 'failed':
-                    print(f"❌ [PAYMENT {i}] Платеж {payment_id} завершился неудачно")
-                    logging.info(f"❌ [PAYMENT {i}] Платеж {payment_id} завершился неудачно")
-                    
-                    # Обновляем статус неудачного платежа
-                    await analytics_db_update_payment_status_async(payment_id, 'failed')
-                
-                elif payment_status == 'error':
-                    print(f"⚠️ [PAYMENT {i}] Платеж {payment_id} завершился с ошибкой")
-                    logging.info(f"⚠️ [PAYMENT {i}] Платеж {payment_id} завершился с ошибкой")
-                    
-                    # Обновляем статус ошибочного платежа
-                    await analytics_db_update_payment_status_async(payment_id, 'error')
-                    
-                    print(f"📱 [PAYMENT {i}] Отправляем уведомление об ошибке пользователю {user_id}...")
-                    logging.info(f"📱 [PAYMENT {i}] Отправляем уведомление об ошибке пользователю {user_id}...")
-                    
-                    # Уведомляем пользователя об ошибке
-                    error_message = (
-                        f"❌ **Ошибка платежа**\n\n"
-                        f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
-                        f"📦 **Платеж:** {payment_id}\n\n"
-                        f"Попробуйте создать новый платеж или обратитесь в поддержку."
-                    )
-                    await send_telegram_notification(user_id, error_message)
-                
-                elif payment_status == 'not_paid_timeout':
-                    print(f"⏰ [PAYMENT {i}] Платеж {payment_id} истек по времени")
-                    logging.info(f"⏰ [PAYMENT {i}] Платеж {payment_id} истек по времени")
-                    
-                    # Обновляем статус платежа с истекшим временем
-                    await analytics_db_update_payment_status_async(payment_id, 'timeout')
-                    
-                    print(f"📱 [PAYMENT {i}] Отправляем уведомление об истечении времени пользователю {user_id}...")
-                    logging.info(f"📱 [PAYMENT {i}] Отправляем уведомление об истечении времени пользователю {user_id}...")
-                    
-                    # Уведомляем пользователя о истечении времени
-                    timeout_message = (
-                        f"⏰ **Время оплаты истекло**\n\n"
-                        f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
-                        f"📦 **Платеж:** {payment_id}\n\n"
-                        f"⚠️ **Важно:** Если вы уже произвели оплату, но кредиты не поступили на баланс, это означает, что платеж не успел обработаться.\n\n"
-                        f"🔧 **Что делать:**\n"
-                        f"• Обратитесь в поддержку: @aiimagebotmanager\n"
-                        f"• Приложите скриншот чека об оплате\n"
-                        f"• Укажите номер платежа: {payment_id}\n"
-                        f"• Укажите ваш ID (узнать можно командой `/my_id`)\n"
-                        f"• Мы зачислим кредиты вручную в течение 24 часов\n\n"
-                        f"❌ **НЕ создавайте новый платеж** - это может привести к двойной оплате!"
-                    )
-                    await send_telegram_notification(user_id, timeout_message)
-                
-                elif payment_status == 'not_paid':
-                    print(f"⏳ [PAYMENT {i}] Платеж {payment_id} не найден у провайдера (not_paid)")
-                    logging.info(f"⏳ [PAYMENT {i}] Платеж {payment_id} не найден у провайдера (not_paid)")
-                    
-                    # Переводим платеж в ручную проверку, чтобы он не оставался в pending
-                    await analytics_db_update_payment_status_async(payment_id, 'manual_review')
-                    
-                    # Уведомляем пользователя и просим связаться с поддержкой
-                    not_paid_message = (
-                        f"⏳ **Оплата пока не найдена**\n\n"
-                        f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
-                        f"📦 **Платеж:** {payment_id}\n\n"
-                        f"Возможны задержка банка, неверная сумма или холд. Чтобы мы проверили платеж, пожалуйста, напишите в поддержку: @aiimagebotmanager и приложите:\n"
-                        f"• Скрин/чек оплаты\n"
-                        f"• Номер платежа: {payment_id}\n"
-                        f"• Ваш ID (команда `/my_id`)\n"
-                        f"• Сумму и время оплаты\n\n"
-                        f"Мы проверим и при необходимости откроем диспут. Кредиты будут зачислены вручную."
-                    )
-                    await send_telegram_notification(user_id, not_paid_message)
-                elif payment_status == 'cancelled' or payment_status == 'canceled' or payment_status == 'cancel':
-                    print(f"🚫 [PAYMENT {i}] Платеж {payment_id} был отменен")
-                    logging.info(f"🚫 [PAYMENT {i}] Платеж {payment_id} был отменен")
-                    
-                    # Обновляем статус отмененного платежа
-                    await analytics_db_update_payment_status_async(payment_id, 'cancelled')
-                    
-                    print(f"📱 [PAYMENT {i}] Отправляем уведомление об отмене пользователю {user_id}...")
-                    logging.info(f"📱 [PAYMENT {i}] Отправляем уведомление об отмене пользователю {user_id}...")
-                    
-                    # Уведомляем пользователя об отмене платежа
-                    cancelled_message = (
-                        f"🚫 **Платеж отменен**\n\n"
-                        f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
-                        f"📦 **Платеж:** {payment_id}\n\n"
-                        f"Для пополнения баланса создайте новый платеж."
-                    )
-                    await send_telegram_notification(user_id, cancelled_message)
-                
-                else:
-                    print(f"ℹ️ [PAYMENT {i}] Платеж {payment_id} имеет неизвестный статус: {payment_status}")
-                    logging.info(f"ℹ️ [PAYMENT {i}] Платеж {payment_id} имеет неизвестный статус: {payment_status}")
-                
-            except Exception as e:
-                print(f"💥 [PAYMENT {i}] Ошибка обработки платежа {payment_id}: {e}")
-                logging.error(f"💥 [PAYMENT {i}] Ошибка обработки платежа {payment_id}: {e}")
-                continue
+            if settlement['credited']:
+                payments_log.info("🎉 [PAYMENT] Кредиты успешно зачислены пользователю %s: %s кредитов", user_id, credit_amount)
+            elif not settlement['applied']:
+                payments_log.info("ℹ️ [PAYMENT] Платеж %s уже проведен, пропускаем", payment_id)
         
-        print(f"✅ [PAYMENT CHECK] Проверка завершена. Обработано {len(pending_payments)} платежей")
-        logging.info(f"✅ [PAYMENT CHECK] Проверка завершена. Обработано {len(pending_payments)} платежей")
-                
-    except Exception as e:
-        print(f"💥 [PAYMENT CHECK] Критическая ошибка проверки pending платежей: {e}")
-        logging.error(f"💥 [PAYMENT CHECK] Критическая ошибка проверки pending платежей: {e}")
-
-# Функция для запуска периодической проверки платежей
-async def start_payment_polling():
-    """Запускает периодическую проверку статуса платежей"""
-    print("🚀 [PAYMENT POLLING] Запуск системы автоматической проверки платежей...")
-    logging.info("🚀 [PAYMENT POLLING] Запуск системы автоматической проверки платежей...")
-    
-    while True:
-        try:
-            print("⏰ [PAYMENT POLLING] Начинаем новую проверку платежей...")
-            logging.info("⏰ [PAYMENT POLLING] Начинаем новую проверку платежей...")
+        elif payment_status == 'failed':
+            payments_log.info("❌ [PAYMENT] Платеж %s завершился неудачно", payment_id)
             
-            await check_pending_payments()
+            # Обновляем статус неудачного платежа
+            settlement = await analytics_db_settle_payment_async(payment_id, 'failed')
+        
+        elif payment_status == 'error':
+            payments_log.info("⚠️ [PAYMENT] Платеж %s завершился с ошибкой", payment_id)
             
-            print("😴 [PAYMENT POLLING] Ожидание 45 секунд до следующей проверки...")
-            logging.info("😴 [PAYMENT POLLING] Ожидание 45 секунд до следующей проверки...")
+            # Уведомляем пользователя об ошибке
+            error_message = (
+                f"❌ **Ошибка платежа**\n\n"
+                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
+                f"📦 **Платеж:** {payment_id}\n\n"
+                f"Попробуйте создать новый платеж или обратитесь в поддержку."
+            )
             
-            # Ждем 45 секунд перед следующей проверкой
-            await asyncio.sleep(45)
-        except Exception as e:
-            print(f"💥 [PAYMENT POLLING] Ошибка в payment polling: {e}")
-            logging.error(f"💥 [PAYMENT POLLING] Ошибка в payment polling: {e}")
+            # Обновляем статус ошибочного платежа
+            settlement = await analytics_db_settle_payment_async(payment_id, 'error', error_message)
+            if settlement['applied']:
+                payments_log.info("📱 [PAYMENT] Уведомление об ошибке поставлено в очередь для пользователя %s", user_id)
+        
+        elif payment_status == 'not_paid_timeout':
+            payments_log.info("⏰ [PAYMENT] Платеж %s истек по времени", payment_id)
+            
+            # Уведомляем пользователя о истечении времени
+            timeout_message = (
+                f"⏰ **Время оплаты истекло**\n\n"
+                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
+                f"📦 **Платеж:** {payment_id}\n\n"
+                f"⚠️ **Важно:** Если вы уже произвели оплату, но кредиты не поступили на баланс, это означает, что платеж не успел обработаться.\n\n"
+                f"🔧 **Что делать:**\n"
+                f"• Обратитесь в поддержку: @aiimagebotmanager\n"
+                f"• Приложите скриншот чека об оплате\n"
+                f"• Укажите номер платежа: {payment_id}\n"
+                f"• Укажите ваш ID (узнать можно командой `/my_id`)\n"
+                f"• Мы зачислим кредиты вручную в течение 24 часов\n\n"
+                f"❌ **НЕ создавайте новый платеж** - это может привести к двойной оплате!"
+            )
+            
+            # Обновляем статус платежа с истекшим временем
+            settlement = await analytics_db_settle_payment_async(payment_id, 'timeout', timeout_message)
+            if settlement['applied']:
+                payments_log.info("📱 [PAYMENT] Уведомление об истечении времени поставлено в очередь для пользователя %s", user_id)
+        
+        elif payment_status == 'not_paid':
+            payments_log.info("⏳ [PAYMENT] Платеж %s не найден у провайдера (not_paid)", payment_id)
+            
+            # Уведомляем пользователя и просим связаться с поддержкой
+            not_paid_message = (
+                f"⏳ **Оплата пока не найдена**\n\n"
+                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
+                f"📦 **Платеж:** {payment_id}\n\n"
+                f"Возможны задержка банка, неверная сумма или холд. Чтобы мы проверили платеж, пожалуйста, напишите в поддержку: @aiimagebotmanager и приложите:\n"
+                f"• Скрин/чек оплаты\n"
+                f"• Номер платежа: {payment_id}\n"
+                f"• Ваш ID (команда `/my_id`)\n"
+                f"• Сумму и время оплаты\n\n"
+                f"Мы проверим и при необходимости откроем диспут. Кредиты будут зачислены вручную."
+            )
             
-            print("😴 [PAYMENT POLLING] Ожидание 15 секунд после ошибки...")
-            logging.info("😴 [PAYMENT POLLING] Ожидание 15 секунд после ошибки...")
+            # Переводим платеж в ручную проверку, чтобы он не оставался в pending
+            settlement = await analytics_db_settle_payment_async(payment_id, 'manual_review', not_paid_message)
+        
+        elif payment_status == 'cancelled' or payment_status == 'canceled' or payment_status == 'cancel':
+            payments_log.info("🚫 [PAYMENT] Платеж %s был отменен", payment_id)
+            
+            # Уведомляем пользователя об отмене платежа
+            cancelled_message = (
+                f"🚫 **Платеж отменен**\n\n"
+                f"💰 **Сумма:** {payment.get('amount')} {payment.get('currency', 'KGS')}\n"
+                f"📦 **Платеж:** {payment_id}\n\n"
+                f"Для пополнения баланса создайте новый платеж."
+            )
             
-            # При ошибке ждем меньше времени
-            await asyncio.sleep(15)
+            # Обновляем статус отмененного платежа
+            settlement = await analytics_db_settle_payment_async(payment_id, 'cancelled', cancelled_message)
+            if settlement['applied']:
+                payments_log.info("📱 [PAYMENT] Уведомление об отмене поставлено в очередь для пользователя %s", user_id)
+        
+        else:
+            payments_log.info("ℹ️ [PAYMENT] Платеж %s имеет неизвестный статус: %s", payment_id, payment_status)
+        
+        if settlement is not None and settlement['error']:
+            # Проведение не записано: платеж в базе все еще pending, проверим его снова
+            payments_log.error("💥 [PAYMENT] Не удалось провести платеж %s со статусом %s", payment_id, payment_status)
+            return None
+        
+        # Платеж остается pending, пока провайдер не вернет финальный статус
+        return payment_status in FINAL_PAYMENT_STATUSES
+        
+    except Exception as e:
+        payments_log.error("💥 [PAYMENT] Ошибка обработки платежа %s: %s", payment_id, e)
+        return None
 
-# Создаем Flask приложение для callback
-flask_app = Flask(__name__)
+# Функция для запуска периодической проверки платежей
+async def start_payment_polling():
+    """Запускает адаптивную параллельную проверку статуса платежей"""
+    payments_log.info("🚀 [PAYMENT POLLING] Запуск системы автоматической проверки платежей...")
+    
+    poller = PaymentPoller(
+        fetch_pending=analytics_db_get_pending_payments_async,
+        check_payment=check_single_payment
+    )
+    metrics_registry.callback(
+        'bot_payment_poller_stats', 'Статистика PaymentPoller (проходы, вызовы API, отслеживаемые платежи)',
+        lambda: dict(poller.stats), labelnames=['stat'])
+    await poller.run_forever()
 
-async def send_telegram_notification(user_id: int, message: str):
+async def send_telegram_notification(user_id: int, message: str, parse_mode: str = 'Markdown'):
     """
-    Отправляет уведомление пользователю в Telegram
+    Отправляет уведомление пользователю в Telegram (используется диспетчером outbox)
     
     Args:
         user_id: ID пользователя в Telegram
         message: Текст сообщения
+        parse_mode: Режим разметки Telegram
+        
+    Returns:
+        Словарь {'ok', 'retry_after', 'permanent', 'error'}
     """
     try:
         bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         if not bot_token:
             logging.error("TELEGRAM_BOT_TOKEN не установлен")
-            return False
+            return {'ok': False, 'error': 'TELEGRAM_BOT_TOKEN не установлен'}
         
         url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
         data = {
             'chat_id': user_id,
-            'text': message,
-            'parse_mode': 'Markdown'
+            'text': message
         }
+        if parse_mode:
+            data['parse_mode'] = parse_mode
         
-        # Используем асинхронный вызов для предотвращения блокировки
-        loop = asyncio.get_event_loop()
         # Используем асинхронный HTTP клиент
         session = await init_http_session()
+        started = time.perf_counter()
         async with session.post(url, data=data) as response:
+            TELEGRAM_API_DURATION.labels('sendMessage', str(response.status)).observe(time.perf_counter() - started)
             if response.status == 200:
                 logging.info(f"Уведомление отправлено пользователю {user_id}")
-                return True
-            else:
-                response_text = await response.text()
-                logging.error(f"Ошибка отправки уведомления: {response.status} - {response_text}")
-                return False
-        
-        
+                return {'ok': True}
+            
+            response_text = await response.text()
+            logging.error(f"Ошибка отправки уведомления: {response.status} - {response_text}")
+            retry_after = None
+            if response.status == 429:
+                try:
+                    retry_after = (await response.json(content_type=None)).get('parameters', {}).get('retry_after')
+                except Exception:
+                    retry_after = None
+                retry_after = retry_after or 5
+            return {
+                'ok': False,
+                'retry_after': retry_after,
+                # Бот заблокирован или чат не существует - повторять бессмысленно
+                'permanent': response.status in (400, 403),
+                'error': f"{response.status} - {response_text[:200]}"
+            }
             
     except Exception as e:
         logging.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
-        return False
+        return {'ok': False, 'error': str(e)}
+
+# Диспетчер очереди уведомлений (создается при запуске фоновых сервисов)
+notification_dispatcher = None
+
+def wake_notification_dispatcher():
+    """Будит диспетчер уведомлений, если он запущен"""
+    if notification_dispatcher is not None:
+        notification_dispatcher.wake()
+
+async def start_notification_dispatcher():
+    """Запускает отправку уведомлений из outbox"""
+    global notification_dispatcher
+    notification_dispatcher = NotificationDispatcher(
+        claim=analytics_db_claim_due_notifications_async,
+        send=send_telegram_notification,
+        mark_sent=analytics_db_mark_notification_sent_async,
+        reschedule=analytics_db_reschedule_notification_async
+    )
+    metrics_registry.callback(
+        'bot_notification_dispatcher_stats', 'Статистика диспетчера outbox (отправлено, повторы, 429)',
+        lambda: dict(notification_dispatcher.stats), labelnames=['stat'])
+    await notification_dispatcher.run_forever()
+
+# Порт HTTP сервера для callback при локальном запуске (на Railway используется PORT)
+CALLBACK_PORT = int(os.getenv('CALLBACK_PORT', '5000'))
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """
+    Принимает обновления Telegram и передает их в очередь Application
+    """
+    application = request.app['application']
+    try:
+        data = await request.json()
+    except Exception:
+        return web.Response(status=400)
+    
+    update = Update.de_json(data, application.bot)
+    await application.update_queue.put(update)
+    return web.Response()
 
-@flask_app.route('/payment/ca', methods=['POST'])
-async def payment_callback():
+async def payment_callback(request: web.Request) -> web.Response:
     """
     Обрабатывает callback уведомления от Betatransfer
     """
     try:
         # Получаем данные callback (формат: application/x-www-form-urlencoded)
-        callback_data = request.form.to_dict()
+        callback_data = dict(await request.post())
         logging.info(f"Получен callback: {callback_data}")
         
         if not callback_data:
             logging.error("Пустые данные callback")
-            return jsonify({"error": "Empty callback data"}), 400
+            return web.json_response({"error": "Empty callback data"}, status=400)
         
-        # Обрабатываем callback через API асинхронно
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            THREAD_POOL,
-            lambda: betatransfer_api.process_callback(callback_data)
-        )
+        # Проверка подписи - только md5, выполняем прямо в event loop
+        result = betatransfer_api.process_callback(callback_data)
         
         if result.get("status") == "error":
             logging.error(f"Ошибка обработки callback: {result.get('error')}")
-            return jsonify({"error": result.get("error")}), 400
+            return web.json_response({"error": result.get("error")}, status=400)
         
         # Извлекаем информацию о платеже
         payment_info = result.get("payment_info", {})
@@ -1098,103 +1296,112 @@ async def payment_callback():
         
         # Если платеж успешен, зачисляем кредиты
         if status == "completed":
-            # Получаем информацию о платеже из базы по betatransfer_id
-            payment_record = await analytics_db_get_payment_by_betatransfer_id_async(payment_id)
-            if payment_record:
-                user_id = payment_record.get("user_id")
-                credit_amount = payment_record.get("credit_amount")
-                
-                # Зачисляем кредиты пользователю
-                await analytics_db_add_credits_async(user_id, credit_amount)
-                
-                # Обновляем статус платежа
-                await analytics_db_update_payment_status_async(payment_id, "completed")
-                
-                logging.info(f"Кредиты зачислены пользователю {user_id}: {credit_amount}")
-                
-                # Отправляем уведомление пользователю
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ **Платеж успешно обработан!**\n\n"
-                             f"💰 Зачислено кредитов: {credit_amount}\n"
-                             f"💳 Сумма: {amount} {currency}\n"
-                             f"🆔 ID платежа: {payment_id}"
-                    )
-                except Exception as e:
-                    logging.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
-            else:
-                logging.error(f"Платеж {payment_id} не найден в базе данных")
+            # Статус, баланс, транзакция и уведомление в outbox меняются одной транзакцией
+            # только для pending платежа
+            settlement = await analytics_db_settle_payment_async(
+                payment_id, "completed",
+                lambda settled: f"✅ **Платеж успешно обработан!**\n\n"
+                                f"💰 Зачислено кредитов: {settled['credit_amount']}\n"
+                                f"💳 Сумма: {amount} {currency}\n"
+                                f"🆔 ID платежа: {payment_id}"
+            )
+            if settlement['error']:
+                # 5xx: Betatransfer повторит callback, кредиты не потеряются
+                return web.json_response({"error": "Settlement failed"}, status=500)
+            if settlement['credited']:
+                logging.info(f"Кредиты зачислены пользователю {settlement['user_id']}: {settlement['credit_amount']}")
+            elif not settlement['applied']:
+                logging.info(f"Платеж {payment_id} уже проведен или не найден, повторный callback пропущен")
         
         # Если платеж отменен, обновляем статус и уведомляем пользователя
         elif status == "cancelled" or status == "canceled" or status == "cancel":
-            # Получаем информацию о платеже из базы по betatransfer_id
-            payment_record = await analytics_db_get_payment_by_betatransfer_id_async(payment_id)
-            if payment_record:
-                user_id = payment_record.get("user_id")
-                
-                # Обновляем статус платежа
-                await analytics_db_update_payment_status_async(payment_id, "cancelled")
-                
-                logging.info(f"Платеж {payment_id} отменен для пользователя {user_id}")
-                
-                # Отправляем уведомление пользователю
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"🚫 **Платеж отменен**\n\n"
-                             f"💳 Сумма: {amount} {currency}\n"
-                             f"🆔 ID платежа: {payment_id}\n\n"
-                             f"Для пополнения баланса создайте новый платеж."
-                    )
-                except Exception as e:
-                    logging.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+            settlement = await analytics_db_settle_payment_async(
+                payment_id, "cancelled",
+                f"🚫 **Платеж отменен**\n\n"
+                f"💳 Сумма: {amount} {currency}\n"
+                f"🆔 ID платежа: {payment_id}\n\n"
+                f"Для пополнения баланса создайте новый платеж."
+            )
+            if settlement['error']:
+                return web.json_response({"error": "Settlement failed"}, status=500)
+            if settlement['applied']:
+                logging.info(f"Платеж {payment_id} отменен для пользователя {settlement['user_id']}")
             else:
-                logging.error(f"Платеж {payment_id} не найден в базе данных")
+                logging.info(f"Платеж {payment_id} уже проведен или не найден, повторный callback пропущен")
         
         # Возвращаем 200 OK (требование Betatransfer)
-        return jsonify({"status": "success"}), 200
+        return web.json_response({"status": "success"})
         
     except Exception as e:
         logging.error(f"Ошибка обработки callback: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        return web.json_response({"error": "Internal server error"}, status=500)
 
-@flask_app.route('/payment/su', methods=['GET'])
-def payment_success():
+async def payment_success(request: web.Request) -> web.Response:
     """
     Страница успешной оплаты
     """
-    return jsonify({
+    return web.json_response({
         "status": "success",
         "message": "Payment completed successfully"
     })
 
-@flask_app.route('/payment/fai', methods=['GET'])
-def payment_fail():
+async def payment_fail(request: web.Request) -> web.Response:
     """
     Страница неуспешной оплаты
     """
-    return jsonify({
+    return web.json_response({
         "status": "failed",
         "message": "Payment failed"
     })
 
-@flask_app.route('/health', methods=['GET'])
-def health_check():
+async def health_check(request: web.Request) -> web.Response:
     """
     Проверка здоровья сервера
     """
-    return jsonify({"status": "healthy"})
+    return web.json_response({"status": "healthy"})
 
-# Включаем логирование
+# Если задан, /metrics требует заголовок Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
-logging.basicConfig(
+async def metrics_handler(request: web.Request) -> web.Response:
+    """
+    Метрики процесса в текстовом формате Prometheus
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(body=metrics_registry.render().encode('utf-8'),
+                        headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+def create_web_app(application, webhook_path: str = None) -> web.Application:
+    """
+    Создает aiohttp приложение с webhook Telegram, callback Betatransfer, /health и /metrics
+    
+    Args:
+        application: telegram.ext.Application бота
+        webhook_path: Путь webhook Telegram (без ведущего /), None - webhook не нужен
+    """
+    web_app = web.Application()
+    web_app['application'] = application
+    if webhook_path:
+        web_app.router.add_post(f'/{webhook_path}', telegram_webhook)
+    web_app.router.add_post('/payment/ca', payment_callback)
+    web_app.router.add_get('/payment/su', payment_success)
+    web_app.router.add_get('/payment/fai', payment_fail)
+    web_app.router.add_get('/health', health_check)
+    web_app.router.add_get('/metrics', metrics_handler)
+    return web_app
 
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+async def start_web_server(application, port: int, webhook_path: str = None) -> web.AppRunner:
+    """Запускает HTTP сервер в текущем event loop и возвращает его runner"""
+    runner = web.AppRunner(create_web_app(application, webhook_path), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    return runner
 
-    level=logging.INFO
+# Включаем логирование: очередь, фоновый поток записи, JSON и выборка по категориям
 
-)
+setup_logging()
 
 
 
@@ -1879,15 +2086,15 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Получаем информацию о пользователе
 
-    limits = await analytics_db_get_user_limits_async(user_id)
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
 
-    credits = await analytics_db_get_user_credits_async(user_id)
+    credits = {'balance': entitlements['balance']}
 
     
 
     # Формируем информацию о статусе
 
-    free_generations_left = await analytics_db_get_free_generations_left_async(user_id)
+    free_generations_left = entitlements['free_generations_left']
 
     
 
@@ -2884,6 +3091,17 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⚠️ Временные проблемы с базой данных. Попробуйте позже.")
         return
 
+    # Квантили времени генерации за сутки (сначала сбрасываем скетчи этого процесса)
+    try:
+        await flush_latency_sketches()
+        latency = await asyncio.wait_for(
+            analytics_db_get_latency_quantiles_async(24),
+            timeout=10.0
+        )
+    except asyncio.TimeoutError:
+        logging.error(f"Timeout getting latency quantiles for admin {user_id}")
+        latency = {'all': {}, 'models': {}}
+
     
 
     stats_text = f"""
@@ -2950,6 +3168,46 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     
 
+    stats_text += "\n⏱️ **Время генерации за 24 часа (p50 / p90 / p99):**\n"
+
+    
+
+    # Добавляем квантили времени генерации
+
+    if latency['all'].get('count'):
+
+        overall = latency['all']
+
+        stats_text += f"• Все модели: {overall['p50']:.1f}с / {overall['p90']:.1f}с / {overall['p99']:.1f}с ({overall['count']})\n"
+
+        for model, model_latency in list(latency['models'].items())[:5]:
+
+            stats_text += f"• {model}: {model_latency['p50']:.1f}с / {model_latency['p90']:.1f}с / {model_latency['p99']:.1f}с ({model_latency['count']})\n"
+
+    else:
+
+        stats_text += "• Нет данных\n"
+
+    
+
+    stats_text += "\n💰 **Выручка за 30 дней:**\n"
+
+    
+
+    # Добавляем выручку по валютам
+
+    if global_stats.get('revenue_30d'):
+
+        for currency, (payments_count, revenue) in global_stats['revenue_30d'].items():
+
+            stats_text += f"• {revenue:.2f} {currency} ({payments_count} платежей)\n"
+
+    else:
+
+        stats_text += "• Нет данных\n"
+
+    
+
     stats_text += "\n📅 **За последние 7 дней:**\n"
 
     
@@ -3603,6 +3861,8 @@ def enhance_prompts_with_character_context(prompts, topic):
 
 
 
+@tracer.trace('edit_image', attrs=lambda update, context, state, *args, **kwargs: job_trace_attrs(
+    update, state, model='black-forest-labs/flux-kontext-pro'))
 async def edit_image_with_flux(update, context, state, original_image_url, edit_prompt):
 
     """
@@ -3647,20 +3907,21 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
         user_id = update.callback_query.from_user.id
 
     if user_id:
-        logging.info(f"DEBUG: Найден user_id={user_id}")
-        free_generations_left = await analytics_db_get_free_generations_left_async(user_id)
-        user_credits = await analytics_db_get_user_credits_async(user_id)
+        generation_log.debug("Найден user_id=%s", user_id)
+        entitlements = await analytics_db_get_user_entitlements_async(user_id)
+        free_generations_left = entitlements['free_generations_left']
+        user_credits = {'balance': entitlements['balance']}
         
         # Редактирование доступно за бесплатные генерации ИЛИ за кредиты
-        logging.info(f"DEBUG: free_generations_left={free_generations_left}, user_credits['balance']={user_credits['balance']}")
+        generation_log.debug("free_generations_left=%s, user_credits['balance']=%s", free_generations_left, user_credits['balance'])
         if free_generations_left > 0:
             # Доступно за бесплатную генерацию
             generation_type = "free"
-            logging.info(f"DEBUG: Установлен generation_type=free для пользователя {user_id}")
+            generation_log.debug("Установлен generation_type=free для пользователя %s", user_id)
         elif user_credits['balance'] >= 12:  # Стоимость редактирования FLUX
             # Доступно за кредиты
             generation_type = "credits"
-            logging.info(f"DEBUG: Установлен generation_type=credits для пользователя {user_id}")
+            generation_log.debug("Установлен generation_type=credits для пользователя %s", user_id)
         else:
             # Нет доступа - ни бесплатных генераций, ни кредитов
             keyboard = [
@@ -3691,7 +3952,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
             )
             return None
     else:
-        logging.warning(f"DEBUG: user_id не найден! update.message={hasattr(update, 'message')}, update.callback_query={hasattr(update, 'callback_query')}")
+        generation_log.warning("user_id не найден! update.message=%s, update.callback_query=%s", hasattr(update, 'message'), hasattr(update, 'callback_query'))
 
     try:
 
@@ -3719,7 +3980,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
 
         if not os.environ.get('REPLICATE_API_TOKEN'):
 
-            logging.error("API токен Replicate не найден")
+            generation_log.error("API токен Replicate не найден")
 
             if send_text:
 
@@ -3747,7 +4008,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
 
         if not original_image_url or not edit_prompt:
 
-            logging.error("Отсутствуют обязательные параметры")
+            generation_log.error("Отсутствуют обязательные параметры")
 
             if send_text:
 
@@ -3776,16 +4037,16 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
         
         if original_image_url.startswith(('http://', 'https://')):
             # Это URL - используем напрямую
-            logging.info(f"Используем URL изображения: {original_image_url}")
+            generation_log.debug("Используем URL изображения: %s", original_image_url)
             input_image = original_image_url
         else:
             # Это локальный путь - создаем data URI
-            logging.info(f"Создаем data URI для локального файла: {original_image_url}")
+            generation_log.debug("Создаем data URI для локального файла: %s", original_image_url)
             try:
                 # Читаем файл
                 loop = asyncio.get_event_loop()
                 image_data = await loop.run_in_executor(
-                    THREAD_POOL,
+                    FILE_EXECUTOR,
                     lambda: open(original_image_url, 'rb').read()
                 )
                 
@@ -3802,10 +4063,10 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                 encoded = base64.b64encode(image_data).decode()
                 input_image = f"data:{mime_type};base64,{encoded}"
                 
-                logging.info(f"Создан data URI, размер: {len(image_data)} байт")
+                generation_log.debug("Создан data URI, размер: %s байт", len(image_data))
                 
             except Exception as e:
-                logging.error(f"Ошибка при создании data URI: {e}")
+                generation_log.error("Ошибка при создании data URI: %s", e)
                 if send_text:
                     keyboard = [
                         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -3818,7 +4079,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                 return None
 
         # Генерируем отредактированное изображение через FLUX.1 Kontext Pro
-        logging.info(f"Отправляем запрос в FLUX с промптом: {edit_prompt}")
+        generation_log.info("Отправляем запрос в FLUX с промптом: %s", edit_prompt)
 
         try:
             # Используем асинхронный вызов для предотвращения блокировки
@@ -3832,12 +4093,12 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                 timeout=60
             )
 
-            logging.info(f"Получен ответ от FLUX: {output}")
-            logging.info(f"Тип ответа: {type(output)}")
+            generation_log.debug("Получен ответ от FLUX: %s", output)
+            generation_log.debug("Тип ответа: %s", type(output))
 
         except Exception as replicate_error:
-            logging.error(f"Ошибка при вызове Replicate FLUX: {replicate_error}")
-            logging.error(f"Тип ошибки Replicate: {type(replicate_error).__name__}")
+            generation_log.error("Ошибка при вызове Replicate FLUX: %s", replicate_error)
+            generation_log.error("Тип ошибки Replicate: %s", type(replicate_error).__name__)
 
             if send_text:
                 keyboard = [
@@ -3866,10 +4127,10 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
         elif hasattr(output, '__getitem__'):
             edited_image_url = output[0] if output else None
 
-        logging.info(f"Извлеченный URL: {edited_image_url}")
+        generation_log.debug("Извлеченный URL: %s", edited_image_url)
 
         if not edited_image_url:
-            logging.error("Не удалось извлечь URL из ответа FLUX")
+            generation_log.error("Не удалось извлечь URL из ответа FLUX")
 
             if send_text:
                 keyboard = [
@@ -3885,7 +4146,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
 
         # Проверяем, что URL валидный
         if not edited_image_url.startswith('http'):
-            logging.error(f"Некорректный URL отредактированного изображения: {edited_image_url}")
+            generation_log.error("Некорректный URL отредактированного изображения: %s", edited_image_url)
 
             if send_text:
                 keyboard = [
@@ -3902,8 +4163,8 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
         # Отправляем результат
         try:
             # Загружаем отредактированное изображение
-            logging.info(f"Загружаем отредактированное изображение с URL: {edited_image_url}")
-            logging.info(f"Тип URL: {type(edited_image_url)}")
+            generation_log.debug("Загружаем отредактированное изображение с URL: %s", edited_image_url)
+            generation_log.debug("Тип URL: %s", type(edited_image_url))
 
             # Используем асинхронный вызов для предотвращения блокировки
             loop = asyncio.get_event_loop()
@@ -3911,7 +4172,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
             session = await init_http_session()
             async with session.get(edited_image_url) as edited_response:
                 if edited_response.status != 200:
-                    logging.error(f"Ошибка загрузки отредактированного изображения: {edited_response.status}")
+                    generation_log.error("Ошибка загрузки отредактированного изображения: %s", edited_response.status)
                     if send_text:
                         keyboard = [
                             [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -3922,36 +4183,36 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                 
                 edited_image_data = await edited_response.read()
 
-            logging.info(f"Статус загрузки отредактированного изображения: {edited_response.status}")
+            generation_log.debug("Статус загрузки отредактированного изображения: %s", edited_response.status)
 
             if edited_response.status == 200:
-                logging.info(f"Успешно загружено отредактированное изображение, размер: {len(edited_image_data)} байт")
+                generation_log.info("Успешно загружено отредактированное изображение, размер: %s байт", len(edited_image_data))
 
                 # СПИСЫВАЕМ БЕСПЛАТНУЮ ГЕНЕРАЦИЮ ИЛИ КРЕДИТЫ
-                logging.info(f"DEBUG: user_id={user_id}, generation_type={generation_type}")
+                generation_log.debug("user_id=%s, generation_type=%s", user_id, generation_type)
                 if user_id and generation_type:
                     if generation_type == "free":
                         # Списываем бесплатную генерацию
-                        logging.info(f"DEBUG: Списываем бесплатную генерацию для пользователя {user_id}")
+                        generation_log.debug("Списываем бесплатную генерацию для пользователя %s", user_id)
                         if await analytics_db_increment_free_generations_async(user_id):
-                            logging.info(f"Пользователь {user_id} использовал бесплатную генерацию для редактирования")
+                            generation_log.info("Пользователь %s использовал бесплатную генерацию для редактирования", user_id)
                         else:
-                            logging.error(f"Ошибка списания бесплатной генерации для пользователя {user_id}")
+                            generation_log.error("Ошибка списания бесплатной генерации для пользователя %s", user_id)
                     elif generation_type == "credits":
                         # Списываем кредиты
-                        logging.info(f"DEBUG: Списываем кредиты для пользователя {user_id}")
+                        generation_log.debug("Списываем кредиты для пользователя %s", user_id)
                         if await analytics_db_use_credits_async(user_id, 12, "Редактирование изображения через FLUX.1 Kontext Pro"):
-                            logging.info(f"Пользователь {user_id} использовал 12 кредитов для редактирования")
+                            generation_log.info("Пользователь %s использовал 12 кредитов для редактирования", user_id)
                         else:
-                            logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+                            generation_log.error("Ошибка списания кредитов для пользователя %s", user_id)
                 else:
-                    logging.warning(f"DEBUG: Не удалось списать - user_id={user_id}, generation_type={generation_type}")
+                    generation_log.warning("Не удалось списать - user_id=%s, generation_type=%s", user_id, generation_type)
 
                 try:
                     # Отправляем отредактированное изображение напрямую по URL
-                    logging.info("Пытаемся отправить изображение по URL...")
-                    logging.info(f"URL для отправки: {edited_image_url}")
-                    logging.info(f"Chat ID: {chat_id}")
+                    generation_log.info("Пытаемся отправить изображение по URL...")
+                    generation_log.debug("URL для отправки: %s", edited_image_url)
+                    generation_log.debug("Chat ID: %s", chat_id)
 
                     await context.bot.send_photo(
                         chat_id=chat_id,
@@ -3959,7 +4220,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                         caption=f"Отредактировано: {edit_prompt}"
                     )
 
-                    logging.info("Изображение успешно отправлено по URL")
+                    generation_log.info("Изображение успешно отправлено по URL")
 
                     # Отправляем сообщение об успехе с кнопкой главного меню
                     if send_text:
@@ -3973,12 +4234,12 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                         )
 
                 except Exception as send_error:
-                    logging.error(f"Ошибка отправки по URL: {send_error}")
-                    logging.error(f"Тип ошибки отправки: {type(send_error).__name__}")
+                    generation_log.error("Ошибка отправки по URL: %s", send_error)
+                    generation_log.error("Тип ошибки отправки: %s", type(send_error).__name__)
 
                     # Попробуем альтернативный способ - загрузить изображение и отправить как файл
                     try:
-                        logging.info("Пытаемся загрузить изображение и отправить как файл...")
+                        generation_log.info("Пытаемся загрузить изображение и отправить как файл...")
 
                         # Загружаем изображение по URL
                         loop = asyncio.get_event_loop()
@@ -3986,26 +4247,26 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                         async with session.get(edited_image_url) as response:
                             if response.status == 200:
                                 edited_image_data = await response.read()
-                                logging.info(f"Загружено изображение, размер: {len(edited_image_data)} байт")
+                                generation_log.info("Загружено изображение, размер: %s байт", len(edited_image_data))
                                 
                                 # Создаем временный файл асинхронно
                                 temp_edited_path = await loop.run_in_executor(
-                                    THREAD_POOL,
+                                    FILE_EXECUTOR,
                                     lambda: tempfile.NamedTemporaryFile(delete=False, suffix='.jpg').name
                                 )
                                 
                                 # Записываем данные в файл асинхронно
                                 await loop.run_in_executor(
-                                    THREAD_POOL,
+                                    FILE_EXECUTOR,
                                     lambda: open(temp_edited_path, 'wb').write(edited_image_data)
                                 )
 
-                                logging.info(f"Временный файл создан: {temp_edited_path}")
+                                generation_log.info("Временный файл создан: %s", temp_edited_path)
 
                                 # Отправляем отредактированное изображение из файла (асинхронно)
                                 loop = asyncio.get_event_loop()
                                 edited_data = await loop.run_in_executor(
-                                    THREAD_POOL,
+                                    FILE_EXECUTOR,
                                     lambda: open(temp_edited_path, 'rb').read()
                                 )
 
@@ -4015,14 +4276,14 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                                     caption=f"Отредактировано: {edit_prompt}"
                                 )
 
-                                logging.info("Изображение успешно отправлено из файла")
+                                generation_log.info("Изображение успешно отправлено из файла")
 
                                 # Удаляем временный файл
                                 try:
                                     os.unlink(temp_edited_path)
-                                    logging.info("Временный файл удален")
+                                    generation_log.info("Временный файл удален")
                                 except Exception as cleanup_error:
-                                    logging.warning(f"Не удалось удалить временный файл: {cleanup_error}")
+                                    generation_log.warning("Не удалось удалить временный файл: %s", cleanup_error)
 
                                 # Отправляем сообщение об успехе с кнопкой главного меню
                                 if send_text:
@@ -4035,7 +4296,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                                         reply_markup=InlineKeyboardMarkup(keyboard)
                                     )
                             else:
-                                logging.error(f"Ошибка загрузки изображения: {response.status}")
+                                generation_log.error("Ошибка загрузки изображения: %s", response.status)
                                 if send_text:
                                     keyboard = [
                                         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -4047,8 +4308,8 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                                     )
 
                     except Exception as file_send_error:
-                        logging.error(f"Ошибка отправки из файла: {file_send_error}")
-                        logging.error(f"Тип ошибки файла: {type(file_send_error).__name__}")
+                        generation_log.error("Ошибка отправки из файла: %s", file_send_error)
+                        generation_log.error("Тип ошибки файла: %s", type(file_send_error).__name__)
                         if send_text:
                             keyboard = [
                                 [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -4060,7 +4321,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                             )
 
             else:
-                logging.error(f"Ошибка загрузки отредактированного изображения: {edited_response.status}")
+                generation_log.error("Ошибка загрузки отредактированного изображения: %s", edited_response.status)
 
                 if send_text:
                     keyboard = [
@@ -4073,7 +4334,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                     )
 
         except requests.exceptions.Timeout:
-            logging.error("Таймаут при загрузке отредактированного изображения")
+            generation_log.error("Таймаут при загрузке отредактированного изображения")
 
             if send_text:
                 keyboard = [
@@ -4086,9 +4347,9 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
                 )
 
         except Exception as e:
-            logging.error(f"Общая ошибка отправки изображения: {e}")
-            logging.error(f"Тип ошибки: {type(e).__name__}")
-            logging.error(f"Детали ошибки: {str(e)}")
+            generation_log.error("Общая ошибка отправки изображения: %s", e)
+            generation_log.error("Тип ошибки: %s", type(e).__name__)
+            generation_log.error("Детали ошибки: %s", str(e))
 
             if send_text:
                 keyboard = [
@@ -4105,9 +4366,9 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
     except Exception as e:
         error_msg = str(e)
 
-        logging.error(f"Общая ошибка в edit_image_with_flux: {e}")
-        logging.error(f"Тип ошибки: {type(e).__name__}")
-        logging.error(f"Детали ошибки: {str(e)}")
+        generation_log.error("Общая ошибка в edit_image_with_flux: %s", e)
+        generation_log.error("Тип ошибки: %s", type(e).__name__)
+        generation_log.error("Детали ошибки: %s", str(e))
 
         if "insufficient_credit" in error_msg.lower():
             if send_text:
@@ -4146,6 +4407,7 @@ async def edit_image_with_flux(update, context, state, original_image_url, edit_
 
 
 
+@tracer.trace('send_images', attrs=lambda update, context, state, *args, **kwargs: job_trace_attrs(update, state))
 async def send_images(update, context, state, prompt_type='auto', user_prompt=None, scenes=None):
 
     """
@@ -4192,7 +4454,7 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
     # Проверяем, что у нас есть способ отправки сообщений
     if not send_text:
-        logging.error("send_text is None, cannot send messages")
+        media_log.error("send_text is None, cannot send messages")
         return
 
     # Логируем начало генерации
@@ -4241,8 +4503,6 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
     try:
 
-        import replicate
-
         replicate_client = replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'))
 
         # Попытка получить информацию об аккаунте для проверки баланса
@@ -4251,11 +4511,12 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
             # Простая проверка доступности API
             loop = asyncio.get_event_loop()
-            test_response = await replicate_run_async(
-                    "replicate/hello-world",
-                {"text": "test"},
-                timeout=30
-            )
+            with tracer.span('preflight'):
+                test_response = await replicate_run_async(
+                        "replicate/hello-world",
+                    {"text": "test"},
+                    timeout=30
+                )
 
             # Если дошли до сюда, значит API работает
 
@@ -4315,8 +4576,9 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
     # Проверяем лимиты пользователя
     user_id = update.effective_user.id
-    free_generations_left = await analytics_db_get_free_generations_left_async(user_id)
-    user_credits = await analytics_db_get_user_credits_async(user_id)
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
+    free_generations_left = entitlements['free_generations_left']
+    user_credits = {'balance': entitlements['balance']}
     
     # Определяем стоимость генерации
     selected_model = state.get('image_gen_model', 'Ideogram')
@@ -4367,9 +4629,9 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
     # Логируем параметры для отладки (только в логи)
 
-    logging.info(f"Отладка: format='{user_format}', image_count='{image_count}', prompt_type='{prompt_type}', user_prompt='{user_prompt}'")
+    media_log.debug("Отладка: format='%s', image_count='%s', prompt_type='%s', user_prompt='%s'", user_format, image_count, prompt_type, user_prompt)
 
-    logging.info(f"Состояние: {state}")
+    media_log.debug("Состояние: %s", state)
 
     
 
@@ -4657,15 +4919,19 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
     blocked_prompts = []
 
-    for prompt in prompts:
+    with tracer.span('safety_filter', prompts=len(prompts)):
 
-        if is_prompt_safe(prompt):
+        for prompt in prompts:
 
-            safe_prompts.append(prompt)
+            if is_prompt_safe(prompt):
 
-        else:
+                safe_prompts.append(prompt)
+
+            else:
 
-            blocked_prompts.append(prompt)
+                blocked_prompts.append(prompt)
+
+    tracer.annotate(images_requested=min(len(safe_prompts), max_scenes), blocked=len(blocked_prompts))
 
     if not safe_prompts:
 
@@ -4719,12 +4985,13 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
             await send_text(f"🚀 Запускаю параллельную генерацию {len(tasks)} изображений...")
 
         # Ждем завершения всех задач
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        with tracer.span('generate_images', count=len(tasks)):
+            results = await asyncio.gather(*tasks, return_exceptions=True)
 
         # Обрабатываем результаты
         for result in results:
             if isinstance(result, Exception):
-                logging.error(f"Ошибка в параллельной генерации: {result}")
+                media_log.error("Ошибка в параллельной генерации: %s", result)
                 if send_text:
                     await send_text(f"❌ Ошибка при генерации: {result}")
                 continue
@@ -4746,25 +5013,25 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
                 processed_count += 1
 
                 # Добавлено изображение в медиа группу
-                print(f"   последний элемент media: {media[-1].media}")
-                print(f"   длина media[-1].media: {len(str(media[-1].media)) if media[-1].media else 'None'}")
+                media_log.debug("   последний элемент media: %s", media[-1].media)
+                media_log.debug("   длина media[-1].media: %s", len(str(media[-1].media)) if media[-1].media else 'None')
             else:
                 # Ошибка при генерации
-                logging.error(f"Ошибка генерации изображения {idx}: {error}")
+                media_log.error("Ошибка генерации изображения %s: %s", idx, error)
                 if send_text:
                     await send_text(f"❌ Ошибка при генерации изображения {idx}: {error}")
 
     # Удаляем старый последовательный код - он заменен на параллельный выше
     # Оставляем только обработку результатов
     if media and send_media:
-        logging.info(f"Отправка медиа группы из {len(media)} изображений")
+        media_log.info("Отправка медиа группы из %s изображений", len(media))
         
         try:
             # Пытаемся отправить как группу
             await send_media(media=media)
-            logging.info("Медиа группа отправлена успешно")
+            media_log.info("Медиа группа отправлена успешно")
         except Exception as group_error:
-            logging.error(f"Ошибка отправки группы: {group_error}")
+            media_log.error("Ошибка отправки группы: %s", group_error)
             # Если группа не отправляется, отправляем по одному
             for i, item in enumerate(media):
                 try:
@@ -4774,16 +5041,16 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
                             await update.message.reply_document(document=item.media, caption=item.caption)
                         else:
                             await context.bot.send_document(chat_id=chat_id, document=item.media, caption=item.caption)
-                        logging.info(f"SVG документ {i+1} отправлен отдельно")
+                        media_log.info("SVG документ %s отправлен отдельно", i+1)
                     else:
                         # Отправляем как фото (обычные изображения)
                         if hasattr(update, 'message') and update.message:
                             await update.message.reply_photo(photo=item.media, caption=item.caption)
                         else:
                             await context.bot.send_photo(chat_id=chat_id, photo=item.media, caption=item.caption)
-                        logging.info(f"Изображение {i+1} отправлено отдельно")
+                        media_log.info("Изображение %s отправлено отдельно", i+1)
                 except Exception as photo_error:
-                    logging.error(f"Ошибка отправки изображения {i+1}: {photo_error}")
+                    media_log.error("Ошибка отправки изображения %s: %s", i+1, photo_error)
 
     elif processed_count == 0 and send_text:
 
@@ -4835,42 +5102,21 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
 
         await analytics_db_log_action_async(user_id, "generation_success", f"count:{processed_count}, time:{generation_time:.1f}s")
         
-        # Списываем кредиты или увеличиваем счетчик бесплатных генераций
-        if generation_type == "free":
-            # Списываем по количеству реально созданных изображений
-            free_generations_used = 0
-            for i in range(processed_count):
-                if await analytics_db_get_free_generations_left_async(user_id) > 0:
-                    if await analytics_db_increment_free_generations_async(user_id):
-                        free_generations_used += 1
-                        logging.info(f"Пользователь {user_id} использовал бесплатную генерацию {free_generations_used}")
-                    else:
-                        logging.error(f"Ошибка списания бесплатной генерации для пользователя {user_id}")
-                        break
-                else:
-                    # Если бесплатные закончились, переключаемся на кредиты
-                    generation_type = "credits"
-                    break
-    
-            # Если переключились на кредиты, списываем их
-            if generation_type == "credits":
-                remaining_count = processed_count - free_generations_used
-                if remaining_count > 0:
-                    total_cost = generation_cost * remaining_count
-                    if await analytics_db_use_credits_async(user_id, total_cost, f"Генерация {remaining_count} изображений через {selected_model}"):
-                        logging.info(f"Пользователь {user_id} использовал {total_cost} кредитов за {remaining_count} изображений")
-                    else:
-                        logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
-            else:
-                logging.info(f"Пользователь {user_id} использовал {free_generations_used} бесплатных генераций")
-        
-        elif generation_type == "credits":
-            # Списываем кредиты за каждое изображение
-            total_cost = generation_cost * processed_count
-            if await analytics_db_use_credits_async(user_id, total_cost, f"Генерация {processed_count} изображений через {selected_model}"):
-                logging.info(f"Пользователь {user_id} использовал {total_cost} кредитов за {processed_count} изображений")
-            else:
-                logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+        # Списываем бесплатные генерации и остаток кредитами одной транзакцией
+        # по количеству реально созданных изображений
+        if generation_type in ("free", "credits"):
+            debit = await analytics_db_consume_generations_async(
+                user_id,
+                processed_count,
+                generation_cost,
+                f"Генерация {processed_count} изображений через {selected_model}"
+            )
+            if debit['free_used']:
+                media_log.info("Пользователь %s использовал %s бесплатных генераций", user_id, debit['free_used'])
+            if debit['credits_used']:
+                media_log.info("Пользователь %s использовал %s кредитов за %s изображений", user_id, debit['credits_used'], processed_count - debit['free_used'])
+            if not debit['success']:
+                media_log.error("Ошибка списания кредитов для пользователя %s", user_id)
 
 
     else:
@@ -4996,12 +5242,12 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
             try:
                 await send_text("Хотите создать еще картинки?", reply_markup=reply_markup)
             except Exception as e:
-                logging.error(f"Ошибка отправки сообщения с кнопками: {e}")
+                media_log.error("Ошибка отправки сообщения с кнопками: %s", e)
                 # Если не удалось отправить с кнопками, отправляем без них
                 try:
                     await send_text("Хотите создать еще картинки?")
                 except Exception as e2:
-                    logging.error(f"Ошибка отправки простого сообщения: {e2}")
+                    media_log.error("Ошибка отправки простого сообщения: %s", e2)
 
     else:
 
@@ -5075,12 +5321,12 @@ async def send_images(update, context, state, prompt_type='auto', user_prompt=No
             try:
                 await send_text("Хотите другие варианты или уточнить, что должно быть на картинке?", reply_markup=reply_markup)
             except Exception as e:
-                logging.error(f"Ошибка отправки сообщения с кнопками: {e}")
+                media_log.error("Ошибка отправки сообщения с кнопками: %s", e)
                 # Если не удалось отправить с кнопками, отправляем без них
                 try:
                     await send_text("Хотите другие варианты или уточнить, что должно быть на картинке?")
                 except Exception as e2:
-                    logging.error(f"Ошибка отправки простого сообщения: {e2}")
+                    media_log.error("Ошибка отправки простого сообщения: %s", e2)
 
 
 
@@ -5612,11 +5858,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("buy_credits:"):
 
-        asyncio.create_task(handle_credit_purchase_async(update, context))
+        start_job(handle_credit_purchase_async, update, context)
 
     elif data.startswith("check_payment:"):
 
-        asyncio.create_task(check_payment_status_async(update, context))
+        start_job(check_payment_status_async, update, context)
+
+    elif data.startswith("resume_job:"):
+
+        await resume_interrupted_job(update, context, int(data.split(':')[1]))
 
     elif data.startswith('format:'):
 
@@ -6406,7 +6656,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             await update.callback_query.edit_message_text('Генерирую новые изображения по тем же сценам...')
 
-            asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=state['last_scenes']))
+            start_job(send_images_async, update, context, state, prompt_type='auto', scenes=state['last_scenes'])
 
         elif user_format in ['instagram reels', 'tiktok', 'youtube shorts'] and 'last_script' in state:
 
@@ -6416,11 +6666,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             state['last_scenes'] = scenes
 
-            asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes))
+            start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes)
 
         else:
 
-            asyncio.create_task(send_images_async(update, context, state, prompt_type=state.get('last_prompt_type', 'auto'), user_prompt=state.get('last_user_prompt')))
+            start_job(send_images_async, update, context, state, prompt_type=state.get('last_prompt_type', 'auto'), user_prompt=state.get('last_user_prompt'))
 
     elif data == "more_images_same_settings":
 
@@ -6432,13 +6682,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             await update.callback_query.edit_message_text('Генерирую новые изображения с теми же настройками...')
 
-            asyncio.create_task(send_images_async(update, context, state, prompt_type=state.get('last_prompt_type', 'user'), user_prompt=state.get('last_user_prompt')))
+            start_job(send_images_async, update, context, state, prompt_type=state.get('last_prompt_type', 'user'), user_prompt=state.get('last_user_prompt'))
 
         else:
 
             # Fallback для других форматов
 
-            asyncio.create_task(send_images_async(update, context, state, prompt_type=state.get('last_prompt_type', 'auto'), user_prompt=state.get('last_user_prompt')))
+            start_job(send_images_async, update, context, state, prompt_type=state.get('last_prompt_type', 'auto'), user_prompt=state.get('last_user_prompt'))
 
     elif data == "change_settings":
 
@@ -6602,7 +6852,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if user_format in ['instagram reels', 'tiktok', 'youtube shorts'] and 'last_scenes' in state:
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=state['last_scenes']))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=state['last_scenes'])
 
             elif user_format in ['instagram reels', 'tiktok', 'youtube shorts'] and 'last_script' in state:
 
@@ -6610,11 +6860,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 state['last_scenes'] = scenes
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes)
 
             else:
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto'))
+                start_job(send_images_async, update, context, state, prompt_type='auto')
 
         except Exception as e:
 
@@ -6658,11 +6908,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 scenes = state['last_scenes'][:count]
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes)
 
             else:
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto'))
+                start_job(send_images_async, update, context, state, prompt_type='auto')
 
         except Exception as e:
 
@@ -6918,7 +7168,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 await query.edit_message_text(f'Генерирую изображения для оставшихся {len(remaining_scenes)} сцен...')
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=remaining_scenes))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=remaining_scenes)
 
             else:
 
@@ -6966,7 +7216,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 await query.edit_message_text(f'Генерирую изображения для всех {len(all_scenes)} сцен...')
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=all_scenes))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=all_scenes)
 
             else:
 
@@ -7124,7 +7374,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 await query.edit_message_text(f'Генерирую изображения для {len(scenes_to_generate)} сцен...')
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes_to_generate))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes_to_generate)
 
             else:
 
@@ -7595,7 +7845,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Пользователь хочет генерировать с простым переводом
 
         # Запускаем генерацию видео в фоне
-        asyncio.create_task(generate_video_async(update, context, state))
+        start_job(generate_video_async, update, context, state)
         
         # Отправляем уведомление о начале обработки
         if hasattr(update, 'callback_query') and update.callback_query:
@@ -7619,7 +7869,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Пользователь выбрал улучшенный промпт
 
         # Запускаем генерацию видео в фоне
-        asyncio.create_task(generate_video_async(update, context, state))
+        start_job(generate_video_async, update, context, state)
         
         # Отправляем уведомление о начале обработки
         if hasattr(update, 'callback_query') and update.callback_query:
@@ -7691,7 +7941,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             del state['enhanced_prompt']  # Убираем улучшенный промпт
 
         # Запускаем генерацию видео в фоне
-        asyncio.create_task(generate_video_async(update, context, state))
+        start_job(generate_video_async, update, context, state)
         
         # Отправляем уведомление о начале обработки
         if hasattr(update, 'callback_query') and update.callback_query:
@@ -7829,7 +8079,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
 
         # Запускаем генерацию контента в фоне
-        asyncio.create_task(generate_content_async(update, context, state))
+        start_job(generate_content_async, update, context, state)
 
     elif step == 'custom_image_count':
 
@@ -8051,7 +8301,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         USER_STATE[user_id]['step'] = STEP_DONE
 
-        asyncio.create_task(send_images_async(update, context, state, prompt_type='user', user_prompt=user_prompt))
+        start_job(send_images_async, update, context, state, prompt_type='user', user_prompt=user_prompt)
 
     elif step == 'simple_image_count_selection':
 
@@ -8318,7 +8568,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text('Спасибо! Генерирую изображения...')
 
-        asyncio.create_task(send_images_async(update, context, state, prompt_type='user', user_prompt=user_prompt))
+        start_job(send_images_async, update, context, state, prompt_type='user', user_prompt=user_prompt)
 
     
 
@@ -8613,13 +8863,13 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                     await update.message.reply_text(f'Генерирую {count} изображений...')
 
-                    asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes))
+                    start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes)
 
                 else:
 
                     await update.message.reply_text(f'Генерирую {count} изображений...')
 
-                    asyncio.create_task(send_images_async(update, context, state, prompt_type='auto'))
+                    start_job(send_images_async, update, context, state, prompt_type='auto')
 
             else:
 
@@ -8669,7 +8919,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 await update.message.reply_text(f'Генерирую изображения для {count} сцен...')
 
-                asyncio.create_task(send_images_async(update, context, state, prompt_type='auto', scenes=scenes_to_generate))
+                start_job(send_images_async, update, context, state, prompt_type='auto', scenes=scenes_to_generate)
 
             else:
 
@@ -8854,7 +9104,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Редактируем изображение с переведенным промптом
 
-        asyncio.create_task(edit_image_with_flux_async(update, context, state, selected_image_url, english_prompt))
+        start_job(edit_image_with_flux_async, update, context, state, selected_image_url, english_prompt)
 
         
 
@@ -8900,8 +9150,6 @@ async def show_prompt_review(update, context, state):
 
             try:
 
-                import openai
-
                 client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
                 # Используем асинхронный вызов для предотвращения блокировки
@@ -9015,7 +9263,7 @@ async def show_prompt_review(update, context, state):
         # Fallback к прямой генерации
 
         # Запускаем генерацию видео в фоне
-        asyncio.create_task(generate_video_async(update, context, state))
+        start_job(generate_video_async, update, context, state)
         
         # Отправляем уведомление о начале обработки
         if hasattr(update, 'callback_query') and update.callback_query:
@@ -9038,8 +9286,6 @@ async def enhance_prompt_with_gpt(original_prompt, english_prompt, attempt=1):
 
     try:
 
-        import openai
-
         client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
         
@@ -9087,7 +9333,7 @@ Keep the enhancement reasonable and don't add completely new elements not implie
         # Используем асинхронный вызов для предотвращения блокировки
         loop = asyncio.get_event_loop()
         response = await asyncio.wait_for(
-            loop.run_in_executor(THREAD_POOL, lambda: client.chat.completions.create(
+            loop.run_in_executor(API_EXECUTOR, lambda: client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": system_content},
@@ -9216,7 +9462,7 @@ async def show_enhanced_prompt(update, context, state):
         # Fallback к прямой генерации
 
         # Запускаем генерацию видео в фоне
-        asyncio.create_task(generate_video_async(update, context, state))
+        start_job(generate_video_async, update, context, state)
         
         # Отправляем уведомление о начале обработки
         if hasattr(update, 'callback_query') and update.callback_query:
@@ -9581,6 +9827,146 @@ async def generate_video_async(update, context, state):
             reply_markup=reply_markup
         )
 
+# ==================== ГЕНЕРАЦИИ В РАБОТЕ И ОСТАНОВКА ====================
+
+# Генерации, которые можно запустить повторно после остановки бота: вид -> обертка
+RESUMABLE_JOBS = {
+    'images': send_images_async,
+    'video': generate_video_async,
+    'edit': edit_image_with_flux_async,
+    'content': generate_content_async,
+}
+JOB_KINDS = {func: kind for kind, func in RESUMABLE_JOBS.items()}
+JOB_TITLES = {
+    'images': 'генерация изображений',
+    'video': 'генерация видео',
+    'edit': 'редактирование изображения',
+    'content': 'создание контента',
+}
+
+def start_job(func, update, context, *args, **kwargs):
+    """
+    Запускает фоновую задачу обработчика через координатор генераций
+    
+    Для генераций из RESUMABLE_JOBS первым аргументом после context идет
+    state: вместе с остальными аргументами он сохраняется, если задача не
+    успеет завершиться до остановки бота. Пока бот останавливается, задача
+    не запускается, а пользователь получает просьбу повторить позже.
+    """
+    kind = JOB_KINDS.get(func, func.__name__)
+    payload = None
+    if kind in RESUMABLE_JOBS:
+        payload = {'state': args[0], 'args': list(args[1:]), 'kwargs': kwargs}
+    user = update.effective_user
+    chat = update.effective_chat
+    task = job_coordinator.spawn(
+        kind,
+        lambda: func(update, context, *args, **kwargs),
+        user_id=user.id if user else None,
+        chat_id=chat.id if chat else None,
+        payload=payload
+    )
+    if task is None and chat is not None:
+        asyncio.create_task(notify_restarting(context.bot, chat.id))
+    return task
+
+async def notify_restarting(bot, chat_id: int):
+    """Сообщает, что задача не запущена из-за перезапуска бота"""
+    try:
+        await bot.send_message(
+            chat_id=chat_id,
+            text="⏳ Бот перезапускается. Повторите действие через минуту - кредиты не списаны."
+        )
+    except Exception as e:
+        logging.error(f"Ошибка уведомления о перезапуске для {chat_id}: {e}")
+
+async def notify_interrupted_jobs(bot):
+    """
+    Предлагает пользователям повторить генерации, прерванные остановкой бота
+    
+    Вызывается процессом, который сохранил прерванные задачи, и при старте
+    (на случай, если прежний процесс не успел отправить предложения).
+    """
+    jobs = await analytics_db_claim_interrupted_job_notifications_async()
+    for job in jobs:
+        title = JOB_TITLES.get(job['kind'], 'генерация')
+        if job['charged']:
+            text = (f"⚠️ Бот перезапускался, и {title} прервалась после списания.\n\n"
+                    f"Напишите в поддержку и укажите номер задачи {job['id']} - мы вернем кредиты "
+                    f"или пришлем результат.")
+            keyboard = [[InlineKeyboardButton("📞 Поддержка", callback_data="support")]]
+        else:
+            text = (f"⚠️ Бот перезапускался, и {title} не успела завершиться. "
+                    f"Кредиты не списаны.\n\nНажмите «Продолжить», чтобы запустить ее с теми же настройками.")
+            keyboard = [[InlineKeyboardButton("▶️ Продолжить", callback_data=f"resume_job:{job['id']}")]]
+        keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+        try:
+            await bot.send_message(
+                chat_id=job['chat_id'] or job['user_id'],
+                text=text,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        except Exception as e:
+            logging.error(f"Ошибка отправки предложения повторить задачу {job['id']}: {e}")
+            await analytics_db_release_interrupted_job_notification_async(job['id'])
+
+async def resume_interrupted_job(update, context, job_id: int):
+    """Повторно запускает прерванную генерацию по кнопке «Продолжить»"""
+    user_id = update.callback_query.from_user.id
+    job = await analytics_db_take_interrupted_job_async(job_id, user_id)
+    if job is None or job['kind'] not in RESUMABLE_JOBS:
+        await context.bot.send_message(
+            chat_id=update.callback_query.message.chat_id,
+            text="ℹ️ Эта генерация уже запущена повторно или устарела. Начните новую из главного меню.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]])
+        )
+        return
+    
+    payload = job['payload']
+    # Восстанавливаем состояние диалога на момент остановки
+    state = USER_STATE.setdefault(user_id, {})
+    state.update(payload.get('state') or {})
+    logging.info(f"▶️ Возобновляем {job['kind']} (задача {job_id}) пользователя {user_id}")
+    start_job(RESUMABLE_JOBS[job['kind']], update, context, state,
+              *payload.get('args', []), **payload.get('kwargs', {}))
+
+async def drain_in_flight_jobs(application, timeout: float = SHUTDOWN_DRAIN_SECONDS):
+    """
+    Дожидается генераций при остановке бота
+    
+    Новые задачи не принимаются; запущенные получают timeout секунд на
+    завершение. Оставшиеся отменяются, сохраняются в interrupted_jobs,
+    а пользователям отправляется предложение повторить. В polling это
+    post_stop (обновления уже не принимаются, бот еще может отправлять
+    сообщения), в webhook вызывается после остановки сервера и app.stop().
+    """
+    report = await job_coordinator.drain(timeout)
+    saved = []
+    if report.unfinished:
+        await job_coordinator.cancel(report.unfinished)
+        saved = await analytics_db_save_interrupted_jobs_async([
+            {'user_id': job.user_id, 'chat_id': job.chat_id, 'kind': job.kind,
+             'payload': job.payload, 'charged': job.charged}
+            for job in report.unfinished if job.resumable and job.user_id
+        ])
+        if saved:
+            await notify_interrupted_jobs(application.bot)
+    logging.info(
+        "🛑 Дренаж генераций за %.1f с: завершено %s из %s, прервано %s, сохранено для возобновления %s",
+        report.seconds, report.finished, report.total, len(report.unfinished), len(saved),
+        extra={'drain_seconds': round(report.seconds, 3), 'jobs_finished': report.finished,
+               'jobs_interrupted': len(report.unfinished), 'jobs_saved': len(saved)}
+    )
+
+async def flush_telemetry():
+    """Сбрасывает буферы телеметрии перед выходом: скетчи времени генерации и файл трасс"""
+    try:
+        await flush_latency_sketches()
+    except Exception as e:
+        logging.error(f"Ошибка сброса скетчей времени генерации: {e}")
+    if tracer.exporter is not None:
+        tracer.exporter.close()
+
 async def generate_video(update, context, state):
 
     """Генерирует видео с помощью Replicate API"""
@@ -9611,13 +9997,14 @@ async def generate_video(update, context, state):
 
     if not chat_id or not user_id:
 
-        logging.error("Не удалось определить chat_id или user_id")
+        generation_log.error("Не удалось определить chat_id или user_id")
 
         return
 
     # Проверяем доступ к видео (только за кредиты)
-    free_generations_left = await analytics_db_get_free_generations_left_async(user_id)
-    user_credits = await analytics_db_get_user_credits_async(user_id)
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
+    free_generations_left = entitlements['free_generations_left']
+    user_credits = {'balance': entitlements['balance']}
 
     # Получаем параметры видео для расчета стоимости
     video_type = state.get('video_type', 'text_to_video')
@@ -9715,7 +10102,7 @@ async def generate_video(update, context, state):
 
                 # Если промпт не задан, это ошибка - пользователь должен был его ввести
 
-                logging.error(f"video_prompt не задан для text-to-video. State: {state}")
+                generation_log.error("video_prompt не задан для text-to-video. State: %s", state)
 
                 raise Exception("Промпт для видео не задан. Пожалуйста, попробуйте еще раз.")
 
@@ -9727,15 +10114,15 @@ async def generate_video(update, context, state):
 
                 english_prompt = state['enhanced_prompt']
 
-                logging.info(f"Using enhanced prompt: {english_prompt}")
+                generation_log.debug("Using enhanced prompt: %s", english_prompt)
 
             elif english_prompt != video_prompt:
 
-                logging.info(f"Using translated prompt: {english_prompt}")
+                generation_log.debug("Using translated prompt: %s", english_prompt)
 
             else:
 
-                logging.info(f"Using original prompt: {english_prompt}")
+                generation_log.debug("Using original prompt: %s", english_prompt)
 
             
 
@@ -9767,7 +10154,7 @@ async def generate_video(update, context, state):
 
                 # Если изображение не выбрано, это ошибка - пользователь должен был его загрузить
 
-                logging.error(f"selected_image_url не задан для image-to-video. State: {state}")
+                generation_log.error("selected_image_url не задан для image-to-video. State: %s", state)
 
                 raise Exception("Изображение для видео не загружено. Пожалуйста, попробуйте еще раз.")
 
@@ -9779,7 +10166,7 @@ async def generate_video(update, context, state):
 
                 # Если промпт не задан, это ошибка - пользователь должен был его ввести
 
-                logging.error(f"video_prompt не задан для image-to-video. State: {state}")
+                generation_log.error("video_prompt не задан для image-to-video. State: %s", state)
 
                 raise Exception("Промпт для видео не задан. Пожалуйста, опишите, какое видео вы хотите получить из изображения.")
 
@@ -9791,15 +10178,15 @@ async def generate_video(update, context, state):
 
                 english_prompt = state['enhanced_prompt']
 
-                logging.info(f"Using enhanced prompt for image-to-video: {english_prompt}")
+                generation_log.debug("Using enhanced prompt for image-to-video: %s", english_prompt)
 
             elif english_prompt != video_prompt:
 
-                logging.info(f"Using translated prompt for image-to-video: {english_prompt}")
+                generation_log.debug("Using translated prompt for image-to-video: %s", english_prompt)
 
             else:
 
-                logging.info(f"Using original prompt for image-to-video: {english_prompt}")
+                generation_log.debug("Using original prompt for image-to-video: %s", english_prompt)
 
             
 
@@ -9923,20 +10310,20 @@ async def generate_video(update, context, state):
 
         try:
 
-            logging.info("Проверяем доступность Replicate API...")
+            generation_log.info("Проверяем доступность Replicate API...")
 
             # Простая проверка через тестовый запрос
 
             loop = asyncio.get_event_loop()
             test_output = await asyncio.wait_for(
-                loop.run_in_executor(THREAD_POOL, lambda: replicate.run(
+                loop.run_in_executor(API_EXECUTOR, lambda: replicate.run(
                     "replicate/hello-world",
                     input={"text": "test"}
                 )),
                 timeout=30.0  # 30 секунд для теста
             )
 
-            logging.info("Replicate API доступен")
+            generation_log.info("Replicate API доступен")
 
         except Exception as credit_check_error:
 
@@ -9944,7 +10331,7 @@ async def generate_video(update, context, state):
 
             if "insufficient credit" in error_str or "insufficient_credit" in error_str:
 
-                logging.error("Недостаточно кредитов на Replicate")
+                generation_log.error("Недостаточно кредитов на Replicate")
 
                 # Отправляем сообщение о недостатке кредитов
 
@@ -10012,7 +10399,7 @@ async def generate_video(update, context, state):
 
             else:
 
-                logging.warning(f"Проблема с Replicate API: {credit_check_error}")
+                generation_log.warning("Проблема с Replicate API: %s", credit_check_error)
 
                 # Продолжаем попытку генерации
 
@@ -10020,25 +10407,23 @@ async def generate_video(update, context, state):
 
         # Вызываем Replicate API для генерации видео
 
-        import replicate
-
         
 
         # Логируем параметры API для диагностики
 
-        logging.info(f"🎬 Отправляем запрос к Replicate API:")
+        generation_log.info("🎬 Отправляем запрос к Replicate API: %s, %s, %s с", video_type, video_quality, video_duration)
 
-        logging.info(f"   Модель: bytedance/seedance-1-pro")
+        generation_log.debug("   Модель: bytedance/seedance-1-pro")
 
-        logging.info(f"   Параметры: {input_data}")
+        generation_log.debug("   Параметры: %s", input_data)
 
-        logging.info(f"   Тип видео: {video_type}")
+        generation_log.debug("   Тип видео: %s", video_type)
 
-        logging.info(f"   Качество: {video_quality}")
+        generation_log.debug("   Качество: %s", video_quality)
 
-        logging.info(f"   Длительность: {video_duration}")
+        generation_log.debug("   Длительность: %s", video_duration)
 
-        logging.info(f"   Aspect ratio: {state.get('aspect_ratio', 'не указан')}")
+        generation_log.debug("   Aspect ratio: %s", state.get('aspect_ratio', 'не указан'))
 
         
 
@@ -10052,23 +10437,23 @@ async def generate_video(update, context, state):
 
         
 
-        logging.info(f"🔍 Минимальные параметры для сравнения: {minimal_input}")
+        generation_log.debug("🔍 Минимальные параметры для сравнения: %s", minimal_input)
 
         
 
         # Валидация параметров
 
-        logging.info(f"🔍 Валидация параметров:")
+        generation_log.debug("🔍 Валидация параметров:")
 
-        logging.info(f"   duration: {video_duration} (тип: {type(video_duration)})")
+        generation_log.debug("   duration: %s (тип: %s)", video_duration, type(video_duration))
 
-        logging.info(f"   resolution: {video_quality} (тип: {type(video_quality)})")
+        generation_log.debug("   resolution: %s (тип: %s)", video_quality, type(video_quality))
 
-        logging.info(f"   aspect_ratio: {state.get('aspect_ratio', 'не указан')} (тип: {type(state.get('aspect_ratio'))})")
+        generation_log.debug("   aspect_ratio: %s (тип: %s)", state.get('aspect_ratio', 'не указан'), type(state.get('aspect_ratio')))
 
-        logging.info(f"   camera_fixed: False (тип: {type(False)})")
+        generation_log.debug("   camera_fixed: False (тип: %s)", type(False))
 
-        logging.info(f"   fps: 24 (тип: {type(24)})")
+        generation_log.debug("   fps: 24 (тип: %s)", type(24))
 
         
 
@@ -10076,15 +10461,15 @@ async def generate_video(update, context, state):
 
         if not isinstance(video_duration, int):
 
-            logging.warning(f"⚠️ duration должен быть int, получен: {type(video_duration)}")
+            generation_log.warning("⚠️ duration должен быть int, получен: %s", type(video_duration))
 
         if not isinstance(video_quality, str):
 
-            logging.warning(f"⚠️ resolution должен быть str, получен: {type(video_quality)}")
+            generation_log.warning("⚠️ resolution должен быть str, получен: %s", type(video_quality))
 
         if state.get('aspect_ratio') and not isinstance(state.get('aspect_ratio'), str):
 
-            logging.warning(f"⚠️ aspect_ratio должен быть str, получен: {type(state.get('aspect_ratio'))}")
+            generation_log.warning("⚠️ aspect_ratio должен быть str, получен: %s", type(state.get('aspect_ratio')))
 
         
 
@@ -10092,11 +10477,11 @@ async def generate_video(update, context, state):
 
             # Используем модель Bytedance Seedance 1.0 Pro
 
-            logging.info(f"🚀 Вызываем API с полными параметрами...")
+            generation_log.info("🚀 Вызываем API с полными параметрами...")
 
             loop = asyncio.get_event_loop()
             output = await asyncio.wait_for(
-                loop.run_in_executor(THREAD_POOL, lambda: replicate.run(
+                loop.run_in_executor(API_EXECUTOR, lambda: replicate.run(
                     "bytedance/seedance-1-pro",
                     input=input_data
                 )),
@@ -10109,7 +10494,7 @@ async def generate_video(update, context, state):
 
             if hasattr(output, '__await__'):
 
-                logging.info("Получен асинхронный результат, ожидаем...")
+                generation_log.info("Получен асинхронный результат, ожидаем...")
 
                 output = await output
 
@@ -10117,25 +10502,25 @@ async def generate_video(update, context, state):
 
         except Exception as replicate_error:
 
-            logging.error(f"❌ Ошибка Replicate API: {replicate_error}")
+            generation_log.error("❌ Ошибка Replicate API: %s", replicate_error)
 
             
 
             # Попробуем с минимальными параметрами
 
-            logging.info(f"🔄 Пробуем с минимальными параметрами...")
+            generation_log.info("🔄 Пробуем с минимальными параметрами...")
 
             try:
 
                 output = await asyncio.wait_for(
-                    loop.run_in_executor(THREAD_POOL, lambda: replicate.run(
+                    loop.run_in_executor(API_EXECUTOR, lambda: replicate.run(
                         "bytedance/seedance-1-pro",
                         input=minimal_input
                     )),
                     timeout=300.0  # 5 минут для видео
                 )
 
-                logging.info(f"✅ Минимальные параметры сработали!")
+                generation_log.info("✅ Минимальные параметры сработали!")
 
                 
 
@@ -10143,7 +10528,7 @@ async def generate_video(update, context, state):
 
                 if hasattr(output, '__await__'):
 
-                    logging.info("Получен асинхронный результат, ожидаем...")
+                    generation_log.info("Получен асинхронный результат, ожидаем...")
 
                     output = await output
 
@@ -10151,7 +10536,7 @@ async def generate_video(update, context, state):
 
             except Exception as minimal_error:
 
-                logging.error(f"❌ Минимальные параметры тоже не сработали: {minimal_error}")
+                generation_log.error("❌ Минимальные параметры тоже не сработали: %s", minimal_error)
 
                 raise Exception(f"Ошибка API Replicate: {str(replicate_error)}")
 
@@ -10161,13 +10546,13 @@ async def generate_video(update, context, state):
 
         # output может быть списком, строкой или объектом FileOutput
 
-        logging.info(f"🎬 Replicate API вернул результат:")
+        generation_log.info("🎬 Replicate API вернул результат: %s", type(output).__name__)
 
-        logging.info(f"   Тип: {type(output)}")
+        generation_log.debug("   Тип: %s", type(output))
 
-        logging.info(f"   Значение: {output}")
+        generation_log.debug("   Значение: %s", output)
 
-        logging.info(f"   Длина (если список): {len(output) if isinstance(output, list) else 'N/A'}")
+        generation_log.debug("   Длина (если список): %s", len(output) if isinstance(output, list) else 'N/A')
 
         
 
@@ -10175,15 +10560,15 @@ async def generate_video(update, context, state):
 
         if hasattr(output, '__dict__'):
 
-            logging.info(f"   Атрибуты объекта: {output.__dict__}")
+            generation_log.debug("   Атрибуты объекта: %s", output.__dict__)
 
         if hasattr(output, 'url'):
 
-            logging.info(f"   Метод .url(): {output.url}")
+            generation_log.debug("   Метод .url(): %s", output.url)
 
         if hasattr(output, 'file_path'):
 
-            logging.info(f"   Метод .file_path: {output.file_path}")
+            generation_log.debug("   Метод .file_path: %s", output.file_path)
 
         
 
@@ -10195,7 +10580,7 @@ async def generate_video(update, context, state):
 
                 video_url = output[0]
 
-                logging.info(f"Получен URL из списка: {video_url}")
+                generation_log.info("Получен URL из списка: %s", video_url)
 
             # Если output - это строка (прямой URL)
 
@@ -10203,7 +10588,7 @@ async def generate_video(update, context, state):
 
                 video_url = output
 
-                logging.info(f"Получен URL строкой: {video_url}")
+                generation_log.info("Получен URL строкой: %s", video_url)
 
             # Если output - это объект FileOutput
 
@@ -10211,7 +10596,7 @@ async def generate_video(update, context, state):
 
                 video_url = output.url
 
-                logging.info(f"Получен URL из объекта.url: {video_url}")
+                generation_log.info("Получен URL из объекта.url: %s", video_url)
 
             # Если output - это объект с атрибутом file_path
 
@@ -10219,7 +10604,7 @@ async def generate_video(update, context, state):
 
                 video_url = output.file_path
 
-                logging.info(f"Получен URL из объекта.file_path: {video_url}")
+                generation_log.info("Получен URL из объекта.file_path: %s", video_url)
 
             else:
 
@@ -10227,7 +10612,7 @@ async def generate_video(update, context, state):
 
                 video_url = str(output)
 
-                logging.info(f"Преобразован в строку: {video_url}")
+                generation_log.info("Преобразован в строку: %s", video_url)
 
         else:
 
@@ -10243,7 +10628,7 @@ async def generate_video(update, context, state):
 
         
 
-        logging.info(f"Финальный URL для видео: {video_url}")
+        generation_log.debug("Финальный URL для видео: %s", video_url)
 
         
 
@@ -10251,15 +10636,15 @@ async def generate_video(update, context, state):
 
         file_extension = video_url.split('.')[-1].lower() if '.' in video_url else ''
 
-        logging.info(f"🎬 Анализ файла:")
+        generation_log.debug("🎬 Анализ файла:")
 
-        logging.info(f"   URL: {video_url}")
+        generation_log.debug("   URL: %s", video_url)
 
-        logging.info(f"   Расширение: {file_extension}")
+        generation_log.debug("   Расширение: %s", file_extension)
 
-        logging.info(f"   Содержит 'gif' в URL: {'gif' in video_url.lower()}")
+        generation_log.debug("   Содержит 'gif' в URL: %s", 'gif' in video_url.lower())
 
-        logging.info(f"   Содержит 'mp4' в URL: {'mp4' in video_url.lower()}")
+        generation_log.debug("   Содержит 'mp4' в URL: %s", 'mp4' in video_url.lower())
 
         
 
@@ -10269,7 +10654,7 @@ async def generate_video(update, context, state):
 
         is_video_file = file_extension in video_extensions
 
-        logging.info(f"   Расширение видео: {is_video_file}")
+        generation_log.debug("   Расширение видео: %s", is_video_file)
 
         
 
@@ -10279,15 +10664,15 @@ async def generate_video(update, context, state):
 
             is_video_file = True  # Принудительно считаем GIF как видео
 
-            logging.warning("⚠️ Обнаружен GIF файл в URL! API вернул GIF вместо MP4, но отправляем как видео!")
+            generation_log.warning("⚠️ Обнаружен GIF файл в URL! API вернул GIF вместо MP4, но отправляем как видео!")
 
         elif 'mp4' in video_url.lower():
 
-            logging.info("✅ Обнаружен MP4 файл в URL")
+            generation_log.info("✅ Обнаружен MP4 файл в URL")
 
         else:
 
-            logging.warning(f"⚠️ Неизвестный формат файла: {file_extension}")
+            generation_log.warning("⚠️ Неизвестный формат файла: %s", file_extension)
 
         
 
@@ -10295,12 +10680,12 @@ async def generate_video(update, context, state):
 
         try:
 
-            logging.info("🔍 Проверяем доступность файла...")
+            generation_log.debug("🔍 Проверяем доступность файла...")
 
             async with aiohttp.ClientSession() as session:
                 async with session.head(video_url, timeout=aiohttp.ClientTimeout(total=30)) as head_response:
                     if head_response.status != 200:
-                        logging.warning(f"Файл недоступен (статус: {head_response.status})")
+                        generation_log.warning("Файл недоступен (статус: %s)", head_response.status)
                         # Продолжаем попытку отправки, возможно это временная проблема
                     else:
                         # Анализируем заголовки для определения типа файла
@@ -10309,11 +10694,11 @@ async def generate_video(update, context, state):
 
                 
 
-                logging.info(f"🔍 HTTP заголовки файла:")
+                generation_log.debug("🔍 HTTP заголовки файла:")
 
-                logging.info(f"   Content-Type: {content_type}")
+                generation_log.debug("   Content-Type: %s", content_type)
 
-                logging.info(f"   Content-Length: {content_length}")
+                generation_log.debug("   Content-Length: %s", content_length)
 
                 
 
@@ -10321,15 +10706,15 @@ async def generate_video(update, context, state):
 
                 if 'gif' in content_type.lower():
 
-                    logging.warning("⚠️ Сервер говорит, что это GIF файл!")
+                    generation_log.warning("⚠️ Сервер говорит, что это GIF файл!")
 
                 elif 'mp4' in content_type.lower() or 'video' in content_type.lower():
 
-                    logging.info("✅ Сервер говорит, что это видео файл")
+                    generation_log.info("✅ Сервер говорит, что это видео файл")
 
                 else:
 
-                    logging.warning(f"⚠️ Неизвестный Content-Type: {content_type}")
+                    generation_log.warning("⚠️ Неизвестный Content-Type: %s", content_type)
 
                 
 
@@ -10337,7 +10722,7 @@ async def generate_video(update, context, state):
 
                     file_size_mb = int(content_length) / (1024 * 1024)
 
-                    logging.info(f"   Размер файла: {file_size_mb:.1f} МБ")
+                    generation_log.debug("   Размер файла: %.1f МБ", file_size_mb)
 
                     
 
@@ -10345,15 +10730,15 @@ async def generate_video(update, context, state):
 
                     if file_size_mb > 50:
 
-                        logging.warning(f"Файл превышает лимит Telegram: {file_size_mb:.1f} МБ")
+                        generation_log.warning("Файл превышает лимит Telegram: %.1f МБ", file_size_mb)
 
                     elif file_size_mb > 20:
 
-                        logging.info(f"Файл большой: {file_size_mb:.1f} МБ, могут быть проблемы с отправкой")
+                        generation_log.info("Файл большой: %.1f МБ, могут быть проблемы с отправкой", file_size_mb)
 
         except Exception as check_error:
 
-            logging.warning(f"Не удалось проверить файл: {check_error}")
+            generation_log.warning("Не удалось проверить файл: %s", check_error)
 
             # Продолжаем попытку отправки
 
@@ -10367,7 +10752,7 @@ async def generate_video(update, context, state):
                 async with session.get(video_url, timeout=aiohttp.ClientTimeout(total=10)) as test_response:
                     if test_response.status != 200:
 
-                        logging.error(f"Файл недоступен для скачивания (статус: {test_response.status})")
+                        generation_log.error("Файл недоступен для скачивания (статус: %s)", test_response.status)
                         
                         # Отправляем сообщение с инструкциями
                         await context.bot.send_message(
@@ -10391,7 +10776,7 @@ async def generate_video(update, context, state):
 
         except Exception as test_error:
 
-            logging.warning(f"Не удалось протестировать файл: {test_error}")
+            generation_log.warning("Не удалось протестировать файл: %s", test_error)
 
             # Продолжаем попытку отправки
 
@@ -10417,11 +10802,11 @@ async def generate_video(update, context, state):
 
             await context.bot.delete_message(chat_id=chat_id, message_id=test_msg.message_id)
 
-            logging.info("Чат доступен для отправки сообщений")
+            generation_log.info("Чат доступен для отправки сообщений")
 
         except Exception as chat_error:
 
-            logging.error(f"Проблема с доступом к чату: {chat_error}")
+            generation_log.error("Проблема с доступом к чату: %s", chat_error)
 
             # Отправляем сообщение с инструкциями
 
@@ -10507,17 +10892,15 @@ async def generate_video(update, context, state):
 
         # Метод 1: Отправляем как документ для гарантированной работы
 
-        logging.info(f"📤 Отправляем видео в Telegram:")
+        generation_log.info("📤 Отправляем видео в Telegram: %s", video_url)
 
-        logging.info(f"   URL: {video_url}")
+        generation_log.debug("   Формат файла: %s", file_extension)
 
-        logging.info(f"   Формат файла: {file_extension}")
+        generation_log.debug("   Content-Type: %s", content_type if 'content_type' in locals() else 'не определен')
 
-        logging.info(f"   Content-Type: {content_type if 'content_type' in locals() else 'не определен'}")
+        generation_log.debug("   Размер: %s МБ", file_size_mb if 'file_size_mb' in locals() else 'не определен')
 
-        logging.info(f"   Размер: {file_size_mb if 'file_size_mb' in locals() else 'не определен'} МБ")
-
-        logging.info(f"   Метод: send_document")
+        generation_log.debug("   Метод: send_document")
 
         
 
@@ -10548,7 +10931,7 @@ async def generate_video(update, context, state):
 
             video_sent = True
 
-            logging.info("✅ Видео успешно отправлено как документ")
+            generation_log.info("✅ Видео успешно отправлено как документ")
             
             # СПИСЫВАЕМ КРЕДИТЫ ЗА ВИДЕО
             if user_id:
@@ -10577,9 +10960,9 @@ async def generate_video(update, context, state):
                         base_cost = 37
                 
                 if await analytics_db_use_credits_async(user_id, base_cost, f"Генерация видео {video_quality} {video_duration}с через Bytedance Seedance 1.0 Pro"):
-                    logging.info(f"Пользователь {user_id} использовал {base_cost} кредитов за видео")
+                    generation_log.info("Пользователь %s использовал %s кредитов за видео", user_id, base_cost)
                 else:
-                    logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+                    generation_log.error("Ошибка списания кредитов для пользователя %s", user_id)
 
             # Очищаем состояние после успешной генерации
             state['step'] = None
@@ -10626,11 +11009,11 @@ async def generate_video(update, context, state):
 
             video_error = e
 
-            logging.error(f"❌ Не удалось отправить как видео: {video_error}")
+            generation_log.error("❌ Не удалось отправить как видео: %s", video_error)
 
-            logging.error(f"   Тип ошибки: {type(video_error).__name__}")
+            generation_log.error("   Тип ошибки: %s", type(video_error).__name__)
 
-            logging.error(f"   Детали ошибки: {str(video_error)}")
+            generation_log.error("   Детали ошибки: %s", str(video_error))
 
             
 
@@ -10656,7 +11039,7 @@ async def generate_video(update, context, state):
 
                 video_sent = True
 
-                logging.info("Видео успешно отправлено как документ (MP4)")
+                generation_log.info("Видео успешно отправлено как документ (MP4)")
                 
                 # СПИСЫВАЕМ КРЕДИТЫ ЗА ВИДЕО
                 if user_id:
@@ -10685,9 +11068,9 @@ async def generate_video(update, context, state):
                             base_cost = 37
                     
                     if await analytics_db_use_credits_async(user_id, base_cost, f"Генерация видео {video_quality} {video_duration}с через Bytedance Seedance 1.0 Pro"):
-                        logging.info(f"Пользователь {user_id} использовал {base_cost} кредитов за видео")
+                        generation_log.info("Пользователь %s использовал %s кредитов за видео", user_id, base_cost)
                     else:
-                        logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+                        generation_log.error("Ошибка списания кредитов для пользователя %s", user_id)
 
                 # Очищаем состояние после успешной генерации
                 state['step'] = None
@@ -10734,7 +11117,7 @@ async def generate_video(update, context, state):
 
                 doc_error = e
 
-                logging.error(f"Не удалось отправить как документ: {doc_error}")
+                generation_log.error("Не удалось отправить как документ: %s", doc_error)
 
             
 
@@ -10742,7 +11125,7 @@ async def generate_video(update, context, state):
 
                 try:
 
-                    logging.info("Пробуем загрузить файл локально и отправить...")
+                    generation_log.info("Пробуем загрузить файл локально и отправить...")
 
                     
 
@@ -10750,8 +11133,6 @@ async def generate_video(update, context, state):
 
                     import tempfile
 
-                    import requests
-
                     
 
                     # Сначала проверяем размер файла
@@ -10763,11 +11144,11 @@ async def generate_video(update, context, state):
 
                                 if content_length:
                                     file_size_mb = int(content_length) / (1024 * 1024)
-                                    logging.info(f"Размер файла: {file_size_mb:.1f} МБ")
+                                    generation_log.info("Размер файла: %.1f МБ", file_size_mb)
                                     
                                     # Проверяем лимиты Telegram
                                     if file_size_mb > 50:
-                                        logging.warning(f"Файл слишком большой для отправки: {file_size_mb:.1f} МБ")
+                                        generation_log.warning("Файл слишком большой для отправки: %.1f МБ", file_size_mb)
                                         # Вместо исключения, отправляем сообщение с рекомендациями
                                         await context.bot.send_message(
                                             chat_id=chat_id,
@@ -10786,10 +11167,10 @@ async def generate_video(update, context, state):
                                             ])
                                         )
                                         video_sent = True
-                                        logging.info("Отправлено сообщение о большом файле")
+                                        generation_log.info("Отправлено сообщение о большом файле")
                                         return  # Выходим из функции
                                     elif file_size_mb > 20:
-                                        logging.info(f"Файл большой ({file_size_mb:.1f} МБ), могут быть проблемы с отправкой")
+                                        generation_log.info("Файл большой (%.1f МБ), могут быть проблемы с отправкой", file_size_mb)
 
                     
 
@@ -10801,7 +11182,7 @@ async def generate_video(update, context, state):
                                 # Создаем временный файл асинхронно
                                 loop = asyncio.get_event_loop()
                                 temp_file_path = await loop.run_in_executor(
-                                    THREAD_POOL,
+                                    FILE_EXECUTOR,
                                     lambda: tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
                                 )
                                 
@@ -10813,7 +11194,7 @@ async def generate_video(update, context, state):
                                         if chunk:
                                             # Записываем chunk в файл асинхронно
                                             await loop.run_in_executor(
-                                                THREAD_POOL,
+                                                FILE_EXECUTOR,
                                                 lambda: open(temp_file_path, 'ab').write(chunk)
                                             )
                                             total_size += len(chunk)
@@ -10822,7 +11203,7 @@ async def generate_video(update, context, state):
                                             if total_size > 50 * 1024 * 1024:  # 50 МБ
                                                 raise Exception("Файл превышает лимит Telegram (50 МБ)")
                                     
-                                logging.info(f"Файл загружен локально: {temp_file_path}, размер: {total_size / (1024*1024):.1f} МБ")
+                                generation_log.info("Файл загружен локально: %s, размер: %.1f МБ", temp_file_path, total_size / (1024*1024))
 
                                 
                                 # Проверяем, что файл действительно создался и имеет размер
@@ -10834,7 +11215,7 @@ async def generate_video(update, context, state):
                                     # Читаем видео файл асинхронно
                                     loop = asyncio.get_event_loop()
                                     video_data = await loop.run_in_executor(
-                                        THREAD_POOL,
+                                        FILE_EXECUTOR,
                                         lambda: open(temp_file_path, 'rb').read()
                                     )
                                     
@@ -10860,7 +11241,7 @@ async def generate_video(update, context, state):
                                     
                                     video_sent = True
 
-                                    logging.info("Видео успешно отправлено из локального файла")
+                                    generation_log.info("Видео успешно отправлено из локального файла")
                                     
                                     # Очищаем состояние после успешной генерации
                                     state['step'] = None
@@ -10873,14 +11254,14 @@ async def generate_video(update, context, state):
 
                                 except Exception as send_error:
 
-                                    logging.error(f"Ошибка при отправке локального файла: {send_error}")
+                                    generation_log.error("Ошибка при отправке локального файла: %s", send_error)
                                     
                                     # Попробуем отправить как документ
                                     try:
                                         # Читаем видео файл асинхронно
                                         loop = asyncio.get_event_loop()
                                         video_data = await loop.run_in_executor(
-                                            THREAD_POOL,
+                                            FILE_EXECUTOR,
                                             lambda: open(temp_file_path, 'rb').read()
                                         )
                                         
@@ -10898,7 +11279,7 @@ async def generate_video(update, context, state):
                                             )
 
                                         video_sent = True
-                                        logging.info("Видео успешно отправлено как документ из локального файла")
+                                        generation_log.info("Видео успешно отправлено как документ из локального файла")
                                             
                                         # Очищаем состояние после успешной генерации
                                         state['step'] = None
@@ -10910,7 +11291,7 @@ async def generate_video(update, context, state):
                                         state.pop('enhanced_prompt', None)
                                             
                                     except Exception as doc_error:
-                                        logging.error(f"Ошибка при отправке как документ: {doc_error}")
+                                        generation_log.error("Ошибка при отправке как документ: %s", doc_error)
                                         # Отправляем ссылку как последний вариант
                                         await context.bot.send_message(
                                             chat_id=chat_id,
@@ -10952,9 +11333,9 @@ async def generate_video(update, context, state):
                                             base_cost = 37
                                     
                                     if await analytics_db_use_credits_async(user_id, base_cost, f"Генерация видео {video_quality} {video_duration}с через Bytedance Seedance 1.0 Pro"):
-                                        logging.info(f"Пользователь {user_id} использовал {base_cost} кредитов за видео")
+                                        generation_log.info("Пользователь %s использовал %s кредитов за видео", user_id, base_cost)
                                     else:
-                                        logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+                                        generation_log.error("Ошибка списания кредитов для пользователя %s", user_id)
 
 
                         
@@ -10967,13 +11348,13 @@ async def generate_video(update, context, state):
 
                         except Exception as cleanup_error:
 
-                            logging.warning(f"Не удалось удалить временный файл: {cleanup_error}")
+                            generation_log.warning("Не удалось удалить временный файл: %s", cleanup_error)
 
                 except Exception as e:
 
                     local_error = e
 
-                    logging.error(f"Не удалось отправить из локального файла: {local_error}")
+                    generation_log.error("Не удалось отправить из локального файла: %s", local_error)
 
                     
 
@@ -11004,7 +11385,7 @@ async def generate_video(update, context, state):
 
                             video_sent = True
 
-                            logging.info("Видео успешно отправлено как документ")
+                            generation_log.info("Видео успешно отправлено как документ")
                             
                             # Очищаем состояние после успешной генерации
                             state['step'] = None
@@ -11042,9 +11423,9 @@ async def generate_video(update, context, state):
                                         base_cost = 37
                                 
                                 if await analytics_db_use_credits_async(user_id, base_cost, f"Генерация видео {video_quality} {video_duration}с через Bytedance Seedance 1.0 Pro"):
-                                    logging.info(f"Пользователь {user_id} использовал {base_cost} кредитов за видео")
+                                    generation_log.info("Пользователь %s использовал %s кредитов за видео", user_id, base_cost)
                                 else:
-                                    logging.error(f"Ошибка списания кредитов для пользователя {user_id}")
+                                    generation_log.error("Ошибка списания кредитов для пользователя %s", user_id)
 
                             # Даже если GIF отправился, отправляем ссылку на MP4
 
@@ -11082,7 +11463,7 @@ async def generate_video(update, context, state):
 
                             anim_error = e
 
-                            logging.error(f"Не удалось отправить как документ: {anim_error}")
+                            generation_log.error("Не удалось отправить как документ: %s", anim_error)
 
         
 
@@ -11092,23 +11473,23 @@ async def generate_video(update, context, state):
 
             # Логируем все ошибки для диагностики
 
-            logging.error("Все методы отправки видео не удались:")
+            generation_log.error("Все методы отправки видео не удались:")
 
             if video_error:
 
-                logging.error(f"Ошибка send_document: {video_error}")
+                generation_log.error("Ошибка send_document: %s", video_error)
 
             if doc_error:
 
-                logging.error(f"Ошибка send_document: {doc_error}")
+                generation_log.error("Ошибка send_document: %s", doc_error)
 
             if local_error:
 
-                logging.error(f"Ошибка локальной отправки: {local_error}")
+                generation_log.error("Ошибка локальной отправки: %s", local_error)
 
             if anim_error:
 
-                logging.error(f"Ошибка send_document: {anim_error}")
+                generation_log.error("Ошибка send_document: %s", anim_error)
 
             
 
@@ -11304,7 +11685,7 @@ async def generate_video(update, context, state):
 
             )
 
-            logging.info("Отправлена ссылка на видео с инструкциями")
+            generation_log.info("Отправлена ссылка на видео с инструкциями")
 
         
 
@@ -11354,7 +11735,7 @@ async def generate_video(update, context, state):
 
     except Exception as e:
 
-        logging.error(f"Ошибка при генерации видео: {e}")
+        generation_log.error("Ошибка при генерации видео: %s", e)
 
         
 
@@ -11638,41 +12019,41 @@ async def generate_video(update, context, state):
 
         # Итоговое логирование результата
 
-        logging.info(f"🎬 ИТОГОВЫЙ РЕЗУЛЬТАТ генерации видео:")
+        generation_log.info("🎬 ИТОГОВЫЙ РЕЗУЛЬТАТ генерации видео: отправлено %s", video_sent if 'video_sent' in locals() else 'не определен')
 
-        logging.info(f"   Тип видео: {video_type}")
+        generation_log.debug("   Тип видео: %s", video_type)
 
-        logging.info(f"   Качество: {video_quality}")
+        generation_log.debug("   Качество: %s", video_quality)
 
-        logging.info(f"   Длительность: {video_duration}")
+        generation_log.debug("   Длительность: %s", video_duration)
 
-        logging.info(f"   Aspect ratio: {state.get('aspect_ratio', 'не указан')}")
+        generation_log.debug("   Aspect ratio: %s", state.get('aspect_ratio', 'не указан'))
 
-        logging.info(f"   URL файла: {video_url if 'video_url' in locals() else 'не определен'}")
+        generation_log.debug("   URL файла: %s", video_url if 'video_url' in locals() else 'не определен')
 
-        logging.info(f"   Формат файла: {file_extension if 'file_extension' in locals() else 'не определен'}")
+        generation_log.debug("   Формат файла: %s", file_extension if 'file_extension' in locals() else 'не определен')
 
-        logging.info(f"   Видео отправлено: {video_sent if 'video_sent' in locals() else 'не определен'}")
+        generation_log.debug("   Видео отправлено: %s", video_sent if 'video_sent' in locals() else 'не определен')
 
         if 'video_sent' in locals() and not video_sent:
 
-            logging.error(f"   Ошибки отправки:")
+            generation_log.error("   Ошибки отправки:")
 
             if 'video_error' in locals() and video_error:
 
-                logging.error(f"     send_document: {video_error}")
+                generation_log.error("     send_document: %s", video_error)
 
             if 'doc_error' in locals() and doc_error:
 
-                logging.error(f"     send_document: {doc_error}")
+                generation_log.error("     send_document: %s", doc_error)
 
             if 'local_error' in locals() and local_error:
 
-                logging.error(f"     локальная отправка: {local_error}")
+                generation_log.error("     локальная отправка: %s", local_error)
 
             if 'anim_error' in locals() and anim_error:
 
-                logging.error(f"     send_document: {anim_error}")
+                generation_log.error("     send_document: %s", anim_error)
 
         
 
@@ -11708,15 +12089,15 @@ async def show_subscription_menu(update: Update, context: ContextTypes.DEFAULT_T
 
     # Получаем информацию о пользователе
 
-    limits = await analytics_db_get_user_limits_async(user_id)
+    entitlements = await analytics_db_get_user_entitlements_async(user_id)
 
-    credits = await analytics_db_get_user_credits_async(user_id)
+    credits = {'balance': entitlements['balance']}
 
     
 
     # Формируем текст статуса
 
-    free_generations_left = await analytics_db_get_free_generations_left_async(user_id)
+    free_generations_left = entitlements['free_generations_left']
 
     
 
@@ -11937,23 +12318,15 @@ async def handle_credit_purchase(update: Update, context: ContextTypes.DEFAULT_T
 
     try:
 
-        from betatransfer_api import betatransfer_api
-
-        
-
         # Создаем платеж асинхронно
 
         logging.info(f"Создание платежа для пакета: {package['credits']} кредитов за {package['price']} сом")
 
-        loop = asyncio.get_event_loop()
-        payment_result = await loop.run_in_executor(
-            THREAD_POOL,
-            lambda: betatransfer_api.create_payment(
-                amount=package['price'],
-                currency=package['currency'],
-                description=f"Пакет кредитов: {package['name']} ({package['credits']} кредитов)",
-                payer_id=str(user_id)
-            )
+        payment_result = await async_betatransfer_api.create_payment(
+            amount=package['price'],
+            currency=package['currency'],
+            description=f"Пакет кредитов: {package['name']} ({package['credits']} кредитов)",
+            payer_id=str(user_id)
         )
 
         logging.info(f"Результат создания платежа: {'успешно' if 'error' not in payment_result else 'ошибка'}")
@@ -12082,14 +12455,8 @@ async def check_payment_status(update: Update, context: ContextTypes.DEFAULT_TYP
 
     try:
 
-        from betatransfer_api import betatransfer_api
-        
         # Получаем статус платежа асинхронно
-        loop = asyncio.get_event_loop()
-        payment_status = await loop.run_in_executor(
-            THREAD_POOL,
-            lambda: betatransfer_api.get_payment_status(payment_id)
-        )
+        payment_status = await async_betatransfer_api.get_payment_status(payment_id)
 
         
 
@@ -12265,61 +12632,40 @@ async def activate_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, p
 
 
 
-def main():
-
-    import os
-
-    from dotenv import load_dotenv
-
-    
-
-    # Загружаем переменные из .env файла если он существует
-
-    load_dotenv()
-
-    
-
-    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-
-    if not TOKEN:
-
-        print("❌ ОШИБКА: TELEGRAM_BOT_TOKEN не установлен!")
-
-        print("📝 Установите переменную окружения TELEGRAM_BOT_TOKEN")
-
-        print("💡 Запустите setup_env.py для инструкций")
-
-        return
-
-    
-
-    # Устанавливаем API токен для Replicate если не установлен
-
-    if not os.getenv('REPLICATE_API_TOKEN'):
-
-        print("⚠️ ВНИМАНИЕ: REPLICATE_API_TOKEN не установлен!")
-
-        print("📝 Установите переменную окружения REPLICATE_API_TOKEN")
-
-        print("💡 Для Railway добавьте её в настройках проекта")
-
-        return
-
-    
-
-    # Настройки для улучшения стабильности соединения
-    from telegram.request import HTTPXRequest
+def build_application(token: str, base_url: str = None, base_file_url: str = None,
+                      connection_pool_size: int = 8, post_init=None, post_stop=None, post_shutdown=None):
+    """
+    Создает telegram.ext.Application со всеми обработчиками бота
     
+    Args:
+        token: Токен бота
+        base_url, base_file_url: Адреса Bot API (None - api.telegram.org);
+            нагрузочный тест подставляет локальный сервер
+        connection_pool_size: Размер пула HTTP соединений к Bot API
+        post_init, post_stop, post_shutdown: Колбэки запуска и остановки (только run_polling)
+    """
     # Создаем кастомный HTTP клиент с увеличенными таймаутами
-    request = HTTPXRequest(
-        connection_pool_size=8,
+    # (запросы к Bot API замеряются для /metrics)
+    request = InstrumentedHTTPXRequest(
+        connection_pool_size=connection_pool_size,
         connect_timeout=30.0,
         read_timeout=30.0,
         write_timeout=30.0,
         pool_timeout=30.0
     )
     
-    app = ApplicationBuilder().token(TOKEN).request(request).build()
+    builder = ApplicationBuilder().token(token).request(request)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    if post_init:
+        builder = builder.post_init(post_init)
+    if post_stop:
+        builder = builder.post_stop(post_stop)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    app = builder.build()
     
     # Добавляем обработчик ошибок
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -12333,6 +12679,12 @@ def main():
     app.add_error_handler(error_handler)
 
     
+    # Запись входящих обновлений для replay_updates.py (UPDATE_RECORD_DIR)
+    recorder = update_recorder_from_env()
+    if recorder is not None:
+        app.add_handler(TypeHandler(Update, recorder.handle_update), group=-1)
+
+    
 
     # Добавляем обработчики
 
@@ -12369,12 +12721,72 @@ def main():
     app.add_handler(CommandHandler('pending_payments', pending_payments_command_async))
     app.add_handler(CommandHandler('cleanup_payments', cleanup_payments_command_async))
     app.add_handler(CommandHandler('cleanup_confirm', cleanup_confirm_command_async))
+    app.add_handler(CommandHandler('storage', storage_command))
+    app.add_handler(CommandHandler('slow_traces', slow_traces_command))
+    app.add_handler(CommandHandler('loop_lag', loop_lag_command))
+    app.add_handler(CommandHandler('profile', profile_command))
+    app.add_handler(CommandHandler('heap_snapshot', heap_snapshot_command))
 
     app.add_handler(CallbackQueryHandler(button_handler))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
     app.add_handler(MessageHandler(filters.PHOTO, text_handler))
+    
+    return app
+
+
+def main():
+
+    import os
+
+    from dotenv import load_dotenv
+
+    
+
+    # Загружаем переменные из .env файла если он существует
+
+    load_dotenv()
+
+    
+
+    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+    if not TOKEN:
+
+        print("❌ ОШИБКА: TELEGRAM_BOT_TOKEN не установлен!")
+
+        print("📝 Установите переменную окружения TELEGRAM_BOT_TOKEN")
+
+        print("💡 Запустите setup_env.py для инструкций")
+
+        return
+
+    
+
+    # Устанавливаем API токен для Replicate если не установлен
+
+    if not os.getenv('REPLICATE_API_TOKEN'):
+
+        print("⚠️ ВНИМАНИЕ: REPLICATE_API_TOKEN не установлен!")
+
+        print("📝 Установите переменную окружения REPLICATE_API_TOKEN")
+
+        print("💡 Для Railway добавьте её в настройках проекта")
+
+        return
+
+    
+
+    # Схема базы создается в фоне, пока поднимаются HTTP сервер и webhook
+    analytics_db.start_schema_migration()
+
+    
+
+    # post_init/post_stop/post_shutdown вызываются только в run_polling (локальный запуск);
+    # run_polling сам останавливается по SIGINT/SIGTERM, post_stop дренирует генерации
+    app = build_application(TOKEN, post_init=start_local_services, post_stop=drain_in_flight_jobs,
+                            post_shutdown=stop_local_services)
 
     
 
@@ -12405,6 +12817,15 @@ def main():
 
             
 
+            # Запускаем единый HTTP сервер: webhook, callback платежей и /health.
+            # Сервер поднимается до set_webhook, чтобы первые обновления после деплоя не уходили в пустоту
+            try:
+                web_runner = await start_web_server(app, port, webhook_path=TOKEN)
+                print("✅ Webhook запущен успешно")
+            except Exception as e:
+                logging.error(f"Ошибка запуска webhook: {e}")
+                return
+
             # Устанавливаем webhook
 
             webhook_url = f"https://web-production-3dd82.up.railway.app/{TOKEN}"
@@ -12423,31 +12844,7 @@ def main():
 
                 logging.error(f"Ошибка установки webhook: {e}")
 
-                return
-
-            
-
-            # Запускаем webhook
-
-            try:
-
-                await app.updater.start_webhook(
-
-                    listen="0.0.0.0",
-
-                    port=port,
-
-                    url_path=TOKEN,
-
-                    webhook_url=webhook_url
-
-                )
-
-                print("✅ Webhook запущен успешно")
-
-            except Exception as e:
-
-                logging.error(f"Ошибка запуска webhook: {e}")
+                await web_runner.cleanup()
 
                 return
 
@@ -12457,6 +12854,8 @@ def main():
 
             print(f"🔑 Token: {TOKEN[:10]}...")
 
+            print("🌐 Callback платежей доступен по /payment/ca на том же порту")
+
             
 
             # Проверяем статус webhook
@@ -12473,31 +12872,42 @@ def main():
 
             
 
-            # Запускаем Flask сервер для callback в отдельном потоке
-            import threading
-            def run_flask():
-                flask_app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
-            
-            flask_thread = threading.Thread(target=run_flask, daemon=True)
-            flask_thread.start()
-            print("🌐 Flask callback сервер запущен на порту 5000")
-            
             # Запускаем периодическую проверку платежей
-            payment_polling_task = asyncio.create_task(start_payment_polling())
-            print("🔄 [SYSTEM] Автоматическая проверка платежей запущена (каждые 45 секунд)")
+            # (задачи хранятся в bot_data, чтобы остановка была общей со stop_local_services)
+            app.bot_data['web_runner'] = web_runner
+            app.bot_data['payment_polling_task'] = asyncio.create_task(start_payment_polling())
+            print("🔄 [SYSTEM] Автоматическая проверка платежей запущена (адаптивный интервал)")
+            app.bot_data['notification_task'] = asyncio.create_task(start_notification_dispatcher())
+            print("📬 [SYSTEM] Диспетчер уведомлений запущен")
+            app.bot_data['latency_sketch_task'] = asyncio.create_task(start_latency_sketch_flush())
+            if RETENTION_ENABLED:
+                app.bot_data['retention_task'] = asyncio.create_task(start_retention_job())
+            if LOOP_MONITOR_ENABLED:
+                loop_monitor.start()
+            # SDK генераций догружаются в фоне, чтобы первая генерация не ждала импорт в event loop
+            preload_in_background([openai, replicate])
+            # Генерации, прерванные прошлой остановкой и оставшиеся без предложения повторить
+            asyncio.create_task(notify_interrupted_jobs(app.bot))
             print("📊 [SYSTEM] В Railway deploy logs будут видны все операции с платежами")
 
-            # Держим приложение запущенным
-
-            try:
-
-                await asyncio.Event().wait()
+            # Держим приложение запущенным до SIGTERM (редеплой Railway) или SIGINT
+            stop_signal = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop_signal.set)
+            await stop_signal.wait()
+            shutdown_started = time.perf_counter()
+            logging.info(f"🛑 Получен сигнал остановки, генераций в работе: {job_coordinator.running}")
 
-            except KeyboardInterrupt:
-                # Закрываем HTTP сессию при завершении
-                await close_http_session()
-                print("✅ HTTP сессия закрыта")
-                pass
+            # Новые генерации не запускаем, новые обновления не принимаем:
+            # Telegram повторит доставку, и их обработает новый экземпляр
+            job_coordinator.accepting = False
+            await app.bot_data.pop('web_runner').cleanup()
+            await app.stop()
+            await drain_in_flight_jobs(app)
+            await app.shutdown()
+            await stop_local_services(app)
+            print(f"👋 Бот остановлен за {time.perf_counter() - shutdown_started:.1f} с")
 
         
 
@@ -12508,39 +12918,55 @@ def main():
         # Запускаем локально с polling
 
         print("🚀 Бот запущен локально с polling")
-        
-        # Инициализируем HTTP сессию для асинхронных запросов
-        async def init_http():
-            await init_http_session()
-            print("✅ HTTP сессия инициализирована")
-        
-        asyncio.run(init_http())
-        
-        # Запускаем Flask сервер для callback в отдельном потоке
-        import threading
-        def run_flask():
-            flask_app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
-        
-        flask_thread = threading.Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        print("🌐 Flask callback сервер запущен на порту 5000")
-        
-        # Запускаем периодическую проверку платежей в отдельном потоке
-        def run_payment_polling():
-            asyncio.run(start_payment_polling())
-        
-        polling_thread = threading.Thread(target=run_payment_polling, daemon=True)
-        polling_thread.start()
-        print("🔄 [SYSTEM] Автоматическая проверка платежей запущена (каждые 45 секунд)")
-        print("📊 [SYSTEM] В консоли будут видны все операции с платежами")
 
         try:
             app.run_polling()
         except KeyboardInterrupt:
-            # Закрываем HTTP сессию при завершении
-            asyncio.run(close_http_session())
-            print("✅ HTTP сессия закрыта")
-            print("👋 Бот остановлен")
+            pass
+        print("👋 Бот остановлен")
+
+
+async def start_local_services(application):
+    """Запускает HTTP сессию, сервер callback и проверку платежей в event loop бота (локальный запуск)"""
+    await init_http_session()
+    print("✅ HTTP сессия инициализирована")
+    
+    application.bot_data['web_runner'] = await start_web_server(application, CALLBACK_PORT)
+    print(f"🌐 Callback сервер запущен на порту {CALLBACK_PORT}")
+    
+    application.bot_data['payment_polling_task'] = asyncio.create_task(start_payment_polling())
+    print("🔄 [SYSTEM] Автоматическая проверка платежей запущена (адаптивный интервал)")
+    print("📊 [SYSTEM] В консоли будут видны все операции с платежами")
+    
+    application.bot_data['notification_task'] = asyncio.create_task(start_notification_dispatcher())
+    print("📬 [SYSTEM] Диспетчер уведомлений запущен")
+    application.bot_data['latency_sketch_task'] = asyncio.create_task(start_latency_sketch_flush())
+    if RETENTION_ENABLED:
+        application.bot_data['retention_task'] = asyncio.create_task(start_retention_job())
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    preload_in_background([openai, replicate])
+    asyncio.create_task(notify_interrupted_jobs(application.bot))
+
+
+async def stop_local_services(application):
+    """Останавливает сервисы, запущенные в start_local_services (и в start_webhook)"""
+    for task_name in ('payment_polling_task', 'notification_task', 'latency_sketch_task', 'retention_task'):
+        task = application.bot_data.pop(task_name, None)
+        if task:
+            task.cancel()
+    loop_monitor.stop()
+    web_runner = application.bot_data.pop('web_runner', None)
+    if web_runner:
+        await web_runner.cleanup()
+    await close_http_session()
+    print("✅ HTTP сессия закрыта")
+    await flush_telemetry()
+    # Дожидаемся задач в пулах потоков (база - последней). Генерации уже дренированы,
+    # поэтому срок короткий: Railway присылает SIGKILL через 30 с после SIGTERM
+    await asyncio.get_event_loop().run_in_executor(None, lambda: shutdown_executors(timeout=5.0))
+    # Последним дописываем очередь логов: после этого записи уже не выводятся
+    stop_logging()
 
 
 
@@ -12669,16 +13095,16 @@ async def add_credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"💳 **Новый баланс:** {new_credits} кредитов"
     )
     
-    # Уведомляем пользователя (если возможно)
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🎉 **Вам начислено {credits_to_add} кредитов!**\n\n"
-                 f"💳 **Текущий баланс:** {new_credits} кредитов\n\n"
-                 f"Спасибо за использование нашего бота! 🚀"
-        )
-    except Exception as e:
-        logging.warning(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+    # Уведомляем пользователя через очередь уведомлений
+    queued = await analytics_db_enqueue_notification_async(
+        user_id,
+        f"🎉 **Вам начислено {credits_to_add} кредитов!**\n\n"
+        f"💳 **Текущий баланс:** {new_credits} кредитов\n\n"
+        f"Спасибо за использование нашего бота! 🚀",
+        parse_mode=None
+    )
+    if not queued:
+        logging.warning(f"Не удалось поставить уведомление пользователю {user_id} в очередь")
 
 
 async def my_balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -13048,13 +13474,6 @@ async def cleanup_confirm_command(update: Update, context: ContextTypes.DEFAULT_
             order_id = payment.get('order_id', 'N/A')
             
             try:
-                # Помечаем как timeout
-                await analytics_db_update_payment_status_async(payment_id, 'timeout')
-                
-                print(f"⏰ [CLEANUP] Платеж {payment_id} (Order: {order_id}) помечен как timeout")
-                logging.info(f"⏰ [CLEANUP] Платеж {payment_id} (Order: {order_id}) помечен как timeout")
-                
-                # Уведомляем пользователя
                 timeout_message = (
                     f"⏰ **Время оплаты истекло**\n\n"
                     f"💰 **Сумма:** {amount} {currency}\n"
@@ -13062,9 +13481,15 @@ async def cleanup_confirm_command(update: Update, context: ContextTypes.DEFAULT_
                     f"Для пополнения баланса создайте новый платеж."
                 )
                 
-                await send_telegram_notification(user_id, timeout_message)
-                print(f"📱 [CLEANUP] Уведомление отправлено пользователю {user_id}")
-                logging.info(f"📱 [CLEANUP] Уведомление отправлено пользователю {user_id}")
+                # Помечаем как timeout и ставим уведомление пользователю в очередь
+                settlement = await analytics_db_settle_payment_async(payment_id, 'timeout', timeout_message)
+                if not settlement['applied']:
+                    continue
+                
+                print(f"⏰ [CLEANUP] Платеж {payment_id} (Order: {order_id}) помечен как timeout")
+                logging.info(f"⏰ [CLEANUP] Платеж {payment_id} (Order: {order_id}) помечен как timeout")
+                print(f"📱 [CLEANUP] Уведомление поставлено в очередь для пользователя {user_id}")
+                logging.info(f"📱 [CLEANUP] Уведомление поставлено в очередь для пользователя {user_id}")
                 
                 cleaned_count += 1
                 
@@ -13091,6 +13516,222 @@ async def cleanup_confirm_command(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(f"❌ **Ошибка очистки:**\n\n{str(e)}")
 
 
+async def storage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для просмотра размеров таблиц и состояния архивов (только для админа)"""
+    ADMIN_USER_ID = 7735323051  # Ваш ID
+    
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    try:
+        loop = asyncio.get_event_loop()
+        
+        # /storage run - запустить архивацию немедленно
+        if context.args and context.args[0] == 'run':
+            if not retention_manager.configured:
+                await update.message.reply_text(
+                    "❌ ARCHIVE_DIR не задан: архивация удаляет строки только после записи архива "
+                    "на постоянный том. Укажите ARCHIVE_DIR и повторите."
+                )
+                return
+            await update.message.reply_text("🗄️ Запускаю архивацию старых периодов...")
+            results = await loop.run_in_executor(DB_EXECUTOR, retention_manager.run)
+            if results:
+                lines = []
+                for result in results:
+                    if 'error' in result:
+                        lines.append(f"❌ {result['table']} {result['period']}: {result['error']}")
+                    else:
+                        lines.append(f"✅ {result['table']} {result['period']}: удалено {result['deleted']}")
+                await update.message.reply_text("🗄️ **Архивация завершена:**\n\n" + "\n".join(lines))
+            else:
+                await update.message.reply_text("✅ Просроченных периодов нет")
+        
+        report = await loop.run_in_executor(DB_EXECUTOR, retention_manager.storage_report)
+        
+        message = "🗄️ **Хранилище базы данных**\n\n📊 **Таблицы:**\n"
+        for table, info in list(report['tables'].items())[:15]:
+            size = f"{info['bytes'] / (1024 * 1024):.1f} MB" if info['bytes'] is not None else "N/A"
+            message += f"• {table}: {info['rows']:,} строк, {size}\n"
+        
+        message += "\n⏳ **Сроки хранения:**\n"
+        message += (f"• Фоновая архивация: {'включена' if RETENTION_ENABLED else 'выключена'}, "
+                    f"архивы: {report['archive_dir'] or 'ARCHIVE_DIR не задан'}\n")
+        for table, days in report['retention_days'].items():
+            message += f"• {table}: {days} дней\n"
+        
+        message += "\n📦 **Архивы:**\n"
+        if report['archives']:
+            for table, info in report['archives'].items():
+                message += (
+                    f"• {table}: {info['periods']} мес. до {info['last_period']}, "
+                    f"{info['rows']:,} строк, {info['bytes'] / (1024 * 1024):.1f} MB"
+                )
+                if info['unfinished']:
+                    message += f", незавершенных: {info['unfinished']}"
+                message += "\n"
+        else:
+            message += "• Архивов пока нет\n"
+        
+        message += "\nИспользуйте `/storage run` для архивации просроченных периодов."
+        await update.message.reply_text(message)
+        
+    except Exception as e:
+        logging.error(f"Ошибка получения состояния хранилища: {e}")
+        await update.message.reply_text(f"❌ **Ошибка:**\n\n{str(e)}")
+
+async def slow_traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Самые долгие недавние трассы генераций по этапам (только для админа)"""
+    ADMIN_USER_ID = 7735323051  # Ваш ID
+    
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    try:
+        # /slow_traces [количество] [send_images|edit_image]
+        limit = 5
+        name = None
+        for arg in context.args or []:
+            if arg.isdigit():
+                limit = max(1, min(int(arg), 20))
+            else:
+                name = arg
+        
+        traces = tracer.slowest(limit, name)
+        if not traces:
+            await update.message.reply_text("📭 Трасс пока нет")
+            return
+        
+        message = f"🐢 Самые долгие трассы (из последних {len(tracer.recent())}):\n\n"
+        message += "\n\n".join(format_trace(trace, max_spans=8) for trace in traces)
+        # Лимит Telegram на длину сообщения
+        await update.message.reply_text(message[:4000])
+        
+    except Exception as e:
+        logging.error(f"Ошибка получения трасс: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+async def loop_lag_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Задержка event loop и места блокирующих вызовов (только для админа)"""
+    ADMIN_USER_ID = 7735323051  # Ваш ID
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    if not loop_monitor.running:
+        await update.message.reply_text("📭 Мониторинг event loop не запущен (LOOP_MONITOR_ENABLED=false)")
+        return
+    
+    # /loop_lag [количество мест]
+    args = context.args or []
+    limit = max(1, min(int(args[0]), 20)) if args and args[0].isdigit() else 5
+    # Лимит Telegram на длину сообщения
+    await update.message.reply_text(loop_monitor.format_report(limit)[:4000])
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Семплирующий профиль процесса за N секунд в формате collapsed stacks (только для админов)"""
+    user_id = update.effective_user.id
+    
+    # Проверяем, является ли пользователь админом
+    admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
+    if user_id not in admin_ids:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    # /profile [секунды] [loop] - loop: только поток event loop
+    seconds = 30
+    thread_ids = None
+    for arg in context.args or []:
+        if arg.isdigit():
+            seconds = max(1, min(int(arg), sampling_profiler.max_seconds))
+        elif arg == 'loop':
+            # Обработчик выполняется в потоке event loop
+            thread_ids = [threading.get_ident()]
+    
+    if sampling_profiler.running:
+        await update.message.reply_text("⏳ Профилирование уже идет, дождитесь результата")
+        return
+    
+    await update.message.reply_text(f"🔬 Профилирую {seconds} с...")
+    try:
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(FILE_EXECUTOR, lambda: sampling_profiler.profile(seconds, thread_ids))
+        filename = f"profile_{result.started:%Y%m%d_%H%M%S}.collapsed"
+        await update.message.reply_document(
+            document=result.collapsed().encode('utf-8'),
+            filename=filename,
+            caption="Открыть: speedscope.app или flamegraph.pl"
+        )
+        # Лимит Telegram на длину сообщения
+        await update.message.reply_text(result.summary()[:4000])
+    except ProfilerBusyError:
+        await update.message.reply_text("⏳ Профилирование уже идет, дождитесь результата")
+    except Exception as e:
+        logging.error(f"Ошибка профилирования: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+async def heap_snapshot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Снимки tracemalloc и рост памяти по строкам кода (только для админов)"""
+    user_id = update.effective_user.id
+    
+    # Проверяем, является ли пользователь админом
+    admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
+    if user_id not in admin_ids:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    # /heap_snapshot [start|stop]; без аргумента - снимок и разница с предыдущим
+    action = (context.args or [''])[0].lower()
+    timer = context.bot_data.get('heap_trace_timer')
+    try:
+        if action == 'stop':
+            if timer:
+                timer.cancel()
+            heap_profiler.stop()
+            await update.message.reply_text("🧠 Трассировка памяти выключена")
+            return
+        
+        if action == 'start' or not heap_profiler.tracing:
+            loop = asyncio.get_event_loop()
+            started = await loop.run_in_executor(FILE_EXECUTOR, heap_profiler.start)
+            if started:
+                # Трассировка замедляет процесс - выключаем ее сами, если про нее забудут
+                if timer:
+                    timer.cancel()
+                context.bot_data['heap_trace_timer'] = loop.call_later(HEAP_TRACE_MAX_MINUTES * 60, heap_profiler.stop)
+                await update.message.reply_text(
+                    f"🧠 Трассировка памяти включена, базовый снимок снят.\n"
+                    f"Повторите /heap_snapshot под нагрузкой, чтобы увидеть рост. "
+                    f"Выключится сама через {HEAP_TRACE_MAX_MINUTES} мин или по /heap_snapshot stop"
+                )
+                return
+        
+        loop = asyncio.get_event_loop()
+        diff = await loop.run_in_executor(FILE_EXECUTOR, heap_profiler.snapshot_diff)
+        await update.message.reply_text(diff.summary()[:4000])
+        await update.message.reply_document(
+            document=diff.report().encode('utf-8'),
+            filename=f"heap_diff_{datetime.now():%Y%m%d_%H%M%S}.txt"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка снимка памяти: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+
+async def start_retention_job():
+    """Периодически архивирует и удаляет просроченные периоды журналов (RETENTION_ENABLED=true)"""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            results = await loop.run_in_executor(DB_EXECUTOR, retention_manager.run)
+            if results:
+                logging.info(f"🗄️ [RETENTION] Обработано периодов: {len(results)}")
+        except Exception as e:
+            logging.error(f"💥 [RETENTION] Ошибка архивации: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+
 if __name__ == '__main__':
     # Принудительно запускаем миграцию базы данных
     print("🔧 Запуск миграции базы данных...")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Проверка планов горячих запросов AnalyticsDB
+
+Создает схему со всеми миграциями и для каждого горячего запроса выполняет
+EXPLAIN: в плане должны быть ожидаемые для запроса индексы (любой индекс не
+засчитывается - например, поиск платежа по betatransfer_id через индекс
+статуса перебирает все pending платежи). Без DATABASE_URL проверяется
+временная SQLite база, с DATABASE_URL - PostgreSQL (с enable_seqscan = off,
+чтобы на пустых таблицах планировщик показал, есть ли подходящий индекс).
+
+Использование:
+    python check_query_plans.py
+"""
+
+import os
+import re
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if not os.getenv('DATABASE_URL'):
+    # SQLite база создается в текущей директории - работаем во временной
+    os.chdir(tempfile.mkdtemp(prefix="query_plans_"))
+
+from database import AnalyticsDB, SCHEMA_MIGRATIONS
+from data_retention import RetentionManager
+
+
+def pk(table):
+    """Ожидаемый индекс - первичный ключ таблицы"""
+    return f"pk:{table}"
+
+
+# Запросы каталога: (имя в query_catalog, ожидаемые индексы, параметры).
+# SQL берется из db.queries - тот же, что выполняет AnalyticsDB
+CATALOG_QUERIES = [
+    ('payment.by_betatransfer_id', ['idx_payments_betatransfer_id'], ('bt1',)),
+    ('payment.by_order_id', ['idx_payments_order_id'], ('order1',)),
+    ('payment.pending', ['idx_payments_status_created_at'], ()),
+    ('payment.pending_since', ['idx_payments_status_created_at'], ('2024-01-01 00:00:00',)),
+    ('credit_transaction.by_payment',
+     ['idx_credit_transactions_payment_id', 'idx_payments_betatransfer_id'], ('bt1',)),
+    ('entitlements.get', [pk('user_limits'), pk('user_credits')], (1,)),
+    # get_user_stats
+    ('stats.user_generation', [pk('user_generation_stats')], (1,)),
+    # get_global_stats: окно за последние N дней по дневным агрегатам
+    ('stats.recent_generations', [pk('stats_daily')], ('2024-01-01',)),
+    ('stats.recent_active_users', [pk('stats_daily_users')], ('2024-01-01',)),
+    ('stats.recent_models', [pk('stats_daily')], ('2024-01-01',)),
+    ('stats.recent_formats', [pk('stats_daily')], ('2024-01-01',)),
+    ('stats.recent_revenue', [pk('stats_daily_revenue')], ('2024-01-01',)),
+]
+
+# Запросы с блокировками, которые не входят в каталог: SQL расходится по диалектам
+# и повторяет settle_payment и claim_due_notifications.
+# (название, ожидаемые индексы, {диалект: (SQL, параметры)})
+LOCKING_QUERIES = [
+    ('settle_payment', ['idx_payments_betatransfer_id'], {
+        "sqlite": ("SELECT id, user_id, credit_amount, amount, currency FROM payments "
+                   "WHERE betatransfer_id = ? AND +status = 'pending'", ('bt1',)),
+        "postgresql": ("UPDATE payments SET status = %s, completed_at = CURRENT_TIMESTAMP "
+                       "WHERE betatransfer_id = %s AND status = 'pending' "
+                       "RETURNING id, user_id, credit_amount, amount, currency", ('completed', 'bt1')),
+    }),
+    ('claim_due_notifications', ['idx_notification_outbox_due'], {
+        "sqlite": ("SELECT id, user_id, message, parse_mode, attempts + 1 FROM notification_outbox "
+                   "WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP ORDER BY id LIMIT ?", (50,)),
+        "postgresql": ("UPDATE notification_outbox "
+                       "SET next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second', attempts = attempts + 1 "
+                       "WHERE id IN (SELECT id FROM notification_outbox "
+                       "WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP "
+                       "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+                       "RETURNING id, user_id, message, parse_mode, attempts", (60, 50)),
+    }),
+]
+
+
+def retention_queries(db):
+    """Выборки и удаление архивации журналов (RetentionManager) по индексу timestamp"""
+    retention = RetentionManager(db)
+    start, end = '2024-01-01 00:00:00', '2024-02-01 00:00:00'
+    queries = []
+    for table in retention.retention_days:
+        index = [f'idx_{table}_timestamp']
+        queries += [
+            (f'retention.oldest {table}', index, retention.oldest_sql(table), ()),
+            (f'retention.export {table}', index, retention.export_sql(table), (start, end, start, 0, 100)),
+            (f'retention.drop {table}', index, retention.drop_sql(table), (start, end, 100)),
+        ]
+    return queries
+
+
+def hot_queries(db):
+    """Горячие запросы с SQL под диалект базы: (название, ожидаемые индексы, SQL, параметры)"""
+    queries = [(name, indexes, db.queries.sql(name), params) for name, indexes, params in CATALOG_QUERIES]
+    queries += [(name, indexes) + variants[db.db_type] for name, indexes, variants in LOCKING_QUERIES]
+    return queries + retention_queries(db)
+
+
+def sqlite_plan(cursor, sql, params):
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def postgresql_plan(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def uses_index(db_type, plan, index):
+    """Есть ли в плане поиск по индексу (pk:<таблица> - по первичному ключу)"""
+    table = index[3:] if index.startswith('pk:') else None
+    if db_type == "postgresql":
+        # "Index Scan using X on t", "Index Only Scan using X", "Bitmap Index Scan on X"
+        name = f"{table}_pkey" if table else index
+        return any(re.search(rf"Index (Only )?Scan (using|on) {name}\b", line) for line in plan)
+    if table:
+        # Первичный ключ INTEGER PRIMARY KEY - сам rowid, составной - автоиндекс sqlite_autoindex_<таблица>_N
+        pattern = rf"USING (INTEGER PRIMARY KEY|(COVERING )?INDEX sqlite_autoindex_{table}_\d+)"
+    else:
+        pattern = rf"USING (COVERING )?INDEX {index}\b"
+    return any(re.search(pattern, line) for line in plan)
+
+
+def main():
+    db = AnalyticsDB()
+    expected_version = max(version for version, _, _, _ in SCHEMA_MIGRATIONS)
+    schema_version = db.get_schema_version()
+    print(f"🗄️ База: {db.db_type}, версия схемы: {schema_version} (ожидается {expected_version})")
+
+    failures = 0
+    if schema_version != expected_version:
+        print("❌ Применены не все миграции")
+        failures += 1
+
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        if db.db_type == "postgresql":
+            cursor.execute("SET enable_seqscan = off")
+
+        for name, indexes, sql, params in hot_queries(db):
+            if db.db_type == "postgresql":
+                plan = postgresql_plan(cursor, sql, params)
+            else:
+                plan = sqlite_plan(cursor, sql, params)
+
+            missing = [index for index in indexes if not uses_index(db.db_type, plan, index)]
+            if missing:
+                failures += 1
+                print(f"❌ {name}: не используется {', '.join(missing)}")
+                for line in plan:
+                    print(f"     {line}")
+            else:
+                print(f"✅ {name}: {' | '.join(line.strip() for line in plan)}")
+        if db.db_type == "postgresql":
+            # EXPLAIN UPDATE не выполняет запрос, но транзакцию закрываем без изменений
+            conn.rollback()
+
+    if failures:
+        print(f"❌ Проблемных запросов: {failures}")
+        sys.exit(1)
+    print("✅ Все горячие запросы используют ожидаемые индексы")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+Хранение и архивация журналов user_actions, generations и errors
+
+Журналы разбиты на месячные периоды по timestamp. Период, целиком вышедший
+за срок хранения, выгружается в сжатый JSONL архив
+(ARCHIVE_DIR/<таблица>/<таблица>_YYYY-MM.jsonl.gz) и только после успешной
+записи архива удаляется из базы пачками. Ход архивации записывается в
+таблицу archive_log, поэтому прерванный запуск безопасно продолжается.
+
+Агрегаты (stats_*, user_generation_stats, счетчики в users) не зависят от
+удаляемых строк, поэтому статистика после архивации не меняется.
+
+Архивация удаляет данные безвозвратно, поэтому выключена по умолчанию:
+фоновая задача запускается только с RETENTION_ENABLED=true, а строки
+удаляются только если ARCHIVE_DIR явно указывает на постоянный том (диск
+контейнера Railway стирается при каждом редеплое вместе с архивами).
+"""
+
+import gzip
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+# Фоновая архивация (по умолчанию выключена)
+RETENTION_ENABLED = os.getenv('RETENTION_ENABLED', 'false').lower() == 'true'
+# Сроки хранения журналов в базе (дни)
+RETENTION_DAYS = {
+    'user_actions': int(os.getenv('RETENTION_USER_ACTIONS_DAYS', '90')),
+    'generations': int(os.getenv('RETENTION_GENERATIONS_DAYS', '180')),
+    'errors': int(os.getenv('RETENTION_ERRORS_DAYS', '90')),
+}
+# Директория архивов на постоянном томе; пусто - архивация не удаляет строки
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '')
+# Размер пачки при выгрузке и удалении строк
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '5000'))
+# Как часто запускать архивацию в фоне (часы)
+RETENTION_INTERVAL_HOURS = int(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+
+
+def _month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(moment: datetime) -> datetime:
+    return _month_start(_month_start(moment) + timedelta(days=32))
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+class RetentionManager:
+    """Архивация и удаление старых периодов журналов"""
+
+    def __init__(self, db, archive_dir: str = ARCHIVE_DIR, retention_days: Dict[str, int] = None,
+                 batch_size: int = RETENTION_BATCH_SIZE):
+        """
+        Args:
+            db: Экземпляр AnalyticsDB
+            archive_dir: Директория архивов (пусто - архивация отказывается удалять строки)
+            retention_days: Сроки хранения по таблицам (по умолчанию RETENTION_DAYS)
+            batch_size: Размер пачки строк
+        """
+        self.db = db
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days or RETENTION_DAYS
+        self.batch_size = max(1, batch_size)
+
+    @property
+    def configured(self) -> bool:
+        """Задана ли директория архивов, без которой строки не удаляются"""
+        return bool(self.archive_dir)
+
+    @property
+    def _placeholder(self) -> str:
+        return '%s' if self.db.db_type == "postgresql" else '?'
+
+    # SQL архивации по таблице (используется и в check_query_plans.py)
+    def oldest_sql(self, table: str) -> str:
+        return f'SELECT MIN(timestamp) FROM {table}'
+
+    def export_sql(self, table: str) -> str:
+        # Keyset-пагинация по (timestamp, id) идет по индексу timestamp: память и
+        # время пачки не зависят ни от размера периода, ни от размера таблицы
+        p = self._placeholder
+        return f'''
+            SELECT * FROM {table}
+            WHERE timestamp >= {p} AND timestamp < {p} AND (timestamp, id) > ({p}, {p})
+            ORDER BY timestamp, id
+            LIMIT {p}
+        '''
+
+    def drop_sql(self, table: str) -> str:
+        p = self._placeholder
+        return f'''
+            DELETE FROM {table} WHERE id IN (
+                SELECT id FROM {table}
+                WHERE timestamp >= {p} AND timestamp < {p}
+                LIMIT {p}
+            )
+        '''
+
+    def expired_periods(self, table: str, now: datetime = None) -> List[str]:
+        """Месяцы (YYYY-MM), которые целиком старше срока хранения таблицы"""
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.retention_days[table])
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self.oldest_sql(table))
+            oldest = _parse_timestamp(cursor.fetchone()[0])
+        if oldest is None:
+            return []
+
+        periods = []
+        month = _month_start(oldest)
+        while _next_month(month) <= cutoff:
+            periods.append(month.strftime('%Y-%m'))
+            month = _next_month(month)
+        return periods
+
+    def _archive_path(self, table: str, period: str) -> str:
+        return os.path.join(self.archive_dir, table, f"{table}_{period}.jsonl.gz")
+
+    def _log_status(self, table: str, period: str) -> Optional[str]:
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT status FROM archive_log WHERE table_name = {self._placeholder} AND period = {self._placeholder}',
+                (table, period)
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def _write_log(self, table: str, period: str, status: str, rows: int = None,
+                   path: str = None, size: int = None):
+        p = self._placeholder
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if status == 'exported':
+                cursor.execute(f'''
+                    INSERT INTO archive_log (table_name, period, status, rows_archived, file_path, file_bytes, archived_at)
+                    VALUES ({p}, {p}, 'exported', {p}, {p}, {p}, CURRENT_TIMESTAMP)
+                    ON CONFLICT (table_name, period) DO UPDATE
+                    SET status = 'exported', rows_archived = EXCLUDED.rows_archived,
+                        file_path = EXCLUDED.file_path, file_bytes = EXCLUDED.file_bytes,
+                        archived_at = CURRENT_TIMESTAMP
+                ''', (table, period, rows, path, size))
+            else:
+                cursor.execute(f'''
+                    UPDATE archive_log SET status = {p}, dropped_at = CURRENT_TIMESTAMP
+                    WHERE table_name = {p} AND period = {p}
+                ''', (status, table, period))
+            conn.commit()
+
+    def _export(self, table: str, start: str, end: str, path: str) -> int:
+        """Выгружает строки периода в gzip JSONL, возвращает число строк"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        sql = self.export_sql(table)
+        rows = 0
+        last_timestamp, last_id = start, 0
+
+        with self.db.get_connection() as conn, gzip.open(temp_path, 'wt', encoding='utf-8') as archive:
+            cursor = conn.cursor()
+            while True:
+                cursor.execute(sql, (start, end, last_timestamp, last_id, self.batch_size))
+                batch = cursor.fetchall()
+                if not batch:
+                    break
+                columns = [description[0] for description in cursor.description]
+                for row in batch:
+                    archive.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                    archive.write('\n')
+                rows += len(batch)
+                last_timestamp = batch[-1][columns.index('timestamp')]
+                last_id = batch[-1][columns.index('id')]
+
+        os.replace(temp_path, path)
+        return rows
+
+    def _drop(self, table: str, start: str, end: str) -> int:
+        """Удаляет строки периода пачками, чтобы не держать длинные блокировки"""
+        sql = self.drop_sql(table)
+        deleted = 0
+        while True:
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql, (start, end, self.batch_size))
+                count = cursor.rowcount
+                conn.commit()
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+
+    def archive_period(self, table: str, period: str) -> Dict:
+        """Архивирует и удаляет один месяц таблицы"""
+        start_dt = datetime.strptime(period, '%Y-%m')
+        start = start_dt.strftime('%Y-%m-%d %H:%M:%S')
+        end = _next_month(start_dt).strftime('%Y-%m-%d %H:%M:%S')
+        path = self._archive_path(table, period)
+
+        status = self._log_status(table, period)
+        rows = None
+        if status == 'exported' and os.path.exists(path):
+            # Предыдущий запуск выгрузил период, но не успел удалить строки -
+            # не перезаписываем полный архив частичным
+            logging.info(f"🗄️ [RETENTION] {table} {period}: архив уже есть, продолжаем удаление")
+        else:
+            rows = self._export(table, start, end, path)
+            self._write_log(table, period, 'exported', rows, path, os.path.getsize(path))
+
+        deleted = self._drop(table, start, end)
+        self._write_log(table, period, 'dropped')
+        logging.info(f"🗄️ [RETENTION] {table} {period}: в архиве {rows if rows is not None else '-'}, удалено {deleted}")
+        return {'table': table, 'period': period, 'archived': rows, 'deleted': deleted, 'path': path}
+
+    def run(self, now: datetime = None) -> List[Dict]:
+        """Архивирует все просроченные периоды всех таблиц"""
+        if not self.configured:
+            logging.warning("⚠️ [RETENTION] ARCHIVE_DIR не задан - архивация пропущена, строки не удаляются")
+            return []
+        results = []
+        for table in self.retention_days:
+            for period in self.expired_periods(table, now):
+                try:
+                    results.append(self.archive_period(table, period))
+                except Exception as e:
+                    logging.error(f"💥 [RETENTION] Ошибка архивации {table} {period}: {e}")
+                    results.append({'table': table, 'period': period, 'error': str(e)})
+                    # Следующие месяцы этой таблицы не трогаем, чтобы не оставить дыр в архиве
+                    break
+        return results
+
+    def storage_report(self) -> Dict:
+        """Размеры таблиц и состояние архивов"""
+        tables = {}
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.db_type == "postgresql":
+                cursor.execute('''
+                    SELECT relname, n_live_tup, pg_total_relation_size(relid)
+                    FROM pg_stat_user_tables
+                    ORDER BY pg_total_relation_size(relid) DESC
+                ''')
+                for name, rows, size in cursor.fetchall():
+                    tables[name] = {'rows': rows, 'bytes': size}
+            else:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+                names = [row[0] for row in cursor.fetchall()]
+                sizes = {}
+                try:
+                    # dbstat есть не во всех сборках SQLite; размер - страницы самой таблицы без индексов
+                    cursor.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')
+                    sizes = dict(cursor.fetchall())
+                except sqlite3.Error:
+                    pass
+                for name in names:
+                    cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+                    tables[name] = {'rows': cursor.fetchone()[0], 'bytes': sizes.get(name)}
+                tables = dict(sorted(tables.items(), key=lambda item: -(item[1]['bytes'] or 0)))
+
+            cursor.execute('''
+                SELECT table_name, COUNT(*), SUM(rows_archived), SUM(file_bytes), MAX(period),
+                       SUM(CASE WHEN status = 'dropped' THEN 0 ELSE 1 END)
+                FROM archive_log
+                GROUP BY table_name
+                ORDER BY table_name
+            ''')
+            archives = {
+                table: {
+                    'periods': periods,
+                    'rows': rows or 0,
+                    'bytes': size or 0,
+                    'last_period': last_period,
+                    'unfinished': unfinished or 0,
+                }
+                for table, periods, rows, size, last_period, unfinished in cursor.fetchall()
+            }
+
+        return {'tables': tables, 'archives': archives, 'retention_days': dict(self.retention_days),
+                'archive_dir': self.archive_dir}
@@ -1,11 +1,350 @@
 import os
+import json
 import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from psycopg2 import sql
 import sqlite3
+from latency_sketch import QuantileSketch
+from query_catalog import QueryCatalog, QUERIES, PreparedConnection
+from metrics import metrics_registry, instrument_methods, DB_BUCKETS
+from tracing import trace_methods
+
+# Пул соединений для запросов каталога: максимум соединений с PostgreSQL
+# и сколько секунд ждать свободного соединения
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# Размер кэша подготовленных выражений на соединение SQLite
+SQLITE_STATEMENT_CACHE_SIZE = 256
+# Через сколько секунд повторять создание схемы после ошибки (база была недоступна)
+SCHEMA_RETRY_SECONDS = float(os.getenv('SCHEMA_RETRY_SECONDS', '30'))
+
+# Метрики базы: время каждого публичного метода AnalyticsDB и состояние пула
+DB_METHOD_DURATION = metrics_registry.histogram(
+    'bot_db_method_duration_seconds', 'Время выполнения методов AnalyticsDB', ['method'], buckets=DB_BUCKETS)
+DB_METHOD_ERRORS = metrics_registry.counter(
+    'bot_db_method_exceptions_total', 'Исключения, вышедшие из методов AnalyticsDB', ['method'])
+DB_QUERY_ERRORS = metrics_registry.counter(
+    'bot_db_query_errors_total', 'Ошибки запросов, перехваченные внутри AnalyticsDB', ['query'])
+DB_POOL_IN_USE = metrics_registry.gauge(
+    'bot_db_pool_connections_in_use', 'Соединения пула PostgreSQL, выданные потокам')
+DB_POOL_WAIT = metrics_registry.histogram(
+    'bot_db_pool_wait_seconds', 'Ожидание свободного соединения пула PostgreSQL', buckets=DB_BUCKETS)
+
+# Время жизни снимка лимитов и баланса пользователя в памяти (секунды).
+# Все списания и зачисления в этом процессе сбрасывают снимок сразу,
+# TTL страхует от изменений, сделанных другими процессами (callback_server.py).
+ENTITLEMENTS_CACHE_TTL = int(os.getenv('ENTITLEMENTS_CACHE_TTL', '60'))
+# Сколько снимков держать в памяти: дольше всех не читавшиеся вытесняются первыми
+ENTITLEMENTS_CACHE_MAX_SIZE = int(os.getenv('ENTITLEMENTS_CACHE_MAX_SIZE', '10000'))
+
+# Статусы платежа, при переходе в которые пользователю зачисляются кредиты
+# ('success' пишет проверка статусов, 'completed' - callback Betatransfer)
+CREDITED_PAYMENT_STATUSES = ('success', 'completed')
+
+# Индексы горячих запросов: одинаковый SQL для SQLite и PostgreSQL
+_HOT_PATH_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_payments_betatransfer_id ON payments (betatransfer_id)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_status_created_at ON payments (status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_order_id ON payments (order_id)',
+    'CREATE INDEX IF NOT EXISTS idx_credit_transactions_payment_id ON credit_transactions (payment_id)',
+    'CREATE INDEX IF NOT EXISTS idx_generations_user_id ON generations (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_generations_timestamp ON generations (timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_user_actions_user_id_timestamp ON user_actions (user_id, timestamp)',
+]
+
+# Версионные миграции схемы: (версия, описание, SQL для SQLite, SQL для PostgreSQL).
+# Каждая миграция применяется один раз и записывается в таблицу schema_version.
+# Новые миграции добавляются только в конец списка со следующим номером.
+SCHEMA_MIGRATIONS = [
+    (1, 'Индексы для горячих запросов платежей, транзакций и аналитики',
+     _HOT_PATH_INDEXES, _HOT_PATH_INDEXES),
+    (2, 'Индекс очереди уведомлений по статусу и времени следующей попытки',
+     ['CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (status, next_attempt_at)'],
+     ['CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (status, next_attempt_at)']),
+    (3, 'Агрегаты статистики по часам и дням с заполнением из истории', [
+        '''CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket TEXT NOT NULL,
+            model_name TEXT NOT NULL DEFAULT '',
+            format_type TEXT NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            images INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            generation_time_sum REAL DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            generation_time_max REAL DEFAULT 0,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily (
+            bucket TEXT NOT NULL,
+            model_name TEXT NOT NULL DEFAULT '',
+            format_type TEXT NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            images INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            generation_time_sum REAL DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            generation_time_max REAL DEFAULT 0,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_totals (
+            day TEXT PRIMARY KEY,
+            active_users INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_revenue (
+            day TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            payments INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0,
+            PRIMARY KEY (day, currency)
+        )''',
+        '''INSERT INTO stats_hourly
+           SELECT strftime('%Y-%m-%d %H:00:00', timestamp), COALESCE(model_name, ''), COALESCE(format_type, ''),
+                  COUNT(*), COALESCE(SUM(image_count), 0),
+                  SUM(CASE WHEN success THEN 1 ELSE 0 END), SUM(CASE WHEN success THEN 0 ELSE 1 END),
+                  COALESCE(SUM(generation_time), 0), COUNT(generation_time), COALESCE(MAX(generation_time), 0)
+           FROM generations WHERE timestamp IS NOT NULL GROUP BY 1, 2, 3''',
+        '''INSERT INTO stats_daily
+           SELECT date(timestamp), COALESCE(model_name, ''), COALESCE(format_type, ''),
+                  COUNT(*), COALESCE(SUM(image_count), 0),
+                  SUM(CASE WHEN success THEN 1 ELSE 0 END), SUM(CASE WHEN success THEN 0 ELSE 1 END),
+                  COALESCE(SUM(generation_time), 0), COUNT(generation_time), COALESCE(MAX(generation_time), 0)
+           FROM generations WHERE timestamp IS NOT NULL GROUP BY 1, 2, 3''',
+        '''INSERT INTO stats_daily_users
+           SELECT DISTINCT date(timestamp), user_id FROM generations
+           WHERE user_id IS NOT NULL AND timestamp IS NOT NULL''',
+        '''INSERT INTO stats_daily_totals (day, active_users, new_users)
+           SELECT day, SUM(active_users), SUM(new_users) FROM (
+               SELECT day, COUNT(*) AS active_users, 0 AS new_users FROM stats_daily_users GROUP BY day
+               UNION ALL
+               SELECT date(first_seen), 0, COUNT(*) FROM users WHERE first_seen IS NOT NULL GROUP BY 1
+           ) GROUP BY day''',
+        '''INSERT INTO stats_daily_revenue
+           SELECT date(COALESCE(completed_at, created_at)), COALESCE(currency, ''), COUNT(*), COALESCE(SUM(amount), 0)
+           FROM payments WHERE status IN ('success', 'completed') GROUP BY 1, 2''',
+    ], [
+        '''CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket TIMESTAMP NOT NULL,
+            model_name VARCHAR(100) NOT NULL DEFAULT '',
+            format_type VARCHAR(50) NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            images INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            generation_time_sum DOUBLE PRECISION DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            generation_time_max DOUBLE PRECISION DEFAULT 0,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily (
+            bucket DATE NOT NULL,
+            model_name VARCHAR(100) NOT NULL DEFAULT '',
+            format_type VARCHAR(50) NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            images INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            generation_time_sum DOUBLE PRECISION DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            generation_time_max DOUBLE PRECISION DEFAULT 0,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_users (
+            day DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            PRIMARY KEY (day, user_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_totals (
+            day DATE PRIMARY KEY,
+            active_users INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily_revenue (
+            day DATE NOT NULL,
+            currency VARCHAR(3) NOT NULL,
+            payments INTEGER DEFAULT 0,
+            revenue DECIMAL(12,2) DEFAULT 0,
+            PRIMARY KEY (day, currency)
+        )''',
+        '''INSERT INTO stats_hourly
+           SELECT date_trunc('hour', g.timestamp), COALESCE(g.model_name, ''), COALESCE(g.format_type, ''),
+                  COUNT(*), COALESCE(SUM(g.image_count), 0),
+                  SUM(CASE WHEN g.success THEN 1 ELSE 0 END), SUM(CASE WHEN g.success THEN 0 ELSE 1 END),
+                  COALESCE(SUM(g.generation_time), 0), COUNT(g.generation_time), COALESCE(MAX(g.generation_time), 0)
+           FROM generations g WHERE g.timestamp IS NOT NULL GROUP BY 1, 2, 3''',
+        '''INSERT INTO stats_daily
+           SELECT CAST(g.timestamp AS DATE), COALESCE(g.model_name, ''), COALESCE(g.format_type, ''),
+                  COUNT(*), COALESCE(SUM(g.image_count), 0),
+                  SUM(CASE WHEN g.success THEN 1 ELSE 0 END), SUM(CASE WHEN g.success THEN 0 ELSE 1 END),
+                  COALESCE(SUM(g.generation_time), 0), COUNT(g.generation_time), COALESCE(MAX(g.generation_time), 0)
+           FROM generations g WHERE g.timestamp IS NOT NULL GROUP BY 1, 2, 3''',
+        '''INSERT INTO stats_daily_users
+           SELECT DISTINCT CAST(g.timestamp AS DATE), g.user_id FROM generations g
+           WHERE g.user_id IS NOT NULL AND g.timestamp IS NOT NULL''',
+        '''INSERT INTO stats_daily_totals (day, active_users, new_users)
+           SELECT day, SUM(active_users), SUM(new_users) FROM (
+               SELECT day, COUNT(*) AS active_users, 0 AS new_users FROM stats_daily_users GROUP BY day
+               UNION ALL
+               SELECT CAST(first_seen AS DATE), 0, COUNT(*) FROM users WHERE first_seen IS NOT NULL GROUP BY 1
+           ) AS totals GROUP BY day''',
+        '''INSERT INTO stats_daily_revenue
+           SELECT CAST(COALESCE(completed_at, created_at) AS DATE), COALESCE(currency, ''), COUNT(*),
+                  COALESCE(SUM(amount), 0)
+           FROM payments WHERE status IN ('success', 'completed') GROUP BY 1, 2''',
+    ]),
+    (4, 'Скетчи квантилей времени генерации по часам, моделям и форматам', [
+        '''CREATE TABLE IF NOT EXISTS latency_sketches (
+            bucket TEXT NOT NULL,
+            model_name TEXT NOT NULL DEFAULT '',
+            format_type TEXT NOT NULL DEFAULT '',
+            sketch TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+    ], [
+        '''CREATE TABLE IF NOT EXISTS latency_sketches (
+            bucket TIMESTAMP NOT NULL,
+            model_name VARCHAR(100) NOT NULL DEFAULT '',
+            format_type VARCHAR(50) NOT NULL DEFAULT '',
+            sketch TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bucket, model_name, format_type)
+        )''',
+    ]),
+    (5, 'Счетчики генераций пользователя по моделям и форматам с заполнением из истории', [
+        '''CREATE TABLE IF NOT EXISTS user_generation_stats (
+            user_id INTEGER NOT NULL,
+            model_name TEXT NOT NULL DEFAULT '',
+            format_type TEXT NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            generation_time_sum REAL DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, model_name, format_type)
+        )''',
+        '''INSERT INTO user_generation_stats
+           SELECT user_id, COALESCE(model_name, ''), COALESCE(format_type, ''), COUNT(*),
+                  SUM(CASE WHEN success THEN 1 ELSE 0 END),
+                  COALESCE(SUM(generation_time), 0), COUNT(generation_time)
+           FROM generations WHERE user_id IS NOT NULL GROUP BY 1, 2, 3''',
+    ], [
+        '''CREATE TABLE IF NOT EXISTS user_generation_stats (
+            user_id BIGINT NOT NULL,
+            model_name VARCHAR(100) NOT NULL DEFAULT '',
+            format_type VARCHAR(50) NOT NULL DEFAULT '',
+            generations INTEGER DEFAULT 0,
+            successes INTEGER DEFAULT 0,
+            generation_time_sum DOUBLE PRECISION DEFAULT 0,
+            generation_time_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, model_name, format_type)
+        )''',
+        '''INSERT INTO user_generation_stats
+           SELECT g.user_id, COALESCE(g.model_name, ''), COALESCE(g.format_type, ''), COUNT(*),
+                  SUM(CASE WHEN g.success THEN 1 ELSE 0 END),
+                  COALESCE(SUM(g.generation_time), 0), COUNT(g.generation_time)
+           FROM generations g WHERE g.user_id IS NOT NULL GROUP BY 1, 2, 3''',
+    ]),
+    (6, 'Журнал архивации старых периодов user_actions, generations и errors', [
+        '''CREATE TABLE IF NOT EXISTS archive_log (
+            table_name TEXT NOT NULL,
+            period TEXT NOT NULL,
+            status TEXT NOT NULL,
+            rows_archived INTEGER,
+            file_path TEXT,
+            file_bytes INTEGER,
+            archived_at TIMESTAMP,
+            dropped_at TIMESTAMP,
+            PRIMARY KEY (table_name, period)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_errors_timestamp ON errors (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_user_actions_timestamp ON user_actions (timestamp)',
+    ], [
+        '''CREATE TABLE IF NOT EXISTS archive_log (
+            table_name VARCHAR(50) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            rows_archived INTEGER,
+            file_path TEXT,
+            file_bytes BIGINT,
+            archived_at TIMESTAMP,
+            dropped_at TIMESTAMP,
+            PRIMARY KEY (table_name, period)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_errors_timestamp ON errors (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_user_actions_timestamp ON user_actions (timestamp)',
+    ]),
+    (7, 'Генерации, прерванные остановкой бота, для возобновления', [
+        '''CREATE TABLE IF NOT EXISTS interrupted_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            charged BOOLEAN DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notified_at TIMESTAMP,
+            resumed_at TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_interrupted_jobs_unnotified ON interrupted_jobs (notified_at, id)',
+    ], [
+        '''CREATE TABLE IF NOT EXISTS interrupted_jobs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            kind VARCHAR(20) NOT NULL,
+            payload TEXT NOT NULL,
+            charged BOOLEAN DEFAULT FALSE,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notified_at TIMESTAMP,
+            resumed_at TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_interrupted_jobs_unnotified ON interrupted_jobs (notified_at, id)',
+    ]),
+    (8, 'Удаление индексов журналов по user_id, которые не читает ни один запрос', [
+        'DROP INDEX IF EXISTS idx_user_actions_user_id_timestamp',
+        'DROP INDEX IF EXISTS idx_generations_user_id',
+    ], [
+        'DROP INDEX IF EXISTS idx_user_actions_user_id_timestamp',
+        'DROP INDEX IF EXISTS idx_generations_user_id',
+    ]),
+]
+
+# Выражения текущего часа и дня для агрегатов статистики в UTC: окна get_daily_stats и
+# get_hourly_stats считаются от datetime.utcnow(). В PostgreSQL LOCALTIMESTAMP и CURRENT_DATE
+# берут TimeZone сессии, поэтому час и день берутся от now() AT TIME ZONE 'UTC'
+STATS_BUCKETS = {
+    "sqlite": {
+        'stats_hourly': "strftime('%Y-%m-%d %H:00:00', 'now')",
+        'stats_daily': "date('now')",
+        'day': "date('now')",
+    },
+    "postgresql": {
+        'stats_hourly': "date_trunc('hour', now() AT TIME ZONE 'UTC')",
+        'stats_daily': "CAST(now() AT TIME ZONE 'UTC' AS DATE)",
+        'day': "CAST(now() AT TIME ZONE 'UTC' AS DATE)",
+    },
+}
+
+# Ключ advisory lock, под которым PostgreSQL применяет миграции
+# (бот и callback_server могут стартовать одновременно)
+SCHEMA_MIGRATION_LOCK_ID = 804221
 
 class AnalyticsDB:
     def __init__(self, db_url: str = None):
@@ -23,40 +362,209 @@ class AnalyticsDB:
         else:
             self.db_type = "postgresql"
         
-        self.init_database()
+        # Кэш снимков {user_id: (expires_at, entitlements)} в порядке последнего чтения (LRU)
+        self._entitlements_cache = OrderedDict()
+        # Чтения из базы в работе {user_id: [число чтений, был ли сброс]}: запись живет,
+        # пока идет хотя бы одно чтение, поэтому словарь не растет с числом пользователей
+        self._entitlements_reads = {}
+        self._entitlements_lock = threading.Lock()
+        
+        # Горячие запросы рендерятся под диалект один раз
+        self.queries = QueryCatalog(self.db_type, QUERIES)
+        # Пул соединений: PostgreSQL - общий пул (создается при первом запросе),
+        # SQLite - долгоживущее соединение на поток
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        self._local = threading.local()
+        
+        # Схема создается один раз: в фоне после старта (start_schema_migration)
+        # или при первом соединении, если фоновая миграция еще не запускалась
+        self._schema_ready = threading.Event()
+        self._schema_lock = threading.Lock()
+        self._schema_failed_at = None
+    
+    def ensure_schema(self) -> bool:
+        """
+        Создает таблицы и применяет миграции, если это еще не сделано
+        
+        Параллельные вызовы ждут одну миграцию. После ошибки повтор не чаще
+        раза в SCHEMA_RETRY_SECONDS, чтобы недоступная база не превращала
+        каждый запрос в новую попытку миграции.
+        """
+        if self._schema_ready.is_set():
+            return True
+        with self._schema_lock:
+            if self._schema_ready.is_set():
+                return True
+            if self._schema_failed_at is not None and time.monotonic() - self._schema_failed_at < SCHEMA_RETRY_SECONDS:
+                return False
+            if self.init_database():
+                self._schema_ready.set()
+                self._schema_failed_at = None
+                return True
+            self._schema_failed_at = time.monotonic()
+            return False
+    
+    def start_schema_migration(self) -> threading.Thread:
+        """Запускает создание схемы в фоновом потоке, чтобы старт бота не ждал базу"""
+        thread = threading.Thread(target=self.ensure_schema, name='db-schema-migration', daemon=True)
+        thread.start()
+        return thread
     
     def get_connection(self):
         """Получение подключения к базе данных"""
+        self.ensure_schema()
+        return self._connect()
+    
+    def _connect(self):
         if self.db_type == "sqlite":
             return sqlite3.connect("bot_analytics.db")
         else:
             return psycopg2.connect(self.db_url)
     
-    def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
+    def _get_pool(self) -> ThreadedConnectionPool:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        1, DB_POOL_SIZE, self.db_url, connection_factory=PreparedConnection
+                    )
+        return self._pool
+    
+    @contextmanager
+    def pooled_connection(self):
+        """
+        Соединение из пула для запросов каталога
+        
+        При выходе транзакция фиксируется. После ошибки соединение PostgreSQL
+        закрывается, а не возвращается в пул: его подготовленные выражения и
+        состояние транзакции неизвестны.
+        """
+        self.ensure_schema()
+        if self.db_type == "sqlite":
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = sqlite3.connect("bot_analytics.db", cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+                self._local.conn = conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return
+        
+        started = time.perf_counter()
+        acquired = self._pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+        DB_POOL_WAIT.observe(time.perf_counter() - started)
+        if not acquired:
+            raise RuntimeError(f"нет свободного соединения в пуле за {DB_POOL_TIMEOUT:g} с")
+        DB_POOL_IN_USE.inc()
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                pool.putconn(conn, close=True)
+                raise
+            pool.putconn(conn)
+        finally:
+            DB_POOL_IN_USE.dec()
+            self._pool_slots.release()
+    
+    def close(self):
+        """Закрывает соединения пула"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
+    def init_database(self) -> bool:
+        """Инициализация базы данных и создание таблиц; False - ошибка"""
+        started = time.perf_counter()
         try:
             if self.db_type == "sqlite":
                 self._init_sqlite()
             else:
                 self._init_postgresql()
-            logging.info("База данных успешно инициализирована")
+            logging.info(f"База данных успешно инициализирована за {time.perf_counter() - started:.2f} с")
+            return True
         except Exception as e:
             logging.error(f"Ошибка инициализации базы данных: {e}")
+            return False
     
     def _init_sqlite(self):
         """Инициализация SQLite базы данных"""
         with sqlite3.connect("bot_analytics.db") as conn:
             cursor = conn.cursor()
             self._create_tables_sqlite(cursor)
+            self._apply_migrations(cursor)
             conn.commit()
     
     def _init_postgresql(self):
         """Инициализация PostgreSQL базы данных"""
-        with self.get_connection() as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             self._create_tables_postgresql(cursor)
+            self._apply_migrations(cursor)
             conn.commit()
     
+    def _apply_migrations(self, cursor):
+        """
+        Применяет миграции из SCHEMA_MIGRATIONS, которых еще нет в schema_version
+        
+        Все миграции выполняются в транзакции вызывающего метода: при ошибке
+        ни одна из них не будет записана как примененная.
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        if self.db_type == "postgresql":
+            # Параллельно стартующие процессы ждут, пока первый применит миграции
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_MIGRATION_LOCK_ID,))
+        else:
+            cursor.execute('BEGIN IMMEDIATE')
+        
+        cursor.execute('SELECT version FROM schema_version')
+        applied = {row[0] for row in cursor.fetchall()}
+        
+        for version, description, sqlite_statements, postgresql_statements in SCHEMA_MIGRATIONS:
+            if version in applied:
+                continue
+            statements = postgresql_statements if self.db_type == "postgresql" else sqlite_statements
+            for statement in statements:
+                cursor.execute(statement)
+            if self.db_type == "postgresql":
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                    (version, description)
+                )
+            else:
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+            logging.info(f"🗄️ Применена миграция схемы {version}: {description}")
+    
+    def get_schema_version(self) -> int:
+        """Возвращает номер последней примененной миграции схемы"""
+        result = self.execute_query('SELECT MAX(version) AS version FROM schema_version', fetch_one=True)
+        if not result:
+            return 0
+        version = result['version'] if isinstance(result, dict) else result[0]
+        return version or 0
+    
     def _create_tables_sqlite(self, cursor):
         """Создание таблиц для SQLite"""
         # Таблица пользователей
@@ -171,6 +679,23 @@ class AnalyticsDB:
                 FOREIGN KEY (payment_id) REFERENCES payments (id)
             )
         ''')
+        
+        # Очередь исходящих уведомлений (outbox)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                parse_mode TEXT,
+                dedupe_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
     
     def _create_tables_postgresql(self, cursor):
         """Создание таблиц для PostgreSQL"""
@@ -286,6 +811,23 @@ class AnalyticsDB:
                 FOREIGN KEY (payment_id) REFERENCES payments (id)
             )
         ''')
+        
+        # Очередь исходящих уведомлений (outbox)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                message TEXT NOT NULL,
+                parse_mode VARCHAR(20),
+                dedupe_key VARCHAR(255) UNIQUE,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
     
     def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
         """Универсальный метод выполнения запросов"""
@@ -312,159 +854,95 @@ class AnalyticsDB:
                     conn.commit()
                     return True
         except Exception as e:
+            DB_QUERY_ERRORS.labels('execute_query').inc()
             logging.error(f"Ошибка выполнения запроса: {e}")
             return None
     
+    def run_query(self, name: str, params=(), fetch_one: bool = False, fetch_all: bool = False):
+        """
+        Выполнение запроса из каталога на соединении пула
+        
+        Returns:
+            fetch_one - namedtuple или None, fetch_all - список namedtuple,
+            иначе True. При ошибке - None
+        """
+        try:
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                if fetch_one:
+                    return self.queries.fetch_one(cursor, name, params)
+                if fetch_all:
+                    return self.queries.fetch_all(cursor, name, params)
+                self.queries.execute(cursor, name, params)
+                return True
+        except Exception as e:
+            DB_QUERY_ERRORS.labels(name).inc()
+            logging.error(f"Ошибка выполнения запроса {name}: {e}")
+            return None
+    
     # Методы для работы с пользователями
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Добавление нового пользователя"""
-        query = '''
-            INSERT INTO users (user_id, username, first_name, last_name)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-        ''' if self.db_type == "postgresql" else '''
-            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-        '''
-        return self.execute_query(query, (user_id, username, first_name, last_name))
+        try:
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                self.queries.execute(cursor, 'user.insert', (user_id, username, first_name, last_name))
+                # Новый пользователь учитывается в дневных агрегатах
+                if cursor.rowcount == 1:
+                    self._increment_daily_totals(cursor, new_users=1)
+                return True
+        except Exception as e:
+            logging.error(f"Ошибка добавления пользователя: {e}")
+            return None
     
     def get_user_info_by_id(self, user_id: int) -> Optional[Dict]:
         """Получает информацию о пользователе по user_id"""
-        query = '''
-            SELECT user_id, username, first_name, last_name
-            FROM users WHERE user_id = %s
-        ''' if self.db_type == "postgresql" else '''
-            SELECT user_id, username, first_name, last_name
-            FROM users WHERE user_id = ?
-        '''
-        result = self.execute_query(query, (user_id,), fetch_one=True)
-        if not result:
-            return None
-        if self.db_type == "postgresql":
-            return {
-                'user_id': result.get('user_id'),
-                'username': result.get('username'),
-                'first_name': result.get('first_name'),
-                'last_name': result.get('last_name'),
-            }
-        else:
-            return {
-                'user_id': result[0],
-                'username': result[1],
-                'first_name': result[2],
-                'last_name': result[3],
-            }
+        row = self.run_query('user.info', (user_id,), fetch_one=True)
+        return row._asdict() if row else None
     
     def update_user_activity(self, user_id: int):
         """Обновление времени последней активности пользователя"""
-        query = '''
-            UPDATE users SET last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = %s
-        ''' if self.db_type == "postgresql" else '''
-            UPDATE users SET last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        '''
-        return self.execute_query(query, (user_id,))
+        return self.run_query('user.touch', (user_id,))
     
     def log_generation(self, user_id: int, model_name: str, format_type: str, 
                       prompt: str, image_count: int, success: bool, 
                       error_message: str = None, generation_time: float = None):
         """Логирование генерации изображения"""
         try:
-            with self.get_connection() as conn:
+            with self.pooled_connection() as conn:
                 cursor = conn.cursor()
                 
                 # Добавляем запись о генерации
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        INSERT INTO generations (user_id, model_name, format_type, prompt, 
-                                               image_count, success, error_message, generation_time)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    ''', (user_id, model_name, format_type, prompt, image_count, success, error_message, generation_time))
-                else:
-                    cursor.execute('''
-                        INSERT INTO generations (user_id, model_name, format_type, prompt, 
-                                               image_count, success, error_message, generation_time)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (user_id, model_name, format_type, prompt, image_count, success, error_message, generation_time))
+                self.queries.execute(cursor, 'generation.insert', (
+                    user_id, model_name, format_type, prompt, image_count, success, error_message, generation_time
+                ))
                 
                 # Обновляем счетчики пользователя
-                if success:
-                    if self.db_type == "postgresql":
-                        cursor.execute('''
-                            UPDATE users SET total_generations = total_generations + 1
-                            WHERE user_id = %s
-                        ''', (user_id,))
-                    else:
-                        cursor.execute('''
-                            UPDATE users SET total_generations = total_generations + 1
-                            WHERE user_id = ?
-                        ''', (user_id,))
-                else:
-                    if self.db_type == "postgresql":
-                        cursor.execute('''
-                            UPDATE users SET total_errors = total_errors + 1
-                            WHERE user_id = %s
-                        ''', (user_id,))
-                    else:
-                        cursor.execute('''
-                            UPDATE users SET total_errors = total_errors + 1
-                            WHERE user_id = ?
-                        ''', (user_id,))
+                self.queries.execute(cursor, 'user.count_generation' if success else 'user.count_error', (user_id,))
                 
-                conn.commit()
+                # Обновляем агрегаты статистики в той же транзакции
+                self._record_generation_rollups(cursor, user_id, model_name, format_type,
+                                                image_count, success, generation_time)
+                self._record_user_generation_stats(cursor, user_id, model_name, format_type,
+                                                   success, generation_time)
         except Exception as e:
             logging.error(f"Ошибка логирования генерации: {e}")
     
     def log_error(self, user_id: int, error_type: str, error_message: str, stack_trace: str = None):
         """Логирование ошибки"""
-        query = '''
-            INSERT INTO errors (user_id, error_type, error_message, stack_trace)
-            VALUES (%s, %s, %s, %s)
-        ''' if self.db_type == "postgresql" else '''
-            INSERT INTO errors (user_id, error_type, error_message, stack_trace)
-            VALUES (?, ?, ?, ?)
-        '''
-        return self.execute_query(query, (user_id, error_type, error_message, stack_trace))
+        return self.run_query('error.insert', (user_id, error_type, error_message, stack_trace))
     
     def log_action(self, user_id: int, action_type: str, action_data: str = None):
         """Логирование действия пользователя"""
-        query = '''
-            INSERT INTO user_actions (user_id, action_type, action_data)
-            VALUES (%s, %s, %s)
-        ''' if self.db_type == "postgresql" else '''
-            INSERT INTO user_actions (user_id, action_type, action_data)
-            VALUES (?, ?, ?)
-        '''
-        return self.execute_query(query, (user_id, action_type, action_data))
+        return self.run_query('action.insert', (user_id, action_type, action_data))
     
     # Методы для работы с лимитами
     def get_user_limits(self, user_id: int) -> Dict:
         """Получение лимитов пользователя"""
-        query = '''
-            SELECT free_generations_used, total_free_generations, last_updated
-            FROM user_limits 
-            WHERE user_id = %s
-        ''' if self.db_type == "postgresql" else '''
-            SELECT free_generations_used, total_free_generations, last_updated
-            FROM user_limits 
-            WHERE user_id = ?
-        '''
-        result = self.execute_query(query, (user_id,), fetch_one=True)
+        result = self.run_query('limits.get', (user_id,), fetch_one=True)
         
         if result:
-            if self.db_type == "postgresql":
-                return {
-                    'free_generations_used': result['free_generations_used'],
-                    'total_free_generations': result['total_free_generations'],
-                    'last_updated': result['last_updated']
-                }
-            else:
-                return {
-                    'free_generations_used': result[0],
-                    'total_free_generations': result[1],
-                    'last_updated': result[2]
-                }
+            return result._asdict()
         else:
             return {
                 'free_generations_used': 0,
@@ -474,17 +952,9 @@ class AnalyticsDB:
     
     def init_user_limits(self, user_id: int):
         """Инициализация лимитов пользователя"""
-        query = '''
-            INSERT INTO user_limits 
-            (user_id, free_generations_used, total_free_generations, last_updated)
-            VALUES (%s, 0, 3, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id) DO NOTHING
-        ''' if self.db_type == "postgresql" else '''
-            INSERT OR IGNORE INTO user_limits 
-            (user_id, free_generations_used, total_free_generations, last_updated)
-            VALUES (?, 0, 3, CURRENT_TIMESTAMP)
-        '''
-        return self.execute_query(query, (user_id,))
+        result = self.run_query('limits.init', (user_id,))
+        self.invalidate_entitlements(user_id)
+        return result
     
     def check_generation_limit(self, user_id: int) -> bool:
         """Проверка лимита генераций для пользователя"""
@@ -557,17 +1027,14 @@ class AnalyticsDB:
                             ''', (user_id,))
                 
                 conn.commit()
+                self.invalidate_entitlements(user_id)
         except Exception as e:
             logging.error(f"Ошибка увеличения счетчика генераций: {e}")
     
     def get_free_generations_left(self, user_id: int) -> int:
         """Получение количества оставшихся бесплатных генераций"""
         try:
-            limits = self.get_user_limits(user_id)
-            if not limits:
-                return 0
-            
-            return max(0, limits['total_free_generations'] - limits['free_generations_used'])
+            return self.get_user_entitlements(user_id)['free_generations_left']
         except Exception as e:
             logging.error(f"Ошибка получения бесплатных генераций: {e}")
             return 0
@@ -615,6 +1082,7 @@ class AnalyticsDB:
                         ''', (user_id,))
                     
                     conn.commit()
+                    self.invalidate_entitlements(user_id)
                     return True
                 
                 # Обновляем счетчик использованных генераций
@@ -636,54 +1104,229 @@ class AnalyticsDB:
                     return False
                 
                 conn.commit()
+                self.invalidate_entitlements(user_id)
                 return True
         except Exception as e:
             logging.error(f"Ошибка увеличения счетчика бесплатных генераций: {e}")
             return False
+
+    def consume_generations(self, user_id: int, count: int, cost_per_item: int,
+                            description: str = "Генерация изображений") -> Dict:
+        """
+        Списывает до count бесплатных генераций и остаток кредитами одной транзакцией
+
+        Args:
+            user_id: ID пользователя
+            count: Количество реально созданных результатов
+            cost_per_item: Стоимость одного результата в кредитах
+            description: Описание транзакции списания кредитов
+
+        Returns:
+            Dict с ключами free_used, credits_used и success
+        """
+        result = {'free_used': 0, 'credits_used': 0, 'success': False}
+        if count <= 0:
+            result['success'] = True
+            return result
+
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.db_type == "postgresql":
+                    # Создаем запись лимитов, если ее нет, и блокируем строку до конца транзакции
+                    cursor.execute('''
+                        INSERT INTO user_limits
+                        (user_id, free_generations_used, total_free_generations, last_updated)
+                        VALUES (%s, 0, 3, CURRENT_TIMESTAMP)
+                        ON CONFLICT (user_id) DO NOTHING
+                    ''', (user_id,))
+                    cursor.execute('''
+                        WITH cur AS (
+                            SELECT user_id,
+                                   LEAST(%s, GREATEST(total_free_generations - free_generations_used, 0)) AS take
+                            FROM user_limits
+                            WHERE user_id = %s
+                            FOR UPDATE
+                        )
+                        UPDATE user_limits u
+                        SET free_generations_used = u.free_generations_used + cur.take,
+                            last_updated = CURRENT_TIMESTAMP
+                        FROM cur
+                        WHERE u.user_id = cur.user_id
+                        RETURNING cur.take
+                    ''', (count, user_id))
+                    take_row = cursor.fetchone()
+                    free_used = take_row[0] if take_row else 0
+                else:
+                    # BEGIN IMMEDIATE сразу берет блокировку записи, чтобы чтение и списание были атомарны
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO user_limits
+                        (user_id, free_generations_used, total_free_generations, last_updated)
+                        VALUES (?, 0, 3, CURRENT_TIMESTAMP)
+                    ''', (user_id,))
+                    cursor.execute('''
+                        SELECT MIN(?, MAX(total_free_generations - free_generations_used, 0))
+                        FROM user_limits
+                        WHERE user_id = ?
+                    ''', (count, user_id))
+                    take_row = cursor.fetchone()
+                    free_used = take_row[0] if take_row else 0
+                    if free_used > 0:
+                        cursor.execute('''
+                            UPDATE user_limits
+                            SET free_generations_used = free_generations_used + ?,
+                                last_updated = CURRENT_TIMESTAMP
+                            WHERE user_id = ?
+                        ''', (free_used, user_id))
+
+                result['free_used'] = free_used
+
+                # Остаток списываем кредитами в той же транзакции
+                remaining = count - free_used
+                if remaining > 0:
+                    total_cost = cost_per_item * remaining
+                    if self.db_type == "postgresql":
+                        cursor.execute('''
+                            UPDATE user_credits
+                            SET credits_balance = credits_balance - %s, total_used = total_used + %s
+                            WHERE user_id = %s AND credits_balance >= %s
+                        ''', (total_cost, total_cost, user_id, total_cost))
+
+                        if cursor.rowcount > 0:
+                            cursor.execute('''
+                                INSERT INTO credit_transactions
+                                (user_id, transaction_type, amount, description)
+                                VALUES (%s, 'usage', %s, %s)
+                            ''', (user_id, total_cost, description))
+                    else:
+                        cursor.execute('''
+                            UPDATE user_credits
+                            SET credits_balance = credits_balance - ?, total_used = total_used + ?
+                            WHERE user_id = ? AND credits_balance >= ?
+                        ''', (total_cost, total_cost, user_id, total_cost))
+
+                        if cursor.rowcount > 0:
+                            cursor.execute('''
+                                INSERT INTO credit_transactions
+                                (user_id, transaction_type, amount, description)
+                                VALUES (?, 'usage', ?, ?)
+                            ''', (user_id, total_cost, description))
+
+                    if cursor.rowcount > 0:
+                        result['credits_used'] = total_cost
+                        result['success'] = True
+                else:
+                    result['success'] = True
+
+                conn.commit()
+                self.invalidate_entitlements(user_id)
+                return result
+        except Exception as e:
+            logging.error(f"Ошибка списания генераций: {e}")
+            return result
+
+    # Снимок лимитов и баланса пользователя
+    def get_cached_entitlements(self, user_id: int) -> Optional[Dict]:
+        """Возвращает снимок из кэша без обращения к базе или None, если его нет"""
+        with self._entitlements_lock:
+            entry = self._entitlements_cache.get(user_id)
+            if not entry:
+                return None
+            expires_at, entitlements = entry
+            if expires_at < time.monotonic():
+                del self._entitlements_cache[user_id]
+                return None
+            self._entitlements_cache.move_to_end(user_id)
+            return dict(entitlements)
+    
+    def invalidate_entitlements(self, user_id: int):
+        """Сбрасывает снимок пользователя после любого списания или зачисления"""
+        with self._entitlements_lock:
+            self._entitlements_cache.pop(user_id, None)
+            reads = self._entitlements_reads.get(user_id)
+            if reads:
+                reads[1] = True
+    
+    def get_user_entitlements(self, user_id: int) -> Dict:
+        """
+        Получение бесплатных генераций и баланса кредитов одним запросом
+        
+        Результат кэшируется в памяти до первого изменения лимитов или кредитов
+        пользователя (или до истечения ENTITLEMENTS_CACHE_TTL). Если во время
+        чтения снимок был сброшен списанием или зачислением, прочитанные
+        значения могли устареть и в кэш не попадают.
+        
+        Returns:
+            Dict с ключами free_generations_left, free_generations_used,
+            total_free_generations, balance, total_purchased, total_used
+        """
+        cached = self.get_cached_entitlements(user_id)
+        if cached is not None:
+            return cached
+        
+        with self._entitlements_lock:
+            reads = self._entitlements_reads.setdefault(user_id, [0, False])
+            reads[0] += 1
+        try:
+            with self.pooled_connection() as conn:
+                row = self.queries.fetch_one(conn.cursor(), 'entitlements.get', (user_id,))
+        except Exception as e:
+            logging.error(f"Ошибка получения лимитов и баланса: {e}")
+            row = None
+        finally:
+            with self._entitlements_lock:
+                reads[0] -= 1
+                invalidated = reads[1]
+                if reads[0] == 0:
+                    del self._entitlements_reads[user_id]
+        if row is None:
+            # Ошибка запроса - не кэшируем
+            return {
+                'free_generations_left': 0,
+                'free_generations_used': 0,
+                'total_free_generations': 3,
+                'balance': 0,
+                'total_purchased': 0,
+                'total_used': 0
+            }
+        
+        # Пользователь без записи лимитов получает стандартные 3 бесплатные генерации
+        used = row[0] if row[0] is not None else 0
+        total = row[1] if row[1] is not None else 3
+        entitlements = {
+            'free_generations_left': max(0, total - used),
+            'free_generations_used': used,
+            'total_free_generations': total,
+            'balance': row[2] or 0,
+            'total_purchased': row[3] or 0,
+            'total_used': row[4] or 0
+        }
+        
+        if not invalidated:
+            with self._entitlements_lock:
+                self._entitlements_cache[user_id] = (time.monotonic() + ENTITLEMENTS_CACHE_TTL, entitlements)
+                self._entitlements_cache.move_to_end(user_id)
+                while len(self._entitlements_cache) > ENTITLEMENTS_CACHE_MAX_SIZE:
+                    self._entitlements_cache.popitem(last=False)
+        return dict(entitlements)
     
     # Методы для работы с кредитами
     def get_user_credits(self, user_id: int) -> Dict:
         """Получение баланса кредитов пользователя"""
-        query = '''
-            SELECT credits_balance, total_purchased, total_used
-            FROM user_credits 
-            WHERE user_id = %s
-        ''' if self.db_type == "postgresql" else '''
-            SELECT credits_balance, total_purchased, total_used
-            FROM user_credits 
-            WHERE user_id = ?
-        '''
-        result = self.execute_query(query, (user_id,), fetch_one=True)
-        
-        if result:
-            if self.db_type == "postgresql":
-                return {
-                    'balance': result['credits_balance'],
-                    'total_purchased': result['total_purchased'],
-                    'total_used': result['total_used']
-                }
-            else:
-                return {
-                    'balance': result[0],
-                    'total_purchased': result[1],
-                    'total_used': result[2]
-                }
-        else:
-            return {'balance': 0, 'total_purchased': 0, 'total_used': 0}
+        entitlements = self.get_user_entitlements(user_id)
+        return {
+            'balance': entitlements['balance'],
+            'total_purchased': entitlements['total_purchased'],
+            'total_used': entitlements['total_used']
+        }
     
     def init_user_credits(self, user_id: int):
         """Инициализация кредитов пользователя"""
-        query = '''
-            INSERT INTO user_credits 
-            (user_id, credits_balance, total_purchased, total_used)
-            VALUES (%s, 0, 0, 0)
-            ON CONFLICT (user_id) DO NOTHING
-        ''' if self.db_type == "postgresql" else '''
-            INSERT OR IGNORE INTO user_credits 
-            (user_id, credits_balance, total_purchased, total_used)
-            VALUES (?, 0, 0, 0)
-        '''
-        return self.execute_query(query, (user_id,))
+        result = self.run_query('credits.init', (user_id,))
+        self.invalidate_entitlements(user_id)
+        return result
     
     def add_credits(self, user_id: int, amount: int, payment_id: int = None, 
                     description: str = "Покупка кредитов"):
@@ -735,6 +1378,7 @@ class AnalyticsDB:
                     ''', (user_id, amount, description, payment_id))
                 
                 conn.commit()
+                self.invalidate_entitlements(user_id)
                 return True
         except Exception as e:
             logging.error(f"Ошибка добавления кредитов: {e}")
@@ -802,6 +1446,7 @@ class AnalyticsDB:
                     ''', (user_id, amount, description))
                 
                 conn.commit()
+                self.invalidate_entitlements(user_id)
                 return True
         except Exception as e:
             logging.error(f"Ошибка использования кредитов: {e}")
@@ -812,49 +1457,555 @@ class AnalyticsDB:
                       payment_id: str = None, order_id: str = None, 
                       credit_amount: int = None) -> bool:
         """Создание записи о платеже"""
+        return self.run_query('payment.insert', (user_id, amount, currency, payment_id, order_id or '', credit_amount or 0))
+    
+    def get_payment_by_order_id(self, order_id: str) -> Optional[Dict]:
+        """Получение информации о платеже по order_id"""
+        result = self.run_query('payment.by_order_id', (order_id,), fetch_one=True)
+        return result._asdict() if result else None
+    
+    def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """Обновление статуса платежа"""
+        return self.run_query('payment.update_status', (status, payment_id))
+    
+    def settle_payment(self, betatransfer_id: str, status: str, notification: str = None) -> Dict:
+        """
+        Переводит pending платеж в финальный статус и при успехе зачисляет кредиты
+        
+        Смена статуса (только из 'pending'), пополнение баланса, запись в
+        credit_transactions и уведомление в notification_outbox выполняются
+        одной транзакцией. Повторный callback или гонка с проверкой статусов
+        сводятся к одному UPDATE без изменений.
+        
+        Args:
+            betatransfer_id: ID платежа в Betatransfer
+            status: Новый статус платежа
+            notification: Текст уведомления пользователю или функция, строящая его
+                по результату (user_id, credit_amount, amount, currency). Уведомление
+                ставится в очередь только если статус платежа действительно изменился
+            
+        Returns:
+            Dict с ключами applied (статус изменен этим вызовом), credited
+            (зачислены кредиты), error (ошибка базы - транзакция не применена,
+            проведение нужно повторить), user_id, credit_amount, amount, currency.
+            applied=False без error - платеж уже проведен или не найден
+        """
+        result = {
+            'applied': False,
+            'credited': False,
+            'error': False,
+            'user_id': None,
+            'credit_amount': 0,
+            'amount': None,
+            'currency': None
+        }
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Compare-and-set: меняем статус только у платежа, который еще pending
+                if self.db_type == "postgresql":
+                    cursor.execute('''
+                        UPDATE payments
+                        SET status = %s, completed_at = CURRENT_TIMESTAMP
+                        WHERE betatransfer_id = %s AND status = 'pending'
+                        RETURNING id, user_id, credit_amount, amount, currency
+                    ''', (status, betatransfer_id))
+                    row = cursor.fetchone()
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    # +status: без статистики SQLite выбирает индекс (status, created_at) и перебирает
+                    # все pending платежи, а искать нужно по idx_payments_betatransfer_id
+                    cursor.execute('''
+                        SELECT id, user_id, credit_amount, amount, currency
+                        FROM payments
+                        WHERE betatransfer_id = ? AND +status = 'pending'
+                    ''', (betatransfer_id,))
+                    row = cursor.fetchone()
+                    if row:
+                        cursor.execute('''
+                            UPDATE payments
+                            SET status = ?, completed_at = CURRENT_TIMESTAMP
+                            WHERE id = ?
+                        ''', (status, row[0]))
+                
+                if not row:
+                    conn.commit()
+                    return result
+                
+                payment_db_id, user_id, credit_amount, amount, currency = row
+                result.update({
+                    'applied': True,
+                    'user_id': user_id,
+                    'credit_amount': credit_amount or 0,
+                    'amount': amount,
+                    'currency': currency
+                })
+                
+                if status in CREDITED_PAYMENT_STATUSES and credit_amount and credit_amount > 0:
+                    description = f"Покупка кредитов (платеж {betatransfer_id})"
+                    if self.db_type == "postgresql":
+                        cursor.execute('''
+                            INSERT INTO user_credits
+                            (user_id, credits_balance, total_purchased, total_used)
+                            VALUES (%s, %s, %s, 0)
+                            ON CONFLICT (user_id) DO UPDATE
+                            SET credits_balance = user_credits.credits_balance + EXCLUDED.credits_balance,
+                                total_purchased = user_credits.total_purchased + EXCLUDED.total_purchased
+                        ''', (user_id, credit_amount, credit_amount))
+                        cursor.execute('''
+                            INSERT INTO credit_transactions
+                            (user_id, transaction_type, amount, description, payment_id)
+                            VALUES (%s, 'purchase', %s, %s, %s)
+                        ''', (user_id, credit_amount, description, payment_db_id))
+                    else:
+                        cursor.execute('''
+                            UPDATE user_credits
+                            SET credits_balance = credits_balance + ?, total_purchased = total_purchased + ?
+                            WHERE user_id = ?
+                        ''', (credit_amount, credit_amount, user_id))
+                        if cursor.rowcount == 0:
+                            cursor.execute('''
+                                INSERT INTO user_credits
+                                (user_id, credits_balance, total_purchased, total_used)
+                                VALUES (?, ?, ?, 0)
+                            ''', (user_id, credit_amount, credit_amount))
+                        cursor.execute('''
+                            INSERT INTO credit_transactions
+                            (user_id, transaction_type, amount, description, payment_id)
+                            VALUES (?, 'purchase', ?, ?, ?)
+                        ''', (user_id, credit_amount, description, payment_db_id))
+                    result['credited'] = True
+                
+                if status in CREDITED_PAYMENT_STATUSES:
+                    self._record_revenue_rollup(cursor, amount, currency)
+                
+                if notification:
+                    message = notification(result) if callable(notification) else notification
+                    self._enqueue_notification(
+                        cursor, user_id, message,
+                        dedupe_key=f"payment:{betatransfer_id}:{status}"
+                    )
+                
+                conn.commit()
+                self.invalidate_entitlements(user_id)
+                return result
+        except Exception as e:
+            logging.error(f"Ошибка проведения платежа {betatransfer_id}: {e}")
+            result.update({'applied': False, 'credited': False, 'error': True})
+            return result
+    
+    # Методы очереди уведомлений (outbox)
+    def _enqueue_notification(self, cursor, user_id: int, message: str,
+                              dedupe_key: str = None, parse_mode: str = 'Markdown'):
+        """Добавляет уведомление в outbox в рамках транзакции вызывающего метода"""
+        self.queries.execute(cursor, 'outbox.insert', (user_id, message, parse_mode, dedupe_key))
+    
+    def enqueue_notification(self, user_id: int, message: str, dedupe_key: str = None,
+                             parse_mode: str = 'Markdown') -> bool:
+        """
+        Ставит уведомление пользователю в очередь отправки
+        
+        Args:
+            user_id: ID пользователя в Telegram
+            message: Текст сообщения
+            dedupe_key: Ключ дедупликации - повторная постановка с тем же ключом игнорируется
+            parse_mode: Режим разметки Telegram
+        """
+        try:
+            with self.pooled_connection() as conn:
+                self._enqueue_notification(conn.cursor(), user_id, message, dedupe_key, parse_mode)
+                return True
+        except Exception as e:
+            logging.error(f"Ошибка постановки уведомления в очередь: {e}")
+            return False
+    
+    def claim_due_notifications(self, limit: int = 50, lease_seconds: int = 60) -> List[Dict]:
+        """
+        Забирает уведомления, готовые к отправке
+        
+        Забранные записи сдвигаются на lease_seconds вперед: если процесс упадет
+        до подтверждения отправки, уведомление будет отправлено повторно.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.db_type == "postgresql":
+                    cursor.execute('''
+                        UPDATE notification_outbox
+                        SET next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second',
+                            attempts = attempts + 1
+                        WHERE id IN (
+                            SELECT id FROM notification_outbox
+                            WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                            ORDER BY id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, user_id, message, parse_mode, attempts
+                    ''', (lease_seconds, limit))
+                    rows = cursor.fetchall()
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('''
+                        SELECT id, user_id, message, parse_mode, attempts + 1
+                        FROM notification_outbox
+                        WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (limit,))
+                    rows = cursor.fetchall()
+                    if rows:
+                        cursor.executemany('''
+                            UPDATE notification_outbox
+                            SET next_attempt_at = datetime('now', ?), attempts = attempts + 1
+                            WHERE id = ?
+                        ''', [(f'+{lease_seconds} seconds', row[0]) for row in rows])
+                conn.commit()
+                
+                columns = ['id', 'user_id', 'message', 'parse_mode', 'attempts']
+                return [dict(zip(columns, row)) for row in sorted(rows)]
+        except Exception as e:
+            logging.error(f"Ошибка получения уведомлений из очереди: {e}")
+            return []
+    
+    def mark_notification_sent(self, notification_id: int):
+        """Отмечает уведомление отправленным"""
+        return self.run_query('outbox.mark_sent', (notification_id,))
+    
+    def reschedule_notification(self, notification_id: int, error: str, delay_seconds: float,
+                                give_up: bool = False):
+        """Откладывает повторную отправку уведомления или помечает его неотправляемым"""
+        status = 'failed' if give_up else 'pending'
+        delay_seconds = int(max(1, delay_seconds))
+        return self.run_query('outbox.reschedule', (status, (error or '')[:1000], delay_seconds, notification_id))
+    
+    # Методы прерванных генераций (дренаж при остановке)
+    def save_interrupted_jobs(self, jobs: List[Dict]) -> List[int]:
+        """
+        Сохраняет генерации, не завершившиеся до остановки бота
+        
+        Args:
+            jobs: Словари user_id, chat_id, kind, payload (dict), charged
+        
+        Returns:
+            ID сохраненных записей (пустой список при ошибке)
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                ids = []
+                for job in jobs:
+                    values = (job['user_id'], job.get('chat_id'), job['kind'],
+                              json.dumps(job['payload'], ensure_ascii=False, default=str), bool(job.get('charged')))
+                    if self.db_type == "postgresql":
+                        cursor.execute('''
+                            INSERT INTO interrupted_jobs (user_id, chat_id, kind, payload, charged)
+                            VALUES (%s, %s, %s, %s, %s) RETURNING id
+                        ''', values)
+                        ids.append(cursor.fetchone()[0])
+                    else:
+                        cursor.execute('''
+                            INSERT INTO interrupted_jobs (user_id, chat_id, kind, payload, charged)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', values)
+                        ids.append(cursor.lastrowid)
+                conn.commit()
+                return ids
+        except Exception as e:
+            logging.error(f"Ошибка сохранения прерванных генераций: {e}")
+            return []
+    
+    def claim_interrupted_job_notifications(self, limit: int = 100) -> List[Dict]:
+        """
+        Забирает прерванные генерации, о которых пользователь еще не знает
+        
+        Запись помечается уведомленной при выборке, чтобы старый и новый
+        процесс при редеплое не отправили одно предложение дважды.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.db_type == "postgresql":
+                    cursor.execute('''
+                        UPDATE interrupted_jobs SET notified_at = CURRENT_TIMESTAMP
+                        WHERE id IN (
+                            SELECT id FROM interrupted_jobs
+                            WHERE notified_at IS NULL
+                            ORDER BY id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, user_id, chat_id, kind, charged
+                    ''', (limit,))
+                    rows = cursor.fetchall()
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('''
+                        SELECT id, user_id, chat_id, kind, charged FROM interrupted_jobs
+                        WHERE notified_at IS NULL
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (limit,))
+                    rows = cursor.fetchall()
+                    if rows:
+                        cursor.executemany(
+                            'UPDATE interrupted_jobs SET notified_at = CURRENT_TIMESTAMP WHERE id = ?',
+                            [(row[0],) for row in rows])
+                conn.commit()
+                
+                columns = ['id', 'user_id', 'chat_id', 'kind', 'charged']
+                return [dict(zip(columns, row)) for row in sorted(rows)]
+        except Exception as e:
+            logging.error(f"Ошибка получения прерванных генераций: {e}")
+            return []
+    
+    def release_interrupted_job_notification(self, job_id: int):
+        """Возвращает запись в очередь уведомлений, если отправить предложение не удалось"""
+        return self.execute_query(
+            'UPDATE interrupted_jobs SET notified_at = NULL WHERE id = %s' if self.db_type == "postgresql"
+            else 'UPDATE interrupted_jobs SET notified_at = NULL WHERE id = ?', (job_id,))
+    
+    def take_interrupted_job(self, job_id: int, user_id: int, max_age_hours: int = 24) -> Optional[Dict]:
+        """
+        Забирает прерванную генерацию пользователя для повторного запуска
+        
+        Возвращает запись один раз: повторное нажатие кнопки и записи старше
+        max_age_hours, а также уже оплаченные генерации возвращают None.
+        """
+        cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.db_type == "postgresql":
+                    cursor.execute('''
+                        UPDATE interrupted_jobs SET status = 'resumed', resumed_at = CURRENT_TIMESTAMP
+                        WHERE id = %s AND user_id = %s AND status = 'pending' AND NOT charged
+                          AND created_at >= %s
+                        RETURNING kind, payload
+                    ''', (job_id, user_id, cutoff))
+                    row = cursor.fetchone()
+                else:
+                    cursor.execute('''
+                        UPDATE interrupted_jobs SET status = 'resumed', resumed_at = CURRENT_TIMESTAMP
+                        WHERE id = ? AND user_id = ? AND status = 'pending' AND NOT charged
+                          AND created_at >= ?
+                    ''', (job_id, user_id, cutoff.strftime('%Y-%m-%d %H:%M:%S')))
+                    row = None
+                    if cursor.rowcount == 1:
+                        cursor.execute('SELECT kind, payload FROM interrupted_jobs WHERE id = ?', (job_id,))
+                        row = cursor.fetchone()
+                conn.commit()
+                if not row:
+                    return None
+                return {'id': job_id, 'kind': row[0], 'payload': json.loads(row[1])}
+        except Exception as e:
+            logging.error(f"Ошибка возобновления генерации {job_id}: {e}")
+            return None
+    
+    # Методы агрегатов статистики (stats_hourly, stats_daily и др.)
+    def _record_generation_rollups(self, cursor, user_id: int, model_name: str, format_type: str,
+                                   image_count: int, success: bool, generation_time: float = None):
+        """Обновляет часовые и дневные агрегаты в транзакции log_generation"""
+        values = (
+            model_name or '', format_type or '', image_count or 0,
+            1 if success else 0, 0 if success else 1,
+            generation_time or 0, 1 if generation_time is not None else 0, generation_time or 0
+        )
+        self.queries.execute(cursor, 'rollup.hourly', values)
+        self.queries.execute(cursor, 'rollup.daily', values)
+        
+        # Уникальные активные пользователи дня: счетчик растет только при первой генерации за день
+        self.queries.execute(cursor, 'rollup.daily_user', (user_id,))
+        if cursor.rowcount == 1:
+            self._increment_daily_totals(cursor, active_users=1)
+    
+    def _record_user_generation_stats(self, cursor, user_id: int, model_name: str, format_type: str,
+                                      success: bool, generation_time: float = None):
+        """Обновляет счетчики пользователя по модели и формату в транзакции log_generation"""
+        self.queries.execute(cursor, 'rollup.user_generation_stats', (
+            user_id, model_name or '', format_type or '', 1 if success else 0,
+            generation_time or 0, 1 if generation_time is not None else 0
+        ))
+    
+    def _increment_daily_totals(self, cursor, active_users: int = 0, new_users: int = 0):
+        """Увеличивает дневные счетчики пользователей"""
+        self.queries.execute(cursor, 'rollup.daily_totals', (active_users, new_users))
+    
+    def _record_revenue_rollup(self, cursor, amount, currency: str):
+        """Учитывает оплаченный платеж в дневной выручке"""
+        self.queries.execute(cursor, 'rollup.revenue', (currency or '', amount or 0))
+    
+    def get_daily_stats(self, days: int = 7) -> List[Tuple]:
+        """
+        Ежедневная статистика из агрегатов: (дата, генераций, пользователей, среднее время)
+        
+        Стоимость запроса пропорциональна числу дней и моделей, а не числу генераций.
+        """
+        date_limit = (datetime.utcnow() - timedelta(days=days)).date().isoformat()
         query = '''
-            INSERT INTO payments 
-            (user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at)
-            VALUES (%s, %s, %s, 'pending', %s, %s, %s, CURRENT_TIMESTAMP)
+            SELECT d.bucket, SUM(d.generations), COALESCE(t.active_users, 0),
+                   SUM(d.generation_time_sum) / NULLIF(SUM(d.generation_time_count), 0)
+            FROM stats_daily d
+            LEFT JOIN stats_daily_totals t ON t.day = d.bucket
+            WHERE d.bucket >= %s
+            GROUP BY d.bucket, t.active_users
+            ORDER BY d.bucket DESC
         ''' if self.db_type == "postgresql" else '''
-            INSERT INTO payments 
-            (user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at)
-            VALUES (?, ?, ?, 'pending', ?, ?, ?, CURRENT_TIMESTAMP)
+            SELECT d.bucket, SUM(d.generations), COALESCE(t.active_users, 0),
+                   SUM(d.generation_time_sum) / NULLIF(SUM(d.generation_time_count), 0)
+            FROM stats_daily d
+            LEFT JOIN stats_daily_totals t ON t.day = d.bucket
+            WHERE d.bucket >= ?
+            GROUP BY d.bucket, t.active_users
+            ORDER BY d.bucket DESC
         '''
-        return self.execute_query(query, (user_id, amount, currency, payment_id, order_id or '', credit_amount or 0))
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, (date_limit,))
+                return [
+                    (str(day), generations or 0, users or 0, float(avg_time) if avg_time is not None else None)
+                    for day, generations, users, avg_time in cursor.fetchall()
+                ]
+        except Exception as e:
+            logging.error(f"Ошибка получения ежедневной статистики: {e}")
+            return []
     
-    def get_payment_by_order_id(self, order_id: str) -> Optional[Dict]:
-        """Получение информации о платеже по order_id"""
+    def get_hourly_stats(self, hours: int = 24) -> List[Tuple]:
+        """Почасовая статистика из агрегатов: (час, генераций, успешных, ошибок, среднее время, максимум)"""
+        time_limit = (datetime.utcnow() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:00:00')
         query = '''
-            SELECT * FROM payments 
-            WHERE order_id = %s
+            SELECT bucket, SUM(generations), SUM(successes), SUM(errors),
+                   SUM(generation_time_sum) / NULLIF(SUM(generation_time_count), 0),
+                   MAX(generation_time_max)
+            FROM stats_hourly
+            WHERE bucket >= %s
+            GROUP BY bucket
+            ORDER BY bucket DESC
         ''' if self.db_type == "postgresql" else '''
-            SELECT * FROM payments 
-            WHERE order_id = ?
+            SELECT bucket, SUM(generations), SUM(successes), SUM(errors),
+                   SUM(generation_time_sum) / NULLIF(SUM(generation_time_count), 0),
+                   MAX(generation_time_max)
+            FROM stats_hourly
+            WHERE bucket >= ?
+            GROUP BY bucket
+            ORDER BY bucket DESC
         '''
-        result = self.execute_query(query, (order_id,), fetch_one=True)
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, (time_limit,))
+                return [
+                    (str(hour), generations or 0, successes or 0, errors or 0,
+                     float(avg_time) if avg_time is not None else None, float(max_time or 0))
+                    for hour, generations, successes, errors, avg_time, max_time in cursor.fetchall()
+                ]
+        except Exception as e:
+            logging.error(f"Ошибка получения почасовой статистики: {e}")
+            return []
+    
+    def merge_latency_sketches(self, items) -> bool:
+        """
+        Сливает накопленные в памяти скетчи времени генерации с сохраненными в базе
         
-        if result and self.db_type == "postgresql":
-            return dict(result)
-        elif result:
-            # Для SQLite возвращаем список колонок
-            columns = ['id', 'user_id', 'amount', 'currency', 'status', 'betatransfer_id', 
-                      'order_id', 'credit_amount', 'payment_method', 'created_at', 'completed_at']
-            return dict(zip(columns, result))
-        return None
+        Args:
+            items: Список (час, модель, формат, QuantileSketch) из LatencySketchRegistry.drain()
+            
+        Returns:
+            True если все скетчи записаны (иначе вызывающий должен вернуть их в реестр)
+        """
+        if not items:
+            return True
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.db_type == "sqlite":
+                    cursor.execute('BEGIN IMMEDIATE')
+                for bucket, model_name, format_type, sketch in items:
+                    # Чтение и запись под блокировкой строки, чтобы экземпляры не перетерли друг друга
+                    if self.db_type == "postgresql":
+                        # Пустая строка создается заранее: иначе два экземпляра могут одновременно
+                        # не найти ее и второй INSERT затрет скетч первого
+                        cursor.execute('''
+                            INSERT INTO latency_sketches (bucket, model_name, format_type, sketch)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (bucket, model_name, format_type) DO NOTHING
+                        ''', (bucket, model_name, format_type, QuantileSketch(sketch.relative_accuracy).to_json()))
+                        cursor.execute('''
+                            SELECT sketch FROM latency_sketches
+                            WHERE bucket = %s AND model_name = %s AND format_type = %s
+                            FOR UPDATE
+                        ''', (bucket, model_name, format_type))
+                    else:
+                        cursor.execute('''
+                            SELECT sketch FROM latency_sketches
+                            WHERE bucket = ? AND model_name = ? AND format_type = ?
+                        ''', (bucket, model_name, format_type))
+                    row = cursor.fetchone()
+                    
+                    merged = QuantileSketch.from_json(row[0]) if row else QuantileSketch(sketch.relative_accuracy)
+                    merged.merge(sketch)
+                    
+                    if self.db_type == "postgresql":
+                        cursor.execute('''
+                            UPDATE latency_sketches SET sketch = %s, updated_at = CURRENT_TIMESTAMP
+                            WHERE bucket = %s AND model_name = %s AND format_type = %s
+                        ''', (merged.to_json(), bucket, model_name, format_type))
+                    else:
+                        cursor.execute('''
+                            INSERT OR REPLACE INTO latency_sketches (bucket, model_name, format_type, sketch, updated_at)
+                            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        ''', (bucket, model_name, format_type, merged.to_json()))
+                conn.commit()
+                return True
+        except Exception as e:
+            logging.error(f"Ошибка сохранения скетчей времени генерации: {e}")
+            return False
     
-    def update_payment_status(self, payment_id: str, status: str) -> bool:
-        """Обновление статуса платежа"""
+    def get_latency_quantiles(self, hours: int = 24, quantiles=(0.5, 0.9, 0.99)) -> Dict:
+        """
+        Квантили времени генерации за последние hours часов
+        
+        Returns:
+            {'all': {...}, 'models': {модель: {...}}}, где {...} содержит count, mean
+            и ключи p50/p90/p99 для запрошенных квантилей
+        """
+        time_limit = (datetime.utcnow() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:00:00')
         query = '''
-            UPDATE payments 
-            SET status = %s, completed_at = CURRENT_TIMESTAMP
-            WHERE betatransfer_id = %s
+            SELECT model_name, sketch FROM latency_sketches WHERE bucket >= %s
         ''' if self.db_type == "postgresql" else '''
-            UPDATE payments 
-            SET status = ?, completed_at = CURRENT_TIMESTAMP
-            WHERE betatransfer_id = ?
+            SELECT model_name, sketch FROM latency_sketches WHERE bucket >= ?
         '''
-        return self.execute_query(query, (status, payment_id))
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, (time_limit,))
+                rows = cursor.fetchall()
+        except Exception as e:
+            logging.error(f"Ошибка получения квантилей времени генерации: {e}")
+            return {'all': {}, 'models': {}}
+        
+        overall = QuantileSketch()
+        per_model = {}
+        for model_name, data in rows:
+            sketch = QuantileSketch.from_json(data)
+            overall.merge(sketch)
+            per_model.setdefault(model_name or 'unknown', QuantileSketch()).merge(sketch)
+        
+        def summarize(sketch):
+            summary = {'count': sketch.count, 'mean': sketch.mean}
+            for q in quantiles:
+                summary[f"p{q * 100:g}"] = sketch.quantile(q)
+            return summary
+        
+        return {
+            'all': summarize(overall),
+            'models': {
+                model: summarize(sketch)
+                for model, sketch in sorted(per_model.items(), key=lambda item: -item[1].count)
+            }
+        }
     
     # Статистические методы
     def get_user_stats(self, user_id: int) -> Dict:
@@ -880,49 +2031,26 @@ class AnalyticsDB:
                 if not user_data:
                     return {}
                 
-                # Статистика по моделям
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT model_name, COUNT(*) as count, 
-                               AVG(generation_time) as avg_time,
-                               SUM(CASE WHEN success = true THEN 1 ELSE 0 END) as successful
-                        FROM generations 
-                        WHERE user_id = %s 
-                        GROUP BY model_name
-                        ORDER BY count DESC
-                    ''', (user_id,))
-                else:
-                    cursor.execute('''
-                        SELECT model_name, COUNT(*) as count, 
-                               AVG(generation_time) as avg_time,
-                               SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful
-                        FROM generations 
-                        WHERE user_id = ? 
-                        GROUP BY model_name
-                        ORDER BY count DESC
-                    ''', (user_id,))
+                # Статистика по моделям и форматам - одно чтение счетчиков пользователя по первичному ключу
+                self.queries.execute(cursor, 'stats.user_generation', (user_id,))
                 
-                models_stats = cursor.fetchall()
-                
-                # Статистика по форматам
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT format_type, COUNT(*) as count
-                        FROM generations 
-                        WHERE user_id = %s 
-                        GROUP BY format_type
-                        ORDER BY count DESC
-                    ''', (user_id,))
-                else:
-                    cursor.execute('''
-                        SELECT format_type, COUNT(*) as count
-                        FROM generations 
-                        WHERE user_id = ? 
-                        GROUP BY format_type
-                        ORDER BY count DESC
-                    ''', (user_id,))
+                models = {}
+                formats = {}
+                for model_name, format_type, generations, successes, time_sum, time_count in cursor.fetchall():
+                    model = models.setdefault(model_name or None, [0, 0, 0.0, 0])
+                    model[0] += generations
+                    model[1] += successes
+                    model[2] += time_sum or 0
+                    model[3] += time_count
+                    formats[format_type or None] = formats.get(format_type or None, 0) + generations
                 
-                formats_stats = cursor.fetchall()
+                # Формат как у прежних GROUP BY: (модель, количество, среднее время, успешных)
+                models_stats = sorted(
+                    ((model_name, count, time_sum / time_count if time_count else None, successful)
+                     for model_name, (count, successful, time_sum, time_count) in models.items()),
+                    key=lambda row: row[1], reverse=True
+                )
+                formats_stats = sorted(formats.items(), key=lambda row: row[1], reverse=True)
                 
                 return {
                     'total_generations': user_data[0],
@@ -937,48 +2065,49 @@ class AnalyticsDB:
             return {}
     
     def get_global_stats(self, days: int = 30) -> Dict:
-        """Получение глобальной статистики"""
+        """
+        Получение глобальной статистики из агрегатов
+        
+        Итоги считаются по дневным агрегатам (stats_daily, stats_daily_totals,
+        stats_daily_revenue) без прохода по users и generations.
+        """
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
+                date_limit = (datetime.utcnow() - timedelta(days=days)).date().isoformat()
                 
-                # Общая статистика
-                cursor.execute('''
-                    SELECT COUNT(DISTINCT user_id) as total_users,
-                           SUM(total_generations) as total_generations,
-                           SUM(total_errors) as total_errors
-                    FROM users
-                ''')
-                global_data = cursor.fetchone()
+                # Итоги за все время
+                cursor.execute('SELECT SUM(new_users) FROM stats_daily_totals')
+                total_users = cursor.fetchone()[0]
+                cursor.execute('SELECT SUM(successes), SUM(errors) FROM stats_daily')
+                total_generations, total_errors = cursor.fetchone()
                 
                 # Статистика за последние N дней
-                date_limit = datetime.now() - timedelta(days=days)
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT COUNT(DISTINCT user_id) as active_users,
-                               COUNT(*) as generations_count,
-                               AVG(generation_time) as avg_generation_time
-                        FROM generations 
-                        WHERE timestamp >= %s
-                    ''', (date_limit,))
-                else:
-                    cursor.execute('''
-                        SELECT COUNT(DISTINCT user_id) as active_users,
-                               COUNT(*) as generations_count,
-                               AVG(generation_time) as avg_generation_time
-                        FROM generations 
-                        WHERE timestamp >= ?
-                    ''', (date_limit,))
+                self.queries.execute(cursor, 'stats.recent_generations', (date_limit,))
+                recent_generations, avg_generation_time = cursor.fetchone()
+                
+                self.queries.execute(cursor, 'stats.recent_active_users', (date_limit,))
+                active_users = cursor.fetchone()[0]
+                
+                self.queries.execute(cursor, 'stats.recent_models', (date_limit,))
+                popular_models = [(model or 'unknown', count) for model, count in cursor.fetchall()]
                 
-                recent_data = cursor.fetchone()
+                self.queries.execute(cursor, 'stats.recent_formats', (date_limit,))
+                popular_formats = [(format_type or 'unknown', count) for format_type, count in cursor.fetchall()]
+                
+                self.queries.execute(cursor, 'stats.recent_revenue', (date_limit,))
+                revenue = {currency: (payments or 0, float(total or 0)) for currency, payments, total in cursor.fetchall()}
                 
                 return {
-                    'total_users': global_data[0] or 0,
-                    'total_generations': global_data[1] or 0,
-                    'total_errors': global_data[2] or 0,
-                    'active_users_30d': recent_data[0] or 0,
-                    'generations_30d': recent_data[1] or 0,
-                    'avg_generation_time': recent_data[2] or 0
+                    'total_users': total_users or 0,
+                    'total_generations': total_generations or 0,
+                    'total_errors': total_errors or 0,
+                    'active_users_30d': active_users or 0,
+                    'generations_30d': recent_generations or 0,
+                    'avg_generation_time': float(avg_generation_time or 0),
+                    'popular_models': popular_models,
+                    'popular_formats': popular_formats,
+                    'revenue_30d': revenue
                 }
         except Exception as e:
             logging.error(f"Ошибка получения глобальной статистики: {e}")
@@ -1037,41 +2166,22 @@ class AnalyticsDB:
                 'completed_revenue': 0
             }
 
-    def get_pending_payments(self):
-        """Получает все pending платежи для проверки статуса"""
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at
-                        FROM payments 
-                        WHERE status = 'pending' AND betatransfer_id IS NOT NULL
-                        ORDER BY created_at ASC
-                    ''')
-                else:
-                    cursor.execute('''
-                        SELECT user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at
-                        FROM payments 
-                        WHERE status = 'pending' AND betatransfer_id IS NOT NULL
-                        ORDER BY created_at ASC
-                    ''')
-                
-                columns = [description[0] for description in cursor.description]
-                payments = []
-                
-                for row in cursor.fetchall():
-                    if self.db_type == "postgresql":
-                        payment = dict(zip(columns, row))
-                    else:
-                        payment = dict(zip(columns, row))
-                    payments.append(payment)
-                
-                return payments
-                
-        except Exception as e:
-            logging.error(f"Ошибка получения pending платежей: {e}")
+    def get_pending_payments(self, created_after: datetime = None):
+        """
+        Получает pending платежи для проверки статуса
+        
+        Args:
+            created_after: Только платежи, созданные позже этого момента (UTC); None - все
+        """
+        if created_after is None:
+            rows = self.run_query('payment.pending', fetch_all=True)
+        else:
+            rows = self.run_query('payment.pending_since', (created_after.strftime('%Y-%m-%d %H:%M:%S'),),
+                                  fetch_all=True)
+        if rows is None:
+            logging.error("Ошибка получения pending платежей")
             return []
+        return [row._asdict() for row in rows]
 
     def get_old_pending_payments(self, hours: int = 24):
         """Получает старые pending платежи для очистки"""
@@ -1131,22 +2241,10 @@ class AnalyticsDB:
             True если создание успешно, False иначе
         """
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                if self.db_type == "postgresql":
-                    cursor.execute("""
-                        INSERT INTO payments 
-                        (user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at)
-                        VALUES (%s, %s, %s, 'pending', %s, %s, %s, CURRENT_TIMESTAMP)
-                    """, (user_id, amount, currency, payment_id, order_id or '', credit_amount or 0))
-                else:
-                    cursor.execute("""
-                        INSERT INTO payments 
-                        (user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at)
-                        VALUES (?, ?, ?, 'pending', ?, ?, ?, CURRENT_TIMESTAMP)
-                    """, (user_id, amount, currency, payment_id, order_id or '', credit_amount or 0))
-                
-                conn.commit()
+            with self.pooled_connection() as conn:
+                self.queries.execute(conn.cursor(), 'payment.insert', (
+                    user_id, amount, currency, payment_id, order_id or '', credit_amount or 0
+                ))
                 return True
                 
         except Exception as e:
@@ -1156,21 +2254,9 @@ class AnalyticsDB:
     def get_credit_transaction_by_payment_id(self, payment_id: str):
         """Проверяет, есть ли уже транзакция кредитов для данного платежа"""
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT id FROM credit_transactions 
-                        WHERE payment_id = (SELECT id FROM payments WHERE betatransfer_id = %s)
-                    ''', (payment_id,))
-                else:
-                    cursor.execute('''
-                        SELECT id FROM credit_transactions 
-                        WHERE payment_id = (SELECT id FROM payments WHERE betatransfer_id = ?)
-                    ''', (payment_id,))
-                
-                result = cursor.fetchone()
-                return result is not None
+            with self.pooled_connection() as conn:
+                row = self.queries.fetch_one(conn.cursor(), 'credit_transaction.by_payment', (payment_id,))
+                return row is not None
                 
         except Exception as e:
             logging.error(f"Ошибка проверки транзакции по payment_id: {e}")
@@ -1218,32 +2304,19 @@ class AnalyticsDB:
     def get_payment_by_betatransfer_id(self, betatransfer_id: str) -> Optional[Dict]:
         """Получение информации о платеже по betatransfer_id"""
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                if self.db_type == "postgresql":
-                    cursor.execute('''
-                        SELECT * FROM payments 
-                        WHERE betatransfer_id = %s
-                    ''', (betatransfer_id,))
-                else:
-                    cursor.execute('''
-                        SELECT * FROM payments 
-                        WHERE betatransfer_id = ?
-                    ''', (betatransfer_id,))
-                
-                row = cursor.fetchone()
-                if row:
-                    if self.db_type == "postgresql":
-                        columns = [description[0] for description in cursor.description]
-                        return dict(zip(columns, row))
-                    else:
-                        columns = ['id', 'user_id', 'amount', 'currency', 'status', 'betatransfer_id', 
-                                  'order_id', 'credit_amount', 'payment_method', 'created_at', 'completed_at']
-                        return dict(zip(columns, row))
-                return None
+            with self.pooled_connection() as conn:
+                row = self.queries.fetch_one(conn.cursor(), 'payment.by_betatransfer_id', (betatransfer_id,))
+                return row._asdict() if row else None
         except Exception as e:
             logging.error(f"Ошибка получения платежа по betatransfer_id: {e}")
             return None
 
-# Глобальный экземпляр базы данных
+# Время каждого публичного метода; соединения, проверка схемы и чтение кэша в памяти не замеряются
+_UNINSTRUMENTED = ('get_connection', 'pooled_connection', 'close', 'get_cached_entitlements',
+                   'ensure_schema', 'start_schema_migration')
+instrument_methods(AnalyticsDB, DB_METHOD_DURATION, DB_METHOD_ERRORS, exclude=_UNINSTRUMENTED)
+# Внутри трассы генерации каждый публичный метод - отдельный этап 'db.<метод>'
+trace_methods(AnalyticsDB, 'db.', exclude=_UNINSTRUMENTED)
+
+# Глобальный экземпляр базы данных (схема создается при первом соединении или start_schema_migration)
 analytics_db = AnalyticsDB()
@@ -0,0 +1,148 @@
+"""
+Раздельные пулы потоков для блокирующих операций
+
+Раньше база, Replicate, OpenAI и работа с временными файлами делили один
+пул на 300 потоков, и наплыв долгих генераций видео мог занять все потоки,
+оставив списания и платежи ждать в общей очереди. Теперь у каждого вида
+работы свой пул (bulkhead) со своим размером:
+
+    DB_EXECUTOR   - вызовы AnalyticsDB
+    API_EXECUTOR  - синхронные клиенты внешних API (replicate.run, OpenAI)
+    FILE_EXECUTOR - временные файлы и служебные задачи (профилировщик)
+
+Очередь каждого пула ограничена: если заняты все потоки и очередь полна,
+submit сразу бросает PoolRejectedError вместо того, чтобы копить задачи
+без предела. Время ожидания в очереди, число занятых потоков и отказы
+выгружаются на /metrics с меткой pool.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+from metrics import metrics_registry, DB_BUCKETS
+from tracing import ContextThreadPoolExecutor
+
+# Размеры пулов и их очередей
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '32'))
+DB_EXECUTOR_QUEUE = int(os.getenv('DB_EXECUTOR_QUEUE', '1000'))
+API_EXECUTOR_WORKERS = int(os.getenv('API_EXECUTOR_WORKERS', '200'))
+API_EXECUTOR_QUEUE = int(os.getenv('API_EXECUTOR_QUEUE', '200'))
+FILE_EXECUTOR_WORKERS = int(os.getenv('FILE_EXECUTOR_WORKERS', '16'))
+FILE_EXECUTOR_QUEUE = int(os.getenv('FILE_EXECUTOR_QUEUE', '256'))
+
+EXECUTOR_WAIT = metrics_registry.histogram(
+    'bot_executor_wait_seconds', 'Время ожидания задачи в очереди пула потоков', ['pool'], buckets=DB_BUCKETS)
+EXECUTOR_REJECTED = metrics_registry.counter(
+    'bot_executor_rejected_total', 'Задачи, отклоненные из-за переполненной очереди пула', ['pool'])
+
+
+class PoolRejectedError(RuntimeError):
+    """Очередь пула потоков переполнена"""
+
+
+class BoundedExecutor(ContextThreadPoolExecutor):
+    """
+    Пул потоков с ограниченной очередью и замерами
+
+    Задачи выполняются в копии contextvars вызывающего кода (как в
+    ContextThreadPoolExecutor), поэтому трассировка работает и здесь.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self.name = name
+        self.max_queue = max_queue
+        # Слоты на выполняемые и ожидающие задачи вместе
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._counts_lock = threading.Lock()
+        self._in_flight = 0
+        self._active = 0
+        self._wait = EXECUTOR_WAIT.labels(name)
+        self._rejected = EXECUTOR_REJECTED.labels(name)
+
+    @property
+    def active(self) -> int:
+        """Задачи, которые выполняются прямо сейчас"""
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        """Задачи, ожидающие свободного потока"""
+        return max(0, self._in_flight - self._active)
+
+    def submit(self, fn, /, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            self._rejected.inc()
+            raise PoolRejectedError(f"Пул {self.name} переполнен: {self._max_workers} потоков заняты, "
+                                    f"в очереди {self.max_queue} задач")
+        enqueued = time.perf_counter()
+
+        def run():
+            self._wait.observe(time.perf_counter() - enqueued)
+            with self._counts_lock:
+                self._active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counts_lock:
+                    self._active -= 1
+
+        with self._counts_lock:
+            self._in_flight += 1
+        try:
+            future = super().submit(run)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self._counts_lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def drain(self, timeout: float) -> bool:
+        """Перестает принимать задачи и ждет завершения принятых; False - не успели"""
+        self.shutdown(wait=False)
+        deadline = time.monotonic() + timeout
+        while self._in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._in_flight
+
+
+DB_EXECUTOR = BoundedExecutor('db', DB_EXECUTOR_WORKERS, DB_EXECUTOR_QUEUE)
+API_EXECUTOR = BoundedExecutor('api', API_EXECUTOR_WORKERS, API_EXECUTOR_QUEUE)
+FILE_EXECUTOR = BoundedExecutor('file', FILE_EXECUTOR_WORKERS, FILE_EXECUTOR_QUEUE)
+
+# Порядок остановки: база последней, чтобы завершающиеся генерации успели записать результат
+EXECUTORS: List[BoundedExecutor] = [API_EXECUTOR, FILE_EXECUTOR, DB_EXECUTOR]
+
+metrics_registry.callback(
+    'bot_executor_queue_depth', 'Задачи, ожидающие свободного потока, по пулу',
+    lambda: {executor.name: executor.queued for executor in EXECUTORS}, labelnames=['pool'])
+metrics_registry.callback(
+    'bot_executor_active', 'Занятые потоки по пулу',
+    lambda: {executor.name: executor.active for executor in EXECUTORS}, labelnames=['pool'])
+metrics_registry.callback(
+    'bot_executor_workers', 'Предел потоков по пулу',
+    lambda: {executor.name: executor._max_workers for executor in EXECUTORS}, labelnames=['pool'])
+
+
+def shutdown_executors(timeout: float = 30.0) -> Dict[str, bool]:
+    """
+    Останавливает пулы по очереди, дожидаясь принятых задач
+
+    Блокирующий вызов: из event loop его запускают в отдельном потоке.
+    Возвращает {пул: все задачи завершены}.
+    """
+    deadline = time.monotonic() + timeout
+    results = {}
+    for executor in EXECUTORS:
+        results[executor.name] = executor.drain(max(0.0, deadline - time.monotonic()))
+        if not results[executor.name]:
+            logging.warning(f"⚠️ Пул {executor.name}: не дождались {executor._in_flight} задач")
+    return results
@@ -0,0 +1,306 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочных тестов
+
+Один aiohttp сервер изображает сразу четыре API:
+    /bot<token>/<method>          - Telegram Bot API (ответы в формате Bot API)
+    /file/bot<token>/<path>       - скачивание файлов Telegram
+    /replicate/v1/...             - предсказания Replicate (создание и опрос)
+    /openai/v1/chat/completions   - OpenAI chat completion
+    /betatransfer/payment, /info  - создание платежа и его статус
+    /files/<name>                 - "сгенерированные" картинки и видео
+
+Задержки Replicate берутся из логнормального распределения с заданной
+медианой, часть предсказаний завершается ошибкой. Все вызовы Bot API
+запоминаются по chat_id, чтобы драйвер теста видел ответы бота и кнопки.
+
+Клиенты бота переключаются на заглушки через переменные окружения
+(см. FakeServices.environ), которые нужно выставить до импорта bot.py.
+"""
+
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# PNG 1x1 - содержимое любой "сгенерированной" картинки
+PNG_BYTES = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489'
+    '0000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082'
+)
+# Модели, которые отдают видео (одна ссылка вместо списка картинок)
+VIDEO_MODEL_HINTS = ('seedance', 'video', 'kling', 'veo', 'hailuo', 'wan-')
+BOT_USER = {'id': 100000001, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'load_test_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class LatencyModel:
+    """Логнормальная задержка с медианой median (секунды) и разбросом sigma"""
+
+    def __init__(self, median: float, sigma: float = 0.0, failure_rate: float = 0.0):
+        self.median = median
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(rng.gauss(0, self.sigma)) if self.sigma > 0 else self.median
+
+    def fails(self, rng: random.Random) -> bool:
+        return self.failure_rate > 0 and rng.random() < self.failure_rate
+
+    def to_dict(self) -> Dict:
+        return {'median': self.median, 'sigma': self.sigma, 'failure_rate': self.failure_rate}
+
+
+class FakeServices:
+    """aiohttp сервер со всеми заглушками и журналом вызовов"""
+
+    def __init__(self, replicate: LatencyModel, preflight: LatencyModel = None, openai: LatencyModel = None,
+                 telegram: LatencyModel = None, betatransfer: LatencyModel = None, seed: int = 1):
+        self.replicate_latency = replicate
+        self.preflight_latency = preflight or LatencyModel(0.05)
+        self.openai_latency = openai or LatencyModel(0.3, 0.3)
+        self.telegram_latency = telegram or LatencyModel(0.02, 0.3)
+        self.betatransfer_latency = betatransfer or LatencyModel(0.1, 0.3)
+        self.rng = random.Random(seed)
+        self.port = None
+        self._runner = None
+        self._message_ids = 0
+        self._predictions: Dict[str, Dict] = {}
+        self._payments: Dict[str, Dict] = {}
+        # chat_id -> список вызовов Bot API (метод, параметры)
+        self.chats: Dict[int, List[Dict]] = defaultdict(list)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def environ(self) -> Dict[str, str]:
+        """Переменные окружения, направляющие клиентов бота на заглушки"""
+        return {
+            'REPLICATE_BASE_URL': f"{self.base}/replicate",
+            'REPLICATE_API_TOKEN': 'load-test-token',
+            'REPLICATE_POLL_INTERVAL': '0.05',
+            'OPENAI_BASE_URL': f"{self.base}/openai/v1",
+            'OPENAI_API_KEY': 'load-test-key',
+            'BETATRANSFER_BASE_URL': f"{self.base}/betatransfer",
+            'BETATRANSFER_API_KEY': 'load-test-key',
+            'BETATRANSFER_SECRET_KEY': 'load-test-secret',
+        }
+
+    async def start(self, port: int = 0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.telegram_method)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.file)
+        app.router.add_get('/files/{path:.*}', self.file)
+        app.router.add_post('/replicate/v1/predictions', self.replicate_create)
+        app.router.add_post('/replicate/v1/models/{owner}/{name}/predictions', self.replicate_create)
+        app.router.add_get('/replicate/v1/predictions/{id}', self.replicate_get)
+        app.router.add_get('/replicate/v1/models/{owner}/{name}/versions/{version}', self.replicate_version)
+        app.router.add_post('/openai/v1/chat/completions', self.openai_chat)
+        app.router.add_post('/betatransfer/payment', self.betatransfer_payment)
+        app.router.add_post('/betatransfer/info', self.betatransfer_info)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ==================== Telegram Bot API ====================
+
+    def _message(self, chat_id, params: Dict) -> Dict:
+        self._message_ids += 1
+        message = {
+            'message_id': self._message_ids,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if params.get('text') is not None:
+            message['text'] = params['text']
+        if params.get('caption') is not None:
+            message['caption'] = params['caption']
+        if params.get('reply_markup'):
+            message['reply_markup'] = params['reply_markup']
+        return message
+
+    async def telegram_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        form = await request.post()
+        params = {}
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                params[key] = f"<file {value.filename}>"
+                continue
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        self.calls[method] += 1
+        await asyncio.sleep(self.telegram_latency.sample(self.rng))
+
+        chat_id = params.get('chat_id')
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getFile':
+            result = {'file_id': params.get('file_id'), 'file_unique_id': 'u' + str(params.get('file_id')),
+                      'file_size': len(PNG_BYTES), 'file_path': f"photos/{params.get('file_id')}.png"}
+        elif method == 'sendMediaGroup':
+            media = params.get('media') or []
+            result = [self._message(chat_id, {'caption': item.get('caption')}) for item in media]
+        elif method.startswith(('send', 'edit', 'copy', 'forward')):
+            result = self._message(chat_id, params)
+        else:
+            # answerCallbackQuery, deleteMessage, setWebhook и т.п.
+            result = True
+
+        if chat_id is not None:
+            try:
+                self.chats[int(chat_id)].append({'method': method, 'params': params,
+                                                 'result': result if isinstance(result, dict) else None})
+            except (TypeError, ValueError):
+                pass
+        return web.json_response({'ok': True, 'result': result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        path = request.match_info['path']
+        if path.endswith('.mp4'):
+            return web.Response(body=b'\x00' * 1024, content_type='video/mp4')
+        return web.Response(body=PNG_BYTES, content_type='image/png')
+
+    def last_keyboard_message(self, chat_id: int) -> Optional[Dict]:
+        """Последнее сообщение бота с inline-клавиатурой в чате"""
+        for call in reversed(self.chats.get(chat_id, [])):
+            markup = call['params'].get('reply_markup')
+            if isinstance(markup, dict) and markup.get('inline_keyboard'):
+                return call
+        return None
+
+    def last_message(self, chat_id: int) -> Optional[Dict]:
+        for call in reversed(self.chats.get(chat_id, [])):
+            if call['result']:
+                return call['result']
+        return None
+
+    # ==================== Replicate ====================
+
+    def _prediction_json(self, prediction: Dict) -> Dict:
+        now = time.monotonic()
+        data = dict(prediction['data'])
+        if now >= prediction['ready_at']:
+            if prediction['failed']:
+                data.update(status='failed', error='load test: simulated model failure')
+            else:
+                data.update(status='succeeded', output=prediction['output'], completed_at=_now_iso())
+        else:
+            data['status'] = 'processing'
+        return data
+
+    async def replicate_create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        owner, name = request.match_info.get('owner'), request.match_info.get('name')
+        model = f"{owner}/{name}" if owner else body.get('version', 'unknown')
+        self.calls[f'replicate:{model}'] += 1
+        latency = self.preflight_latency if model == 'replicate/hello-world' else self.replicate_latency
+        prediction_id = uuid.uuid4().hex[:20]
+        if any(hint in model for hint in VIDEO_MODEL_HINTS):
+            output = f"{self.base}/files/{prediction_id}.mp4"
+        elif model == 'replicate/hello-world':
+            output = 'hello test'
+        else:
+            output = [f"{self.base}/files/{prediction_id}.png"]
+        prediction = {
+            'ready_at': time.monotonic() + latency.sample(self.rng),
+            'failed': latency.fails(self.rng),
+            'output': output,
+            'data': {
+                'id': prediction_id, 'model': model, 'version': body.get('version', ''),
+                'status': 'starting', 'input': body.get('input', {}), 'output': None, 'logs': '',
+                'error': None, 'metrics': {}, 'created_at': _now_iso(), 'started_at': _now_iso(),
+                'completed_at': None,
+                'urls': {'get': f"{self.base}/replicate/v1/predictions/{prediction_id}",
+                         'cancel': f"{self.base}/replicate/v1/predictions/{prediction_id}/cancel"},
+            },
+        }
+        self._predictions[prediction_id] = prediction
+        return web.json_response(self._prediction_json(prediction), status=201)
+
+    async def replicate_get(self, request: web.Request) -> web.Response:
+        prediction = self._predictions.get(request.match_info['id'])
+        if prediction is None:
+            return web.json_response({'detail': 'Not found'}, status=404)
+        data = self._prediction_json(prediction)
+        if data['status'] in ('succeeded', 'failed'):
+            # Завершенное предсказание больше не нужно держать в памяти после выдачи
+            self._predictions.pop(request.match_info['id'], None)
+        return web.json_response(data)
+
+    async def replicate_version(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'id': request.match_info['version'], 'created_at': _now_iso(), 'cog_version': '0.8.6',
+            'openapi_schema': {'components': {'schemas': {'Output': {'type': 'array', 'items': {'type': 'string'}}}}},
+        })
+
+    # ==================== OpenAI ====================
+
+    async def openai_chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls['openai:chat'] += 1
+        await asyncio.sleep(self.openai_latency.sample(self.rng))
+        if self.openai_latency.fails(self.rng):
+            return web.json_response({'error': {'message': 'load test: simulated failure', 'type': 'server_error'}},
+                                     status=500)
+        content = '\n'.join(
+            f"{i}. A detailed cinematic scene number {i}, soft light, high detail, 35mm photo" for i in range(1, 6)
+        )
+        return web.json_response({
+            'id': 'chatcmpl-' + uuid.uuid4().hex[:12], 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': 50, 'completion_tokens': 60, 'total_tokens': 110},
+        })
+
+    # ==================== Betatransfer ====================
+
+    async def betatransfer_payment(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        self.calls['betatransfer:payment'] += 1
+        await asyncio.sleep(self.betatransfer_latency.sample(self.rng))
+        payment_id = str(100000 + len(self._payments))
+        self._payments[payment_id] = {'amount': form.get('amount'), 'currency': form.get('currency'),
+                                      'orderId': form.get('orderId')}
+        return web.json_response({'status': 'success', 'id': payment_id,
+                                  'urlPayment': f"{self.base}/pay/{payment_id}",
+                                  'amount': form.get('amount'), 'currency': form.get('currency')})
+
+    async def betatransfer_info(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        self.calls['betatransfer:info'] += 1
+        await asyncio.sleep(self.betatransfer_latency.sample(self.rng))
+        payment_id = form.get('id')
+        payment = self._payments.get(payment_id)
+        if payment is None:
+            return web.json_response({'status': 'error', 'message': 'Payment not found'})
+        # Платеж считается оплаченным сразу
+        return web.json_response({'id': payment_id, 'status': 'success', 'amount': payment['amount'],
+                                  'currency': payment['currency'], 'orderId': payment['orderId']})
@@ -0,0 +1,179 @@
+"""
+Учет генераций в работе и их дренаж при остановке
+
+Генерации запускались голым asyncio.create_task, и при редеплое Railway
+(SIGTERM) процесс завершался посреди предсказания Replicate: пользователь
+оставался без результата, а иногда и со списанными кредитами. Теперь
+каждая генерация запускается через JobCoordinator.spawn:
+
+- координатор помнит задачу, ее вид, пользователя и аргументы для
+  повторного запуска;
+- код списания выполняется через charge(), и координатор знает, что за
+  прерванную задачу уже заплачено;
+- drain() перестает принимать новые задачи и ждет запущенные до срока,
+  а незавершенные возвращает вызывающему коду, который сохраняет их в базу
+  и отменяет.
+
+Модуль не зависит от Telegram: что сохранять и как предлагать повтор,
+решает bot.py.
+"""
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import metrics_registry
+
+# Сколько ждать завершения генераций после SIGTERM: Railway присылает SIGKILL через 30 с,
+# остаток уходит на сохранение прерванных задач и сброс телеметрии
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '20'))
+
+JOBS_STARTED = metrics_registry.counter('bot_jobs_started_total', 'Запущенные генерации по виду', ['kind'])
+JOBS_REJECTED = metrics_registry.counter(
+    'bot_jobs_rejected_total', 'Генерации, не запущенные из-за остановки бота', ['kind'])
+SHUTDOWN_DRAIN_DURATION = metrics_registry.gauge(
+    'bot_shutdown_drain_seconds', 'Длительность последнего дренажа генераций при остановке')
+
+_current_job: contextvars.ContextVar = contextvars.ContextVar('current_job', default=None)
+
+
+class TrackedJob:
+    """Генерация в работе"""
+
+    __slots__ = ('job_id', 'kind', 'user_id', 'chat_id', 'payload', 'task', 'started', 'charged')
+
+    def __init__(self, job_id: int, kind: str, user_id: Optional[int], chat_id: Optional[int],
+                 payload: Optional[Dict]):
+        self.job_id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.chat_id = chat_id
+        # Аргументы повторного запуска; None - задачу нельзя возобновить
+        self.payload = payload
+        self.task: Optional[asyncio.Task] = None
+        self.started = time.monotonic()
+        self.charged = False
+
+    @property
+    def resumable(self) -> bool:
+        return self.payload is not None
+
+
+class DrainReport:
+    """Итог дренажа: сколько задач было, сколько завершилось и какие остались"""
+
+    def __init__(self, total: int, unfinished: List[TrackedJob], seconds: float):
+        self.total = total
+        self.unfinished = unfinished
+        self.finished = total - len(unfinished)
+        self.seconds = seconds
+
+
+class JobCoordinator:
+    """Запускает генерации как отслеживаемые задачи и дренирует их при остановке"""
+
+    def __init__(self):
+        self._jobs: Dict[int, TrackedJob] = {}
+        self._ids = itertools.count(1)
+        self.accepting = True
+
+    @property
+    def running(self) -> int:
+        return len(self._jobs)
+
+    def running_by_kind(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.kind] = counts.get(job.kind, 0) + 1
+        return counts
+
+    def spawn(self, kind: str, factory: Callable, user_id: int = None, chat_id: int = None,
+              payload: Dict = None) -> Optional[asyncio.Task]:
+        """
+        Запускает задачу factory() и отслеживает ее до завершения
+
+        Корутина создается только если координатор принимает задачи, поэтому
+        отказ не оставляет невыполненных корутин. None - бот останавливается.
+        """
+        if not self.accepting:
+            JOBS_REJECTED.labels(kind).inc()
+            logging.warning(f"⏳ Генерация {kind} пользователя {user_id} отклонена: бот останавливается")
+            return None
+
+        job = TrackedJob(next(self._ids), kind, user_id, chat_id, payload)
+
+        async def run():
+            _current_job.set(job)
+            try:
+                return await factory()
+            finally:
+                self._jobs.pop(job.job_id, None)
+
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(run(), name=f"job-{kind}-{job.job_id}")
+        JOBS_STARTED.labels(kind).inc()
+        return job.task
+
+    def mark_charged(self):
+        """Отмечает, что текущая задача списала кредиты или бесплатные генерации"""
+        job = _current_job.get()
+        if job is not None:
+            job.charged = True
+
+    async def charge(self, debit: Awaitable, debited: Callable[[Any], bool]):
+        """
+        Ждет списание и оставляет отметку charged, только если оно прошло
+
+        Отметка ставится до ожидания: транзакция в потоке БД завершается, даже
+        если задачу отменили посреди списания. Само ожидание защищено от отмены
+        (asyncio.shield) - при отмене дренажем дожидаемся результата, снимаем
+        отметку, если debited(result) сообщает, что ничего не списано, и только
+        потом пропускаем отмену дальше. Так сохраненная прерванная задача
+        помечена оплаченной ровно тогда, когда списание записано в базу.
+        """
+        job = _current_job.get()
+        was_charged = job.charged if job is not None else False
+        self.mark_charged()
+        future = asyncio.ensure_future(debit)
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            result = await asyncio.shield(future)
+            if job is not None and not debited(result):
+                job.charged = was_charged
+            raise
+        if job is not None and not debited(result):
+            job.charged = was_charged
+        return result
+
+    async def drain(self, timeout: float = SHUTDOWN_DRAIN_SECONDS) -> DrainReport:
+        """Перестает принимать задачи и ждет запущенные не дольше timeout секунд"""
+        self.accepting = False
+        started = time.monotonic()
+        jobs = list(self._jobs.values())
+        if jobs:
+            logging.info(f"⏳ Ждем завершения генераций: {len(jobs)} ({self.running_by_kind()}), "
+                         f"не дольше {timeout:.0f} с")
+            await asyncio.wait([job.task for job in jobs], timeout=timeout)
+        unfinished = [job for job in jobs if not job.task.done()]
+        seconds = time.monotonic() - started
+        SHUTDOWN_DRAIN_DURATION.set(seconds)
+        return DrainReport(len(jobs), unfinished, seconds)
+
+    async def cancel(self, jobs: List[TrackedJob], timeout: float = 5.0):
+        """Отменяет задачи и ждет, пока они обработают отмену"""
+        tasks = [job.task for job in jobs if not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+job_coordinator = JobCoordinator()
+
+metrics_registry.callback(
+    'bot_jobs_in_flight', 'Генерации в работе по виду', job_coordinator.running_by_kind, labelnames=['kind'])
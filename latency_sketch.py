@@ -0,0 +1,180 @@
+"""
+Потоковые квантили времени генерации (скетчи в стиле DDSketch)
+
+Каждый скетч хранит счетчики по логарифмическим корзинам, поэтому квантиль
+вычисляется с относительной погрешностью не больше LATENCY_SKETCH_ACCURACY,
+а скетчи с разных экземпляров бота складываются без потери точности.
+
+В памяти процесса скетчи копятся по ключу (час, модель, формат) и
+периодически сливаются в таблицу latency_sketches
+(AnalyticsDB.merge_latency_sketches).
+"""
+
+import json
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Относительная точность квантилей (0.01 = 1%)
+LATENCY_SKETCH_ACCURACY = float(os.getenv('LATENCY_SKETCH_ACCURACY', '0.01'))
+# Максимум корзин в одном скетче (младшие корзины схлопываются)
+LATENCY_SKETCH_MAX_BINS = int(os.getenv('LATENCY_SKETCH_MAX_BINS', '2048'))
+# Как часто сбрасывать накопленные скетчи в базу (секунды)
+LATENCY_SKETCH_FLUSH_INTERVAL = int(os.getenv('LATENCY_SKETCH_FLUSH_INTERVAL', '60'))
+
+# Значения меньше этого порога попадают в нулевую корзину
+MIN_TRACKED_VALUE = 1e-6
+
+
+class QuantileSketch:
+    """Скетч распределения с гарантированной относительной точностью квантилей"""
+
+    def __init__(self, relative_accuracy: float = LATENCY_SKETCH_ACCURACY,
+                 max_bins: int = LATENCY_SKETCH_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        # Середина корзины (gamma^(i-1), gamma^i] с относительной ошибкой не больше accuracy
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, weight: int = 1):
+        """Добавляет значение в скетч"""
+        if value is None or weight <= 0:
+            return
+        value = max(0.0, float(value))
+        if value < MIN_TRACKED_VALUE:
+            self.zero_count += weight
+        else:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0) + weight
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        self.count += weight
+        self.sum += value * weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def _collapse(self):
+        """Схлопывает младшие корзины, чтобы не превысить max_bins (точность страдает только у малых значений)"""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def merge(self, other: 'QuantileSketch'):
+        """Добавляет к скетчу все значения другого скетча с той же точностью"""
+        if other.count == 0:
+            return
+        if not math.isclose(other.gamma, self.gamma):
+            raise ValueError("Нельзя объединить скетчи с разной точностью")
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Значение квантиля q (0..1) или None для пустого скетча"""
+        if self.count == 0:
+            return None
+        q = min(1.0, max(0.0, q))
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return min(self.max, max(self.min, self._value(index)))
+        return self.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'a': self.relative_accuracy,
+            'z': self.zero_count,
+            'n': self.count,
+            's': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'b': {str(index): weight for index, weight in self.bins.items()},
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data: str) -> 'QuantileSketch':
+        payload = json.loads(data)
+        sketch = cls(relative_accuracy=payload.get('a', LATENCY_SKETCH_ACCURACY))
+        sketch.zero_count = payload.get('z', 0)
+        sketch.count = payload.get('n', 0)
+        sketch.sum = payload.get('s', 0.0)
+        if sketch.count:
+            sketch.min = payload['min']
+            sketch.max = payload['max']
+        sketch.bins = {int(index): weight for index, weight in payload.get('b', {}).items()}
+        return sketch
+
+
+def hour_bucket(moment: datetime = None) -> str:
+    """Ключ часа в формате stats_hourly (UTC)"""
+    return (moment or datetime.utcnow()).strftime('%Y-%m-%d %H:00:00')
+
+
+class LatencySketchRegistry:
+    """Скетчи времени генерации по (час, модель, формат), накопленные с последнего сброса в базу"""
+
+    def __init__(self):
+        self._sketches: Dict[Tuple[str, str, str], QuantileSketch] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, format_type: str, seconds: float):
+        """Учитывает время одной генерации"""
+        if seconds is None:
+            return
+        key = (hour_bucket(), model_name or '', format_type or '')
+        with self._lock:
+            sketch = self._sketches.get(key)
+            if sketch is None:
+                sketch = self._sketches[key] = QuantileSketch()
+            sketch.add(seconds)
+
+    def drain(self) -> List[Tuple[str, str, str, QuantileSketch]]:
+        """Забирает накопленные скетчи для записи в базу"""
+        with self._lock:
+            items, self._sketches = self._sketches, {}
+        return [(bucket, model, format_type, sketch) for (bucket, model, format_type), sketch in items.items()]
+
+    def restore(self, items: Iterable[Tuple[str, str, str, QuantileSketch]]):
+        """Возвращает скетчи, которые не удалось записать, чтобы не потерять данные"""
+        with self._lock:
+            for bucket, model, format_type, sketch in items:
+                key = (bucket, model, format_type)
+                if key in self._sketches:
+                    self._sketches[key].merge(sketch)
+                else:
+                    self._sketches[key] = sketch
+
+
+# Глобальный реестр скетчей процесса
+latency_sketches = LatencySketchRegistry()
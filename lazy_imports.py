@@ -0,0 +1,72 @@
+"""
+Отложенный импорт тяжелых SDK
+
+Импорт openai занимает около 250 мс, replicate и requests - еще десятки
+миллисекунд, а нужны они только при первой генерации или платеже. Модули
+объявляются через LazyModule и импортируются при первом обращении к
+атрибуту:
+
+    openai = LazyModule('openai')
+    ...
+    client = openai.OpenAI(...)   # здесь выполняется import openai
+
+Чтобы первая генерация не платила за импорт в event loop, после старта
+бота preload_in_background догружает модули в отдельном потоке.
+"""
+
+import importlib
+import logging
+import threading
+import time
+from typing import Iterable
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту"""
+
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            # import_module потокобезопасен: параллельные обращения ждут один импорт
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return module
+
+    @property
+    def loaded(self) -> bool:
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'загружен' if self.loaded else 'не загружен'
+        return f"<LazyModule {self._name} ({state})>"
+
+
+def preload_in_background(modules: Iterable[LazyModule]) -> threading.Thread:
+    """Импортирует модули в фоновом потоке, не задерживая обработку обновлений"""
+    modules = list(modules)
+
+    def run():
+        for module in modules:
+            started = time.perf_counter()
+            try:
+                module._load()
+                logging.info(f"📦 Модуль {module._name} загружен за {time.perf_counter() - started:.2f} с")
+            except Exception as e:
+                logging.error(f"Ошибка фонового импорта {module._name}: {e}")
+
+    thread = threading.Thread(target=run, name='lazy-import-preload', daemon=True)
+    thread.start()
+    return thread
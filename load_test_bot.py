@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Офлайн нагрузочный тест бота: сценарии пользователей против заглушек сервисов
+
+Поднимает fake_services.FakeServices (Bot API, Replicate, OpenAI,
+Betatransfer) на локальном порту, собирает настоящий Application из
+bot.build_application и прогоняет через его обработчики синтетические
+обновления от --users виртуальных пользователей. Каждый пользователь
+выполняет --flows-per-user сценариев из смеси --mix:
+
+    image    - /start, простые изображения, ориентация, модель, количество, промпт
+    edit     - /start, редактирование, загрузка фото, описание правки
+    video    - /start, видео по тексту, качество, длительность, формат, промпт
+    purchase - /start, пакеты кредитов, покупка, проверка статуса
+
+Шаг сценария считается завершенным, когда обработчик вернул управление и
+закончились все задачи, которые он запустил (генерация идет в фоне через
+asyncio.create_task). В отчете p50/p95/p99 по сценариям и шагам,
+пропускная способность, память и число вызовов внешних сервисов.
+Результат сохраняется в --out/<время>.json; --compare сравнивает с
+предыдущим прогоном (latest - последний сохраненный) и помечает регрессии.
+
+Использование:
+    python load_test_bot.py [--users 20] [--flows-per-user 3] [--mix image=6,edit=2,video=1,purchase=1]
+                            [--replicate-median 2.0] [--replicate-sigma 0.5] [--replicate-failure-rate 0.02]
+                            [--compare latest] [--fail-on-regression]
+"""
+
+import argparse
+import asyncio
+import contextvars
+import glob
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_services import FakeServices, LatencyModel
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_test_results')
+LOAD_TEST_TOKEN = '123456:LOADTEST'
+# Пользователи нагрузочного теста не пересекаются с реальными ID
+FIRST_USER_ID = 900000000
+
+PROMPTS = [
+    "Уютный деревянный дом в лесу на закате, туман, теплый свет в окнах",
+    "Космический корабль над красной планетой, звезды, футуристический дизайн",
+    "Чашка кофе на столе у окна, утренний свет, минимализм",
+    "Городская улица после дождя, неоновые вывески, отражения в лужах",
+]
+EDIT_PROMPTS = ["Изменить цвет фона на синий", "Добавить солнцезащитные очки", "Сделать в стиле акварели"]
+
+# Шаги сценариев: ('command' | 'text', текст), ('click', callback_data или его префикс), ('photo', None)
+FLOWS = {
+    'image': [
+        ('command', '/start'),
+        ('click', 'create_simple_images'),
+        ('click', 'simple_orientation:'),
+        ('click', 'image_gen_model:'),
+        ('click', 'skip_style'),
+        ('click', 'image_count_simple:2'),
+        ('text', PROMPTS),
+    ],
+    'edit': [
+        ('command', '/start'),
+        ('click', 'edit_image'),
+        ('photo', None),
+        ('text', EDIT_PROMPTS),
+    ],
+    'video': [
+        ('command', '/start'),
+        ('click', 'video_generation'),
+        ('click', 'video_text_to_video'),
+        ('click', 'video_quality:480p'),
+        ('click', 'video_duration:5'),
+        ('click', 'aspect_ratio:16:9'),
+        ('text', PROMPTS),
+        ('click', 'generate_as_is'),
+    ],
+    'purchase': [
+        ('command', '/start'),
+        ('click', 'credit_packages'),
+        ('click', 'buy_credits:'),
+        ('click', 'check_payment:'),
+    ],
+}
+
+# Задачи, запущенные обработчиками текущего шага (заполняется фабрикой задач)
+_step_tasks = contextvars.ContextVar('step_tasks', default=None)
+
+
+def _task_factory(loop, coro, **kwargs):
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    tasks = _step_tasks.get()
+    if tasks is not None:
+        tasks.add(task)
+    return task
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4) if values else 0.0,
+        'p50': round(percentile(values, 0.50), 4),
+        'p95': round(percentile(values, 0.95), 4),
+        'p99': round(percentile(values, 0.99), 4),
+        'max': round(max(values), 4) if values else 0.0,
+    }
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in FLOWS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий {name}, доступны: {', '.join(FLOWS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class FlowError(Exception):
+    pass
+
+
+class LoadTest:
+    def __init__(self, args, services: FakeServices):
+        self.args = args
+        self.services = services
+        self.rng = random.Random(args.seed)
+        self.update_id = 0
+        self.app = None
+        self.flow_times = defaultdict(list)
+        self.step_times = defaultdict(lambda: defaultdict(list))
+        self.flow_errors = defaultdict(int)
+        self.error_samples = []
+        # Ошибки обработчиков по user_id (из error handler приложения)
+        self.handler_errors = defaultdict(list)
+
+    async def setup(self):
+        import bot
+        from database import analytics_db
+        self.bot_module = bot
+        self.analytics_db = analytics_db
+        self.app = bot.build_application(
+            LOAD_TEST_TOKEN,
+            base_url=f"{self.services.base}/bot",
+            base_file_url=f"{self.services.base}/file/bot",
+            connection_pool_size=max(8, self.args.users * 2),
+        )
+        self.app.add_error_handler(self._record_handler_error)
+        await bot.init_http_session()
+        await self.app.initialize()
+
+        # Пользователи с запасом кредитов, чтобы сценарии не упирались в лимиты
+        loop = asyncio.get_event_loop()
+        for user_id in self.user_ids():
+            await loop.run_in_executor(None, analytics_db.add_user, user_id, f"load{user_id}", "Load", "Test")
+            await loop.run_in_executor(None, analytics_db.add_credits, user_id, 100000, None, "Нагрузочный тест")
+
+    async def teardown(self):
+        await self.app.shutdown()
+        await self.bot_module.close_http_session()
+
+    async def _record_handler_error(self, update, context):
+        user = getattr(update, 'effective_user', None)
+        self.handler_errors[user.id if user else None].append(repr(context.error)[:300])
+
+    def user_ids(self):
+        return range(FIRST_USER_ID, FIRST_USER_ID + self.args.users)
+
+    # ==================== Синтетические обновления ====================
+
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'last_name': 'Test',
+                'username': f"load{user_id}", 'language_code': 'ru'}
+
+    def _message(self, user_id, **fields):
+        message = {'message_id': self._next_update_id(), 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)}
+        message.update(fields)
+        return {'update_id': self._next_update_id(), 'message': message}
+
+    def build_update(self, user_id, kind, value):
+        if kind == 'command':
+            return self._message(user_id, text=value,
+                                 entities=[{'type': 'bot_command', 'offset': 0, 'length': len(value.split()[0])}])
+        if kind == 'text':
+            text = self.rng.choice(value) if isinstance(value, list) else value
+            return self._message(user_id, text=text)
+        if kind == 'photo':
+            file_id = f"photo{self._next_update_id()}"
+            return self._message(user_id, photo=[{'file_id': file_id, 'file_unique_id': 'u' + file_id,
+                                                  'width': 1024, 'height': 1024, 'file_size': 2048}])
+        if kind == 'click':
+            call = self.services.last_keyboard_message(user_id)
+            buttons = [button.get('callback_data') for row in (call['params']['reply_markup']['inline_keyboard']
+                                                               if call else [])
+                       for button in row if button.get('callback_data')]
+            matches = [data for data in buttons if data == value or (value.endswith(':') and data.startswith(value))
+                       or data.startswith(value + ':') or (data.startswith(value) and value.endswith(tuple('0123456789')))]
+            if not matches:
+                raise FlowError(f"нет кнопки {value!r} среди {buttons[:12]}")
+            data = self.rng.choice(matches)
+            message = call['result'] or {'message_id': 1, 'date': int(time.time()),
+                                         'chat': {'id': user_id, 'type': 'private'}}
+            return {'update_id': self._next_update_id(), 'callback_query': {
+                'id': str(self._next_update_id()), 'from': self._user(user_id), 'chat_instance': str(user_id),
+                'data': data, 'message': message}}
+        raise ValueError(kind)
+
+    # ==================== Выполнение сценариев ====================
+
+    async def run_step(self, user_id, kind, value) -> float:
+        from telegram import Update
+        update = Update.de_json(self.build_update(user_id, kind, value), self.app.bot)
+        tasks = set()
+        token = _step_tasks.set(tasks)
+        started = time.perf_counter()
+        try:
+            await self.app.process_update(update)
+        finally:
+            _step_tasks.reset(token)
+        # Дожидаемся фоновой работы шага, включая задачи, запущенные из нее
+        deadline = started + self.args.step_timeout
+        while True:
+            pending = [task for task in tasks if not task.done()]
+            if not pending:
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise FlowError(f"шаг {kind} {value!r} не завершился за {self.args.step_timeout} с")
+            await asyncio.wait(pending, timeout=remaining)
+        return time.perf_counter() - started
+
+    def _bot_error_text(self, user_id, since: int):
+        for call in self.services.chats.get(user_id, [])[since:]:
+            text = call['params'].get('text') or ''
+            if isinstance(text, str) and text.startswith('❌'):
+                return text.split('\n')[0][:200]
+        return None
+
+    async def run_flow(self, user_id, name):
+        since = len(self.services.chats.get(user_id, []))
+        errors_before = len(self.handler_errors[user_id])
+        started = time.perf_counter()
+        try:
+            for index, (kind, value) in enumerate(FLOWS[name]):
+                elapsed = await self.run_step(user_id, kind, value)
+                label = f"{index + 1}:{kind}:{value if isinstance(value, str) else '...'}"
+                self.step_times[name][label].append(elapsed)
+            error = self._bot_error_text(user_id, since)
+            if len(self.handler_errors[user_id]) > errors_before:
+                error = self.handler_errors[user_id][-1]
+        except FlowError as e:
+            error = str(e)
+        duration = time.perf_counter() - started
+        if error:
+            self.flow_errors[name] += 1
+            if len(self.error_samples) < 30:
+                self.error_samples.append({'flow': name, 'user_id': user_id, 'error': error})
+        else:
+            self.flow_times[name].append(duration)
+
+    async def run_user(self, user_id, mix):
+        names, weights = list(mix), list(mix.values())
+        for _ in range(self.args.flows_per_user):
+            await self.run_flow(user_id, self.rng.choices(names, weights)[0])
+
+    async def run(self, mix):
+        return await asyncio.gather(*(self.run_user(user_id, mix) for user_id in self.user_ids()))
+
+
+def db_method_summary(limit=10):
+    """Самые затратные методы AnalyticsDB по метрикам процесса"""
+    from metrics import metrics_registry
+    metric = metrics_registry.get('bot_db_method_duration_seconds')
+    if metric is None:
+        return {}
+    totals = {}
+    for (method,), child in metric._items():
+        counts, total = child.snapshot()
+        if sum(counts):
+            totals[method] = {'calls': sum(counts), 'total_s': round(total, 4),
+                              'mean_ms': round(total / sum(counts) * 1000, 3)}
+    return dict(sorted(totals.items(), key=lambda item: item[1]['total_s'], reverse=True)[:limit])
+
+
+def git_commit(directory: str = None):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=directory or os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def load_baseline(path, results_dir=RESULTS_DIR):
+    if path == 'latest':
+        runs = sorted(glob.glob(os.path.join(results_dir, '*.json')))
+        if not runs:
+            return None, None
+        path = runs[-1]
+    with open(path, encoding='utf-8') as f:
+        return path, json.load(f)
+
+
+def compare(result, baseline, threshold):
+    """Печатает сравнение с базовым прогоном и возвращает список регрессий"""
+    regressions = []
+    print(f"\n📊 Сравнение с {baseline.get('started_at')} ({baseline.get('git_commit') or '?'}):")
+    for name, stats in result['flows'].items():
+        old = baseline.get('flows', {}).get(name)
+        if not old or not old.get('count') or not stats['count']:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            change = (stats[key] - old[key]) / old[key] if old[key] else 0.0
+            marker = ''
+            if change > threshold:
+                marker = ' ⚠️ регрессия'
+                regressions.append(f"{name} {key}: {old[key]:.3f} → {stats[key]:.3f} с ({change:+.0%})")
+            print(f"  {name:<9} {key}: {old[key]:.3f} → {stats[key]:.3f} с ({change:+.0%}){marker}")
+    old_tp, new_tp = baseline.get('throughput_flows_per_s') or 0, result['throughput_flows_per_s']
+    if old_tp:
+        change = (new_tp - old_tp) / old_tp
+        marker = ''
+        if change < -threshold:
+            marker = ' ⚠️ регрессия'
+            regressions.append(f"пропускная способность: {old_tp:.2f} → {new_tp:.2f} сценариев/с ({change:+.0%})")
+        print(f"  пропускная способность: {old_tp:.2f} → {new_tp:.2f} сценариев/с ({change:+.0%}){marker}")
+    return regressions
+
+
+async def main_async(args):
+    services = FakeServices(
+        replicate=LatencyModel(args.replicate_median, args.replicate_sigma, args.replicate_failure_rate),
+        preflight=LatencyModel(args.preflight_median, 0.3),
+        openai=LatencyModel(args.openai_median, 0.3, args.openai_failure_rate),
+        telegram=LatencyModel(args.telegram_median, 0.3),
+        betatransfer=LatencyModel(args.betatransfer_median, 0.3),
+        seed=args.seed,
+    )
+    await services.start()
+    os.environ.update(services.environ())
+
+    # База, трассы и прочие файлы бота - во временной директории
+    workdir = tempfile.mkdtemp(prefix="bot_load_")
+    os.environ.pop('DATABASE_URL', None)
+    os.chdir(workdir)
+
+    asyncio.get_event_loop().set_task_factory(_task_factory)
+    rss_start = rss_mb()
+    test = LoadTest(args, services)
+    await test.setup()
+    rss_ready = rss_mb()
+
+    print(f"🚀 {args.users} пользователей × {args.flows_per_user} сценариев, смесь {args.mix}, заглушки на {services.base}")
+    started_at = datetime.now().isoformat(timespec='seconds')
+    started = time.perf_counter()
+    await test.run(args.mix)
+    wall = time.perf_counter() - started
+    await test.teardown()
+    await services.stop()
+
+    completed = sum(len(times) for times in test.flow_times.values())
+    failed = sum(test.flow_errors.values())
+    result = {
+        'started_at': started_at,
+        'git_commit': git_commit(),
+        'config': {
+            'users': args.users, 'flows_per_user': args.flows_per_user, 'mix': args.mix, 'seed': args.seed,
+            'replicate': services.replicate_latency.to_dict(), 'preflight': services.preflight_latency.to_dict(),
+            'openai': services.openai_latency.to_dict(), 'telegram': services.telegram_latency.to_dict(),
+            'betatransfer': services.betatransfer_latency.to_dict(),
+        },
+        'wall_time_s': round(wall, 3),
+        'throughput_flows_per_s': round(completed / wall, 4) if wall else 0.0,
+        'flows': {name: dict(summarize(test.flow_times.get(name, [])), errors=test.flow_errors.get(name, 0))
+                  for name in args.mix},
+        'steps': {name: {label: summarize(values) for label, values in steps.items()}
+                  for name, steps in test.step_times.items()},
+        'memory_mb': {'rss_start': round(rss_start, 1), 'rss_after_setup': round(rss_ready, 1),
+                      'rss_end': round(rss_mb(), 1),
+                      'max_rss': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        'external_calls': dict(sorted(services.calls.items())),
+        'db_methods': db_method_summary(),
+        'errors': test.error_samples,
+    }
+
+    print()
+    print("=" * 72)
+    print(f"{'Сценарий':<10}{'успешно':>8}{'ошибок':>8}{'p50, с':>10}{'p95, с':>10}{'p99, с':>10}{'max, с':>10}")
+    for name, stats in result['flows'].items():
+        print(f"{name:<10}{stats['count']:>8}{stats['errors']:>8}{stats['p50']:>10.3f}{stats['p95']:>10.3f}"
+              f"{stats['p99']:>10.3f}{stats['max']:>10.3f}")
+    print(f"\n⏱️  {completed} сценариев за {wall:.1f} с: {result['throughput_flows_per_s']:.2f} сценариев/с, "
+          f"ошибок {failed}")
+    memory = result['memory_mb']
+    print(f"💾 RSS: {memory['rss_start']} → {memory['rss_end']} MB (пик {memory['max_rss']} MB)")
+    print(f"🔌 Вызовы: {result['external_calls']}")
+    for sample in result['errors'][:5]:
+        print(f"❌ {sample['flow']} ({sample['user_id']}): {sample['error']}")
+
+    regressions = []
+    if args.compare:
+        baseline_path, baseline = load_baseline(args.compare, args.out)
+        if baseline is None:
+            print("\nℹ️ Сохраненных прогонов для сравнения нет")
+        else:
+            regressions = compare(result, baseline, args.regression_threshold)
+            result['compared_with'] = os.path.basename(baseline_path)
+            result['regressions'] = regressions
+
+    if not args.no_save:
+        os.makedirs(args.out, exist_ok=True)
+        path = os.path.join(args.out, datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результат сохранен: {path}")
+
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота с заглушками внешних сервисов")
+    parser.add_argument('--users', type=int, default=20, help="Одновременных пользователей")
+    parser.add_argument('--flows-per-user', type=int, default=3, help="Сценариев на пользователя")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('image=6,edit=2,video=1,purchase=1'),
+                        help="Веса сценариев, например image=6,edit=2,video=1,purchase=1")
+    parser.add_argument('--replicate-median', type=float, default=2.0, help="Медиана генерации Replicate, с")
+    parser.add_argument('--replicate-sigma', type=float, default=0.5, help="Разброс (sigma логнормального)")
+    parser.add_argument('--replicate-failure-rate', type=float, default=0.02, help="Доля неудачных генераций")
+    parser.add_argument('--preflight-median', type=float, default=0.2, help="Медиана replicate/hello-world, с")
+    parser.add_argument('--openai-median', type=float, default=0.5, help="Медиана OpenAI chat, с")
+    parser.add_argument('--openai-failure-rate', type=float, default=0.0, help="Доля ошибок OpenAI")
+    parser.add_argument('--telegram-median', type=float, default=0.03, help="Медиана ответа Bot API, с")
+    parser.add_argument('--betatransfer-median', type=float, default=0.15, help="Медиана ответа Betatransfer, с")
+    parser.add_argument('--step-timeout', type=float, default=600, help="Предел длительности шага, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=RESULTS_DIR, help="Директория результатов")
+    parser.add_argument('--no-save', action='store_true', help="Не сохранять результат")
+    parser.add_argument('--compare', help="Файл прошлого прогона или latest")
+    parser.add_argument('--regression-threshold', type=float, default=0.2,
+                        help="Допустимый рост p50/p95/p99 и падение пропускной способности (доля)")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Код выхода 1 при регрессии")
+    args = parser.parse_args()
+    args.out = os.path.abspath(args.out)
+    if args.compare and args.compare != 'latest':
+        args.compare = os.path.abspath(args.compare)
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест пропускной способности callback'ов Betatransfer
+
+Поднимает HTTP сервер бота (create_web_app из bot.py) на локальном порту
+с временной SQLite базой, создает pending платежи и отправляет на
+/payment/ca подписанные callback'и (включая дубликаты) с заданной
+параллельностью. В конце выводит RPS, задержки и проверяет, что каждый
+платеж зачислен ровно один раз и получил ровно одно уведомление в outbox.
+
+Использование:
+    python load_test_callbacks.py [--payments 500] [--duplicates 2] [--concurrency 50]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+# База и ключи должны быть настроены до импорта bot/database
+WORKDIR = tempfile.mkdtemp(prefix="callback_load_")
+os.environ.pop('DATABASE_URL', None)
+os.environ['BETATRANSFER_SECRET_KEY'] = 'load-test-secret'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORKDIR)
+
+import aiohttp
+
+import bot
+from database import analytics_db
+
+
+class FakeBot:
+    """Заглушка telegram.Bot: считает уведомления вместо отправки"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.update_queue = asyncio.Queue()
+
+
+def signed_callback(payment_id: str, order_id: str, amount: str) -> dict:
+    sign = hashlib.md5((amount + order_id + os.environ['BETATRANSFER_SECRET_KEY']).encode('utf-8')).hexdigest()
+    return {
+        'id': payment_id,
+        'orderId': order_id,
+        'amount': amount,
+        'currency': 'KGS',
+        'status': 'completed',
+        'sign': sign,
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(payments: int, duplicates: int, concurrency: int, port: int):
+    # Готовим pending платежи
+    for i in range(payments):
+        user_id = 1000 + i
+        analytics_db.add_user(user_id)
+        analytics_db.create_payment_with_credits(user_id, 100.0, 'KGS', f'bt{i}', f'order{i}', 50)
+
+    application = FakeApplication()
+    runner = await bot.start_web_server(application, port)
+
+    requests_data = [signed_callback(f'bt{i}', f'order{i}', '100.0')
+                     for _ in range(duplicates) for i in range(payments)]
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    url = f'http://127.0.0.1:{port}/payment/ca'
+
+    async with aiohttp.ClientSession() as session:
+        async def send(data):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, data=data) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(data) for data in requests_data))
+        elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+
+    credited = sum(1 for i in range(payments) if analytics_db.get_user_credits(1000 + i)['balance'] == 50)
+    over_credited = sum(1 for i in range(payments) if analytics_db.get_user_credits(1000 + i)['balance'] > 50)
+
+    print(f"📊 Callback'ов отправлено: {len(requests_data)} (платежей {payments}, дубликатов x{duplicates})")
+    print(f"⏱️ Общее время: {elapsed:.2f} с, пропускная способность: {len(requests_data) / elapsed:.1f} запросов/с")
+    print(f"📈 Задержка p50: {percentile(latencies, 0.5) * 1000:.1f} мс, "
+          f"p95: {percentile(latencies, 0.95) * 1000:.1f} мс, p99: {percentile(latencies, 0.99) * 1000:.1f} мс")
+    print(f"🔢 Коды ответов: {statuses}")
+    print(f"💰 Зачислено ровно один раз: {credited}/{payments}, зачислено повторно: {over_credited}")
+    with analytics_db.get_connection() as conn:
+        queued = conn.cursor().execute("SELECT COUNT(*) FROM notification_outbox").fetchone()[0]
+    print(f"📱 Уведомлений в очереди: {queued}")
+
+    return credited == payments and over_credited == 0 and queued == payments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест callback'ов Betatransfer")
+    parser.add_argument('--payments', type=int, default=500)
+    parser.add_argument('--duplicates', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    print(f"🗄️ Временная база: {WORKDIR}")
+    ok = asyncio.run(run(args.payments, args.duplicates, args.concurrency, args.port))
+    print("✅ Тест пройден" if ok else "❌ Обнаружены ошибки зачисления")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
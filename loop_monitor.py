@@ -0,0 +1,230 @@
+"""
+Задержка event loop и поиск блокирующих вызовов
+
+Корутина-пульс раз в LOOP_LAG_INTERVAL засыпает на интервал и замеряет,
+насколько позже ее разбудили: это время, в течение которого loop был занят
+чужим синхронным кодом. Все замеры идут в гистограмму
+bot_event_loop_lag_seconds.
+
+Отдельный поток-сторож следит за пульсом. Если пульс не приходит дольше
+LOOP_LAG_THRESHOLD, loop заблокирован прямо сейчас - сторож снимает стек
+потока loop (sys._current_frames) и запоминает текущую задачу asyncio.
+Место блокировки - ближайший к вершине стека кадр из файлов проекта,
+например bot.py:5120 extract_scenes_from_script. Когда loop
+освобождается, длительность блокировки приписывается этому месту; самые
+затратные места выводит /loop_lag.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Dict, List, Optional
+
+from metrics import metrics_registry
+
+LOOP_MONITOR_ENABLED = os.getenv('LOOP_MONITOR_ENABLED', 'true').lower() != 'false'
+# Период пульса (секунды)
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+# Задержка, начиная с которой снимается стек и блокировка попадает в отчет
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.2'))
+# Сколько последних замеров держать для квантилей (3000 по 0.1 с - около 5 минут)
+LOOP_LAG_WINDOW = int(os.getenv('LOOP_LAG_WINDOW', '3000'))
+# Предел числа различных мест блокировки (ограничивает и метки метрик)
+LOOP_BLOCKING_SITES_MAX = int(os.getenv('LOOP_BLOCKING_SITES_MAX', '50'))
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNKNOWN_SITE = 'unknown'
+
+LOOP_LAG = metrics_registry.histogram(
+    'bot_event_loop_lag_seconds', "Задержка пробуждения корутины-пульса event loop", buckets=LAG_BUCKETS)
+LOOP_STALLS = metrics_registry.counter(
+    'bot_event_loop_stalls_total', "Блокировки event loop дольше порога по месту в коде", ['site'])
+LOOP_STALLED_SECONDS = metrics_registry.counter(
+    'bot_event_loop_stalled_seconds_total', "Суммарное время блокировок event loop по месту в коде", ['site'])
+
+_PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class BlockingSite:
+    """Статистика одного места блокировки"""
+
+    __slots__ = ('site', 'count', 'total', 'max', 'task', 'stack', 'last_seen')
+
+    def __init__(self, site: str):
+        self.site = site
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.task = None
+        self.stack: List[str] = []
+        self.last_seen = 0.0
+
+    def to_dict(self) -> Dict:
+        return {'site': self.site, 'count': self.count, 'total_s': round(self.total, 3),
+                'max_s': round(self.max, 3), 'task': self.task, 'stack': ''.join(self.stack)}
+
+
+class _Capture:
+    __slots__ = ('beat', 'site', 'task', 'stack')
+
+    def __init__(self, beat: float, site: str, task: Optional[str], stack: List[str]):
+        self.beat = beat
+        self.site = site
+        self.task = task
+        self.stack = stack
+
+
+def _is_project_frame(filename: str) -> bool:
+    return (filename.startswith(_PROJECT_ROOT) and 'site-packages' not in filename
+            and os.path.basename(filename) != 'loop_monitor.py')
+
+
+class LoopLagMonitor:
+    """Пульс event loop и поток-сторож, снимающий стек при блокировке"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD,
+                 window: int = LOOP_LAG_WINDOW, max_sites: int = LOOP_BLOCKING_SITES_MAX):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_sites = max_sites
+        self._lags = deque(maxlen=window)
+        self._sites: Dict[str, BlockingSite] = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+        self._last_beat = None
+        self._capture: Optional[_Capture] = None
+        metrics_registry.callback('bot_event_loop_lag_max_seconds',
+                                  "Максимальная задержка event loop в окне последних замеров",
+                                  lambda: max(self._lags, default=0.0))
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запускает пульс в текущем event loop и поток-сторож"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._heartbeat(), name='loop-lag-monitor')
+        self._watchdog = threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True)
+        self._watchdog.start()
+        logging.info(f"🫀 Мониторинг event loop: пульс {self.interval} с, порог {self.threshold} с")
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            beat = time.perf_counter()
+            self._last_beat = beat
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - beat - self.interval)
+            self._observe(beat, lag)
+
+    def _observe(self, beat: float, lag: float):
+        LOOP_LAG.observe(lag)
+        self._lags.append(lag)
+        if lag < self.threshold:
+            return
+        capture = self._capture
+        if capture is None or capture.beat != beat:
+            # Блокировка короче шага сторожа - стек снять не успели
+            capture = _Capture(beat, UNKNOWN_SITE, None, [])
+        self._capture = None
+        with self._lock:
+            stats = self._sites.get(capture.site)
+            if stats is None:
+                if len(self._sites) >= self.max_sites:
+                    # Вытесняем место с наименьшим суммарным временем
+                    del self._sites[min(self._sites.values(), key=lambda s: s.total).site]
+                stats = self._sites[capture.site] = BlockingSite(capture.site)
+            stats.count += 1
+            stats.total += lag
+            stats.max = max(stats.max, lag)
+            stats.last_seen = time.time()
+            if capture.stack:
+                stats.task = capture.task
+                stats.stack = capture.stack
+        LOOP_STALLS.labels(capture.site).inc()
+        LOOP_STALLED_SECONDS.labels(capture.site).inc(lag)
+        logging.warning(f"🐌 Event loop заблокирован на {lag:.2f} с: {capture.site}"
+                        f"{f' (задача {capture.task})' if capture.task else ''}")
+
+    def _watch(self):
+        step = max(0.01, min(self.interval, self.threshold) / 2)
+        while not self._stop.wait(step):
+            beat = self._last_beat
+            if beat is None:
+                continue
+            stalled = time.perf_counter() - beat - self.interval
+            if stalled >= self.threshold and (self._capture is None or self._capture.beat != beat):
+                try:
+                    self._capture = self._capture_stack(beat)
+                except Exception as e:
+                    logging.debug(f"Не удалось снять стек event loop: {e}")
+
+    def _capture_stack(self, beat: float) -> Optional[_Capture]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        site_frame = next((entry for entry in reversed(stack) if _is_project_frame(entry.filename)), stack[-1])
+        site = f"{os.path.basename(site_frame.filename)}:{site_frame.lineno} {site_frame.name}"
+        task = None
+        current = getattr(asyncio.tasks, '_current_tasks', {}).get(self._loop)
+        if current is not None:
+            coro = current.get_coro()
+            task = f"{current.get_name()} {getattr(coro, '__qualname__', coro)}"
+        return _Capture(beat, site, task, traceback.format_list(stack[-12:]))
+
+    def lag_quantiles(self) -> Dict[str, float]:
+        lags = sorted(self._lags)
+        if not lags:
+            return {'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+        return {'p50': lags[len(lags) // 2], 'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+                'max': lags[-1]}
+
+    def top_sites(self, limit: int = 10) -> List[BlockingSite]:
+        with self._lock:
+            sites = list(self._sites.values())
+        return sorted(sites, key=lambda site: site.total, reverse=True)[:limit]
+
+    def format_report(self, limit: int = 5, stack_frames: int = 4) -> str:
+        """Текстовый отчет для /loop_lag"""
+        quantiles = self.lag_quantiles()
+        lines = [f"🫀 Задержка event loop за последние {len(self._lags)} замеров "
+                 f"(пульс {self.interval} с, порог {self.threshold} с):",
+                 f"p50 {quantiles['p50'] * 1000:.1f} мс, p99 {quantiles['p99'] * 1000:.1f} мс, "
+                 f"максимум {quantiles['max'] * 1000:.1f} мс"]
+        sites = self.top_sites(limit)
+        if not sites:
+            lines.append("\n✅ Блокировок дольше порога не было")
+            return '\n'.join(lines)
+        lines.append("\n🐌 Места блокировок (по суммарному времени):")
+        for stats in sites:
+            lines.append(f"\n{stats.site}: {stats.count} раз, всего {stats.total:.2f} с, максимум {stats.max:.2f} с")
+            if stats.task:
+                lines.append(f"  задача: {stats.task}")
+            if stack_frames and stats.stack:
+                lines.append(''.join(stats.stack[-stack_frames:]).rstrip())
+        return '\n'.join(lines)
+
+
+# Общий монитор процесса (запускается вместе с сервисами бота)
+loop_monitor = LoopLagMonitor()
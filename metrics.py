@@ -0,0 +1,362 @@
+"""
+Метрики процесса бота в текстовом формате Prometheus
+
+Реестр хранит счетчики, gauge и гистограммы в памяти процесса. Запись
+значения - это поиск дочерней серии по кортежу меток и несколько операций
+под ее собственной блокировкой, поэтому инструментирование горячих путей
+(генерация, запросы к базе, отправка в Telegram) почти ничего не стоит.
+Текст для /metrics собирается только при запросе.
+
+Значения, которые и так считаются в других местах (статистика поллера
+платежей, очередь пула потоков), регистрируются как callback-метрики и
+читаются в момент выгрузки.
+"""
+
+import functools
+import math
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Границы для запросов к базе: большинство укладывается в миллисекунды
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterChild:
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def get(self) -> float:
+        return self._value
+
+
+class _GaugeChild:
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def get(self) -> float:
+        return self._value
+
+
+class _HistogramChild:
+    __slots__ = ('_upper_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self._upper_bounds = upper_bounds
+        # Последняя корзина - +Inf
+        self._counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """Контекстный менеджер, измеряющий время блока"""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Timer:
+    __slots__ = ('_child', '_started')
+
+    def __init__(self, child: _HistogramChild):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._started)
+        return False
+
+
+class _Metric:
+    """Базовый класс метрики с дочерними сериями по значениям меток"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._child_for(())
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _child_for(self, key: Tuple[str, ...]):
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def labels(self, *values):
+        """Серия с указанными значениями меток (в порядке labelnames)"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидается {len(self.labelnames)} меток, передано {len(values)}")
+        return self._child_for(tuple(str(value) for value in values))
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for key, child in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def samples(self):
+        for key, child in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(float(bound) for bound in buckets if bound != math.inf))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def samples(self):
+        bounds = self.upper_bounds + (math.inf,)
+        for key, child in self._items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric(_Metric):
+    """
+    Метрика, значение которой читается функцией в момент выгрузки
+
+    Функция возвращает число (метрика без меток) или словарь
+    {значение метки или кортеж значений: число}.
+    """
+
+    def __init__(self, name: str, documentation: str, func: Callable, labelnames: Sequence[str] = (),
+                 kind: str = 'gauge'):
+        self.func = func
+        self.kind = kind
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return None
+
+    def samples(self):
+        value = self.func()
+        if value is None:
+            return
+        if not isinstance(value, dict):
+            yield f"{self.name} {_format_value(value)}"
+            return
+        for key, sample in sorted(value.items(), key=lambda item: str(item[0])):
+            key = key if isinstance(key, tuple) else (key,)
+            yield f"{self.name}{_format_labels(self.labelnames, [str(part) for part in key])} {_format_value(sample)}"
+
+
+class MetricsRegistry:
+    """Набор метрик процесса; повторная регистрация имени возвращает ту же метрику"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Метрика {metric.name} уже зарегистрирована с другим типом или метками")
+                if isinstance(metric, CallbackMetric):
+                    # Callback заменяется: например, при перезапуске поллера платежей
+                    existing.func = metric.func
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, func: Callable, labelnames: Sequence[str] = (),
+                 kind: str = 'gauge') -> CallbackMetric:
+        return self._register(CallbackMetric(name, documentation, func, labelnames, kind))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # Сломанный callback не должен ронять выгрузку остальных метрик
+                lines.append(f"# {metric.name}: ошибка сбора: {e}".replace('\n', ' '))
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation.replace(chr(10), ' ')}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_methods(cls, duration: Histogram, errors: Counter, exclude: Iterable[str] = ()):
+    """
+    Оборачивает публичные методы класса замером времени
+
+    Время каждого вызова пишется в duration с меткой method, исключения
+    считаются в errors с той же меткой и пробрасываются дальше.
+    """
+    exclude = set(exclude)
+    for name, func in list(vars(cls).items()):
+        if name.startswith('_') or name in exclude or not callable(func) or isinstance(func, (staticmethod, classmethod)):
+            continue
+        setattr(cls, name, _timed_method(func, duration.labels(name), errors.labels(name)))
+    return cls
+
+
+def _timed_method(func, duration_child: _HistogramChild, errors_child: _CounterChild):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            errors_child.inc()
+            raise
+        finally:
+            duration_child.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def timed_async(duration_child: _HistogramChild):
+    """Декоратор корутины: пишет время каждого вызова в серию гистограммы"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                duration_child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# Общий реестр процесса
+metrics_registry = MetricsRegistry()
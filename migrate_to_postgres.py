@@ -1,22 +1,60 @@
 #!/usr/bin/env python3
 """
 Скрипт миграции данных из SQLite в PostgreSQL
-Использование: python migrate_to_postgres.py
+Использование: python migrate_to_postgres.py [--fresh] [--yes] [--workers N] [--batch-size N]
+
+Таблицы читаются потоково (fetchmany по rowid, память не зависит от размера
+таблицы), преобразуются по колонкам целой пачкой и загружаются в PostgreSQL
+через COPY. После каждой пачки в той же транзакции сохраняется контрольная
+точка в таблице migration_checkpoints, поэтому прерванная миграция
+продолжается с места остановки. Независимые таблицы переносятся параллельно,
+в конце сверяются число строк и контрольные суммы.
+
+--fresh очищает таблицы PostgreSQL и контрольные точки перед переносом.
 """
 
+import argparse
+import hashlib
+import io
+import logging
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import logging
-from datetime import datetime
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_sqlite_connection():
+SQLITE_PATH = "bot_analytics.db"
+# Строк в одной пачке COPY (и в одной транзакции)
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '5000'))
+# Сколько таблиц переносить одновременно
+MIGRATION_WORKERS = int(os.getenv('MIGRATION_WORKERS', '4'))
+
+# Этапы переноса с учетом внешних ключей: таблицы внутри этапа независимы
+# и переносятся параллельно, следующий этап начинается после предыдущего
+MIGRATION_STAGES = [
+    ['users'],
+    ['payments', 'generations', 'errors', 'user_actions', 'user_limits', 'user_credits',
+     'notification_outbox', 'stats_hourly', 'stats_daily', 'stats_daily_users',
+     'stats_daily_totals', 'stats_daily_revenue', 'latency_sketches',
+     'user_generation_stats', 'archive_log'],
+    ['credit_transactions'],
+]
+
+CHECKPOINT_TABLE = 'migration_checkpoints'
+
+_INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+_FLOAT_TYPES = ('real', 'double precision', 'numeric')
+
+
+def get_sqlite_connection(path: str = SQLITE_PATH):
     """Подключение к SQLite базе"""
-    return sqlite3.connect("bot_analytics.db")
+    return sqlite3.connect(path)
+
 
 def get_postgres_connection():
     """Подключение к PostgreSQL базе"""
@@ -25,106 +63,359 @@ def get_postgres_connection():
         raise ValueError("DATABASE_URL не установлен. Установите переменную окружения DATABASE_URL")
     return psycopg2.connect(db_url)
 
-def migrate_table(sqlite_conn, postgres_conn, table_name, columns, transform_func=None):
-    """Миграция таблицы из SQLite в PostgreSQL"""
-    try:
-        # Получаем данные из SQLite
-        sqlite_cursor = sqlite_conn.cursor()
-        sqlite_cursor.execute(f"SELECT * FROM {table_name}")
-        rows = sqlite_cursor.fetchall()
-        
-        if not rows:
-            logging.info(f"Таблица {table_name} пуста, пропускаем")
-            return
-        
-        # Получаем названия колонок
-        column_names = [description[0] for description in sqlite_cursor.description]
-        
-        # Подготавливаем данные для PostgreSQL
-        postgres_cursor = postgres_conn.cursor()
-        
-        # Создаем плейсхолдеры для INSERT
-        placeholders = ', '.join(['%s'] * len(column_names))
-        columns_str = ', '.join(column_names)
-        
-        insert_query = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders})"
-        
-        migrated_count = 0
+
+def _to_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 't', 'true', 'yes')
+    return bool(value)
+
+
+def _to_int(value):
+    return value if value is None or isinstance(value, int) else int(value)
+
+
+def _column_transform(pg_type: str) -> Optional[Callable]:
+    """Преобразование значения SQLite под тип колонки PostgreSQL (None - без изменений)"""
+    if pg_type == 'boolean':
+        return _to_bool
+    if pg_type in _INTEGER_TYPES:
+        return _to_int
+    return None
+
+
+def _copy_value(value) -> str:
+    """Значение в текстовом формате COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    text = str(value)
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _copy_buffer(rows) -> io.StringIO:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def _canonical(value, pg_type: str) -> str:
+    """Одинаковое представление значения из SQLite и PostgreSQL для контрольной суммы"""
+    if value is None:
+        return '\\N'
+    if pg_type == 'boolean':
+        return 't' if _to_bool(value) else 'f'
+    if pg_type in _INTEGER_TYPES:
+        return str(int(value))
+    if pg_type in _FLOAT_TYPES:
+        number = float(value)
+        # real в PostgreSQL хранит ~6 значащих цифр
+        return str(int(number)) if number.is_integer() else f'{number:.6g}'
+    if pg_type.startswith('timestamp') or pg_type == 'date':
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                return value
+        if pg_type == 'date' and isinstance(value, datetime):
+            value = value.date()
+        if isinstance(value, datetime):
+            return value.replace(tzinfo=None).isoformat(' ')
+        if isinstance(value, date):
+            return value.isoformat()
+    return str(value)
+
+
+class TableChecksum:
+    """Контрольная сумма таблицы, не зависящая от порядка строк"""
+
+    def __init__(self, types: List[str]):
+        self.types = types
+        self.rows = 0
+        self.total = 0
+
+    def add(self, row):
+        canonical = '\x1f'.join(_canonical(value, pg_type) for value, pg_type in zip(row, self.types))
+        digest = hashlib.md5(canonical.encode('utf-8')).digest()
+        self.total = (self.total + int.from_bytes(digest[:8], 'big')) % (1 << 64)
+        self.rows += 1
+
+    @property
+    def hexdigest(self) -> str:
+        return f'{self.total:016x}'
+
+
+class StreamingMigrator:
+    """Потоковый перенос SQLite -> PostgreSQL с контрольными точками"""
+
+    def __init__(self, sqlite_path: str = SQLITE_PATH, batch_size: int = MIGRATION_BATCH_SIZE,
+                 workers: int = MIGRATION_WORKERS):
+        self.sqlite_path = sqlite_path
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+
+    def ensure_schema(self):
+        """Создает схему PostgreSQL (с миграциями AnalyticsDB) и таблицу контрольных точек"""
+        from database import AnalyticsDB
+        AnalyticsDB(os.getenv('DATABASE_URL')).ensure_schema()
+
+        with get_postgres_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+                    table_name TEXT PRIMARY KEY,
+                    last_rowid BIGINT NOT NULL DEFAULT 0,
+                    rows_copied BIGINT NOT NULL DEFAULT 0,
+                    completed_at TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+
+    def tables(self) -> List[List[str]]:
+        """Этапы переноса: только таблицы, которые есть и в SQLite, и в PostgreSQL"""
+        sqlite_conn = get_sqlite_connection(self.sqlite_path)
+        try:
+            cursor = sqlite_conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            source = {row[0] for row in cursor.fetchall()}
+        finally:
+            sqlite_conn.close()
+
+        with get_postgres_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
+            target = {row[0] for row in cursor.fetchall()}
+
+        stages = [[table for table in stage if table in source and table in target] for stage in MIGRATION_STAGES]
+        return [stage for stage in stages if stage]
+
+    def source_counts(self, tables: List[str]) -> Dict[str, int]:
+        sqlite_conn = get_sqlite_connection(self.sqlite_path)
+        try:
+            cursor = sqlite_conn.cursor()
+            counts = {}
+            for table in tables:
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                counts[table] = cursor.fetchone()[0]
+            return counts
+        finally:
+            sqlite_conn.close()
+
+    def reset(self, tables: List[str]):
+        """Очищает таблицы PostgreSQL и контрольные точки для переноса с нуля"""
+        with get_postgres_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+            cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE}")
+            conn.commit()
+        logging.info(f"🧹 Очищено таблиц PostgreSQL: {len(tables)}")
+
+    def _columns(self, sqlite_conn, pg_cursor, table: str) -> Tuple[List[str], List[str]]:
+        """Общие колонки таблицы и их типы в PostgreSQL"""
+        cursor = sqlite_conn.cursor()
+        cursor.execute(f"PRAGMA table_info({table})")
+        source_columns = [row[1] for row in cursor.fetchall()]
+
+        pg_cursor.execute('''
+            SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+        ''', (table,))
+        target_types = dict(pg_cursor.fetchall())
+
+        skipped = [column for column in source_columns if column not in target_types]
+        if skipped:
+            logging.warning(f"⚠️ {table}: колонок нет в PostgreSQL, пропускаем: {', '.join(skipped)}")
+        columns = [column for column in source_columns if column in target_types]
+        return columns, [target_types[column] for column in columns]
+
+    def _checkpoint(self, pg_cursor, table: str) -> Tuple[int, int, bool]:
+        pg_cursor.execute(
+            f"SELECT last_rowid, rows_copied, completed_at FROM {CHECKPOINT_TABLE} WHERE table_name = %s",
+            (table,)
+        )
+        row = pg_cursor.fetchone()
+        if not row:
+            return 0, 0, False
+        return row[0], row[1], row[2] is not None
+
+    def _save_checkpoint(self, pg_cursor, table: str, last_rowid: int, rows_copied: int, completed: bool = False):
+        pg_cursor.execute(f'''
+            INSERT INTO {CHECKPOINT_TABLE} (table_name, last_rowid, rows_copied, completed_at, updated_at)
+            VALUES (%s, %s, %s, CASE WHEN %s THEN CURRENT_TIMESTAMP END, CURRENT_TIMESTAMP)
+            ON CONFLICT (table_name) DO UPDATE
+            SET last_rowid = EXCLUDED.last_rowid, rows_copied = EXCLUDED.rows_copied,
+                completed_at = EXCLUDED.completed_at, updated_at = CURRENT_TIMESTAMP
+        ''', (table, last_rowid, rows_copied, completed))
+
+    def _insert_rows(self, pg_cursor, table: str, columns: List[str], rows) -> int:
+        """Запасной путь для пачки, которую не принял COPY: построчно, пропуская ошибочные строки"""
+        insert_query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+        inserted = 0
         for row in rows:
+            pg_cursor.execute("SAVEPOINT migrate_row")
             try:
-                # Применяем трансформацию если есть
-                if transform_func:
-                    row = transform_func(row, column_names)
-                
-                postgres_cursor.execute(insert_query, row)
-                migrated_count += 1
-            except Exception as e:
-                logging.warning(f"Ошибка при миграции строки в таблице {table_name}: {e}")
-                continue
-        
-        postgres_conn.commit()
-        logging.info(f"✅ Таблица {table_name}: мигрировано {migrated_count} записей")
-        
-    except Exception as e:
-        logging.error(f"Ошибка миграции таблицы {table_name}: {e}")
-        postgres_conn.rollback()
-
-def transform_users(row, columns):
-    """Трансформация данных пользователей"""
-    # Преобразуем user_id в BIGINT для PostgreSQL
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def transform_generations(row, columns):
-    """Трансформация данных генераций"""
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def transform_payments(row, columns):
-    """Трансформация данных платежей"""
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def transform_credits(row, columns):
-    """Трансформация данных кредитов"""
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def transform_limits(row, columns):
-    """Трансформация данных лимитов"""
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def transform_transactions(row, columns):
-    """Трансформация данных транзакций"""
-    row = list(row)
-    if 'user_id' in columns:
-        user_id_idx = columns.index('user_id')
-        row[user_id_idx] = int(row[user_id_idx])
-    return row
-
-def check_sqlite_exists():
+                pg_cursor.execute(insert_query, row)
+                pg_cursor.execute("RELEASE SAVEPOINT migrate_row")
+                inserted += 1
+            except psycopg2.Error as e:
+                pg_cursor.execute("ROLLBACK TO SAVEPOINT migrate_row")
+                logging.warning(f"Ошибка при миграции строки в таблице {table}: {e}")
+        return inserted
+
+    def _reset_sequence(self, pg_cursor, table: str):
+        """Сдвигает SERIAL-последовательность за перенесенные id"""
+        pg_cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        row = pg_cursor.fetchone()
+        if row and row[0]:
+            pg_cursor.execute(
+                f"SELECT setval(%s, COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table}",
+                (row[0],)
+            )
+
+    def copy_table(self, table: str) -> Dict:
+        """Переносит одну таблицу пачками через COPY, продолжая с контрольной точки"""
+        sqlite_conn = get_sqlite_connection(self.sqlite_path)
+        pg_conn = get_postgres_connection()
+        try:
+            pg_cursor = pg_conn.cursor()
+            last_rowid, copied, completed = self._checkpoint(pg_cursor, table)
+            pg_conn.commit()
+            if completed:
+                logging.info(f"⏭️  {table}: уже перенесена ({copied} записей)")
+                return {'table': table, 'rows': copied, 'skipped': 0}
+
+            columns, types = self._columns(sqlite_conn, pg_cursor, table)
+            transforms = [_column_transform(pg_type) for pg_type in types]
+            column_list = ', '.join(columns)
+            if last_rowid:
+                logging.info(f"↪️  {table}: продолжаем после rowid {last_rowid} ({copied} записей уже перенесено)")
+
+            source = sqlite_conn.cursor()
+            source.execute(
+                f"SELECT rowid, {column_list} FROM {table} WHERE rowid > ? ORDER BY rowid",
+                (last_rowid,)
+            )
+            skipped = 0
+            while True:
+                batch = source.fetchmany(self.batch_size)
+                if not batch:
+                    break
+
+                # Преобразуем пачку по колонкам, а не построчно
+                rowids, *values = zip(*batch)
+                values = [list(map(transform, column)) if transform else column
+                          for transform, column in zip(transforms, values)]
+                rows = list(zip(*values))
+
+                try:
+                    pg_cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", _copy_buffer(rows))
+                    inserted = len(rows)
+                except psycopg2.Error as e:
+                    pg_conn.rollback()
+                    logging.warning(f"⚠️ {table}: COPY пачки не прошел ({e}), переносим построчно")
+                    inserted = self._insert_rows(pg_cursor, table, columns, rows)
+
+                copied += inserted
+                skipped += len(rows) - inserted
+                last_rowid = rowids[-1]
+                # Контрольная точка в той же транзакции, что и данные пачки
+                self._save_checkpoint(pg_cursor, table, last_rowid, copied)
+                pg_conn.commit()
+                logging.info(f"🔄 {table}: перенесено {copied} записей")
+
+            self._reset_sequence(pg_cursor, table)
+            self._save_checkpoint(pg_cursor, table, last_rowid, copied, completed=True)
+            pg_conn.commit()
+            logging.info(f"✅ Таблица {table}: мигрировано {copied} записей" +
+                         (f", пропущено {skipped}" if skipped else ""))
+            return {'table': table, 'rows': copied, 'skipped': skipped}
+        except Exception:
+            pg_conn.rollback()
+            raise
+        finally:
+            sqlite_conn.close()
+            pg_conn.close()
+
+    def verify_table(self, table: str) -> Dict:
+        """Сверяет число строк и контрольную сумму таблицы в SQLite и PostgreSQL"""
+        sqlite_conn = get_sqlite_connection(self.sqlite_path)
+        pg_conn = get_postgres_connection()
+        try:
+            columns, types = self._columns(sqlite_conn, pg_conn.cursor(), table)
+            column_list = ', '.join(columns)
+            transforms = [_column_transform(pg_type) for pg_type in types]
+
+            source_sum = TableChecksum(types)
+            source = sqlite_conn.cursor()
+            source.execute(f"SELECT {column_list} FROM {table}")
+            while True:
+                batch = source.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    source_sum.add([transform(value) if transform else value
+                                    for transform, value in zip(transforms, row)])
+
+            target_sum = TableChecksum(types)
+            # Именованный (серверный) курсор: строки приходят пачками по itersize
+            target = pg_conn.cursor(name=f'verify_{table}')
+            target.itersize = self.batch_size
+            target.execute(f"SELECT {column_list} FROM {table}")
+            for row in target:
+                target_sum.add(row)
+            target.close()
+            pg_conn.commit()
+
+            return {
+                'table': table,
+                'source_rows': source_sum.rows,
+                'target_rows': target_sum.rows,
+                'source_checksum': source_sum.hexdigest,
+                'target_checksum': target_sum.hexdigest,
+                'ok': source_sum.rows == target_sum.rows and source_sum.total == target_sum.total,
+            }
+        finally:
+            sqlite_conn.close()
+            pg_conn.close()
+
+    def migrate(self, stages: List[List[str]]) -> List[Dict]:
+        """Переносит этапы по очереди, таблицы внутри этапа - параллельно"""
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="migrate") as executor:
+            for stage in stages:
+                futures = {table: executor.submit(self.copy_table, table) for table in stage}
+                failed = []
+                for table, future in futures.items():
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        logging.error(f"Ошибка миграции таблицы {table}: {e}")
+                        failed.append(table)
+                if failed:
+                    # Зависимые таблицы не переносим: запустите скрипт повторно, он продолжит с контрольных точек
+                    raise RuntimeError(f"не перенесены таблицы: {', '.join(failed)}")
+        return results
+
+    def verify(self, tables: List[str]) -> List[Dict]:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verify") as executor:
+            return list(executor.map(self.verify_table, tables))
+
+
+def check_sqlite_exists(path: str = SQLITE_PATH):
     """Проверяем, существует ли SQLite файл"""
-    if not os.path.exists("bot_analytics.db"):
-        logging.error("Файл bot_analytics.db не найден!")
+    if not os.path.exists(path):
+        logging.error(f"Файл {path} не найден!")
         return False
     return True
 
+
 def check_postgres_connection():
     """Проверяем подключение к PostgreSQL"""
     try:
@@ -138,102 +429,77 @@ def check_postgres_connection():
         logging.error(f"Ошибка подключения к PostgreSQL: {e}")
         return False
 
-def get_table_stats(sqlite_conn, table_name):
-    """Получаем статистику по таблице"""
-    try:
-        cursor = sqlite_conn.cursor()
-        cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-        count = cursor.fetchone()[0]
-        return count
-    except:
-        return 0
 
-def main():
+def main(fresh: bool = None):
     """Основная функция миграции"""
+    parser = argparse.ArgumentParser(description="Миграция данных из SQLite в PostgreSQL")
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH, help="Путь к SQLite базе")
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE, help="Строк в одной пачке COPY")
+    parser.add_argument('--workers', type=int, default=MIGRATION_WORKERS, help="Сколько таблиц переносить параллельно")
+    parser.add_argument('--fresh', action='store_true', help="Очистить таблицы PostgreSQL и начать заново")
+    parser.add_argument('--yes', action='store_true', help="Не спрашивать подтверждение")
+    args = parser.parse_args()
+    if fresh is not None:
+        args.fresh = fresh
+
     logging.info("🚀 Начинаем миграцию данных из SQLite в PostgreSQL")
-    
+
     # Проверяем наличие SQLite файла
-    if not check_sqlite_exists():
+    if not check_sqlite_exists(args.sqlite_path):
         return
-    
+
     # Проверяем подключение к PostgreSQL
     if not check_postgres_connection():
         return
-    
-    # Подключаемся к базам данных
+
+    migrator = StreamingMigrator(args.sqlite_path, args.batch_size, args.workers)
     try:
-        sqlite_conn = get_sqlite_connection()
-        postgres_conn = get_postgres_connection()
-        
+        migrator.ensure_schema()
+        stages = migrator.tables()
+        tables = [table for stage in stages for table in stage]
+
         logging.info("📊 Статистика SQLite базы данных:")
-        
-        # Получаем статистику по таблицам
-        tables_stats = {}
-        tables = ['users', 'generations', 'errors', 'user_actions', 'payments', 
-                 'user_limits', 'user_credits', 'credit_transactions']
-        
+        tables_stats = migrator.source_counts(tables)
         for table in tables:
-            count = get_table_stats(sqlite_conn, table)
-            tables_stats[table] = count
-            logging.info(f"  {table}: {count} записей")
-        
-        # Спрашиваем подтверждение
+            logging.info(f"  {table}: {tables_stats[table]} записей")
+
         total_records = sum(tables_stats.values())
         if total_records == 0:
             logging.warning("В SQLite базе нет данных для миграции")
             return
-        
-        print(f"\n📋 Найдено {total_records} записей для миграции")
-        confirm = input("Продолжить миграцию? (y/N): ").lower().strip()
-        
-        if confirm != 'y':
-            logging.info("Миграция отменена")
-            return
-        
-        # Начинаем миграцию
-        logging.info("🔄 Начинаем миграцию...")
-        
-        # Мигрируем таблицы в правильном порядке (с учетом внешних ключей)
-        migration_order = [
-            ('users', transform_users),
-            ('generations', transform_generations),
-            ('errors', None),
-            ('user_actions', None),
-            ('payments', transform_payments),
-            ('user_limits', transform_limits),
-            ('user_credits', transform_credits),
-            ('credit_transactions', transform_transactions)
-        ]
-        
-        for table_name, transform_func in migration_order:
-            if tables_stats.get(table_name, 0) > 0:
-                logging.info(f"🔄 Мигрируем таблицу {table_name}...")
-                migrate_table(sqlite_conn, postgres_conn, table_name, None, transform_func)
-            else:
-                logging.info(f"⏭️  Таблица {table_name} пуста, пропускаем")
-        
-        # Проверяем результат
+
+        if not args.yes:
+            print(f"\n📋 Найдено {total_records} записей для миграции")
+            mode = "с очисткой PostgreSQL" if args.fresh else "с продолжением с контрольных точек"
+            confirm = input(f"Продолжить миграцию ({mode})? (y/N): ").lower().strip()
+            if confirm != 'y':
+                logging.info("Миграция отменена")
+                return
+
+        if args.fresh:
+            migrator.reset(tables)
+
+        logging.info(f"🔄 Начинаем миграцию: {len(tables)} таблиц, до {migrator.workers} параллельно")
+        migrator.migrate(stages)
+
         logging.info("🔍 Проверяем результат миграции...")
-        postgres_cursor = postgres_conn.cursor()
-        
-        for table in tables:
-            postgres_cursor.execute(f"SELECT COUNT(*) FROM {table}")
-            count = postgres_cursor.fetchone()[0]
-            original_count = tables_stats.get(table, 0)
-            status = "✅" if count == original_count else "⚠️"
-            logging.info(f"  {status} {table}: {count}/{original_count} записей")
-        
-        logging.info("🎉 Миграция завершена!")
-        logging.info("💡 Теперь можно безопасно обновлять бота на Railway")
-        
+        mismatches = 0
+        for result in migrator.verify(tables):
+            status = "✅" if result['ok'] else "⚠️"
+            mismatches += 0 if result['ok'] else 1
+            logging.info(f"  {status} {result['table']}: {result['target_rows']}/{result['source_rows']} записей, "
+                         f"checksum {result['target_checksum']}/{result['source_checksum']}")
+
+        if mismatches:
+            logging.warning(f"⚠️ Расхождения в {mismatches} таблицах - проверьте предупреждения выше")
+        else:
+            logging.info("🎉 Миграция завершена!")
+            logging.info("💡 Теперь можно безопасно обновлять бота на Railway")
+
     except Exception as e:
         logging.error(f"Критическая ошибка миграции: {e}")
-    finally:
-        try:
-            sqlite_conn.close()
-            postgres_conn.close()
-        except:
-            pass
+        logging.info("💡 Запустите скрипт повторно - перенос продолжится с контрольных точек")
+
 
 if __name__ == "__main__":
     main()
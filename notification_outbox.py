@@ -0,0 +1,172 @@
+"""
+Доставка уведомлений пользователям из таблицы notification_outbox
+
+Уведомления о платежах записываются в outbox в той же транзакции, что и
+смена статуса платежа, поэтому падение процесса или ошибка Telegram не
+теряют сообщение. Диспетчер забирает готовые записи пачками, отправляет их
+с ограничением скорости и повторяет неудачные попытки с экспоненциальной
+задержкой (с учетом retry_after из ответа 429).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, List
+
+# Максимум сообщений в секунду (лимит Telegram ~30/с на бота)
+NOTIFICATION_RATE_LIMIT = float(os.getenv('NOTIFICATION_RATE_LIMIT', '25'))
+# Сколько уведомлений забирать из базы за один раз
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '50'))
+# После скольких попыток уведомление помечается как failed
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '8'))
+# Базовая и максимальная задержка повторной отправки (секунды)
+NOTIFICATION_RETRY_BASE_DELAY = float(os.getenv('NOTIFICATION_RETRY_BASE_DELAY', '5'))
+NOTIFICATION_RETRY_MAX_DELAY = float(os.getenv('NOTIFICATION_RETRY_MAX_DELAY', '1800'))
+# Как часто проверять outbox, если нас не будили (секунды)
+NOTIFICATION_IDLE_INTERVAL = float(os.getenv('NOTIFICATION_IDLE_INTERVAL', '10'))
+# На сколько секунд забранное уведомление скрывается от других диспетчеров
+NOTIFICATION_LEASE_SECONDS = int(os.getenv('NOTIFICATION_LEASE_SECONDS', '60'))
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate событий в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = max(0.1, rate)
+        self.capacity = burst if burst is not None else self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Запрещает отправку на seconds секунд (ответ 429 от Telegram)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = time.monotonic()
+
+
+class NotificationDispatcher:
+    """Фоновая отправка уведомлений из outbox"""
+
+    def __init__(self,
+                 claim: Callable[[int], Awaitable[List[Dict]]],
+                 send: Callable[[int, str, str], Awaitable[Dict]],
+                 mark_sent: Callable[[int], Awaitable[None]],
+                 reschedule: Callable[[int, str, float, bool], Awaitable[None]],
+                 rate_limit: float = NOTIFICATION_RATE_LIMIT,
+                 batch_size: int = NOTIFICATION_BATCH_SIZE,
+                 max_attempts: int = NOTIFICATION_MAX_ATTEMPTS,
+                 idle_interval: float = NOTIFICATION_IDLE_INTERVAL):
+        """
+        Args:
+            claim: Корутина, забирающая до N готовых уведомлений из outbox
+            send: Корутина отправки (user_id, message, parse_mode). Возвращает словарь
+                {'ok': bool, 'retry_after': секунды или None, 'permanent': bool, 'error': str}
+            mark_sent: Корутина, помечающая уведомление отправленным
+            reschedule: Корутина (id, error, delay, give_up), откладывающая повторную попытку
+            rate_limit: Максимум сообщений в секунду
+            batch_size: Размер пачки из outbox
+            max_attempts: Максимум попыток отправки одного уведомления
+            idle_interval: Период проверки outbox без явного пробуждения
+        """
+        self.claim = claim
+        self.send = send
+        self.mark_sent = mark_sent
+        self.reschedule = reschedule
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.idle_interval = idle_interval
+        self._bucket = TokenBucket(rate_limit)
+        self._wakeup = asyncio.Event()
+
+        self.stats = {
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'batches': 0,
+        }
+
+    def wake(self):
+        """Будит диспетчер сразу после постановки нового уведомления"""
+        self._wakeup.set()
+
+    def retry_delay(self, attempts: int) -> float:
+        """Экспоненциальная задержка с разбросом для попытки номер attempts"""
+        delay = NOTIFICATION_RETRY_BASE_DELAY * (2 ** min(attempts - 1, 16))
+        delay = min(NOTIFICATION_RETRY_MAX_DELAY, delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _deliver(self, item: Dict):
+        await self._bucket.acquire()
+        try:
+            result = await self.send(item['user_id'], item['message'], item.get('parse_mode'))
+        except Exception as e:
+            result = {'ok': False, 'error': str(e)}
+
+        if result.get('ok'):
+            await self.mark_sent(item['id'])
+            self.stats['sent'] += 1
+            return
+
+        error = result.get('error') or 'unknown error'
+        retry_after = result.get('retry_after')
+        if retry_after:
+            # Telegram просит подождать - останавливаем всю отправку, а не одно сообщение
+            self._bucket.pause(retry_after)
+            self.stats['rate_limited'] += 1
+
+        give_up = result.get('permanent') or item['attempts'] >= self.max_attempts
+        delay = retry_after or self.retry_delay(item['attempts'])
+        await self.reschedule(item['id'], error, delay, give_up)
+
+        if give_up:
+            self.stats['failed'] += 1
+            logging.error(f"📭 [OUTBOX] Уведомление {item['id']} пользователю {item['user_id']} не доставлено: {error}")
+        else:
+            self.stats['retried'] += 1
+            logging.warning(f"⚠️ [OUTBOX] Уведомление {item['id']} отложено на {delay:.0f} с: {error}")
+
+    async def run_once(self) -> int:
+        """Отправляет одну пачку готовых уведомлений, возвращает ее размер"""
+        batch = await self.claim(self.batch_size)
+        if not batch:
+            return 0
+        self.stats['batches'] += 1
+        # Отправляем последовательно: порядок сообщений пользователю важнее скорости
+        for item in batch:
+            await self._deliver(item)
+        return len(batch)
+
+    async def run_forever(self):
+        """Основной цикл диспетчера"""
+        logging.info(f"📬 [OUTBOX] Запуск диспетчера уведомлений: до {self._bucket.rate:g} сообщений/с")
+        while True:
+            # Сбрасываем флаг до выборки, чтобы не потерять пробуждение во время отправки
+            self._wakeup.clear()
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"💥 [OUTBOX] Ошибка отправки пачки уведомлений: {e}")
+                processed = 0
+
+            if processed >= self.batch_size:
+                # Очередь не пуста - сразу забираем следующую пачку
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
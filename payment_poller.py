@@ -0,0 +1,253 @@
+"""
+Адаптивная параллельная проверка статусов pending платежей
+
+Каждый платеж проверяется по своему расписанию: часто сразу после создания,
+затем с экспоненциально растущим интервалом по мере старения платежа.
+После истечения срока жизни платеж больше не опрашивается.
+Одновременно выполняется не более concurrency проверок.
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import metrics_registry
+
+# Минимальный интервал между проверками одного платежа (секунды)
+PAYMENT_POLL_MIN_INTERVAL = int(os.getenv('PAYMENT_POLL_MIN_INTERVAL', '15'))
+# Максимальный интервал между проверками одного платежа (секунды)
+PAYMENT_POLL_MAX_INTERVAL = int(os.getenv('PAYMENT_POLL_MAX_INTERVAL', '300'))
+# Каждые N секунд возраста платежа интервал удваивается
+PAYMENT_POLL_BACKOFF_STEP = int(os.getenv('PAYMENT_POLL_BACKOFF_STEP', '300'))
+# Через сколько часов после создания платеж перестает опрашиваться
+PAYMENT_POLL_EXPIRY_HOURS = int(os.getenv('PAYMENT_POLL_EXPIRY_HOURS', '24'))
+# Максимум одновременных запросов к Betatransfer
+PAYMENT_POLL_CONCURRENCY = int(os.getenv('PAYMENT_POLL_CONCURRENCY', '10'))
+# Как часто перечитывать список pending платежей из базы (секунды)
+PAYMENT_POLL_REFRESH_INTERVAL = int(os.getenv('PAYMENT_POLL_REFRESH_INTERVAL', '45'))
+
+PAYMENT_CHECK_DURATION = metrics_registry.histogram(
+    'bot_payment_check_duration_seconds', 'Время проверки pending платежей (single - один платеж, pass - проход)',
+    ['kind'])
+PENDING_PAYMENTS = metrics_registry.gauge(
+    'bot_pending_payments', 'Pending платежи, которые отслеживает PaymentPoller')
+
+
+def _parse_created_at(value) -> Optional[datetime]:
+    """Приводит created_at из PostgreSQL (datetime) или SQLite (строка) к datetime"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+class PaymentPoller:
+    """Планировщик проверок pending платежей с кучей по времени следующей проверки"""
+
+    def __init__(self,
+                 fetch_pending: Callable[[datetime], Awaitable[List[Dict]]],
+                 check_payment: Callable[[Dict], Awaitable[Optional[bool]]],
+                 concurrency: int = PAYMENT_POLL_CONCURRENCY,
+                 min_interval: int = PAYMENT_POLL_MIN_INTERVAL,
+                 max_interval: int = PAYMENT_POLL_MAX_INTERVAL,
+                 backoff_step: int = PAYMENT_POLL_BACKOFF_STEP,
+                 expiry_hours: int = PAYMENT_POLL_EXPIRY_HOURS,
+                 refresh_interval: int = PAYMENT_POLL_REFRESH_INTERVAL):
+        """
+        Args:
+            fetch_pending: Корутина, возвращающая pending платежи, созданные позже переданного
+                момента (UTC): просроченные платежи не читаются из базы при каждом обновлении
+            check_payment: Корутина проверки одного платежа. Возвращает True, если
+                платеж больше не pending и это записано в базу, False, если его нужно
+                проверить позже, и None при ошибке API или проведения платежа
+            concurrency: Максимум одновременных проверок
+            min_interval: Интервал проверки нового платежа (секунды)
+            max_interval: Верхняя граница интервала (секунды)
+            backoff_step: Каждые backoff_step секунд возраста интервал удваивается
+            expiry_hours: Срок, после которого платеж перестает опрашиваться
+            refresh_interval: Период перечитывания списка pending платежей (секунды)
+        """
+        self.fetch_pending = fetch_pending
+        self.check_payment = check_payment
+        self.concurrency = max(1, concurrency)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_step = max(1, backoff_step)
+        self.expiry_seconds = expiry_hours * 3600
+        self.refresh_interval = refresh_interval
+
+        # Куча (due_time, betatransfer_id) и актуальные данные платежей
+        self._heap = []
+        self._payments = {}
+        self._due = {}
+        # Платежи, проведение которых подтверждено базой: выборка pending,
+        # начатая до проведения, еще может их вернуть
+        self._finished = set()
+        self._next_refresh = 0.0
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        self.stats = {
+            'passes': 0,
+            'tracked': 0,
+            'api_calls': 0,
+            'api_errors': 0,
+            'expired': 0,
+            'finished': 0,
+            'last_pass_checked': 0,
+            'last_pass_duration': 0.0,
+            'max_pass_duration': 0.0,
+        }
+
+    def _age_seconds(self, payment: Dict, now_wall: datetime) -> float:
+        created_at = _parse_created_at(payment.get('created_at'))
+        if created_at is None:
+            return 0.0
+        return max(0.0, (now_wall - created_at).total_seconds())
+
+    def next_interval(self, age_seconds: float) -> float:
+        """Интервал до следующей проверки платежа заданного возраста"""
+        doublings = int(age_seconds // self.backoff_step)
+        # Ограничиваем показатель, чтобы не считать огромные степени для старых платежей
+        interval = self.min_interval * (2 ** min(doublings, 16))
+        return min(self.max_interval, interval)
+
+    def _schedule(self, payment_id: str, due: float):
+        self._due[payment_id] = due
+        heapq.heappush(self._heap, (due, payment_id))
+
+    def _forget(self, payment_id: str):
+        self._payments.pop(payment_id, None)
+        self._due.pop(payment_id, None)
+
+    async def refresh(self):
+        """Синхронизирует расписание со списком pending платежей в базе"""
+        now = time.monotonic()
+        now_wall = datetime.utcnow()
+        pending = await self.fetch_pending(now_wall - timedelta(seconds=self.expiry_seconds)) or []
+        seen = set()
+
+        for payment in pending:
+            payment_id = payment.get('betatransfer_id')
+            if not payment_id:
+                continue
+            seen.add(payment_id)
+            if payment_id in self._finished:
+                continue
+            if self._age_seconds(payment, now_wall) >= self.expiry_seconds:
+                if payment_id in self._payments:
+                    self._forget(payment_id)
+                    self.stats['expired'] += 1
+                continue
+            self._payments[payment_id] = payment
+            if payment_id not in self._due:
+                # Новый платеж проверяем сразу
+                self._schedule(payment_id, now)
+
+        # Платежи, пропавшие из выборки: обработаны callback'ом или админом либо просрочены
+        for payment_id in list(self._payments):
+            if payment_id not in seen:
+                if self._age_seconds(self._payments[payment_id], now_wall) >= self.expiry_seconds:
+                    self.stats['expired'] += 1
+                self._forget(payment_id)
+        self._finished &= seen
+
+        self.stats['tracked'] = len(self._payments)
+        PENDING_PAYMENTS.set(self.stats['tracked'])
+        self._next_refresh = now + self.refresh_interval
+
+    def _pop_due(self, now: float) -> List[str]:
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, payment_id = heapq.heappop(self._heap)
+            # Пропускаем устаревшие записи кучи (платеж удален или перепланирован)
+            if self._due.get(payment_id) != due:
+                continue
+            del self._due[payment_id]
+            due_ids.append(payment_id)
+        return due_ids
+
+    async def _check_one(self, payment_id: str):
+        payment = self._payments.get(payment_id)
+        if payment is None:
+            return
+        async with self._semaphore:
+            self.stats['api_calls'] += 1
+            try:
+                finished = await self.check_payment(payment)
+            except Exception as e:
+                logging.error(f"[PAYMENT POLLER] Ошибка проверки платежа {payment_id}: {e}")
+                finished = None
+
+        if finished is None:
+            self.stats['api_errors'] += 1
+        if finished:
+            self._forget(payment_id)
+            self._finished.add(payment_id)
+            self.stats['finished'] += 1
+            return
+
+        age = self._age_seconds(payment, datetime.utcnow())
+        if age >= self.expiry_seconds:
+            logging.info(f"[PAYMENT POLLER] Платеж {payment_id} истек, опрос прекращен")
+            self._forget(payment_id)
+            self.stats['expired'] += 1
+            return
+        self._schedule(payment_id, time.monotonic() + self.next_interval(age))
+
+    async def run_pass(self):
+        """Обновляет список при необходимости и проверяет все платежи, срок которых наступил"""
+        started = time.monotonic()
+        if started >= self._next_refresh:
+            await self.refresh()
+
+        due_ids = self._pop_due(time.monotonic())
+        if due_ids:
+            await asyncio.gather(*(self._check_one(payment_id) for payment_id in due_ids))
+
+            duration = time.monotonic() - started
+            PAYMENT_CHECK_DURATION.labels('pass').observe(duration)
+            self.stats['passes'] += 1
+            self.stats['tracked'] = len(self._payments)
+            PENDING_PAYMENTS.set(self.stats['tracked'])
+            self.stats['last_pass_checked'] = len(due_ids)
+            self.stats['last_pass_duration'] = duration
+            self.stats['max_pass_duration'] = max(self.stats['max_pass_duration'], duration)
+            logging.info(
+                "[PAYMENT POLLER] Проход: проверено %d, отслеживается %d, длительность %.2f с, "
+                "вызовов API %d, ошибок API %d",
+                len(due_ids), self.stats['tracked'], duration,
+                self.stats['api_calls'], self.stats['api_errors']
+            )
+
+    def seconds_until_next(self) -> float:
+        """Сколько можно спать до следующей проверки или обновления списка"""
+        now = time.monotonic()
+        wake_at = self._next_refresh
+        if self._heap:
+            wake_at = min(wake_at, self._heap[0][0])
+        return max(1.0, wake_at - now)
+
+    async def run_forever(self):
+        """Основной цикл опроса"""
+        logging.info(
+            f"[PAYMENT POLLER] Запуск: параллельно до {self.concurrency}, "
+            f"интервал {self.min_interval}-{self.max_interval} с, срок {self.expiry_seconds // 3600} ч"
+        )
+        while True:
+            try:
+                await self.run_pass()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"[PAYMENT POLLER] Ошибка прохода: {e}")
+                # Следующая попытка обновить список через минимальный интервал
+                self._next_refresh = time.monotonic() + self.min_interval
+            await asyncio.sleep(self.seconds_until_next())
@@ -7,24 +7,28 @@
 import os
 import sys
 import subprocess
-from backup_database import backup_database
+from backup_database import backup_database, verify_backup, rotate_backups
 
 def main():
     print("🚀 Подготовка к деплою...")
     print("=" * 50)
     
-    # Проверяем, существует ли база данных
-    if not os.path.exists("bot_analytics.db"):
+    # Проверяем, существует ли база данных (PostgreSQL копируется дампом по DATABASE_URL)
+    if not os.getenv('DATABASE_URL') and not os.path.exists("bot_analytics.db"):
         print("⚠️  База данных bot_analytics.db не найдена")
         print("   Это нормально, если бот еще не запускался")
         return True
     
     # Создаем резервную копию
     print("📦 Создание резервной копии базы данных...")
-    success = backup_database()
+    manifest = backup_database()
+    
+    # Проверяем, что копия восстанавливается, и только потом удаляем старые
+    success = bool(manifest) and verify_backup(manifest['id'])
     
     if success:
-        print("✅ Резервная копия создана успешно!")
+        rotate_backups()
+        print("✅ Резервная копия создана и проверена!")
         print("   Теперь можно безопасно делать коммит и деплой")
         return True
     else:
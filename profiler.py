@@ -0,0 +1,229 @@
+"""
+Профилирование работающего бота по команде администратора
+
+SamplingProfiler - семплирующий профилировщик: отдельный поток раз в
+PROFILE_INTERVAL снимает стеки потоков через sys._current_frames() и
+считает одинаковые стеки. Код бота при этом не инструментируется, цена -
+обход стеков раз в несколько миллисекунд, поэтому профилировать можно под
+живой нагрузкой. Результат - collapsed stacks ("поток;функция;... N"),
+который открывают flamegraph.pl, speedscope.app и inferno.
+
+HeapProfiler - снимки tracemalloc и разница между ними по строкам кода.
+Трассировка аллокаций замедляет процесс, поэтому включается явно и
+выключается сама через HEAP_TRACE_MAX_MINUTES.
+"""
+
+import linecache
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# Период семплирования (секунды)
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+# Предел длительности одного профилирования (секунды)
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+# Глубина стека в tracemalloc и время, после которого трассировка выключается сама
+HEAP_TRACE_FRAMES = int(os.getenv('HEAP_TRACE_FRAMES', '10'))
+HEAP_TRACE_MAX_MINUTES = int(os.getenv('HEAP_TRACE_MAX_MINUTES', '30'))
+
+# Листовые функции простаивающих потоков: ожидание в селекторе, очереди или событии
+_IDLE_LEAVES = frozenset({
+    ('selectors.py', 'select'), ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'),
+    ('thread.py', '_worker'), ('queue.py', 'get'), ('socket.py', 'accept'),
+})
+
+
+class ProfilerBusyError(Exception):
+    """Профилирование уже идет"""
+
+
+class ProfileResult:
+    """Результат семплирования: счетчики стеков и сводка"""
+
+    def __init__(self, stacks: Counter, self_time: Counter, samples: int, idle_samples: int,
+                 duration: float, threads: str, started: datetime):
+        self.stacks = stacks
+        self.self_time = self_time
+        self.samples = samples
+        self.idle_samples = idle_samples
+        self.duration = duration
+        self.threads = threads
+        self.started = started
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed (flamegraph.pl, speedscope)"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, limit: int = 10) -> str:
+        if not self.samples:
+            return "Ни одного активного стека: процесс простаивал"
+        lines = [f"🔬 Профиль {self.duration:.1f} с ({self.threads}): {self.samples} стеков, "
+                 f"простой отброшен в {self.idle_samples}"]
+        lines.append("\nСобственное время функций:")
+        for frame, count in self.self_time.most_common(limit):
+            lines.append(f"{count / self.samples:6.1%}  {frame}")
+        return '\n'.join(lines)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Семплирующий профилировщик потоков процесса"""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, max_seconds: int = PROFILE_MAX_SECONDS):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._busy = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._busy.locked()
+
+    def profile(self, seconds: float, thread_ids: Optional[List[int]] = None,
+                include_idle: bool = False) -> ProfileResult:
+        """
+        Семплирует стеки в течение seconds (блокирующий вызов)
+
+        Args:
+            seconds: Длительность (ограничена max_seconds)
+            thread_ids: Только эти потоки (например, поток event loop); None - все
+            include_idle: Не отбрасывать стеки простаивающих потоков
+        """
+        if not self._busy.acquire(blocking=False):
+            raise ProfilerBusyError("Профилирование уже идет")
+        try:
+            return self._sample(min(seconds, self.max_seconds), thread_ids, include_idle)
+        finally:
+            self._busy.release()
+
+    def _sample(self, seconds: float, thread_ids, include_idle: bool) -> ProfileResult:
+        own_id = threading.get_ident()
+        wanted = set(thread_ids) if thread_ids else None
+        stacks = Counter()
+        self_time = Counter()
+        samples = idle = 0
+        started_wall = datetime.now()
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (wanted is not None and thread_id not in wanted):
+                    continue
+                leaf = frame.f_code
+                if not include_idle and (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES:
+                    idle += 1
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, str(thread_id)))
+                labels.reverse()
+                stacks[';'.join(labels)] += 1
+                self_time[labels[-1]] += 1
+                samples += 1
+            # Спим остаток периода; время обхода стеков входит в период
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - now)))
+        threads = 'все потоки' if wanted is None else f"потоков: {len(wanted)}"
+        return ProfileResult(stacks, self_time, samples, idle, time.perf_counter() - started, threads,
+                             started_wall)
+
+
+class HeapDiff:
+    """Разница двух снимков tracemalloc"""
+
+    def __init__(self, stats: List[tracemalloc.StatisticDiff], current: int, peak: int, since: datetime):
+        self.stats = stats
+        self.current = current
+        self.peak = peak
+        self.since = since
+
+    def summary(self, limit: int = 10) -> str:
+        total = sum(stat.size_diff for stat in self.stats)
+        lines = [f"🧠 Память Python: {self.current / 1024 / 1024:.1f} MB (пик {self.peak / 1024 / 1024:.1f} MB), "
+                 f"изменение с {self.since:%H:%M:%S}: {total / 1024:+.0f} KB",
+                 "\nНаибольший рост по строкам:"]
+        for stat in self.stats[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size_diff / 1024:+9.1f} KB ({stat.count_diff:+d})  "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        return '\n'.join(lines)
+
+    def report(self, limit: int = 100) -> str:
+        """Подробный отчет: строка кода, ее текст и разница размера и числа блоков"""
+        lines = []
+        for stat in self.stats[:limit]:
+            frame = stat.traceback[0]
+            source = linecache.getline(frame.filename, frame.lineno).strip()
+            lines.append(f"{stat.size_diff / 1024:+.1f} KB ({stat.count_diff:+d} блоков), всего "
+                         f"{stat.size / 1024:.1f} KB: {frame.filename}:{frame.lineno}\n    {source}")
+        return '\n'.join(lines) + '\n'
+
+
+class HeapProfiler:
+    """Снимки tracemalloc с разницей относительно предыдущего снимка"""
+
+    _FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+    def __init__(self, frames: int = HEAP_TRACE_FRAMES):
+        self.frames = frames
+        self._baseline: Optional[Tuple[tracemalloc.Snapshot, datetime]] = None
+        self._lock = threading.Lock()
+        self.started_at: Optional[datetime] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> bool:
+        """Включает трассировку и снимает базовый снимок; False - уже включена"""
+        with self._lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(self.frames)
+            self.started_at = datetime.now()
+            self._baseline = (self._take(), self.started_at)
+            return True
+
+    def stop(self):
+        with self._lock:
+            self._baseline = None
+            self.started_at = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def _take(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self._FILTERS)
+
+    def snapshot_diff(self, key_type: str = 'lineno') -> HeapDiff:
+        """Снимок и разница с предыдущим; новый снимок становится базовым"""
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise RuntimeError("Трассировка памяти не включена")
+            snapshot = self._take()
+            baseline, since = self._baseline
+            stats = snapshot.compare_to(baseline, key_type)
+            self._baseline = (snapshot, datetime.now())
+            current, peak = tracemalloc.get_traced_memory()
+            return HeapDiff(stats, current, peak, since)
+
+
+# Общие профилировщики процесса (команды /profile и /heap_snapshot)
+sampling_profiler = SamplingProfiler()
+heap_profiler = HeapProfiler()
@@ -0,0 +1,447 @@
+"""
+Каталог горячих SQL-запросов AnalyticsDB
+
+Каждый запрос описан один раз с плейсхолдерами ? (если диалекты расходятся
+синтаксисом - с отдельным вариантом для PostgreSQL). AnalyticsDB при
+создании рендерит весь каталог под свой диалект, поэтому на вызове нет ни
+выбора строки по db_type, ни форматирования SQL.
+
+На соединениях из пула запросы готовятся один раз на соединение:
+- PostgreSQL: PREPARE <имя> AS ... ($1, $2, ...), дальше EXECUTE <имя> (...)
+- SQLite: один и тот же объект строки на долгоживущем соединении берется из
+  кэша подготовленных выражений sqlite3 (cached_statements)
+На остальных соединениях отрендеренный SQL выполняется как обычно.
+
+Строки результата отдаются кортежами (namedtuple по колонкам запроса),
+без словаря на каждую строку.
+"""
+
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import psycopg2.extensions
+
+
+class Query:
+    """Описание запроса каталога"""
+
+    __slots__ = ('name', 'sql', 'postgresql')
+
+    def __init__(self, name: str, sql: str, postgresql: str = None):
+        """
+        Args:
+            name: Имя запроса (в PostgreSQL - имя подготовленного выражения, точки заменяются на _)
+            sql: SQL с плейсхолдерами ?, общий для обоих диалектов (или вариант SQLite)
+            postgresql: Вариант для PostgreSQL, если синтаксис отличается
+        """
+        self.name = name
+        self.sql = sql
+        self.postgresql = postgresql
+
+
+class RenderedQuery:
+    """Запрос, отрендеренный под диалект"""
+
+    __slots__ = ('name', 'sql', 'prepare_sql', 'execute_sql', 'row_type')
+
+    def __init__(self, name: str, sql: str, prepare_sql: str = None, execute_sql: str = None):
+        self.name = name
+        self.sql = sql
+        self.prepare_sql = prepare_sql
+        self.execute_sql = execute_sql
+        self.row_type = None
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Соединение PostgreSQL, помнящее подготовленные на нем выражения"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+def _split_placeholders(sql: str) -> List[str]:
+    """Делит SQL по плейсхолдерам ? вне строковых литералов"""
+    parts = []
+    current = []
+    in_literal = False
+    for char in sql:
+        if char == "'":
+            in_literal = not in_literal
+        if char == '?' and not in_literal:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return parts
+
+
+def _render_postgresql(query: Query) -> RenderedQuery:
+    parts = _split_placeholders(query.postgresql or query.sql)
+    count = len(parts) - 1
+    statement = query.name.replace('.', '_')
+
+    # Обычный запрос psycopg2: %s, а литеральные % удваиваются
+    sql = '%s'.join(part.replace('%', '%%') for part in parts)
+    # PREPARE выполняется без параметров, % остаются как есть
+    prepare_sql = f"PREPARE {statement} AS " + ''.join(
+        part + (f"${index + 1}" if index < count else '') for index, part in enumerate(parts)
+    )
+    execute_sql = f"EXECUTE {statement}" + (f" ({', '.join(['%s'] * count)})" if count else '')
+    return RenderedQuery(query.name, sql, prepare_sql, execute_sql)
+
+
+class QueryCatalog:
+    """Каталог, отрендеренный под диалект базы"""
+
+    def __init__(self, db_type: str, queries: List[Query]):
+        self.db_type = db_type
+        self._queries: Dict[str, RenderedQuery] = {}
+        for query in queries:
+            if db_type == "postgresql":
+                self._queries[query.name] = _render_postgresql(query)
+            else:
+                self._queries[query.name] = RenderedQuery(query.name, query.sql)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._queries
+
+    def sql(self, name: str) -> str:
+        """Отрендеренный SQL запроса (для EXPLAIN и отладки)"""
+        return self._queries[name].sql
+
+    def execute(self, cursor, name: str, params=()):
+        """Выполняет запрос каталога на курсоре и возвращает курсор"""
+        query = self._queries[name]
+        prepared = getattr(cursor.connection, 'prepared_statements', None)
+        if prepared is None:
+            cursor.execute(query.sql, params)
+            return cursor
+
+        if name not in prepared:
+            cursor.execute(query.prepare_sql)
+            prepared.add(name)
+        cursor.execute(query.execute_sql, params)
+        return cursor
+
+    def _row_type(self, query: RenderedQuery, cursor):
+        if query.row_type is None:
+            # Тип строки создается один раз по колонкам первого результата
+            query.row_type = namedtuple(
+                'Row_' + query.name.replace('.', '_'),
+                [description[0] for description in cursor.description],
+                rename=True
+            )
+        return query.row_type
+
+    def fetch_one(self, cursor, name: str, params=()) -> Optional[tuple]:
+        """Первая строка результата (namedtuple) или None"""
+        self.execute(cursor, name, params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return self._row_type(self._queries[name], cursor)._make(row)
+
+    def fetch_all(self, cursor, name: str, params=()) -> List[tuple]:
+        """Все строки результата (namedtuple)"""
+        self.execute(cursor, name, params)
+        rows = cursor.fetchall()
+        if not rows:
+            return []
+        make = self._row_type(self._queries[name], cursor)._make
+        return [make(row) for row in rows]
+
+
+# Колонки платежа в порядке таблицы (SELECT * в подготовленном выражении
+# ломается после ALTER TABLE: "cached plan must not change result type")
+_PAYMENT_COLUMNS = ("id, user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, "
+                    "payment_method, created_at, completed_at")
+
+
+# Горячие запросы AnalyticsDB
+QUERIES = [
+    # Пользователи
+    Query('user.insert', '''
+        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+    ''', postgresql='''
+        INSERT INTO users (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO NOTHING
+    '''),
+    Query('user.info', '''
+        SELECT user_id, username, first_name, last_name
+        FROM users WHERE user_id = ?
+    '''),
+    Query('user.touch', '''
+        UPDATE users SET last_activity = CURRENT_TIMESTAMP
+        WHERE user_id = ?
+    '''),
+    Query('user.count_generation', '''
+        UPDATE users SET total_generations = total_generations + 1
+        WHERE user_id = ?
+    '''),
+    Query('user.count_error', '''
+        UPDATE users SET total_errors = total_errors + 1
+        WHERE user_id = ?
+    '''),
+
+    # Журналы
+    Query('generation.insert', '''
+        INSERT INTO generations (user_id, model_name, format_type, prompt,
+                                 image_count, success, error_message, generation_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''),
+    Query('error.insert', '''
+        INSERT INTO errors (user_id, error_type, error_message, stack_trace)
+        VALUES (?, ?, ?, ?)
+    '''),
+    Query('action.insert', '''
+        INSERT INTO user_actions (user_id, action_type, action_data)
+        VALUES (?, ?, ?)
+    '''),
+
+    # Агрегаты статистики (выражения часа и дня - как в STATS_BUCKETS, в UTC независимо от TimeZone сессии)
+    Query('rollup.hourly', '''
+        INSERT INTO stats_hourly
+        (bucket, model_name, format_type, generations, images, successes, errors,
+         generation_time_sum, generation_time_count, generation_time_max)
+        VALUES (strftime('%Y-%m-%d %H:00:00', 'now'), ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, model_name, format_type) DO UPDATE
+        SET generations = stats_hourly.generations + 1,
+            images = stats_hourly.images + EXCLUDED.images,
+            successes = stats_hourly.successes + EXCLUDED.successes,
+            errors = stats_hourly.errors + EXCLUDED.errors,
+            generation_time_sum = stats_hourly.generation_time_sum + EXCLUDED.generation_time_sum,
+            generation_time_count = stats_hourly.generation_time_count + EXCLUDED.generation_time_count,
+            generation_time_max = MAX(stats_hourly.generation_time_max, EXCLUDED.generation_time_max)
+    ''', postgresql='''
+        INSERT INTO stats_hourly
+        (bucket, model_name, format_type, generations, images, successes, errors,
+         generation_time_sum, generation_time_count, generation_time_max)
+        VALUES (date_trunc('hour', now() AT TIME ZONE 'UTC'), ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, model_name, format_type) DO UPDATE
+        SET generations = stats_hourly.generations + 1,
+            images = stats_hourly.images + EXCLUDED.images,
+            successes = stats_hourly.successes + EXCLUDED.successes,
+            errors = stats_hourly.errors + EXCLUDED.errors,
+            generation_time_sum = stats_hourly.generation_time_sum + EXCLUDED.generation_time_sum,
+            generation_time_count = stats_hourly.generation_time_count + EXCLUDED.generation_time_count,
+            generation_time_max = GREATEST(stats_hourly.generation_time_max, EXCLUDED.generation_time_max)
+    '''),
+    Query('rollup.daily', '''
+        INSERT INTO stats_daily
+        (bucket, model_name, format_type, generations, images, successes, errors,
+         generation_time_sum, generation_time_count, generation_time_max)
+        VALUES (date('now'), ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, model_name, format_type) DO UPDATE
+        SET generations = stats_daily.generations + 1,
+            images = stats_daily.images + EXCLUDED.images,
+            successes = stats_daily.successes + EXCLUDED.successes,
+            errors = stats_daily.errors + EXCLUDED.errors,
+            generation_time_sum = stats_daily.generation_time_sum + EXCLUDED.generation_time_sum,
+            generation_time_count = stats_daily.generation_time_count + EXCLUDED.generation_time_count,
+            generation_time_max = MAX(stats_daily.generation_time_max, EXCLUDED.generation_time_max)
+    ''', postgresql='''
+        INSERT INTO stats_daily
+        (bucket, model_name, format_type, generations, images, successes, errors,
+         generation_time_sum, generation_time_count, generation_time_max)
+        VALUES (CAST(now() AT TIME ZONE 'UTC' AS DATE), ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, model_name, format_type) DO UPDATE
+        SET generations = stats_daily.generations + 1,
+            images = stats_daily.images + EXCLUDED.images,
+            successes = stats_daily.successes + EXCLUDED.successes,
+            errors = stats_daily.errors + EXCLUDED.errors,
+            generation_time_sum = stats_daily.generation_time_sum + EXCLUDED.generation_time_sum,
+            generation_time_count = stats_daily.generation_time_count + EXCLUDED.generation_time_count,
+            generation_time_max = GREATEST(stats_daily.generation_time_max, EXCLUDED.generation_time_max)
+    '''),
+    Query('rollup.daily_user', '''
+        INSERT OR IGNORE INTO stats_daily_users (day, user_id) VALUES (date('now'), ?)
+    ''', postgresql='''
+        INSERT INTO stats_daily_users (day, user_id) VALUES (CAST(now() AT TIME ZONE 'UTC' AS DATE), ?)
+        ON CONFLICT (day, user_id) DO NOTHING
+    '''),
+    Query('rollup.daily_totals', '''
+        INSERT INTO stats_daily_totals (day, active_users, new_users)
+        VALUES (date('now'), ?, ?)
+        ON CONFLICT (day) DO UPDATE
+        SET active_users = stats_daily_totals.active_users + EXCLUDED.active_users,
+            new_users = stats_daily_totals.new_users + EXCLUDED.new_users
+    ''', postgresql='''
+        INSERT INTO stats_daily_totals (day, active_users, new_users)
+        VALUES (CAST(now() AT TIME ZONE 'UTC' AS DATE), ?, ?)
+        ON CONFLICT (day) DO UPDATE
+        SET active_users = stats_daily_totals.active_users + EXCLUDED.active_users,
+            new_users = stats_daily_totals.new_users + EXCLUDED.new_users
+    '''),
+    Query('rollup.revenue', '''
+        INSERT INTO stats_daily_revenue (day, currency, payments, revenue)
+        VALUES (date('now'), ?, 1, ?)
+        ON CONFLICT (day, currency) DO UPDATE
+        SET payments = stats_daily_revenue.payments + 1,
+            revenue = stats_daily_revenue.revenue + EXCLUDED.revenue
+    ''', postgresql='''
+        INSERT INTO stats_daily_revenue (day, currency, payments, revenue)
+        VALUES (CAST(now() AT TIME ZONE 'UTC' AS DATE), ?, 1, ?)
+        ON CONFLICT (day, currency) DO UPDATE
+        SET payments = stats_daily_revenue.payments + 1,
+            revenue = stats_daily_revenue.revenue + EXCLUDED.revenue
+    '''),
+    Query('rollup.user_generation_stats', '''
+        INSERT INTO user_generation_stats
+        (user_id, model_name, format_type, generations, successes, generation_time_sum, generation_time_count)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (user_id, model_name, format_type) DO UPDATE
+        SET generations = user_generation_stats.generations + 1,
+            successes = user_generation_stats.successes + EXCLUDED.successes,
+            generation_time_sum = user_generation_stats.generation_time_sum + EXCLUDED.generation_time_sum,
+            generation_time_count = user_generation_stats.generation_time_count + EXCLUDED.generation_time_count
+    '''),
+
+    # Лимиты и кредиты
+    Query('limits.get', '''
+        SELECT free_generations_used, total_free_generations, last_updated
+        FROM user_limits
+        WHERE user_id = ?
+    '''),
+    Query('limits.init', '''
+        INSERT OR IGNORE INTO user_limits
+        (user_id, free_generations_used, total_free_generations, last_updated)
+        VALUES (?, 0, 3, CURRENT_TIMESTAMP)
+    ''', postgresql='''
+        INSERT INTO user_limits
+        (user_id, free_generations_used, total_free_generations, last_updated)
+        VALUES (?, 0, 3, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO NOTHING
+    '''),
+    Query('credits.init', '''
+        INSERT OR IGNORE INTO user_credits
+        (user_id, credits_balance, total_purchased, total_used)
+        VALUES (?, 0, 0, 0)
+    ''', postgresql='''
+        INSERT INTO user_credits
+        (user_id, credits_balance, total_purchased, total_used)
+        VALUES (?, 0, 0, 0)
+        ON CONFLICT (user_id) DO NOTHING
+    '''),
+    # Тип параметра в PostgreSQL указан явно: в списке SELECT его не из чего вывести
+    Query('entitlements.get', '''
+        SELECT l.free_generations_used, l.total_free_generations,
+               c.credits_balance, c.total_purchased, c.total_used
+        FROM (SELECT ? AS user_id) u
+        LEFT JOIN user_limits l ON l.user_id = u.user_id
+        LEFT JOIN user_credits c ON c.user_id = u.user_id
+    ''', postgresql='''
+        SELECT l.free_generations_used, l.total_free_generations,
+               c.credits_balance, c.total_purchased, c.total_used
+        FROM (SELECT CAST(? AS BIGINT) AS user_id) u
+        LEFT JOIN user_limits l ON l.user_id = u.user_id
+        LEFT JOIN user_credits c ON c.user_id = u.user_id
+    '''),
+
+    # Статистика (get_user_stats, get_global_stats)
+    Query('stats.user_generation', '''
+        SELECT model_name, format_type, generations, successes,
+               generation_time_sum, generation_time_count
+        FROM user_generation_stats
+        WHERE user_id = ?
+    '''),
+    Query('stats.recent_generations', '''
+        SELECT SUM(generations),
+               SUM(generation_time_sum) / NULLIF(SUM(generation_time_count), 0)
+        FROM stats_daily
+        WHERE bucket >= ?
+    '''),
+    Query('stats.recent_active_users', '''
+        SELECT COUNT(DISTINCT user_id) FROM stats_daily_users WHERE day >= ?
+    '''),
+    Query('stats.recent_models', '''
+        SELECT model_name, SUM(generations) AS count
+        FROM stats_daily
+        WHERE bucket >= ?
+        GROUP BY model_name
+        ORDER BY count DESC
+        LIMIT 5
+    '''),
+    Query('stats.recent_formats', '''
+        SELECT format_type, SUM(generations) AS count
+        FROM stats_daily
+        WHERE bucket >= ?
+        GROUP BY format_type
+        ORDER BY count DESC
+        LIMIT 5
+    '''),
+    Query('stats.recent_revenue', '''
+        SELECT currency, SUM(payments), SUM(revenue)
+        FROM stats_daily_revenue
+        WHERE day >= ?
+        GROUP BY currency
+        ORDER BY currency
+    '''),
+
+    # Платежи
+    Query('payment.insert', '''
+        INSERT INTO payments
+        (user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at)
+        VALUES (?, ?, ?, 'pending', ?, ?, ?, CURRENT_TIMESTAMP)
+    '''),
+    Query('payment.by_order_id', f'''
+        SELECT {_PAYMENT_COLUMNS}
+        FROM payments
+        WHERE order_id = ?
+    '''),
+    Query('payment.by_betatransfer_id', f'''
+        SELECT {_PAYMENT_COLUMNS}
+        FROM payments
+        WHERE betatransfer_id = ?
+    '''),
+    Query('payment.update_status', '''
+        UPDATE payments
+        SET status = ?, completed_at = CURRENT_TIMESTAMP
+        WHERE betatransfer_id = ?
+    '''),
+    Query('payment.pending', '''
+        SELECT user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at
+        FROM payments
+        WHERE status = 'pending' AND betatransfer_id IS NOT NULL
+        ORDER BY created_at ASC
+    '''),
+    Query('payment.pending_since', '''
+        SELECT user_id, amount, currency, status, betatransfer_id, order_id, credit_amount, created_at
+        FROM payments
+        WHERE status = 'pending' AND betatransfer_id IS NOT NULL AND created_at > ?
+        ORDER BY created_at ASC
+    '''),
+    Query('credit_transaction.by_payment', '''
+        SELECT id FROM credit_transactions
+        WHERE payment_id = (SELECT id FROM payments WHERE betatransfer_id = ?)
+    '''),
+
+    # Outbox уведомлений
+    Query('outbox.insert', '''
+        INSERT OR IGNORE INTO notification_outbox (user_id, message, parse_mode, dedupe_key)
+        VALUES (?, ?, ?, ?)
+    ''', postgresql='''
+        INSERT INTO notification_outbox (user_id, message, parse_mode, dedupe_key)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (dedupe_key) DO NOTHING
+    '''),
+    Query('outbox.mark_sent', '''
+        UPDATE notification_outbox
+        SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+        WHERE id = ?
+    '''),
+    Query('outbox.reschedule', '''
+        UPDATE notification_outbox
+        SET status = ?, last_error = ?,
+            next_attempt_at = datetime('now', '+' || ? || ' seconds')
+        WHERE id = ?
+    ''', postgresql='''
+        UPDATE notification_outbox
+        SET status = ?, last_error = ?,
+            next_attempt_at = CURRENT_TIMESTAMP + CAST(? AS INTEGER) * INTERVAL '1 second'
+        WHERE id = ?
+    '''),
+]
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанных обновлений и сравнение задержек обработчиков
+
+Записи делает update_recorder.UpdateRecorder (UPDATE_RECORD_DIR). Режим
+run подает обновления из записи в бота, подключенного к заглушкам
+fake_services, с исходными паузами между обновлениями, ускоренными в
+--speed раз (0 - без пауз). Обновления идут через update_queue и
+Application.start(), то есть обрабатываются так же, как в продакшене.
+
+Задержка считается для каждого обработчика отдельно и с детализацией по
+действию: callback_data без параметров, команда или шаг USER_STATE для
+текстовых сообщений, например button_handler[image_gen_model] или
+text_handler[waiting_prompt]. Время handler - до возврата из обработчика,
+total - до завершения всех задач, которые он запустил (генерация в фоне).
+
+Режим compare сравнивает два результата run - например, текущего дерева
+и другой сборки, указанной через --bot-dir (git worktree нужного коммита).
+
+Использование:
+    python replay_updates.py run recordings/updates_*.jsonl.gz [--speed 1] [--bot-dir ../bot-main]
+                                 [--out replay_results/main.json]
+    python replay_updates.py compare replay_results/main.json replay_results/feature.json
+                                 [--threshold 0.2] [--fail-on-regression]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+from fake_services import FakeServices, LatencyModel
+from load_test_bot import LOAD_TEST_TOKEN, _step_tasks, _task_factory, git_commit, rss_mb, summarize
+from update_recorder import read_recording
+
+RESULTS_DIR = os.path.join(SCRIPT_DIR, 'replay_results')
+
+
+def load_updates(paths, limit: int = None):
+    """Обновления из файлов записи подряд: (смещение от начала, словарь)"""
+    updates = []
+    base = 0.0
+    for path in paths:
+        first = last = None
+        for offset, data in read_recording(path):
+            first = offset if first is None else first
+            last = offset
+            updates.append((base + offset - first, data))
+            if limit and len(updates) >= limit:
+                return updates
+        if last is not None:
+            base += last - first + 1.0
+    return updates
+
+
+def recorded_user_ids(updates):
+    user_ids = set()
+    for _, data in updates:
+        for key in ('message', 'edited_message', 'callback_query'):
+            user = (data.get(key) or {}).get('from')
+            if user and not user.get('is_bot'):
+                user_ids.add(user['id'])
+    return user_ids
+
+
+def action_of(update, user_state) -> str:
+    """Действие для детализации: callback_data, команда или шаг сценария"""
+    if update.callback_query is not None:
+        data = update.callback_query.data or ''
+        return re.sub(r'_?\d+$', '', data.split(':')[0]) or 'empty'
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith('/'):
+        return message.text.split()[0][1:].split('@')[0]
+    if message is not None and message.photo:
+        kind = 'photo'
+    else:
+        kind = 'text'
+    user = update.effective_user
+    step = (user_state.get(user.id) or {}).get('step') if user is not None else None
+    return f"{kind}:{step or 'no_step'}"
+
+
+class HandlerTimings:
+    """Замеры обработчиков Application во время воспроизведения"""
+
+    def __init__(self, user_state):
+        self.user_state = user_state
+        self.handler = defaultdict(list)
+        self.total = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.monitors = set()
+
+    def wrap(self, app):
+        for group, handlers in app.handlers.items():
+            if group < 0:
+                continue
+            for handler in handlers:
+                handler.callback = self._wrap_callback(handler.callback)
+
+    def _record(self, keys, bucket, value):
+        for key in keys:
+            bucket[key].append(value)
+
+    def _wrap_callback(self, callback):
+        name = getattr(callback, '__name__', repr(callback))
+
+        async def wrapper(update, context):
+            action = action_of(update, self.user_state)
+            keys = (name,) if action == name else (name, f"{name}[{action}]")
+            tasks = set()
+            token = _step_tasks.set(tasks)
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                for key in keys:
+                    self.errors[key] += 1
+                raise
+            finally:
+                _step_tasks.reset(token)
+                elapsed = time.perf_counter() - started
+                self._record(keys, self.handler, elapsed)
+                if any(not task.done() for task in tasks):
+                    monitor = asyncio.create_task(self._wait_background(keys, tasks, started))
+                    self.monitors.add(monitor)
+                    monitor.add_done_callback(self.monitors.discard)
+                else:
+                    self._record(keys, self.total, elapsed)
+
+        wrapper.__name__ = name
+        return wrapper
+
+    async def _wait_background(self, keys, tasks, started):
+        # Задачи обработчика могут запускать новые задачи - ждем, пока не закончатся все
+        while True:
+            pending = [task for task in tasks if not task.done()]
+            if not pending:
+                break
+            await asyncio.wait(pending)
+        self._record(keys, self.total, time.perf_counter() - started)
+
+    def report(self):
+        return {key: {'handler': summarize(self.handler[key]), 'total': summarize(self.total.get(key, [])),
+                      'errors': self.errors.get(key, 0)}
+                for key in sorted(self.handler)}
+
+
+async def run_replay(args):
+    updates = load_updates(args.recordings, args.limit)
+    if not updates:
+        print("❌ В записи нет обновлений")
+        return 1
+
+    services = FakeServices(
+        replicate=LatencyModel(args.replicate_median, args.replicate_sigma, args.replicate_failure_rate),
+        preflight=LatencyModel(args.preflight_median, 0.3),
+        openai=LatencyModel(args.openai_median, 0.3),
+        telegram=LatencyModel(args.telegram_median, 0.3),
+        betatransfer=LatencyModel(args.betatransfer_median, 0.3),
+        seed=args.seed,
+    )
+    await services.start()
+    os.environ.update(services.environ())
+    # Сам воспроизводимый бот ничего не записывает
+    os.environ.pop('UPDATE_RECORD_DIR', None)
+    os.environ.pop('DATABASE_URL', None)
+
+    bot_dir = os.path.abspath(args.bot_dir)
+    sys.path.insert(0, bot_dir)
+    workdir = tempfile.mkdtemp(prefix="bot_replay_")
+    os.chdir(workdir)
+
+    import bot
+    from database import analytics_db
+    from telegram import Update
+    if not hasattr(bot, 'build_application'):
+        print(f"❌ В {bot_dir} нет bot.build_application - сборка слишком старая для воспроизведения")
+        return 1
+
+    asyncio.get_event_loop().set_task_factory(_task_factory)
+    app = bot.build_application(LOAD_TEST_TOKEN, base_url=f"{services.base}/bot",
+                                base_file_url=f"{services.base}/file/bot", connection_pool_size=args.pool_size)
+    timings = HandlerTimings(bot.USER_STATE)
+    timings.wrap(app)
+    await bot.init_http_session()
+    await app.initialize()
+
+    loop = asyncio.get_event_loop()
+    user_ids = recorded_user_ids(updates)
+    for user_id in user_ids:
+        await loop.run_in_executor(None, analytics_db.add_user, user_id, f"user{user_id % 100000}", "User", None)
+        await loop.run_in_executor(None, analytics_db.add_credits, user_id, args.credits, None, "Воспроизведение")
+
+    await app.start()
+    print(f"▶️ {len(updates)} обновлений от {len(user_ids)} пользователей, скорость {args.speed or 'max'}×, "
+          f"бот из {bot_dir}")
+    rss_start = rss_mb()
+    started = time.perf_counter()
+    max_lag = 0.0
+    for offset, data in updates:
+        if args.speed:
+            delay = started + offset / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    await app.update_queue.join()
+    while timings.monitors:
+        await asyncio.wait(list(timings.monitors))
+    wall = time.perf_counter() - started
+    await app.stop()
+    await app.shutdown()
+    await bot.close_http_session()
+    await services.stop()
+
+    bot_errors = sum(1 for calls in services.chats.values() for call in calls
+                     if str(call['params'].get('text') or '').startswith('❌'))
+    result = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'recordings': [os.path.basename(path) for path in args.recordings],
+        'build': {'bot_dir': bot_dir, 'git_commit': git_commit(bot_dir)},
+        'speed': args.speed,
+        'updates': len(updates),
+        'users': len(user_ids),
+        'wall_time_s': round(wall, 3),
+        'feeder_max_lag_s': round(max_lag, 3),
+        'handlers': timings.report(),
+        'bot_error_messages': bot_errors,
+        'external_calls': dict(sorted(services.calls.items())),
+        'memory_mb': {'rss_start': round(rss_start, 1), 'rss_end': round(rss_mb(), 1)},
+    }
+
+    print(f"\n{'Обработчик':<52}{'N':>6}{'ош.':>5}{'p50':>9}{'p95':>9}{'p95 total':>11}")
+    for key, stats in result['handlers'].items():
+        print(f"{key[:51]:<52}{stats['handler']['count']:>6}{stats['errors']:>5}"
+              f"{stats['handler']['p50'] * 1000:>7.1f}мс{stats['handler']['p95'] * 1000:>7.1f}мс"
+              f"{stats['total']['p95']:>10.2f}с")
+    print(f"\n⏱️  {len(updates)} обновлений за {wall:.1f} с; ответов с ❌: {bot_errors}; "
+          f"отставание подачи до {max_lag:.2f} с")
+
+    out = args.out or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результат сохранен: {out}")
+    return 0
+
+
+def compare_results(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+    print(f"📊 {baseline['build'].get('git_commit') or baseline['build']['bot_dir']} → "
+          f"{candidate['build'].get('git_commit') or candidate['build']['bot_dir']}")
+    if baseline.get('recordings') != candidate.get('recordings'):
+        print(f"⚠️ Разные записи: {baseline.get('recordings')} и {candidate.get('recordings')}")
+
+    regressions = []
+    print(f"{'Обработчик':<52}{'p95 до':>10}{'p95 после':>11}{'изм.':>8}")
+    for key in sorted(set(baseline['handlers']) | set(candidate['handlers'])):
+        old, new = baseline['handlers'].get(key), candidate['handlers'].get(key)
+        if old is None or new is None:
+            print(f"{key[:51]:<52}{'есть только в ' + ('новой' if old is None else 'старой') + ' сборке':>29}")
+            continue
+        for metric in ('handler', 'total'):
+            before, after = old[metric]['p95'], new[metric]['p95']
+            if min(old[metric]['count'], new[metric]['count']) < args.min_count:
+                continue
+            change = (after - before) / before if before else 0.0
+            marker = ''
+            if change > args.threshold and (after - before) * 1000 >= args.min_delta_ms:
+                marker = ' ⚠️'
+                regressions.append(f"{key} {metric} p95: {before * 1000:.1f} → {after * 1000:.1f} мс ({change:+.0%})")
+            label = key if metric == 'handler' else f"  └ с фоновыми задачами"
+            print(f"{label[:51]:<52}{before * 1000:>8.1f}мс{after * 1000:>9.1f}мс{change:>+8.0%}{marker}")
+        if new['errors'] > old['errors']:
+            regressions.append(f"{key}: ошибок {old['errors']} → {new['errors']}")
+
+    if regressions:
+        print(f"\n⚠️ Регрессии ({len(regressions)}):")
+        for line in regressions:
+            print(f"  {line}")
+    else:
+        print("\n✅ Регрессий нет")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений бота")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Воспроизвести запись на заглушках сервисов")
+    run.add_argument('recordings', nargs='+', help="Файлы updates_*.jsonl.gz (воспроизводятся подряд)")
+    run.add_argument('--speed', type=float, default=1.0, help="Ускорение пауз между обновлениями (0 - без пауз)")
+    run.add_argument('--limit', type=int, help="Не больше N обновлений")
+    run.add_argument('--bot-dir', default=SCRIPT_DIR, help="Директория сборки бота (bot.py)")
+    run.add_argument('--out', help="Файл результата (по умолчанию replay_results/<время>.json)")
+    run.add_argument('--credits', type=int, default=100000, help="Кредиты каждому пользователю записи")
+    run.add_argument('--pool-size', type=int, default=64, help="Пул соединений к Bot API")
+    run.add_argument('--replicate-median', type=float, default=2.0)
+    run.add_argument('--replicate-sigma', type=float, default=0.5)
+    run.add_argument('--replicate-failure-rate', type=float, default=0.0)
+    run.add_argument('--preflight-median', type=float, default=0.2)
+    run.add_argument('--openai-median', type=float, default=0.5)
+    run.add_argument('--telegram-median', type=float, default=0.03)
+    run.add_argument('--betatransfer-median', type=float, default=0.15)
+    run.add_argument('--seed', type=int, default=1)
+
+    cmp = commands.add_parser('compare', help="Сравнить два результата run")
+    cmp.add_argument('baseline')
+    cmp.add_argument('candidate')
+    cmp.add_argument('--threshold', type=float, default=0.2, help="Допустимый рост p95 (доля)")
+    cmp.add_argument('--min-delta-ms', type=float, default=5.0, help="Меньший рост p95 не считается регрессией")
+    cmp.add_argument('--min-count', type=int, default=5, help="Минимум вызовов для сравнения")
+    cmp.add_argument('--fail-on-regression', action='store_true', help="Код выхода 1 при регрессии")
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        sys.exit(compare_results(args))
+    args.recordings = [os.path.abspath(path) for path in args.recordings]
+    if args.out:
+        args.out = os.path.abspath(args.out)
+    sys.exit(asyncio.run(run_replay(args)))
+
+
+if __name__ == '__main__':
+    main()
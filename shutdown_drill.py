@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Учения остановки бота посреди генераций
+
+Поднимает заглушки сервисов (fake_services.py), запускает --users
+сценариев image/video из load_test_bot и, когда генерации уже идут,
+вызывает тот же дренаж, что и обработчик SIGTERM (drain_in_flight_jobs)
+со сроком --drain-seconds. Модель Replicate отвечает за --fast-median
+секунд у половины пользователей и за --slow-median у другой половины,
+поэтому часть генераций успевает завершиться, а часть прерывается.
+Результат генерации - отправленные пользователю фото, документы и видео,
+оплата - изменение баланса и остатка бесплатных генераций.
+
+Проверяется, что:
+- быстрые генерации дописаны и оплачены, а время дренажа не больше срока;
+- прерванные генерации сохранены в interrupted_jobs, и пользователь
+  получил кнопку «Продолжить»;
+- новые генерации во время остановки не запускаются;
+- по кнопке «Продолжить» генерация запускается заново с теми же
+  настройками и завершается (после перезапуска модель отвечает быстро).
+
+Использование:
+    python shutdown_drill.py [--users 6] [--drain-seconds 5] [--fast-median 0.3] [--slow-median 30]
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices, LatencyModel
+from load_test_bot import FLOWS, LoadTest, FlowError, _task_factory
+
+
+MEDIA_METHODS = ('sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendVideo')
+
+
+def model_calls(services) -> int:
+    """Созданные предсказания генераций (без проверки доступности Replicate)"""
+    return sum(count for name, count in services.calls.items()
+               if name.startswith('replicate:') and name != 'replicate:replicate/hello-world')
+
+
+async def wait_until(condition, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+def delivered(services, user_id) -> int:
+    return sum(1 for call in services.chats.get(user_id, []) if call['method'] in MEDIA_METHODS)
+
+
+def entitlements(test, user_id):
+    return (test.analytics_db.get_user_credits(user_id)['balance'],
+            test.analytics_db.get_free_generations_left(user_id))
+
+
+async def drill(args):
+    services = FakeServices(replicate=LatencyModel(args.fast_median), preflight=LatencyModel(0.001),
+                            openai=LatencyModel(0.01), telegram=LatencyModel(0.001),
+                            betatransfer=LatencyModel(0.001))
+    await services.start()
+    os.environ.update(services.environ())
+    os.environ.pop('DATABASE_URL', None)
+    os.chdir(tempfile.mkdtemp(prefix="bot_shutdown_drill_"))
+    asyncio.get_event_loop().set_task_factory(_task_factory)
+
+    test = LoadTest(Namespace(users=args.users, flows_per_user=1, seed=1, step_timeout=120), services)
+    with redirect_stdout(io.StringIO()):
+        await test.setup()
+    from telegram import Update
+    bot = test.bot_module
+    coordinator = bot.job_coordinator
+    users = list(test.user_ids())
+    slow_users = set(users[len(users) // 2:])
+    failures = []
+
+    try:
+        # Последний шаг сценария запускает генерацию; до него шаги проходят как обычно
+        flows = {user_id: ('video' if index % 3 == 2 else 'image') for index, user_id in enumerate(users)}
+        for user_id, name in flows.items():
+            for kind, value in flows_prefix(name):
+                await test.run_step(user_id, kind, value)
+        before = {user_id: entitlements(test, user_id) for user_id in users}
+
+        # Сначала медленные: их предсказания создаются, пока модель «зависла»
+        services.replicate_latency = LatencyModel(args.slow_median)
+        calls = model_calls(services)
+        steps = [asyncio.ensure_future(run_last_step(test, user_id, flows[user_id])) for user_id in slow_users]
+        await wait_until(lambda: model_calls(services) >= calls + len(slow_users))
+        services.replicate_latency = LatencyModel(args.fast_median)
+        steps += [asyncio.ensure_future(run_last_step(test, user_id, flows[user_id]))
+                  for user_id in users if user_id not in slow_users]
+        await wait_until(lambda: coordinator.running >= len(users))
+        print(f"🚀 Генераций в работе: {coordinator.running} ({coordinator.running_by_kind()})")
+
+        # Остановка: то же, что делает обработчик SIGTERM после остановки приема обновлений
+        with redirect_stdout(io.StringIO()):
+            drain_started = time.perf_counter()
+            await bot.drain_in_flight_jobs(test.app, timeout=args.drain_seconds)
+            drain_seconds = time.perf_counter() - drain_started
+        await asyncio.gather(*steps, return_exceptions=True)
+        print(f"🛑 Дренаж с отменой и сохранением: {drain_seconds:.2f} с (срок {args.drain_seconds} с)")
+        if drain_seconds > args.drain_seconds + 6:
+            failures.append(f"дренаж занял {drain_seconds:.1f} с")
+
+        offers = {user_id: resume_offer(services, user_id) for user_id in users}
+        print(f"\n{'Пользователь':<14}{'модель':<8}{'сценарий':<10}{'медиа':>6}{'оплачено':>10}  итог")
+        for user_id in users:
+            paid = entitlements(test, user_id) != before[user_id]
+            kind = 'медл.' if user_id in slow_users else 'быстр.'
+            outcome = f"предложен повтор ({offers[user_id]})" if offers[user_id] else "завершена"
+            print(f"{user_id:<14}{kind:<8}{flows[user_id]:<10}{delivered(services, user_id):>6}"
+                  f"{'да' if paid else 'нет':>10}  {outcome}")
+            if user_id in slow_users and (not offers[user_id] or paid):
+                failures.append(f"{user_id}: прерванная генерация оплачена или без предложения повтора")
+            if user_id not in slow_users and (offers[user_id] or not paid or not delivered(services, user_id)):
+                failures.append(f"{user_id}: быстрая генерация не завершилась за время дренажа")
+
+        # Во время остановки новые генерации не запускаются
+        rejected_user = users[0]
+        for kind, value in flows_prefix('image'):
+            await test.run_step(rejected_user, kind, value)
+        await run_last_step(test, rejected_user, 'image')
+        await asyncio.sleep(0.2)
+        if coordinator.running:
+            failures.append("генерация запустилась во время остановки")
+        if 'перезапускается' not in last_text(services, rejected_user):
+            failures.append("пользователь не получил сообщение о перезапуске")
+
+        # Новый процесс: прием задач снова открыт, модель отвечает быстро
+        coordinator.accepting = True
+        services.replicate_latency = LatencyModel(args.fast_median)
+        resumed = 0
+        for user_id, data in offers.items():
+            if not data:
+                continue
+            media_before = delivered(services, user_id)
+            await test.run_step(user_id, 'click', data)
+            if delivered(services, user_id) > media_before and entitlements(test, user_id) != before[user_id]:
+                resumed += 1
+            else:
+                failures.append(f"{user_id}: возобновленная генерация не завершилась")
+            # Повторное нажатие той же кнопки не запускает генерацию второй раз
+            paid = entitlements(test, user_id)
+            update = test.build_update(user_id, 'click', 'main_menu')
+            update['callback_query']['data'] = data
+            await test.app.process_update(Update.de_json(update, test.app.bot))
+            await asyncio.sleep(0.2)
+            if coordinator.running or entitlements(test, user_id) != paid:
+                failures.append(f"{user_id}: повторное нажатие «Продолжить» запустило генерацию снова")
+        print(f"\n▶️  Возобновлено и завершено генераций: {resumed}")
+    finally:
+        await test.teardown()
+        await services.stop()
+
+    if failures:
+        print("\n❌ " + "\n❌ ".join(failures))
+        return 1
+    print("\n✅ Остановка прошла без потерянных и дважды оплаченных генераций")
+    return 0
+
+
+def flows_prefix(name):
+    return FLOWS[name][:-1]
+
+
+async def run_last_step(test, user_id, name):
+    kind, value = FLOWS[name][-1]
+    try:
+        await test.run_step(user_id, kind, value)
+    except FlowError:
+        pass
+
+
+def resume_offer(services, user_id):
+    """callback_data кнопки «Продолжить» из последней клавиатуры пользователя"""
+    call = services.last_keyboard_message(user_id)
+    buttons = [button.get('callback_data', '') for row in
+               (call['params']['reply_markup']['inline_keyboard'] if call else []) for button in row]
+    return next((data for data in buttons if data.startswith('resume_job:')), None)
+
+
+def last_text(services, user_id) -> str:
+    messages = [call for call in services.chats.get(user_id, []) if call['method'] == 'sendMessage']
+    return messages[-1]['params'].get('text', '') if messages else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Учения остановки бота посреди генераций")
+    parser.add_argument('--users', type=int, default=6, help="Пользователей (половина с медленной моделью)")
+    parser.add_argument('--drain-seconds', type=float, default=5.0, help="Срок дренажа")
+    parser.add_argument('--fast-median', type=float, default=0.3, help="Ответ модели для быстрых генераций, с")
+    parser.add_argument('--slow-median', type=float, default=30.0, help="Ответ модели для прерываемых генераций, с")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(drill(args)))
+
+
+if __name__ == '__main__':
+    main()
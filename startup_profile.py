@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Профиль холодного старта бота
+
+1. Импорт: python -X importtime -c "import bot" в отдельном процессе.
+   Выводится общее время импорта bot, самые дорогие прямые импорты bot.py
+   и собственное время модулей, сгруппированное по пакетам верхнего уровня.
+
+2. Время до первого обновления: запускается отдельный процесс, который
+   импортирует bot, строит Application против заглушки Telegram
+   (fake_services.py), инициализирует его и обрабатывает /start с чистой
+   SQLite базой. Время считается от запуска процесса до ответа на /start,
+   по этапам: старт интерпретатора, импорт bot, инициализация, первое
+   обновление. С --max-first-update-ms скрипт завершается с кодом 1, если
+   медиана превышает порог, - это проверка для CI.
+
+Использование:
+    python startup_profile.py [--runs 5] [--top 15] [--max-first-update-ms 2500] [--skip-imports]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROJECT_DIR)
+
+PROFILE_TOKEN = '123456:STARTUP'
+PROFILE_USER_ID = 900000001
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def _child_env(extra=None):
+    env = dict(os.environ)
+    env.pop('DATABASE_URL', None)
+    env['PYTHONPATH'] = PROJECT_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env.update(extra or {})
+    return env
+
+
+# ==================== Импорт ====================
+
+def parse_importtime(text: str):
+    """Строки -X importtime: [(имя, глубина, собственное мкс, накопленное мкс)]"""
+    rows = []
+    for line in text.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, (len(indent) - 1) // 2, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def import_profile(top: int):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bot'],
+                            cwd=tempfile.mkdtemp(prefix='bot_startup_'), env=_child_env(),
+                            capture_output=True, text=True, timeout=300)
+    rows = parse_importtime(result.stderr)
+    if result.returncode != 0 or not rows:
+        print(result.stderr[-2000:])
+        raise SystemExit("❌ Не удалось импортировать bot")
+
+    # Строки идут в порядке завершения импорта: прямые импорты bot.py -
+    # строки глубины 1 перед строкой самого bot
+    bot_index = max(index for index, row in enumerate(rows) if row[0] == 'bot' and row[1] == 0)
+    bot_total = rows[bot_index][3]
+    direct = []
+    for name, depth, _, cumulative in reversed(rows[:bot_index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((cumulative, name))
+    packages = defaultdict(int)
+    for name, _, self_us, _ in rows[:bot_index + 1]:
+        packages[name.split('.')[0]] += self_us
+
+    print(f"📦 import bot: {bot_total / 1000:.0f} мс")
+    print(f"\n{'Прямые импорты bot.py':<40}{'мс':>8}")
+    for cumulative, name in sorted(direct, reverse=True)[:top]:
+        print(f"{name:<40}{cumulative / 1000:>8.1f}")
+    print(f"\n{'Собственное время по пакетам':<40}{'мс':>8}")
+    for name, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{name:<40}{self_us / 1000:>8.1f}")
+    return bot_total / 1e6
+
+
+# ==================== Время до первого обновления ====================
+
+async def _child_main():
+    spawned = float(os.environ['STARTUP_PROFILE_SPAWNED'])
+    base = os.environ['STARTUP_PROFILE_BASE']
+    marks = {'interpreter': time.time() - spawned}
+    started = time.perf_counter()
+    import bot
+    from telegram import Update
+    marks['import_bot'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bot.analytics_db.start_schema_migration()
+    app = bot.build_application(PROFILE_TOKEN, base_url=f"{base}/bot", base_file_url=f"{base}/file/bot")
+    await bot.init_http_session()
+    await app.initialize()
+    marks['initialize'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    user = {'id': PROFILE_USER_ID, 'is_bot': False, 'first_name': 'Startup', 'username': 'startup'}
+    update = Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': PROFILE_USER_ID, 'type': 'private'},
+        'from': user, 'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}, app.bot)
+    await app.process_update(update)
+    marks['first_update'] = time.perf_counter() - started
+    marks['total'] = time.time() - spawned
+
+    await app.shutdown()
+    await bot.close_http_session()
+    print(json.dumps(marks))
+
+
+async def _run_child(services):
+    env = _child_env(services.environ())
+    env['STARTUP_PROFILE_BASE'] = services.base
+    env['STARTUP_PROFILE_SPAWNED'] = repr(time.time())
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--child', cwd=tempfile.mkdtemp(prefix='bot_startup_'),
+        env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    lines = [line for line in stdout.decode('utf-8', 'replace').splitlines() if line.startswith('{')]
+    if process.returncode != 0 or not lines:
+        print(stderr.decode('utf-8', 'replace')[-2000:])
+        raise SystemExit("❌ Процесс замера старта завершился с ошибкой")
+    return json.loads(lines[-1])
+
+
+async def first_update_profile(runs: int):
+    from fake_services import FakeServices, LatencyModel
+    services = FakeServices(replicate=LatencyModel(0.01), telegram=LatencyModel(0.001))
+    await services.start()
+    try:
+        results = [await _run_child(services) for _ in range(runs)]
+    finally:
+        await services.stop()
+    phases = ['interpreter', 'import_bot', 'initialize', 'first_update', 'total']
+    medians = {phase: statistics.median(result[phase] for result in results) for phase in phases}
+    print(f"\n⏱️  Время до первого обновления, медиана {runs} запусков:")
+    for phase in phases:
+        print(f"{phase:<16}{medians[phase] * 1000:>8.0f} мс")
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Профиль холодного старта бота")
+    parser.add_argument('--runs', type=int, default=5, help="Запусков для замера времени до первого обновления")
+    parser.add_argument('--top', type=int, default=15, help="Строк в таблицах импорта")
+    parser.add_argument('--max-first-update-ms', type=float, help="Порог медианы (код выхода 1 при превышении)")
+    parser.add_argument('--skip-imports', action='store_true', help="Не строить профиль импорта")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(_child_main())
+        return
+
+    if not args.skip_imports:
+        import_profile(args.top)
+    medians = asyncio.run(first_update_profile(max(1, args.runs)))
+    if args.max_first_update_ms is not None:
+        total_ms = medians['total'] * 1000
+        if total_ms > args.max_first_update_ms:
+            print(f"\n❌ Первое обновление через {total_ms:.0f} мс, порог {args.max_first_update_ms:.0f} мс")
+            sys.exit(1)
+        print(f"\n✅ Первое обновление через {total_ms:.0f} мс, порог {args.max_first_update_ms:.0f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Неблокирующее структурированное логирование
+
+Раньше каждый шаг горячих путей писался дважды (print и logging.info с
+f-строкой), строка собиралась даже при выключенном уровне, а запись в
+stderr шла синхронно прямо в event loop. Теперь:
+
+- корневой логгер пишет через NonBlockingQueueHandler: вызывающий код
+  только кладет LogRecord в ограниченную очередь, а форматирование и
+  запись выполняет фоновый поток QueueListener. При переполнении очереди
+  запись отбрасывается (bot_log_records_dropped_total), loop не ждет;
+- сообщение собирается из msg % args только в фоновом потоке, поэтому в
+  горячих путях логируют с ленивыми аргументами:
+  logger.info("Платеж %s: %s", payment_id, status);
+- JsonFormatter пишет одну JSON строку на запись: время, уровень, логгер,
+  категорию, сообщение, trace_id текущей трассы и поля из extra;
+- SamplingFilter прореживает шумные категории (категория - extra
+  category или имя логгера, например bot.payments или httpx): доля
+  записей LOG_SAMPLING и предел записей в секунду LOG_RATE_LIMITS.
+  WARNING и выше не прореживаются никогда. Первая запись после
+  ограничения несет поле suppressed - сколько записей было пропущено.
+
+Аргументы записи форматируются позже, в фоновом потоке: передавать в лог
+изменяемые объекты, которые сразу после вызова меняются, не стоит.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from metrics import metrics_registry
+from tracing import tracer
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json - одна JSON строка на запись, text - прежний текстовый формат
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Предел очереди записей между вызывающим кодом и фоновым потоком
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Доля сохраняемых записей INFO/DEBUG по категориям: "httpx=0.05,bot.media=0.2"
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'httpx=0.05')
+# Предел записей INFO/DEBUG по категориям: "bot.payments=20" (в секунду) или "bot.media=100/60"
+LOG_RATE_LIMITS = os.getenv('LOG_RATE_LIMITS', 'bot.payments=20,bot.media=10')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+LOG_RECORDS_DROPPED = metrics_registry.counter(
+    'bot_log_records_dropped_total', 'Записи лога, отброшенные из-за переполненной очереди')
+LOG_RECORDS_FILTERED = metrics_registry.counter(
+    'bot_log_records_filtered_total', 'Записи лога, отброшенные выборкой или лимитом по категории',
+    ['category', 'reason'])
+
+# Стандартные атрибуты LogRecord: все остальное пришло через extra
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'taskName', 'category', 'trace_id', 'suppressed', 'sample_rate'}
+
+
+def parse_category_rates(spec: str) -> Dict[str, float]:
+    """Разбирает "категория=доля,...": доля от 0 до 1"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, _, value = item.partition('=')
+        try:
+            rates[category.strip()] = min(1.0, max(0.0, float(value)))
+        except ValueError:
+            logging.warning(f"⚠️ Неверная доля выборки логов: {item}")
+    return rates
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Разбирает "категория=N" или "категория=N/секунды": {категория: (N, секунды)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, _, value = item.partition('=')
+        count, _, period = value.partition('/')
+        try:
+            limits[category.strip()] = (float(count), float(period or 1))
+        except ValueError:
+            logging.warning(f"⚠️ Неверный лимит логов: {item}")
+    return limits
+
+
+def record_category(record: logging.LogRecord) -> str:
+    return getattr(record, 'category', None) or record.name
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'suppressed')
+
+    def __init__(self, count: float, period: float):
+        self.rate = count / period
+        self.capacity = max(1.0, count)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Выборка и лимит записей INFO/DEBUG по категориям
+
+    Правило категории ищется по самому длинному префиксу имени: правило
+    bot.payments действует и на bot.payments.poller. Выборка равномерная
+    (каждая 1/доля запись), а не случайная, чтобы редкие категории не
+    пропадали целиком.
+    """
+
+    def __init__(self, sampling: Optional[Dict[str, float]] = None,
+                 rate_limits: Optional[Dict[str, Tuple[float, float]]] = None):
+        super().__init__()
+        self.sampling = dict(sampling or {})
+        self.rate_limits = dict(rate_limits or {})
+        self._lock = threading.Lock()
+        self._rules: Dict[str, Tuple[Optional[float], Optional[_TokenBucket]]] = {}
+        self._credit: Dict[str, float] = {}
+        self._sampled_out: Dict[str, int] = {}
+
+    def _lookup(self, rules: Dict, category: str):
+        name = category
+        while True:
+            if name in rules:
+                return rules[name]
+            if '.' not in name:
+                return None
+            name = name.rsplit('.', 1)[0]
+
+    def _rule(self, category: str):
+        rule = self._rules.get(category)
+        if rule is None:
+            limit = self._lookup(self.rate_limits, category)
+            rule = self._rules[category] = (self._lookup(self.sampling, category),
+                                            _TokenBucket(*limit) if limit else None)
+        return rule
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record_category(record)
+        with self._lock:
+            rate, bucket = self._rule(category)
+            if rate is None and bucket is None:
+                return True
+            if rate is not None and rate < 1:
+                credit = self._credit.get(category, 1.0) + rate
+                if credit < 1:
+                    self._credit[category] = credit
+                    self._sampled_out[category] = self._sampled_out.get(category, 0) + 1
+                    LOG_RECORDS_FILTERED.labels(category, 'sampled').inc()
+                    return False
+                self._credit[category] = credit - 1
+                record.sample_rate = rate
+            if bucket is not None:
+                if not bucket.take():
+                    bucket.suppressed += 1
+                    LOG_RECORDS_FILTERED.labels(category, 'rate_limited').inc()
+                    return False
+                if bucket.suppressed:
+                    record.suppressed = bucket.suppressed
+                    bucket.suppressed = 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в очередь без ожидания и без форматирования
+
+    Стандартный QueueHandler.prepare собирает сообщение в вызывающем
+    потоке; здесь к записи только добавляется trace_id, а msg % args и
+    traceback форматирует поток QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = tracer.current_trace_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Полная очередь не должна ронять остановку: ждем место для метки конца
+        self.queue.put(self._sentinel, timeout=5)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON строка на запись"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        category = getattr(record, 'category', None)
+        if category:
+            data['category'] = category
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            data['trace_id'] = trace_id
+        for key in ('sample_rate', 'suppressed'):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат с пометкой пропущенных записей"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            text += f" (пропущено записей: {suppressed})"
+        return text
+
+
+_listener: Optional[_LogListener] = None
+_log_queue: Optional[queue.Queue] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None,
+                  queue_size: int = LOG_QUEUE_SIZE, sampling: Optional[str] = None,
+                  rate_limits: Optional[str] = None) -> logging.Handler:
+    """
+    Настраивает корневой логгер: очередь, фоновый поток записи, выборка
+
+    Заменяет обработчики, уже установленные на корневом логгере (в том
+    числе неявный basicConfig от первого logging.warning при импорте).
+    Повторный вызов перенастраивает логирование. Возвращает обработчик
+    очереди.
+    """
+    global _listener, _log_queue
+    stop_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    _log_queue = queue.Queue(maxsize=queue_size)
+    handler = NonBlockingQueueHandler(_log_queue)
+    handler.addFilter(SamplingFilter(parse_category_rates(LOG_SAMPLING if sampling is None else sampling),
+                                     parse_rate_limits(LOG_RATE_LIMITS if rate_limits is None else rate_limits)))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = _LogListener(_log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """Дописывает записи из очереди и останавливает фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_queue_depth() -> int:
+    return _log_queue.qsize() if _log_queue is not None else 0
+
+
+metrics_registry.callback('bot_log_queue_depth', 'Записи лога, ожидающие фонового потока', log_queue_depth)
+atexit.register(stop_logging)
@@ -0,0 +1,348 @@
+"""
+Трассировка генераций по этапам
+
+Трасса - это одна задача пользователя (например, send_images), спан - ее
+этап: чтение лимитов из базы, запрос к GPT, фильтр промптов, каждая
+генерация Replicate, отправка медиагруппы, списание. Текущий спан хранится
+в contextvars, поэтому задачи asyncio.gather и вызовы через
+ContextThreadPoolExecutor автоматически попадают в трассу родителя.
+
+Вне трассы span() ничего не делает, так что обертки горячих путей почти
+бесплатны, пока трассировка не запущена. Завершенные трассы остаются в
+кольцевом буфере (для /slow_traces) и пишутся в JSONL файл с ротацией.
+"""
+
+import concurrent.futures
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Dict, List, Optional
+
+# Файл с завершенными трассами (одна трасса на строку) и его ротация
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces/traces.jsonl')
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', '5'))
+# Сколько последних трасс держать в памяти
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '500'))
+# Предел спанов в одной трассе (защита от циклов с тысячами запросов)
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '500'))
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() != 'false'
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Этап трассы: имя, начало, длительность, атрибуты и исход"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attrs', 'outcome',
+                 'start_wall', 'start', 'duration', '_token')
+
+    def __init__(self, trace: 'Trace', name: str, parent: Optional['Span'], attrs: Dict):
+        self.trace = trace
+        self.span_id = trace.next_span_id()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attrs = attrs
+        self.outcome = None
+        self.start_wall = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self._token = None
+
+    def set(self, **attrs):
+        """Добавляет атрибуты спана (модель, число изображений и т.п.)"""
+        self.attrs.update(attrs)
+
+    def finish(self, outcome: str = None):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start
+            self.outcome = self.outcome or outcome or 'ok'
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'offset_ms': round((self.start - self.trace.root.start) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            'outcome': self.outcome or 'unfinished',
+            'attrs': self.attrs,
+        }
+
+
+class Trace:
+    """Все спаны одной задачи"""
+
+    def __init__(self, name: str, attrs: Dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self._span_ids = 0
+        self._lock = threading.Lock()
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.root = Span(self, name, None, attrs)
+        self.spans.append(self.root)
+
+    def next_span_id(self) -> int:
+        with self._lock:
+            self._span_ids += 1
+            return self._span_ids
+
+    def add(self, span: Span) -> bool:
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return False
+            self.spans.append(span)
+            return True
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration or 0.0
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'trace_id': self.trace_id,
+            'name': self.root.name,
+            'start': datetime.fromtimestamp(self.root.start_wall).isoformat(timespec='milliseconds'),
+            'duration_ms': round(self.duration * 1000, 2),
+            'outcome': self.root.outcome,
+            'attrs': self.root.attrs,
+            'spans': [span.to_dict() for span in spans[1:]],
+            'dropped_spans': self.dropped,
+        }
+
+
+class _NoopScope:
+    """Контекст span() вне трассы"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopScope()
+
+
+class _SpanScope:
+    __slots__ = ('_tracer', '_span', '_token', '_root')
+
+    def __init__(self, tracer: 'Tracer', span: Span, root: bool):
+        self._tracer = tracer
+        self._span = span
+        self._root = root
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self._span.set(error=f"{exc_type.__name__}: {exc}"[:300])
+        self._span.finish('error' if exc_type is not None else 'ok')
+        if self._root:
+            self._tracer.finish_trace(self._span.trace)
+        return False
+
+
+class JsonlTraceExporter:
+    """Пишет завершенные трассы в JSONL файл с ротацией по размеру"""
+
+    def __init__(self, path: str = TRACE_FILE, max_bytes: int = TRACE_FILE_MAX_BYTES,
+                 backup_count: int = TRACE_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def _get_handler(self) -> RotatingFileHandler:
+        if self._handler is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                          backupCount=self.backup_count, encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._handler = handler
+        return self._handler
+
+    def export(self, trace: Dict):
+        line = json.dumps(trace, ensure_ascii=False, default=str)
+        with self._lock:
+            handler = self._get_handler()
+            handler.emit(logging.makeLogRecord({'msg': line, 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+    def close(self):
+        with self._lock:
+            if self._handler is not None:
+                self._handler.close()
+                self._handler = None
+
+
+class Tracer:
+    """Создает трассы и спаны, хранит последние трассы и отдает их экспортеру"""
+
+    def __init__(self, exporter: Optional[JsonlTraceExporter] = None, buffer_size: int = TRACE_BUFFER_SIZE,
+                 enabled: bool = TRACING_ENABLED):
+        self.exporter = exporter
+        self.enabled = enabled
+        self._recent = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    def start_trace(self, name: str, **attrs):
+        """
+        Контекст корневого спана задачи
+
+        Внутри уже идущей трассы работает как обычный спан, чтобы вложенные
+        задачи (send_images из generate_content) не дробили трассу.
+        """
+        if not self.enabled:
+            return _NOOP
+        parent = _current_span.get()
+        if parent is not None:
+            return self._child_scope(parent, name, attrs)
+        trace = Trace(name, attrs)
+        return _SpanScope(self, trace.root, root=True)
+
+    def span(self, name: str, **attrs):
+        """Контекст этапа внутри текущей трассы (вне трассы - ничего не делает)"""
+        parent = _current_span.get()
+        if parent is None:
+            return _NOOP
+        return self._child_scope(parent, name, attrs)
+
+    def _child_scope(self, parent: Span, name: str, attrs: Dict):
+        span = Span(parent.trace, name, parent, attrs)
+        if not parent.trace.add(span):
+            return _NOOP
+        return _SpanScope(self, span, root=False)
+
+    def annotate(self, **attrs):
+        """Добавляет атрибуты текущему спану"""
+        span = _current_span.get()
+        if span is not None:
+            span.set(**attrs)
+
+    def current_trace_id(self) -> Optional[str]:
+        span = _current_span.get()
+        return span.trace.trace_id if span is not None else None
+
+    def finish_trace(self, trace: Trace):
+        # Незакрытые спаны (ранний return, отмена задачи) помечаются отдельно
+        for span in trace.spans:
+            if span.duration is None:
+                span.outcome = 'unfinished'
+        with self._lock:
+            self._recent.append(trace)
+        if self.exporter is not None:
+            try:
+                self.exporter.export(trace.to_dict())
+            except Exception as e:
+                logging.error(f"Ошибка записи трассы {trace.trace_id}: {e}")
+
+    def trace(self, name: str, attrs: Callable = None):
+        """
+        Декоратор корутины: каждый вызов - отдельная трасса
+
+        attrs(*args, **kwargs) возвращает словарь атрибутов корневого спана.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.start_trace(name, **(attrs(*args, **kwargs) if attrs else {})):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def traced(self, name: str, outcome: Callable = None):
+        """
+        Декоратор корутины: вызов внутри трассы становится спаном
+
+        outcome(result) возвращает исход для функций, которые сообщают об
+        ошибке результатом, а не исключением.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name) as span:
+                    result = await func(*args, **kwargs)
+                    if span is not None and outcome is not None:
+                        span.outcome = outcome(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def recent(self) -> List[Trace]:
+        with self._lock:
+            return list(self._recent)
+
+    def slowest(self, limit: int = 10, name: str = None) -> List[Trace]:
+        """Самые долгие трассы из буфера, по убыванию длительности"""
+        traces = [trace for trace in self.recent() if name is None or trace.root.name == name]
+        return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:limit]
+
+
+def trace_methods(cls, prefix: str, exclude=()):
+    """Оборачивает публичные методы класса в спаны '<prefix><метод>'"""
+    exclude = set(exclude)
+    for name, func in list(vars(cls).items()):
+        if name.startswith('_') or name in exclude or not callable(func) or isinstance(func, (staticmethod, classmethod)):
+            continue
+        setattr(cls, name, _span_method(func, prefix + name))
+    return cls
+
+
+def _span_method(func, span_name: str):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_span.get() is None:
+            return func(*args, **kwargs)
+        with tracer.span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ContextThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor, выполняющий задачу в копии contextvars вызывающего кода"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def format_trace(trace: Trace, max_spans: int = 15) -> str:
+    """Краткое текстовое описание трассы: корень и самые долгие этапы"""
+    data = trace.to_dict()
+    attrs = ', '.join(f"{key}={value}" for key, value in data['attrs'].items())
+    lines = [f"{data['start'][11:19]} {data['name']} {data['duration_ms'] / 1000:.2f}с "
+             f"[{data['outcome']}] {attrs}".rstrip()]
+    spans = sorted(data['spans'], key=lambda span: span['duration_ms'] or 0, reverse=True)
+    for span in spans[:max_spans]:
+        duration = f"{span['duration_ms'] / 1000:.2f}с" if span['duration_ms'] is not None else '—'
+        details = ', '.join(f"{key}={value}" for key, value in span['attrs'].items() if key != 'error')
+        outcome = '' if span['outcome'] == 'ok' else f" [{span['outcome']}]"
+        lines.append(f"  +{span['offset_ms'] / 1000:.2f}с {span['name']} {duration}{outcome} {details}".rstrip())
+    if len(spans) > max_spans:
+        lines.append(f"  ... еще {len(spans) - max_spans} этапов")
+    return '\n'.join(lines)
+
+
+# Общий трассировщик процесса
+tracer = Tracer(JsonlTraceExporter())
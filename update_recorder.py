@@ -0,0 +1,212 @@
+"""
+Запись входящих обновлений Telegram для воспроизведения (replay_updates.py)
+
+Включается переменной UPDATE_RECORD_DIR. Каждое обновление обезличивается
+и пишется одной строкой JSON вместе со смещением от начала записи в
+gzip файл recordings/updates_<время>.jsonl.gz; при превышении
+UPDATE_RECORD_MAX_BYTES открывается следующий файл.
+
+Обезличивание сохраняет то, от чего зависит маршрут по обработчикам:
+callback_data, команды, короткие числа (количество изображений) и длину
+текста. ID пользователей и чатов заменяются псевдонимами через HMAC с
+солью, поэтому все обновления одного пользователя остаются связаны между
+собой; имена, тексты, подписи и file_id не сохраняются.
+
+Обработчик записи только кладет обновление в очередь - сериализация,
+обезличивание и сжатие выполняются в отдельном потоке.
+"""
+
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+# Директория записей; пусто - запись выключена
+UPDATE_RECORD_DIR = os.getenv('UPDATE_RECORD_DIR', '')
+# Доля записываемых пользователей (выбираются целиком, по хешу ID)
+UPDATE_RECORD_SAMPLE_RATE = float(os.getenv('UPDATE_RECORD_SAMPLE_RATE', '1.0'))
+# Размер несжатых данных, после которого начинается новый файл
+UPDATE_RECORD_MAX_BYTES = int(os.getenv('UPDATE_RECORD_MAX_BYTES', str(50 * 1024 * 1024)))
+# Соль псевдонимов; без нее псевдонимы меняются при каждом перезапуске
+UPDATE_RECORD_SALT = os.getenv('UPDATE_RECORD_SALT', '')
+
+RECORDING_FORMAT = 'bot-updates/1'
+# Псевдонимы попадают в диапазон, не пересекающийся с реальными ID пользователей
+PSEUDONYM_BASE = 8_000_000_000
+PSEUDONYM_RANGE = 100_000_000
+
+# Поля, которые не нужны для воспроизведения и могут содержать личные данные
+_DROPPED_KEYS = frozenset({
+    'contact', 'location', 'venue', 'reply_to_message', 'forward_from', 'forward_from_chat',
+    'forward_sender_name', 'forward_signature', 'caption_entities', 'phone_number', 'email',
+    'bio', 'description', 'invite_link', 'photo_url', 'thumbnail', 'thumb', 'file_name',
+})
+_NAME_KEYS = ('first_name', 'last_name', 'username', 'title')
+_TEXT_KEYS = ('text', 'caption')
+_FILE_KEYS = ('file_id', 'file_unique_id')
+_PLACEHOLDER = 'текст '
+
+
+class UpdateAnonymizer:
+    """Обезличивает словарь обновления (Update.to_dict())"""
+
+    def __init__(self, salt: str):
+        self._key = salt.encode('utf-8')
+
+    def _digest(self, value) -> int:
+        return int(hmac.new(self._key, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:15], 16)
+
+    def pseudonym(self, entity_id: int) -> int:
+        pseudo = PSEUDONYM_BASE + self._digest(abs(entity_id)) % PSEUDONYM_RANGE
+        return pseudo if entity_id >= 0 else -pseudo
+
+    def sampled(self, user_id: int, rate: float) -> bool:
+        if rate >= 1:
+            return True
+        return (self._digest(f"sample:{user_id}") % 10_000) < rate * 10_000
+
+    @staticmethod
+    def scrub_text(text: str) -> str:
+        """Оставляет команду и короткие числа, остальное - заглушка той же длины"""
+        stripped = text.strip()
+        if stripped.startswith('/'):
+            command, _, args = stripped.partition(' ')
+            return command + (' ' + (_PLACEHOLDER * len(args))[:len(args)] if args else '')
+        if stripped.isdigit() and len(stripped) <= 4:
+            return stripped
+        return (_PLACEHOLDER * (len(text) // len(_PLACEHOLDER) + 1))[:len(text)]
+
+    def anonymize(self, data):
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        # Пользователь (is_bot) или чат (type) - заменяем ID и имена
+        is_entity = 'id' in data and ('is_bot' in data or data.get('type') in
+                                      ('private', 'group', 'supergroup', 'channel'))
+        for key, value in data.items():
+            if key in _DROPPED_KEYS:
+                continue
+            if is_entity and key == 'id':
+                result[key] = self.pseudonym(value)
+            elif is_entity and key in _NAME_KEYS:
+                result[key] = f"user{self._digest(value) % 100_000}" if key == 'username' else 'User'
+            elif key in _TEXT_KEYS and isinstance(value, str):
+                result[key] = self.scrub_text(value)
+            elif key in _FILE_KEYS and isinstance(value, str):
+                result[key] = f"f{self._digest(value):x}"
+            elif key == 'entities':
+                # Нужны только команды: по ним CommandHandler узнает /start и т.п.
+                result[key] = [entity for entity in value if entity.get('type') == 'bot_command']
+            elif key == 'user_id' and isinstance(value, int):
+                result[key] = self.pseudonym(value)
+            elif key == 'chat_instance':
+                result[key] = f"c{self._digest(value):x}"
+            else:
+                result[key] = self.anonymize(value)
+        return result
+
+
+class UpdateRecorder:
+    """Пишет обезличенные обновления в сжатый JSONL в фоновом потоке"""
+
+    def __init__(self, directory: str, sample_rate: float = UPDATE_RECORD_SAMPLE_RATE,
+                 max_bytes: int = UPDATE_RECORD_MAX_BYTES, salt: str = UPDATE_RECORD_SALT):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.anonymizer = UpdateAnonymizer(salt or secrets.token_hex(16))
+        self.recorded = 0
+        self.dropped = 0
+        self._started = time.monotonic()
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._file = None
+        self._written = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, name='update-recorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    async def handle_update(self, update, context):
+        """Обработчик группы -1: ставит обновление в очередь записи"""
+        user = getattr(update, 'effective_user', None)
+        if self._closed or (user is not None and not self.anonymizer.sampled(user.id, self.sample_rate)):
+            return
+        try:
+            self._queue.put((time.monotonic() - self._started, update.to_dict()))
+        except Exception as e:
+            self.dropped += 1
+            logging.debug(f"Обновление не записано: {e}")
+
+    def _open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"updates_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jsonl.gz")
+        self._file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        self._written = 0
+        header = {'format': RECORDING_FORMAT, 'started': datetime.now().isoformat(timespec='seconds'),
+                  'offset': round(time.monotonic() - self._started, 3), 'sample_rate': self.sample_rate}
+        self._file.write(json.dumps(header) + '\n')
+        logging.info(f"📼 Запись обновлений: {path}")
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self._file is None or self._written >= self.max_bytes:
+                    if self._file is not None:
+                        self._file.close()
+                    self._open_file()
+                offset, data = item
+                line = json.dumps({'t': round(offset, 3), 'u': self.anonymizer.anonymize(data)},
+                                  ensure_ascii=False, separators=(',', ':'))
+                self._file.write(line + '\n')
+                self._written += len(line) + 1
+                self.recorded += 1
+                # Сбрасываем буфер, когда очередь опустела: файл читается и до закрытия
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception as e:
+                self.dropped += 1
+                logging.error(f"Ошибка записи обновления: {e}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_recording(path: str):
+    """Читает записи файла: (смещение в секундах, словарь обновления)"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Последняя строка может быть оборвана, если процесс был убит
+                break
+            if 'u' in record:
+                yield record['t'], record['u']
+
+
+def update_recorder_from_env() -> Optional[UpdateRecorder]:
+    """Создает UpdateRecorder, если задан UPDATE_RECORD_DIR"""
+    if not UPDATE_RECORD_DIR:
+        return None
+    return UpdateRecorder(UPDATE_RECORD_DIR)